@@ -114,116 +114,148 @@ with DAG(dag_id=DoiWorkflow.DAG_ID, schedule_interval='@weekly', default_args=de
         python_callable=DoiWorkflow.create_datasets
     )
 
-    # Extend GRID with iso3166 and home repos
-    task_extend_grid = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_EXTEND_GRID,
-        provide_context=True,
-        python_callable=DoiWorkflow.extend_grid
-    )
-
-    # Aggregrate Crossref Events
-    task_aggregate_crossref_events = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_AGGREGATE_CROSSREF_EVENTS,
-        provide_context=True,
-        python_callable=DoiWorkflow.aggregate_crossref_events
-    )
-
-    # Aggregrate Crossref Events
-    task_aggregate_orcid = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_AGGREGATE_ORCID,
-        provide_context=True,
-        python_callable=DoiWorkflow.aggregate_orcid
-    )
-
-    # Aggregrate Microsoft Academic Graph
-    task_aggregate_mag = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_AGGREGATE_MAG,
-        provide_context=True,
-        python_callable=DoiWorkflow.aggregate_mag
-    )
-
-    # Compute OA colours from Unapywall
-    task_aggregate_unpaywall = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_AGGREGATE_UNPAYWALL,
-        provide_context=True,
-        python_callable=DoiWorkflow.aggregate_unpaywall
-    )
-
-    # Extend Crossref with Funder Information
-    task_extend_crossref_funders = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_EXTEND_CROSSREF_FUNDERS,
-        provide_context=True,
-        python_callable=DoiWorkflow.extend_crossref_funders
-    )
-
-    # Aggregrate Open Citations
-    task_aggregate_open_citations = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_AGGREGATE_OPEN_CITATIONS,
-        provide_context=True,
-        python_callable=DoiWorkflow.aggregate_open_citations
-    )
-
-    # Create DOIs snapshot
-    task_create_doi = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_DOI,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_doi
-    )
-
-    # Create aggregation tables
-    task_create_country = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_COUNTRY,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_country
-    )
-
-    task_create_funder = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_FUNDER,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_funder
-    )
-
-    task_create_group = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_GROUP,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_group
-    )
-
-    task_create_institution = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_INSTITUTION,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_institution
-    )
-
-    task_create_author = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_AUTHOR,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_author
-    )
-
-    task_create_journal = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_JOURNAL,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_journal
-    )
-
-    task_create_publisher = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_PUBLISHER,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_publisher
-    )
-
-    task_create_region = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_REGION,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_region
-    )
-
-    task_create_subregion = PythonOperator(
-        task_id=DoiWorkflow.TASK_ID_CREATE_SUBREGION,
-        provide_context=True,
-        python_callable=DoiWorkflow.create_subregion
-    )
+    if DoiWorkflow.FAN_OUT:
+        # Run the BigQuery jobs of all of the pre-processing tasks at once from a single task
+        task_preprocess = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_PREPROCESS,
+            provide_context=True,
+            python_callable=DoiWorkflow.preprocess
+        )
+
+        # Create DOIs snapshot
+        task_create_doi = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_DOI,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_doi
+        )
+
+        # Create all of the aggregation tables at once from a single task
+        task_create_entities = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_ENTITIES,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_entities
+        )
+
+        tasks_preprocessing = [task_preprocess]
+        tasks_postprocessing = [task_create_entities]
+    else:
+        # Extend GRID with iso3166 and home repos
+        task_extend_grid = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_EXTEND_GRID,
+            provide_context=True,
+            python_callable=DoiWorkflow.extend_grid
+        )
+
+        # Aggregrate Crossref Events
+        task_aggregate_crossref_events = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_AGGREGATE_CROSSREF_EVENTS,
+            provide_context=True,
+            python_callable=DoiWorkflow.aggregate_crossref_events
+        )
+
+        # Aggregrate Crossref Events
+        task_aggregate_orcid = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_AGGREGATE_ORCID,
+            provide_context=True,
+            python_callable=DoiWorkflow.aggregate_orcid
+        )
+
+        # Aggregrate Microsoft Academic Graph
+        task_aggregate_mag = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_AGGREGATE_MAG,
+            provide_context=True,
+            python_callable=DoiWorkflow.aggregate_mag
+        )
+
+        # Compute OA colours from Unapywall
+        task_aggregate_unpaywall = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_AGGREGATE_UNPAYWALL,
+            provide_context=True,
+            python_callable=DoiWorkflow.aggregate_unpaywall
+        )
+
+        # Extend Crossref with Funder Information
+        task_extend_crossref_funders = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_EXTEND_CROSSREF_FUNDERS,
+            provide_context=True,
+            python_callable=DoiWorkflow.extend_crossref_funders
+        )
+
+        # Aggregrate Open Citations
+        task_aggregate_open_citations = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_AGGREGATE_OPEN_CITATIONS,
+            provide_context=True,
+            python_callable=DoiWorkflow.aggregate_open_citations
+        )
+
+        # Create DOIs snapshot
+        task_create_doi = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_DOI,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_doi
+        )
+
+        # Create aggregation tables
+        task_create_country = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_COUNTRY,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_country
+        )
+
+        task_create_funder = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_FUNDER,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_funder
+        )
+
+        task_create_group = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_GROUP,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_group
+        )
+
+        task_create_institution = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_INSTITUTION,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_institution
+        )
+
+        task_create_author = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_AUTHOR,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_author
+        )
+
+        task_create_journal = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_JOURNAL,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_journal
+        )
+
+        task_create_publisher = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_PUBLISHER,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_publisher
+        )
+
+        task_create_region = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_REGION,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_region
+        )
+
+        task_create_subregion = PythonOperator(
+            task_id=DoiWorkflow.TASK_ID_CREATE_SUBREGION,
+            provide_context=True,
+            python_callable=DoiWorkflow.create_subregion
+        )
+
+        tasks_preprocessing = [task_extend_grid, task_aggregate_crossref_events, task_aggregate_orcid,
+                               task_aggregate_mag, task_aggregate_unpaywall, task_extend_crossref_funders,
+                               task_aggregate_open_citations]
+        tasks_postprocessing = [task_create_country, task_create_funder, task_create_group, task_create_institution,
+                                task_create_author, task_create_journal, task_create_publisher, task_create_region,
+                                task_create_subregion]
 
     task_copy_tables = PythonOperator(
         task_id=DoiWorkflow.TASK_ID_COPY_TABLES,
@@ -243,13 +275,7 @@ with DAG(dag_id=DoiWorkflow.DAG_ID, schedule_interval='@weekly', default_args=de
                unpaywall_sensor]
 
     # All pre-processing tasks run at once and when finished task_create_doi runs
-    tasks_preprocessing = [task_extend_grid, task_aggregate_crossref_events, task_aggregate_orcid,
-                           task_aggregate_mag, task_aggregate_unpaywall, task_extend_crossref_funders, 
-                           task_aggregate_open_citations]
     sensors >> task_create_datasets >> tasks_preprocessing >> task_create_doi
 
     # After task_create_doi runs all of the post-processing tasks run
-    tasks_postprocessing = [task_create_country, task_create_funder, task_create_group, task_create_institution,
-                            task_create_author,  task_create_journal, task_create_publisher, task_create_region, 
-                            task_create_subregion]
     task_create_doi >> tasks_postprocessing >> task_copy_tables >> task_create_views
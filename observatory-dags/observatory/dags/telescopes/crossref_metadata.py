@@ -18,18 +18,21 @@ from __future__ import annotations
 
 import functools
 import glob
+import gzip
+import json
 import logging
 import os
 import pathlib
 import shutil
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import tarfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 from multiprocessing import cpu_count
 from subprocess import Popen
+from typing import Iterator, List
 
 import pendulum
 import requests
-import time
 from airflow.exceptions import AirflowException
 from airflow.hooks.base_hook import BaseHook
 from airflow.models.taskinstance import TaskInstance
@@ -40,15 +43,25 @@ from observatory.dags.config import schema_path
 from observatory.platform.utils.airflow_utils import AirflowVariable as Variable
 from observatory.platform.utils.config_utils import (AirflowVars, AirflowConns, SubFolder, find_schema, telescope_path,
                                                      check_variables, check_connections, test_data_path)
-from observatory.platform.utils.gc_utils import (bigquery_partitioned_table_id,
+from observatory.platform.utils.file_utils import TRANSFORM_COMPRESS_LEVEL
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_SHARDED,
+                                                 bigquery_partitioned_table_id,
                                                  bigquery_table_exists,
                                                  create_bigquery_dataset,
-                                                 load_bigquery_table,
+                                                 load_bigquery_release_table,
                                                  upload_file_to_cloud_storage,
                                                  upload_files_to_cloud_storage)
+from observatory.platform.utils.gc_transfer import DEFAULT_MAX_CONNECTIONS
 from observatory.platform.utils.proc_utils import wait_for_process
 from observatory.platform.utils.url_utils import retry_session
 
+# orjson parses and serialises JSON several times faster than the json module, it is optional, install it with
+# pip install observatory-dags[crossref]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def download_release(release: CrossrefMetadataRelease, api_token: str):
     """ Downloads release
@@ -89,9 +102,6 @@ def extract_release(release: CrossrefMetadataRelease) -> bool:
     # Make directories
     os.makedirs(release.extract_path, exist_ok=True)
 
-    # Was having issues with the next process not finding the folder that was just created, so sleep for 30 secs
-    time.sleep(30)
-
     # Run command
     cmd = f'tar -xv -I "pigz -d" -f {release.download_path} -C {release.extract_path}'
     p: Popen = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, executable='/bin/bash')
@@ -109,32 +119,124 @@ def extract_release(release: CrossrefMetadataRelease) -> bool:
     return success
 
 
+def json_loads(data: bytes):
+    """ Parse JSON with orjson when it is installed and the json module otherwise.
+
+    :param data: the JSON document.
+    :return: the parsed document.
+    """
+
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    """ Serialise an object as compact JSON with orjson when it is installed and the json module otherwise.
+
+    :param obj: the object.
+    :return: the JSON document.
+    """
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def transform_date_parts(date_parts: List) -> List[int]:
+    """ Normalise the date-parts of a Crossref date, e.g. [[2020, 5, 1]], into a flat list of integers, e.g.
+    [2020, 5, 1], which BigQuery can load into a repeated field. Unknown dates, [[null]], become an empty list.
+
+    :param date_parts: the date-parts.
+    :return: the normalised date parts.
+    """
+
+    if date_parts and isinstance(date_parts[0], list):
+        date_parts = date_parts[0]
+    return [part for part in date_parts if part is not None]
+
+
+def transform_item(item):
+    """ Transform a Crossref Metadata item, or a value within an item, so that it can be loaded into BigQuery: the
+    hyphens in keys are replaced with underscores and date-parts are normalised, recursively.
+
+    :param item: the item or value.
+    :return: the transformed item or value.
+    """
+
+    if isinstance(item, dict):
+        transformed = {}
+        for key, value in item.items():
+            key = key.replace('-', '_')
+            if key == 'date_parts' and isinstance(value, list):
+                transformed[key] = transform_date_parts(value)
+            else:
+                transformed[key] = transform_item(value)
+        return transformed
+    elif isinstance(item, list):
+        return [transform_item(value) for value in item]
+    return item
+
+
+def transform_items(data: bytes) -> Iterator[bytes]:
+    """ Transform the items of a Crossref Metadata file, a JSON object with an items array, into JSON Lines.
+
+    :param data: the contents of the file.
+    :return: an iterator of the transformed items, one JSON document per item.
+    """
+
+    for item in json_loads(data)['items']:
+        yield json_dumps(transform_item(item))
+
+
+def transform_data(data: bytes, output_file_path: str, source: str) -> bool:
+    """ Transform the contents of a Crossref Metadata file into a gzipped JSON Lines file.
+
+    :param data: the contents of the file.
+    :param output_file_path: where to save the transformed file.
+    :param source: the name of the file, for logging.
+    :return: whether the transformation was successful or not.
+    """
+
+    try:
+        with gzip.open(output_file_path, 'wb', compresslevel=TRANSFORM_COMPRESS_LEVEL) as f:
+            for line in transform_items(data):
+                f.write(line)
+                f.write(b'\n')
+    except (OSError, ValueError, KeyError) as e:
+        logging.error(f"transform_data error: {source}: {e}")
+        return False
+
+    logging.info(f"transform_data success: {source}")
+    return True
+
+
 def transform_file(input_file_path: str, output_file_path: str) -> bool:
-    r""" Transform Crossref Metadata file.
+    """ Transform a Crossref Metadata file into a gzipped JSON Lines file.
 
     :param input_file_path: the path of the file to transform.
     :param output_file_path: where to save the transformed file.
     :return: whether the transformation was successful or not.
     """
 
-    cmd = 'mawk \'BEGIN {FS="\\":";RS=",\\"";OFS=FS;ORS=RS} {for (i=1; i<=NF;i++) if(i != NF) gsub("-", "_", $i)}1\'' \
-          f' {input_file_path} | ' \
-          'mawk \'!/^\}$|^\]$|,\\"$/{gsub("\[\[", "[");gsub("]]", "]");gsub(/,[ \\t]*$/,"");' \
-          'gsub("\\"timestamp\\":_", "\\"timestamp\\":");gsub("\\"date_parts\\":\[null]", "\\"date_parts\\":[]");' \
-          'gsub(/^\{\\"items\\":\[/,"");print}\' > ' \
-          f'{output_file_path}'
-    p: Popen = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, executable='/bin/bash')
-    stdout, stderr = wait_for_process(p)
-    logging.debug(stdout)
-    success = p.returncode == 0
+    try:
+        with open(input_file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        logging.error(f"transform_file error: {input_file_path}: {e}")
+        return False
 
-    if success:
-        logging.info(f"transform_file success: {input_file_path}")
-    else:
-        logging.error(f"transform_file error: {input_file_path}")
-        logging.error(stderr)
+    return transform_data(data, output_file_path, input_file_path)
 
-    return success
+
+def transformed_file_name(file_name: str) -> str:
+    """ Make the name of a transformed file from the name of an extracted file, e.g. 0.json becomes 0.jsonl.gz.
+
+    :param file_name: the name or path of the extracted file.
+    :return: the name of the transformed file.
+    """
+
+    return os.path.basename(file_name) + 'l.gz'
 
 
 def transform_release(release: CrossrefMetadataRelease, max_workers: int = cpu_count()) -> bool:
@@ -151,7 +253,7 @@ def transform_release(release: CrossrefMetadataRelease, max_workers: int = cpu_c
     output_release_path = release.transform_path
 
     # Transform each file in parallel
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
         futures = []
         futures_msgs = {}
 
@@ -163,8 +265,8 @@ def transform_release(release: CrossrefMetadataRelease, max_workers: int = cpu_c
 
         # Create tasks for each file
         for input_file_path in input_file_paths:
-            # The output file will be a json lines file, hence adding the 'l' to the file extension
-            output_file_path = os.path.join(output_release_path, os.path.basename(input_file_path) + 'l')
+            # The output file will be a gzipped json lines file
+            output_file_path = os.path.join(output_release_path, transformed_file_name(input_file_path))
             msg = f'input_file_path={input_file_path}, output_file_path={output_file_path}'
             logging.info(f'transform_release: {msg}')
             future = executor.submit(transform_file, input_file_path, output_file_path)
@@ -185,6 +287,77 @@ def transform_release(release: CrossrefMetadataRelease, max_workers: int = cpu_c
     return all(results)
 
 
+def extract_transform_release(release: CrossrefMetadataRelease, max_workers: int = cpu_count()) -> bool:
+    """ Extract and transform a Crossref Metadata release in a single pass, without writing the extracted files to
+    disk. The archive is decompressed with pigz when it is installed, which decompresses in a separate process to
+    reading the archive, and the contents of each file are sent straight to a pool of transform processes. The
+    transformed files are the same as those made by extract_release followed by transform_release.
+
+    :param release: the CrossrefMetadataRelease release.
+    :param max_workers: the number of processes to use when transforming files (one process per file).
+    :return: whether the extraction and transformation were successful or not.
+    """
+
+    logging.info(f"extract_transform_release: {release.download_path}")
+    os.makedirs(release.transform_path, exist_ok=True)
+
+    proc = None
+    results = []
+    try:
+        if shutil.which('pigz') is not None:
+            proc = subprocess.Popen(['pigz', '-dc', release.download_path], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            tar = tarfile.open(fileobj=proc.stdout, mode='r|')
+        else:
+            tar = tarfile.open(release.download_path, mode='r|gz')
+
+        with tar, ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures_msgs = {}
+
+            def collect(futures):
+                for future in futures:
+                    success = future.result()
+                    msg = futures_msgs.pop(future)
+                    results.append(success)
+                    if success:
+                        logging.info(f'extract_transform_release success: {msg}')
+                    else:
+                        logging.error(f'extract_transform_release failed: {msg}')
+
+            # The members of the archive are read in order, so the files are submitted as they are decompressed
+            for member in tar:
+                if not member.isfile() or not member.name.endswith('.json'):
+                    continue
+
+                data = tar.extractfile(member).read()
+                output_file_path = os.path.join(release.transform_path, transformed_file_name(member.name))
+                msg = f'member={member.name}, output_file_path={output_file_path}'
+                future = executor.submit(transform_data, data, output_file_path, member.name)
+                futures_msgs[future] = msg
+
+                # Limit the number of files held in memory while they wait to be transformed
+                if len(futures_msgs) >= max_workers * 2:
+                    done, _ = wait(list(futures_msgs), return_when=FIRST_COMPLETED)
+                    collect(done)
+
+            done, _ = wait(list(futures_msgs))
+            collect(done)
+    except (OSError, tarfile.TarError) as e:
+        logging.error(f"extract_transform_release error: {release.download_path}: {e}")
+        return False
+    finally:
+        if proc is not None:
+            # Closing the pipe stops pigz if the archive wasn't read to the end
+            proc.stdout.close()
+            stderr = proc.stderr.read().decode('utf-8')
+            proc.wait()
+            if proc.returncode != 0:
+                logging.error(f"extract_transform_release pigz error: {release.download_path}: {stderr}")
+                results.append(False)
+
+    return len(results) > 0 and all(results)
+
+
 class CrossrefMetadataRelease:
     """ Used to store info on a given crossref release """
 
@@ -260,9 +433,17 @@ class CrossrefMetadataTelescope:
     RELEASES_TOPIC_NAME = "releases"
     QUEUE = 'remote_queue'
     MAX_PROCESSES = cpu_count()
-    MAX_CONNECTIONS = cpu_count()
+    # The maximum number of Cloud Storage requests in flight
+    MAX_CONNECTIONS = DEFAULT_MAX_CONNECTIONS
     MAX_RETRIES = 3
 
+    # The BigQuery storage mode of the Crossref Metadata releases
+    STORAGE_MODE = STORAGE_MODE_SHARDED
+
+    # Whether the release is extracted and transformed in a single pass by the transform task, without writing the
+    # extracted files to disk, see extract_transform_release. When False, the extract task unpacks the release first.
+    STREAM_EXTRACT = True
+
     TELESCOPE_URL = 'https://api.crossref.org/snapshots/monthly/{year}/{month:02d}/all.json.tar.gz'
     # DEBUG_FILE_PATH = os.path.join(test_data_path(), 'telescopes', 'crossref_metadata.json.tar.gz')
 
@@ -378,7 +559,7 @@ class CrossrefMetadataTelescope:
 
     @staticmethod
     def extract(**kwargs):
-        """ Extract release
+        """ Extract release. Skipped when the release is extracted by the transform task, see STREAM_EXTRACT.
 
         :param kwargs: the context passed from the PythonOperator. See
         https://airflow.apache.org/docs/stable/macros-ref.html
@@ -390,6 +571,10 @@ class CrossrefMetadataTelescope:
         ti: TaskInstance = kwargs['ti']
         release = pull_release(ti)
 
+        if CrossrefMetadataTelescope.STREAM_EXTRACT:
+            logging.info(f'extract skipped, the release is extracted while it is transformed: {release}')
+            return
+
         # Extract the release
         result = extract_release(release)
 
@@ -402,7 +587,8 @@ class CrossrefMetadataTelescope:
 
     @staticmethod
     def transform(**kwargs):
-        """ Transform release with sed command and save to new file.
+        """ Transform release into gzipped JSON Lines files. When STREAM_EXTRACT is True, the downloaded release is
+        extracted and transformed in a single pass.
 
         :param kwargs: the context passed from the PythonOperator. See
         https://airflow.apache.org/docs/stable/macros-ref.html
@@ -415,7 +601,10 @@ class CrossrefMetadataTelescope:
         release = pull_release(ti)
 
         # Transform release
-        result = transform_release(release, max_workers=CrossrefMetadataTelescope.MAX_PROCESSES)
+        if CrossrefMetadataTelescope.STREAM_EXTRACT:
+            result = extract_transform_release(release, max_workers=CrossrefMetadataTelescope.MAX_PROCESSES)
+        else:
+            result = transform_release(release, max_workers=CrossrefMetadataTelescope.MAX_PROCESSES)
 
         # Check result
         if result:
@@ -443,7 +632,7 @@ class CrossrefMetadataTelescope:
 
         # List files and sort so that they are processed in ascending order
         logging.info(f'upload_transformed listing files')
-        file_paths = natsorted(glob.glob(f"{release.transform_path}/*.jsonl"))
+        file_paths = natsorted(glob.glob(f"{release.transform_path}/*.jsonl.gz"))
 
         # List blobs
         logging.info(f'upload_transformed creating blob names')
@@ -485,8 +674,6 @@ class CrossrefMetadataTelescope:
         create_bigquery_dataset(project_id, dataset_id, data_location, CrossrefMetadataTelescope.DESCRIPTION)
 
         # Load each release
-        table_id = bigquery_partitioned_table_id(CrossrefMetadataTelescope.DAG_ID, release.date)
-
         # Select schema file based on release date
         analysis_schema_path = schema_path()
         schema_file_path = find_schema(analysis_schema_path, CrossrefMetadataTelescope.DAG_ID, release.date)
@@ -498,8 +685,9 @@ class CrossrefMetadataTelescope:
         # Load BigQuery table
         uri = f"gs://{bucket_name}/{release.get_blob_name(SubFolder.transformed)}/*"
         logging.info(f"URI: {uri}")
-        load_bigquery_table(uri, dataset_id, data_location, table_id, schema_file_path,
-                            SourceFormat.NEWLINE_DELIMITED_JSON)
+        load_bigquery_release_table(uri, dataset_id, data_location, CrossrefMetadataTelescope.DAG_ID, release.date,
+                                    schema_file_path, SourceFormat.NEWLINE_DELIMITED_JSON,
+                                    storage_mode=CrossrefMetadataTelescope.STORAGE_MODE)
 
     @staticmethod
     def cleanup(**kwargs):
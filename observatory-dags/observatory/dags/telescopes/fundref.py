@@ -17,7 +17,6 @@
 from __future__ import annotations
 
 import gzip
-import io
 import json
 import logging
 import os
@@ -40,10 +39,13 @@ from observatory.dags.config import schema_path
 from observatory.platform.utils.airflow_utils import AirflowVariable as Variable
 from observatory.platform.utils.config_utils import (AirflowVars, SubFolder, find_schema, telescope_path,
                                                      check_variables, test_data_path)
-from observatory.platform.utils.gc_utils import (bigquery_partitioned_table_id,
+from observatory.platform.utils.file_utils import open_checksummed
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_SHARDED,
+                                                 bigquery_partitioned_table_id,
                                                  bigquery_table_exists,
+                                                 CloudStorageSink,
                                                  create_bigquery_dataset,
-                                                 load_bigquery_table,
+                                                 load_bigquery_release_table,
                                                  upload_file_to_cloud_storage)
 from observatory.platform.utils.proc_utils import wait_for_process
 from observatory.platform.utils.url_utils import retry_session
@@ -209,11 +211,13 @@ def strip_whitespace(file_path: str):
     os.rename(file_path + '.tmp', file_path)
 
 
-def transform_release(release: FundrefRelease) -> str:
+def transform_release(release: FundrefRelease, bucket_name: str = None) -> str:
     """ Transform release by parsing the raw rdf file, transforming it into a json file and replacing geoname associated
     ids with their geoname name.
 
     :param release: Instance of FundrefRelease class
+    :param bucket_name: when given, the transformed release is streamed straight to its blob on this Google Cloud
+    Storage bucket instead of being saved to release.filepath_transform.
     """
 
     # Strip leading whitespace from first line if present.
@@ -223,17 +227,17 @@ def transform_release(release: FundrefRelease) -> str:
     funders, funders_by_key = parse_fundref_registry_rdf(release.filepath_extract)
     funders = add_funders_relationships(funders, funders_by_key)
 
-    # Transform FundRef release into JSON Lines format saving in memory buffer
-    # Save in memory buffer to gzipped file
-
-    with io.BytesIO() as bytes_io:
-        with gzip.GzipFile(fileobj=bytes_io, mode='w') as gzip_file:
-            with jsonlines.Writer(gzip_file) as writer:
+    # Transform FundRef release into gzipped JSON Lines format
+    if bucket_name is None:
+        with open_checksummed(release.filepath_transform) as jsonl_gzip_file:
+            with gzip.GzipFile(fileobj=jsonl_gzip_file, mode='wb') as gzip_file:
+                with jsonlines.Writer(gzip_file) as writer:
+                    writer.write_all(funders)
+    else:
+        with CloudStorageSink(bucket_name, release.get_blob_name(SubFolder.transformed), compress=True) as sink:
+            with jsonlines.Writer(sink) as writer:
                 writer.write_all(funders)
 
-        with open(release.filepath_transform, 'wb') as jsonl_gzip_file:
-            jsonl_gzip_file.write(bytes_io.getvalue())
-
     logging.info(f'Success transforming release: {release.url}')
 
     return release.filepath_transform
@@ -516,6 +520,13 @@ class FundrefTelescope:
     # DEBUG_FILE_PATH = os.path.join(test_data_path(), 'telescopes', 'fundref.tar.gz')
     RETRIES = 3
 
+    # The BigQuery storage mode of the Fundref releases
+    STORAGE_MODE = STORAGE_MODE_SHARDED
+
+    # Whether the transform task streams the transformed releases straight to the transform bucket, rather than
+    # saving them locally for the upload_transformed task to upload.
+    STREAM_TRANSFORMED = False
+
     TASK_ID_CHECK_DEPENDENCIES = "check_dependencies"
     TASK_ID_LIST = f"list_releases"
     TASK_ID_DOWNLOAD = f"download"
@@ -668,8 +679,9 @@ class FundrefTelescope:
         releases_list = pull_releases(ti)
 
         # Transform each release
+        bucket_name = Variable.get(AirflowVars.TRANSFORM_BUCKET) if FundrefTelescope.STREAM_TRANSFORMED else None
         for release in releases_list:
-            transform_release(release)
+            transform_release(release, bucket_name=bucket_name)
 
     @staticmethod
     def upload_transformed(**kwargs):
@@ -681,6 +693,11 @@ class FundrefTelescope:
         :return: None.
         """
 
+        # The transform task streamed the releases to the transform bucket already
+        if FundrefTelescope.STREAM_TRANSFORMED:
+            logging.info('Skipping upload as the transformed releases were streamed to the transform bucket')
+            return
+
         # Pull releases
         ti: TaskInstance = kwargs['ti']
         releases_list = pull_releases(ti)
@@ -718,8 +735,6 @@ class FundrefTelescope:
 
         # Load each release into BigQuery
         for release in releases_list:
-            table_id = bigquery_partitioned_table_id(FundrefTelescope.DAG_ID, release.date)
-
             # Select schema file based on release date
             analysis_schema_path = schema_path()
             schema_file_path = find_schema(analysis_schema_path, FundrefTelescope.DAG_ID, release.date)
@@ -731,8 +746,9 @@ class FundrefTelescope:
             # Load BigQuery table
             uri = f"gs://{bucket_name}/{release.get_blob_name(SubFolder.transformed)}"
             logging.info(f"URI: {uri}")
-            load_bigquery_table(uri, dataset_id, data_location, table_id, schema_file_path,
-                                SourceFormat.NEWLINE_DELIMITED_JSON)
+            load_bigquery_release_table(uri, dataset_id, data_location, FundrefTelescope.DAG_ID, release.date,
+                                        schema_file_path, SourceFormat.NEWLINE_DELIMITED_JSON,
+                                        storage_mode=FundrefTelescope.STORAGE_MODE)
 
     @staticmethod
     def cleanup(**kwargs):
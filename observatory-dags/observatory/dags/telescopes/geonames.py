@@ -35,9 +35,10 @@ from observatory.platform.utils.airflow_utils import AirflowVariable as Variable
 from observatory.platform.utils.config_utils import (AirflowVars, SubFolder, find_schema, telescope_path,
                                                      check_variables, test_data_path)
 from observatory.platform.utils.data_utils import get_file
-from observatory.platform.utils.gc_utils import (bigquery_partitioned_table_id,
+from observatory.platform.utils.file_utils import open_checksummed
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_SHARDED,
                                                  create_bigquery_dataset,
-                                                 load_bigquery_table,
+                                                 load_bigquery_release_table,
                                                  upload_file_to_cloud_storage)
 
 
@@ -95,8 +96,9 @@ def transform_release(release: GeonamesRelease) -> str:
     """
 
     with open(release.filepath_extract, 'rb') as file_in:
-        with gzip.open(release.filepath_transform, 'wb') as file_out:
-            shutil.copyfileobj(file_in, file_out)
+        with open_checksummed(release.filepath_transform) as checksummed_out:
+            with gzip.GzipFile(filename=release.filepath_transform, mode='wb', fileobj=checksummed_out) as file_out:
+                shutil.copyfileobj(file_in, file_out)
 
     return release.filepath_transform
 
@@ -164,6 +166,9 @@ class GeonamesTelescope:
     QUEUE = 'default'
     RETRIES = 3
 
+    # The BigQuery storage mode of the GeoNames releases
+    STORAGE_MODE = STORAGE_MODE_SHARDED
+
     UNZIPPED_FILE_NAME = 'allCountries.txt'
     DOWNLOAD_URL = 'https://download.geonames.org/export/dump/allCountries.zip'
     # DEBUG_FILE_PATH = os.path.join(test_data_path(), 'telescopes', 'geonames.txt')
@@ -333,10 +338,9 @@ class GeonamesTelescope:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         bucket_name = Variable.get(AirflowVars.TRANSFORM_BUCKET)
 
-        # Create dataset and make table_id
+        # Create dataset
         dataset_id = GeonamesTelescope.DATASET_ID
         create_bigquery_dataset(project_id, dataset_id, data_location, GeonamesTelescope.DESCRIPTION)
-        table_id = bigquery_partitioned_table_id(GeonamesTelescope.DAG_ID, release.date)
 
         # Select schema file based on release date
         analysis_schema_path = schema_path()
@@ -349,8 +353,9 @@ class GeonamesTelescope:
         # Load BigQuery table
         uri = f"gs://{bucket_name}/{release.get_blob_name(SubFolder.transformed)}"
         logging.info(f"URI: {uri}")
-        load_bigquery_table(uri, dataset_id, data_location, table_id, schema_file_path, SourceFormat.CSV,
-                            csv_field_delimiter='\t', csv_quote_character="")
+        load_bigquery_release_table(uri, dataset_id, data_location, GeonamesTelescope.DAG_ID, release.date,
+                                    schema_file_path, SourceFormat.CSV, storage_mode=GeonamesTelescope.STORAGE_MODE,
+                                    csv_field_delimiter='\t', csv_quote_character="")
 
     @staticmethod
     def cleanup(**kwargs):
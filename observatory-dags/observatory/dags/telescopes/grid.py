@@ -17,7 +17,6 @@
 
 import glob
 import gzip
-import io
 import json
 import logging
 import os
@@ -38,9 +37,11 @@ from observatory.dags.config import schema_path
 from observatory.platform.utils.airflow_utils import AirflowVariable as Variable
 from observatory.platform.utils.config_utils import AirflowVars, SubFolder, find_schema, telescope_path, check_variables
 from observatory.platform.utils.data_utils import get_file
-from observatory.platform.utils.gc_utils import (bigquery_partitioned_table_id,
+from observatory.platform.utils.file_utils import open_checksummed
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_SHARDED,
+                                                 CloudStorageSink,
                                                  create_bigquery_dataset,
-                                                 load_bigquery_table,
+                                                 load_bigquery_release_table,
                                                  upload_file_to_cloud_storage)
 from observatory.platform.utils.url_utils import retry_session
 
@@ -136,11 +137,14 @@ def extract_grid_release(file_path: str, extraction_path: str) -> str:
     return extracted_folder_path
 
 
-def transform_grid_release(release_json_path: str, transformed_path: str) -> Tuple[str, str, str]:
+def transform_grid_release(release_json_path: str, transformed_path: str,
+                           bucket_name: str = None) -> Tuple[str, str, str]:
     """ Transform an extracted GRID release .json file into json lines format and gzip the result.
 
     :param release_json_path: the path to GRID release .json file.
     :param transformed_path: the path to save the results.
+    :param bucket_name: when given, the results are streamed straight to the blob telescopes/grid/{file name} on this
+    Google Cloud Storage bucket instead of being saved in transformed_path.
     :return: the GRID version, the file name and the file path.
     """
 
@@ -150,21 +154,32 @@ def transform_grid_release(release_json_path: str, transformed_path: str) -> Tup
         version = data['version']
         institutes = data['institutes']
 
-        # Transform GRID release into JSON Lines format saving in memory buffer
-        # Save in memory buffer to gzipped file
-        with io.BytesIO() as bytes_io:
-            with gzip.GzipFile(fileobj=bytes_io, mode='w') as gzip_file:
+    # Transform GRID release into gzipped JSON Lines format
+    file_name = f"grid_{version.replace('release_', '')}.jsonl.gz"
+    file_path = os.path.join(transformed_path, file_name)
+    if bucket_name is None:
+        with open_checksummed(file_path) as jsonl_gzip_file:
+            with gzip.GzipFile(fileobj=jsonl_gzip_file, mode='wb') as gzip_file:
                 with jsonlines.Writer(gzip_file) as writer:
                     writer.write_all(institutes)
-
-            file_name = f"grid_{version.replace('release_', '')}.jsonl.gz"
-            file_path = os.path.join(transformed_path, file_name)
-            with open(file_path, 'wb') as jsonl_gzip_file:
-                jsonl_gzip_file.write(bytes_io.getvalue())
+    else:
+        with CloudStorageSink(bucket_name, grid_blob_name(file_name), compress=True) as sink:
+            with jsonlines.Writer(sink) as writer:
+                writer.write_all(institutes)
 
     return version, file_name, file_path
 
 
+def grid_blob_name(file_name: str) -> str:
+    """ Get the name of the blob that a GRID release file is saved to on Google Cloud Storage.
+
+    :param file_name: the file name.
+    :return: the blob name.
+    """
+
+    return f'telescopes/grid/{file_name}'
+
+
 class GridTelescope:
     """ A container for holding the constants and static functions for the GRID telescope. """
 
@@ -175,6 +190,13 @@ class GridTelescope:
     QUEUE = 'default'
     RETRIES = 3
 
+    # The BigQuery storage mode of the GRID releases
+    STORAGE_MODE = STORAGE_MODE_SHARDED
+
+    # Whether the transform task streams the transformed releases straight to the transform bucket, rather than
+    # saving them locally for the upload_transformed task to upload.
+    STREAM_TRANSFORMED = False
+
     TASK_ID_CHECK_DEPENDENCIES = 'check_dependencies'
     TASK_ID_LIST = 'list_releases'
     TASK_ID_DOWNLOAD = 'download'
@@ -346,6 +368,8 @@ class GridTelescope:
             version (str): the version of the GRID release.
             json_gz_file_name (str): the file name for the transformed GRID release.
             json_gz_file_path (str): the path to the transformed GRID release (including file name).
+            streamed (bool): whether the transformed GRID release was streamed to the transform bucket instead of
+            being saved to json_gz_file_path.
 
         :param kwargs: the context passed from the PythonOperator. See
         https://airflow.apache.org/docs/stable/macros-ref.html
@@ -360,6 +384,7 @@ class GridTelescope:
 
         # Prepare paths
         grid_transformed_path = telescope_path(SubFolder.transformed, GridTelescope.DAG_ID)
+        bucket_name = Variable.get(AirflowVars.TRANSFORM_BUCKET) if GridTelescope.STREAM_TRANSFORMED else None
 
         # Transform each release
         msgs_out = []
@@ -372,13 +397,15 @@ class GridTelescope:
                 release_json_file = json_files[0]
                 logging.info(f'Transforming file: {release_json_file}')
 
-                version, file_name, file_path = transform_grid_release(release_json_file, grid_transformed_path)
+                version, file_name, file_path = transform_grid_release(release_json_file, grid_transformed_path,
+                                                                       bucket_name=bucket_name)
 
                 # Prepare messages
                 msg_out = dict()
                 msg_out['version'] = version
                 msg_out['json_gz_file_name'] = file_name
                 msg_out['json_gz_file_path'] = file_path
+                msg_out['streamed'] = bucket_name is not None
                 msgs_out.append(msg_out)
             else:
                 logging.info(f"Skipping transforming as no JSON files in extracted path: {extracted_path}")
@@ -413,10 +440,13 @@ class GridTelescope:
             file_name = msg_in['json_gz_file_name']
             file_path = msg_in['json_gz_file_path']
 
-            # Upload to cloud storage
+            # Upload to cloud storage, unless the transform task streamed the release there already
             release_date = file_name.replace("grid_", "").replace(".jsonl.gz", "")
-            blob_name = f'telescopes/grid/{file_name}'
-            upload_file_to_cloud_storage(bucket_name, blob_name, file_path=file_path)
+            blob_name = grid_blob_name(file_name)
+            if msg_in.get('streamed', False):
+                logging.info(f'Skipping upload as the transformed release was streamed to: {blob_name}')
+            else:
+                upload_file_to_cloud_storage(bucket_name, blob_name, file_path=file_path)
 
             # Prepare metadata
             msg_out = dict()
@@ -466,14 +496,12 @@ class GridTelescope:
                               f'table_name={table_name}, release_date={release_date}')
                 exit(os.EX_CONFIG)
 
-            # Create table id
-            table_id = bigquery_partitioned_table_id(GridTelescope.DAG_ID, release_date)
-
             # Load BigQuery table
             uri = f"gs://{bucket_name}/{blob_name}"
             logging.info(f"URI: {uri}")
-            load_bigquery_table(uri, GridTelescope.DATASET_ID, data_location, table_id, schema_file_path,
-                                SourceFormat.NEWLINE_DELIMITED_JSON)
+            load_bigquery_release_table(uri, GridTelescope.DATASET_ID, data_location, GridTelescope.DAG_ID,
+                                        release_date, schema_file_path, SourceFormat.NEWLINE_DELIMITED_JSON,
+                                        storage_mode=GridTelescope.STORAGE_MODE)
 
     @staticmethod
     def cleanup(**kwargs):
@@ -512,6 +540,8 @@ class GridTelescope:
         msgs_in = ti.xcom_pull(key=GridTelescope.RELEASES_TOPIC_NAME, task_ids=GridTelescope.TASK_ID_TRANSFORM,
                                include_prior_dates=False)
         for msg_in in msgs_in:
+            if msg_in.get('streamed', False):
+                continue
             file_path = msg_in['json_gz_file_path']
             try:
                 pathlib.Path(file_path).unlink()
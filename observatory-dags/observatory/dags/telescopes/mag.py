@@ -16,21 +16,19 @@
 
 import glob
 import logging
+import mmap
 import os
 import re
 import shutil
-import subprocess
 import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing import cpu_count
 from pathlib import Path, PosixPath
-from subprocess import Popen
-from typing import List
+from typing import List, Tuple
 
 from airflow.exceptions import AirflowException
 from airflow.hooks.base_hook import BaseHook
 from airflow.models.taskinstance import TaskInstance
-from google.cloud import storage
 from google.cloud.bigquery import SourceFormat
 from google.cloud.storage import Blob
 from mag_archiver.mag import MagArchiverClient, MagDateType, MagRelease, MagState
@@ -46,16 +44,28 @@ from observatory.platform.utils.config_utils import (AirflowConns,
                                                      check_variables,
                                                      telescope_path,
                                                      test_data_path)
+from observatory.platform.utils.bigquery_jobs import BigQueryJobManager
 from observatory.platform.utils.config_utils import find_schema
 from observatory.platform.utils.gc_utils import (azure_to_google_cloud_storage_transfer,
                                                  bigquery_partitioned_table_id,
                                                  create_bigquery_dataset,
                                                  download_blobs_from_cloud_storage,
-                                                 load_bigquery_table,
+                                                 make_load_job_config,
                                                  table_name_from_blob,
                                                  upload_files_to_cloud_storage,
-                                                 bigquery_table_exists)
-from observatory.platform.utils.proc_utils import wait_for_process
+                                                 bigquery_table_exists,
+                                                 storage_client)
+from observatory.platform.utils.gc_transfer import DEFAULT_MAX_CONNECTIONS
+from observatory.platform.utils.telescope_utils import transfer_journal_path
+
+# The characters that are removed from MAG files: \r, the ^M windows character, and \x0
+MAG_DELETE_CHARS = b'\r\x00'
+
+# The number of bytes of a MAG file that are transformed at a time
+DEFAULT_READ_SIZE = 16 * 1024 * 1024
+
+# Files larger than this many bytes are split into shards of about this size, which are transformed in parallel
+DEFAULT_SHARD_SIZE = 1024 ** 3
 
 
 def pull_releases(ti: TaskInstance) -> List[MagRelease]:
@@ -79,7 +89,7 @@ def list_mag_release_files(release_path: str) -> List[PosixPath]:
     release_folder = os.path.basename(os.path.abspath(release_path))
     include_regex = fr'^.*/{release_folder}(/advanced|/mag|/nlp)?/\w+.txt(.[0-9]+)?$'
 
-    types = ['*.txt', '*.txt.[0-9]']
+    types = ['*.txt', '*.txt.[0-9]*']
     files = []
     for file_type in types:
         paths = list(Path(release_path).rglob(file_type))
@@ -91,54 +101,120 @@ def list_mag_release_files(release_path: str) -> List[PosixPath]:
     return files
 
 
-def transform_mag_file(input_file_path: str, output_file_path: str) -> bool:
-    r""" Transform MAG file, removing the \x0 and \r characters. \r is the ^M windows character.
+def transform_mag_file(input_file_path: str, output_file_path: str, start: int = 0, end: int = None,
+                       read_size: int = DEFAULT_READ_SIZE) -> bool:
+    r""" Transform MAG file, or the part of it between two byte offsets, removing the \x0 and \r characters. \r is the
+    ^M windows character. The file is memory mapped and cleaned a block at a time with bytes.translate.
 
     :param input_file_path: the path of the file to transform.
     :param output_file_path: where to save the transformed file.
+    :param start: the byte offset to start transforming from.
+    :param end: the byte offset to stop transforming at, exclusive, the end of the file when None.
+    :param read_size: the number of bytes to transform at a time.
     :return: whether the transformation was successful or not.
     """
 
-    # TODO: see if we can get rid of shell=True
-    bash_command = fr"sed 's/\r//g; s/\x0//g' {str(input_file_path)} > {output_file_path}"
-    logging.info(f"transform_mag_file bash command: {bash_command}")
-    proc: Popen = subprocess.Popen(bash_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    output, error = wait_for_process(proc)
-    logging.debug(output)
-    success = proc.returncode == 0
+    try:
+        with open(input_file_path, 'rb') as f_in, open(output_file_path, 'wb') as f_out:
+            if end is None:
+                end = os.fstat(f_in.fileno()).st_size
+
+            # An empty file can't be memory mapped
+            if end > start:
+                with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for offset in range(start, end, read_size):
+                        block = data[offset:min(offset + read_size, end)]
+                        f_out.write(block.translate(None, MAG_DELETE_CHARS))
+    except (OSError, ValueError) as e:
+        logging.error(f"transform_mag_file error: {input_file_path}: {e}")
+        return False
+
+    logging.info(f"transform_mag_file success: {input_file_path}, start={start}, end={end}")
+    return True
 
-    if success:
-        logging.info(f"transform_mag_file success: {input_file_path}")
-    else:
-        logging.error(f"transform_mag_file error: {input_file_path}")
-        logging.error(error)
 
-    return success
+def mag_file_shards(file_path: str, shard_size: int) -> List[Tuple[int, int]]:
+    """ Split a MAG file into shards of about shard_size bytes that end at newlines, so that no line is split between
+    two shards.
 
+    :param file_path: the path of the file.
+    :param shard_size: the number of bytes in each shard, the shards end at the first newline after this many bytes.
+    :return: the start and end byte offsets of each shard.
+    """
+
+    size = os.path.getsize(file_path)
+    if size <= shard_size:
+        return [(0, size)]
+
+    shards = []
+    with open(file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            while start < size:
+                newline = data.find(b'\n', min(start + shard_size, size) - 1)
+                end = size if newline == -1 else newline + 1
+                shards.append((start, end))
+                start = end
+    return shards
+
+
+def mag_transform_tasks(paths: List[PosixPath], output_release_path: str,
+                        shard_size: int) -> List[Tuple[str, str, int, int]]:
+    """ Plan the transformation of the files of a MAG release. Files that are larger than shard_size are split into
+    shards. When any file of a table is split, the shards of all of its files are numbered in order, e.g.
+    PaperReferences.txt.1, PaperReferences.txt.2, so that db_load_mag_release loads them into one table with a
+    wildcard. Files that aren't split keep their names.
+
+    :param paths: the paths of the files of the release, see list_mag_release_files.
+    :param output_release_path: the path where the transformed files will be saved.
+    :param shard_size: the number of bytes in each shard.
+    :return: the input path, output path and start and end byte offsets of each shard.
+    """
 
-def transform_mag_release(input_release_path: str, output_release_path: str, max_workers: int = cpu_count()) -> bool:
-    """ Transform a MAG release into a form that can be loaded into BigQuery.
+    # Group the files by table, e.g. PaperAbstractsInvertedIndex.txt.1 and PaperAbstractsInvertedIndex.txt.2
+    tables = {}
+    for path in paths:
+        table_file_name = re.sub(r'\.[0-9]+$', '', path.name)
+        tables.setdefault(table_file_name, []).append((path, mag_file_shards(str(path), shard_size)))
+
+    tasks = []
+    for table_file_name, files in tables.items():
+        split = any(len(shards) > 1 for _, shards in files)
+        index = 1
+        for path, shards in files:
+            for start, end in shards:
+                output_file_name = f'{table_file_name}.{index}' if split else path.name
+                tasks.append((str(path), os.path.join(output_release_path, output_file_name), start, end))
+                index += 1
+    return tasks
+
+
+def transform_mag_release(input_release_path: str, output_release_path: str, max_workers: int = cpu_count(),
+                          shard_size: int = DEFAULT_SHARD_SIZE) -> bool:
+    """ Transform a MAG release into a form that can be loaded into BigQuery. Large files are split into shards, see
+    mag_transform_tasks, so that they are transformed on all cores.
 
     :param input_release_path: the path to the folder containing the files for the MAG release.
     :param output_release_path: the path where the transformed files will be saved.
-    :param max_workers: the number of processes to use when transforming files (one process per file).
+    :param max_workers: the number of processes to use when transforming files (one process per shard).
+    :param shard_size: the number of bytes in each shard of a large file.
     :return: whether the transformation was successful or not.
     """
 
-    # Transform each file in parallel
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # Make path to save files
+    os.makedirs(output_release_path, exist_ok=True)
+
+    # Transform each shard in parallel
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
         # Create tasks
         futures = []
         futures_msgs = {}
 
         paths = list_mag_release_files(input_release_path)
-        for path in paths:
-            # Make path to save file
-            os.makedirs(output_release_path, exist_ok=True)
-            output_path = os.path.join(output_release_path, path.name)
-            msg = f'input_file_path={path}, output_file_path={output_path}'
+        for input_path, output_path, start, end in mag_transform_tasks(paths, output_release_path, shard_size):
+            msg = f'input_file_path={input_path}, output_file_path={output_path}, start={start}, end={end}'
             logging.info(f'transform_mag_release: {msg}')
-            future = executor.submit(transform_mag_file, path, output_path)
+            future = executor.submit(transform_mag_file, input_path, output_path, start=start, end=end)
             futures.append(future)
             futures_msgs[future] = msg
 
@@ -173,7 +249,12 @@ class MagTelescope:
                   'microsoft-academic-graph/'
     RELEASES_TOPIC_NAME = 'releases'
     MAX_PROCESSES = cpu_count()
-    MAX_CONNECTIONS = cpu_count()
+    # Files larger than this many bytes are split into shards that are transformed in parallel
+    TRANSFORM_SHARD_SIZE = DEFAULT_SHARD_SIZE
+    # The maximum number of Cloud Storage requests in flight
+    MAX_CONNECTIONS = DEFAULT_MAX_CONNECTIONS
+    # The maximum number of BigQuery load jobs that run at once
+    MAX_BIGQUERY_JOBS = 10
     RETRIES = 3
 
     TASK_ID_CHECK_DEPENDENCIES = 'check_dependencies'
@@ -354,10 +435,11 @@ class MagTelescope:
         for release in releases:
             logging.info(f"Downloading release: {release}")
             destination_path = os.path.join(extracted_path, release.source_container)
+            journal_path = transfer_journal_path(extracted_path, ti, release.source_container)
             success = download_blobs_from_cloud_storage(bucket_name, release.release_path, destination_path,
                                                         max_processes=MagTelescope.MAX_PROCESSES,
                                                         max_connections=MagTelescope.MAX_CONNECTIONS,
-                                                        retries=MagTelescope.RETRIES)
+                                                        retries=MagTelescope.RETRIES, journal_path=journal_path)
 
             if success:
                 logging.info(f'Success downloading MAG release: {release}')
@@ -379,15 +461,16 @@ class MagTelescope:
         ti: TaskInstance = kwargs['ti']
         releases = pull_releases(ti)
 
-        # For each release and folder to include, transform the files with sed and save into the transformed directory
+        # For each release and folder to include, transform the files and save into the transformed directory
         for release in releases:
             logging.info(f'Transforming MAG release: {release}')
             release_extracted_path = os.path.join(telescope_path(SubFolder.extracted, MagTelescope.DAG_ID),
                                                   release.source_container)
-            release_transformed_path = os.path.join(telescope_path(SubFolder.transformed, MagTelescope.DAG_ID),
-                                                    release.source_container)
+            transformed_path = telescope_path(SubFolder.transformed, MagTelescope.DAG_ID)
+            release_transformed_path = os.path.join(transformed_path, release.source_container)
             success = transform_mag_release(release_extracted_path, release_transformed_path,
-                                            max_workers=MagTelescope.MAX_PROCESSES)
+                                            max_workers=MagTelescope.MAX_PROCESSES,
+                                            shard_size=MagTelescope.TRANSFORM_SHARD_SIZE)
 
             if success:
                 logging.info(f'Success transforming MAG release: {release}')
@@ -415,16 +498,17 @@ class MagTelescope:
         # Upload files to cloud storage
         for release in releases:
             logging.info(f'Uploading MAG release to cloud storage: {release}')
-            release_transformed_path = os.path.join(telescope_path(SubFolder.transformed, MagTelescope.DAG_ID),
-                                                    release.source_container)
+            transformed_path = telescope_path(SubFolder.transformed, MagTelescope.DAG_ID)
+            release_transformed_path = os.path.join(transformed_path, release.source_container)
             posix_paths = list_mag_release_files(release_transformed_path)
             paths = [str(path) for path in posix_paths]
             blob_names = [f'telescopes/{MagTelescope.DAG_ID}/{release.source_container}/{path.name}' for path in
                           posix_paths]
+            journal_path = transfer_journal_path(transformed_path, ti, release.source_container)
             success = upload_files_to_cloud_storage(bucket_name, blob_names, paths,
                                                     max_processes=MagTelescope.MAX_PROCESSES,
                                                     max_connections=MagTelescope.MAX_CONNECTIONS,
-                                                    retries=MagTelescope.RETRIES)
+                                                    retries=MagTelescope.RETRIES, journal_path=journal_path)
             if success:
                 logging.info(f'Success uploading MAG release to cloud storage: {release}')
             else:
@@ -485,8 +569,8 @@ class MagTelescope:
                 logging.warning(f"No such file or directory {release_extracted_path}: {e}")
 
             # Remove all transformed files
-            release_transformed_path = os.path.join(telescope_path(SubFolder.transformed, MagTelescope.DAG_ID),
-                                                    release.source_container)
+            transformed_path = telescope_path(SubFolder.transformed, MagTelescope.DAG_ID)
+            release_transformed_path = os.path.join(transformed_path, release.source_container)
             try:
                 shutil.rmtree(release_transformed_path)
             except FileNotFoundError as e:
@@ -536,74 +620,69 @@ def db_load_mag_release(project_id: str, bucket_name: str, data_location: str, r
     # Create dataset
     create_bigquery_dataset(project_id, dataset_id, data_location, MagTelescope.DESCRIPTION)
 
-    # Get bucket
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-
     # List release blobs
+    bucket = storage_client().bucket(bucket_name)
     blobs: List[Blob] = list(bucket.list_blobs(prefix=release_path))
-    max_workers = len(blobs)
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Create tasks
-        futures = []
-        futures_msgs = {}
-        analysis_schema_path = schema_path()
-        prefix = 'Mag'
-        file_extension = '.txt'
-
-        # De-duplicate blobs, i.e. for tables where there are more than one file:
-        # e.g. PaperAbstractsInvertedIndex.txt.1 and PaperAbstractsInvertedIndex.txt.2 become
-        # PaperAbstractsInvertedIndex.txt.* so that both are loaded into the same table.
-        blob_names = set()
-        for blob in blobs:
-            blob_name = blob.name
-            if not blob_name.endswith(file_extension):
-                blob_name_sans_index = re.match(r'^.+?(?=([0-9]+)?$)', blob_name).group(0)
-                blob_name_with_wildcard = f'{blob_name_sans_index}*'
-                blob_names.add(blob_name_with_wildcard)
-            else:
-                blob_names.add(blob_name)
-
-        for blob_name in blob_names:
-            # Make table name and id
-            table_name = table_name_from_blob(blob_name, file_extension)
-            table_id = bigquery_partitioned_table_id(table_name, release_date)
-
-            # Get schema for table
-            schema_file_path = find_schema(analysis_schema_path, table_name, release_date, prefix=prefix)
-            if schema_file_path is None:
-                logging.error(f'No schema found with search parameters: analysis_schema_path={analysis_schema_path}, '
-                              f'table_name={table_name}, release_date={release_date}, prefix={prefix}')
-                exit(os.EX_CONFIG)
-
-            uri = f'gs://{bucket_name}/{blob_name}'
-            msg = f'uri={uri}, table_id={table_id}, schema_file_path={schema_file_path}'
-            logging.info(f'db_load_mag_release: {msg}')
-
-            if table_name in settings:
-                csv_quote_character = settings[table_name]['quote']
-                csv_allow_quoted_newlines = settings[table_name]['allow_quoted_newlines']
-            else:
-                csv_quote_character = '"'
-                csv_allow_quoted_newlines = False
-
-            future = executor.submit(load_bigquery_table, uri, dataset_id, data_location, table_id, schema_file_path,
-                                     SourceFormat.CSV, csv_field_delimiter='\t',
-                                     csv_quote_character=csv_quote_character,
-                                     csv_allow_quoted_newlines=csv_allow_quoted_newlines)
-            futures_msgs[future] = msg
-            futures.append(future)
-
-        # Wait for completed tasks
-        results = []
-        for future in as_completed(futures):
-            success = future.result()
-            msg = futures_msgs[future]
-            results.append(success)
-            if success:
-                logging.info(f'db_load_mag_release success: {msg}')
-            else:
-                logging.error(f'db_load_mag_release failed: {msg}')
+    # Submit a load job per table, the jobs are run without a thread per job
+    manager = BigQueryJobManager(max_jobs_per_project=MagTelescope.MAX_BIGQUERY_JOBS)
+    analysis_schema_path = schema_path()
+    prefix = 'Mag'
+    file_extension = '.txt'
+
+    # De-duplicate blobs, i.e. for tables where there are more than one file:
+    # e.g. PaperAbstractsInvertedIndex.txt.1 and PaperAbstractsInvertedIndex.txt.2 become
+    # PaperAbstractsInvertedIndex.txt.* so that both are loaded into the same table.
+    blob_names = set()
+    for blob in blobs:
+        blob_name = blob.name
+        if not blob_name.endswith(file_extension):
+            blob_name_sans_index = re.match(r'^.+?(?=([0-9]+)?$)', blob_name).group(0)
+            blob_name_with_wildcard = f'{blob_name_sans_index}*'
+            blob_names.add(blob_name_with_wildcard)
+        else:
+            blob_names.add(blob_name)
+
+    msgs = {}
+    for blob_name in sorted(blob_names):
+        # Make table name and id
+        table_name = table_name_from_blob(blob_name, file_extension)
+        table_id = bigquery_partitioned_table_id(table_name, release_date)
+
+        # Get schema for table
+        schema_file_path = find_schema(analysis_schema_path, table_name, release_date, prefix=prefix)
+        if schema_file_path is None:
+            logging.error(f'No schema found with search parameters: analysis_schema_path={analysis_schema_path}, '
+                          f'table_name={table_name}, release_date={release_date}, prefix={prefix}')
+            exit(os.EX_CONFIG)
+
+        uri = f'gs://{bucket_name}/{blob_name}'
+        msg = f'uri={uri}, table_id={table_id}, schema_file_path={schema_file_path}'
+        logging.info(f'db_load_mag_release: {msg}')
+
+        if table_name in settings:
+            csv_quote_character = settings[table_name]['quote']
+            csv_allow_quoted_newlines = settings[table_name]['allow_quoted_newlines']
+        else:
+            csv_quote_character = '"'
+            csv_allow_quoted_newlines = False
+
+        job_config = make_load_job_config(schema_file_path, SourceFormat.CSV, csv_field_delimiter='\t',
+                                          csv_quote_character=csv_quote_character,
+                                          csv_allow_quoted_newlines=csv_allow_quoted_newlines)
+        manager.submit_load(table_id, project_id, data_location, uri, f'{project_id}.{dataset_id}.{table_id}',
+                            job_config)
+        msgs[table_id] = msg
+
+    # Wait for the jobs to finish
+    results = []
+    for result in manager.run():
+        msg = msgs[result.name]
+        results.append(result.success)
+        if result.success:
+            logging.info(f'db_load_mag_release success: {msg}, bytes_processed={result.bytes_processed}, '
+                         f'slot_millis={result.slot_millis}')
+        else:
+            logging.error(f'db_load_mag_release failed: {msg}, errors={result.errors}')
 
     return all(results)
@@ -34,9 +34,10 @@ from observatory.platform.utils.airflow_utils import AirflowVariable as Variable
 from observatory.platform.utils.config_utils import AirflowVars, SubFolder, telescope_path, check_variables
 from observatory.platform.utils.config_utils import find_schema
 from observatory.platform.utils.data_utils import get_file
-from observatory.platform.utils.gc_utils import (bigquery_partitioned_table_id,
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_SHARDED,
+                                                 bigquery_partitioned_table_id,
                                                  create_bigquery_dataset,
-                                                 load_bigquery_table,
+                                                 load_bigquery_release_table,
                                                  bigquery_table_exists,
                                                  upload_files_to_cloud_storage)
 from observatory.platform.utils.proc_utils import wait_for_process
@@ -150,6 +151,9 @@ class OpenCitationsTelescope:
     RETRIES = 3
     RELEASES_TOPIC_NAME = 'releases'
 
+    # The BigQuery storage mode of the Open Citations releases
+    STORAGE_MODE = STORAGE_MODE_SHARDED
+
     TASK_ID_CHECK_DEPENDENCIES = "check_dependencies"
     TASK_ID_LIST_RELEASES = f"list_releases"
     TASK_ID_DOWNLOAD = f"download"
@@ -359,8 +363,6 @@ class OpenCitationsTelescope:
 
         # Load each release
         for release in releases:
-            table_id = bigquery_partitioned_table_id(table_name, release.release_date)
-
             # Select schema file based on release date
             analysis_schema_path = schema_path()
             schema_file_path = find_schema(analysis_schema_path, table_name, release.release_date)
@@ -372,9 +374,11 @@ class OpenCitationsTelescope:
             # Load BigQuery table
             uri = f"gs://{bucket_name}/{release.transformed_blob_path}"
             logging.info(f"URI: {uri}")
-            load_bigquery_table(uri, dataset_id, data_location, table_id, schema_file_path, SourceFormat.CSV,
-                                csv_field_delimiter=',', csv_quote_character='"', csv_skip_leading_rows=1,
-                                csv_allow_quoted_newlines=True)
+            load_bigquery_release_table(uri, dataset_id, data_location, table_name, release.release_date,
+                                        schema_file_path, SourceFormat.CSV,
+                                        storage_mode=OpenCitationsTelescope.STORAGE_MODE, csv_field_delimiter=',',
+                                        csv_quote_character='"', csv_skip_leading_rows=1,
+                                        csv_allow_quoted_newlines=True)
 
     @staticmethod
     def cleanup(**kwargs):
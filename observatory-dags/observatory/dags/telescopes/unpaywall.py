@@ -14,36 +14,56 @@
 
 # Author: Aniek Roelofs
 
+import contextlib
+import glob
+import gzip
+import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import queue
 import re
 import shutil
 import subprocess
-from typing import List
+from multiprocessing import cpu_count
+from typing import BinaryIO, Iterator, List, Optional
 
 import pendulum
 import xmltodict
 from airflow.exceptions import AirflowException
+from airflow.hooks.base_hook import BaseHook
 from airflow.models import Variable
 from airflow.models.taskinstance import TaskInstance
 from google.cloud.bigquery import SourceFormat
 from pendulum import Pendulum
 
-from observatory.dags.config import schema_path
+from observatory.dags.config import schema_path, workflow_sql_templates_path
 from observatory.platform.utils.airflow_utils import AirflowVariable as Variable
-from observatory.platform.utils.config_utils import AirflowVars, SubFolder, find_schema, telescope_path
-from observatory.platform.utils.config_utils import check_variables
+from observatory.platform.utils.config_utils import AirflowConns, AirflowVars, SubFolder, find_schema, telescope_path
+from observatory.platform.utils.config_utils import check_connections, check_variables
 from observatory.platform.utils.config_utils import test_data_path
 from observatory.platform.utils.data_utils import get_file
-from observatory.platform.utils.gc_utils import (bigquery_partitioned_table_id,
+from observatory.platform.utils.file_utils import TRANSFORM_COMPRESS_LEVEL
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_SHARDED,
+                                                 bigquery_partitioned_table_id,
                                                  bigquery_table_exists,
+                                                 bigquery_table_suffixes,
+                                                 CloudStorageSink,
+                                                 copy_bigquery_table,
                                                  create_bigquery_dataset,
+                                                 delete_bigquery_table,
+                                                 load_bigquery_release_table,
                                                  load_bigquery_table,
-                                                 upload_file_to_cloud_storage)
-from observatory.platform.utils.proc_utils import wait_for_process
+                                                 run_bigquery_query,
+                                                 upload_file_to_cloud_storage,
+                                                 upload_files_to_cloud_storage)
+from observatory.platform.utils.jinja2_utils import make_sql_jinja2_filename, render_template
 from observatory.platform.utils.url_utils import retry_session
 
+# The number of bytes of the decompressed release that are read and transformed at a time
+DEFAULT_READ_SIZE = 8 * 1024 * 1024
+
 
 def pull_releases(ti: TaskInstance) -> List:
     """ Pull a list of Unpaywall release instances with xcom.
@@ -111,48 +131,308 @@ def download_release(release: 'UnpaywallRelease') -> str:
     return file_path
 
 
-def extract_release(release: 'UnpaywallRelease') -> str:
-    """ Decompresses release.
+def list_changefiles(start_date: Pendulum, end_date: Pendulum, api_key: str) -> List['UnpaywallChangefile']:
+    """ List the changefiles of the Unpaywall data feed that were last modified between two dates.
 
-    :param release: Instance of UnpaywallRelease class
+    :param start_date: the start date, inclusive.
+    :param end_date: the end date, exclusive.
+    :param api_key: the Unpaywall data feed API key.
+    :return: a list of UnpaywallChangefile instances.
     """
-    logging.info(f"Extracting file: {release.filepath_download}")
 
-    cmd = f"gunzip -c {release.filepath_download} > {release.filepath_extract}"
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, executable='/bin/bash')
-    stdout, stderr = wait_for_process(p)
+    params = {'api_key': api_key, 'interval': UnpaywallTelescope.CHANGEFILES_INTERVAL}
+    response = retry_session().get(UnpaywallTelescope.CHANGEFILES_URL, params=params)
+    if response is None or response.status_code != 200:
+        status_code = None if response is None else response.status_code
+        raise ConnectionError(f"Error requesting url: {UnpaywallTelescope.CHANGEFILES_URL}, status_code={status_code}")
+
+    changefiles = []
+    for item in response.json()['list']:
+        # The feed lists each changefile as JSON Lines and as CSV
+        if item.get('filetype') != 'jsonl':
+            continue
 
-    if stdout:
-        logging.info(stdout)
+        last_modified = pendulum.parse(item['last_modified'])
+        if start_date <= last_modified < end_date:
+            # The URLs include the API key, which is removed so that it isn't logged
+            url = item['url'].split('?')[0]
+            release_date = UnpaywallChangefile.parse_release_date(item['filename'])
+            changefiles.append(UnpaywallChangefile(item['filename'], last_modified, release_date, url))
 
-    if stderr:
-        raise AirflowException(f"bash command failed for {release.url}: {stderr}")
+    return changefiles
 
-    logging.info(f"File extracted to: {release.filepath_extract}")
 
-    return release.filepath_extract
+def download_changefile(changefile: 'UnpaywallChangefile', api_key: str, chunk_size: int = 1024 * 1024) -> str:
+    """ Downloads a changefile of the Unpaywall data feed.
 
+    :param changefile: the UnpaywallChangefile.
+    :param api_key: the Unpaywall data feed API key.
+    :param chunk_size: the number of bytes to write at a time.
+    :return: the path of the downloaded changefile.
+    """
 
-def transform_release(release: 'UnpaywallRelease') -> str:
-    """ Transforms release by replacing a specific '-' with '_'.
+    logging.info(f"Downloading changefile: {changefile.url}")
+    with retry_session().get(changefile.url, params={'api_key': api_key}, stream=True) as response:
+        if response.status_code != 200:
+            raise ConnectionError(f"Error downloading file {changefile.url}, status_code={response.status_code}")
 
-    :param release: Instance of UnpaywallRelease class
+        with open(changefile.filepath_download, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+    logging.info(f'Success downloading changefile: {changefile.filepath_download}')
+    return changefile.filepath_download
+
+
+def make_merge_changes_query(project_id: str, dataset_id: str, table_id: str, changes_table_id: str,
+                             schema_file_path: str) -> str:
+    """ Make the query that merges a table of changed Unpaywall records into a release table. Records are matched on
+    their doi: matching records are replaced and new records are inserted. When a doi changed more than once, its most
+    recently updated record is used.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param table_id: the id of the release table to merge the changes into.
+    :param changes_table_id: the id of the table of changed records.
+    :param schema_file_path: the path of the schema of the changed records.
+    :return: the query.
     """
-    cmd = f"sed 's/authenticated-orcid/authenticated_orcid/g' {release.filepath_extract} > " \
-          f"{release.filepath_transform}"
 
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, executable='/bin/bash')
-    stdout, stderr = wait_for_process(p)
+    with open(schema_file_path, 'r') as f:
+        columns = [field['name'] for field in json.load(f)]
+
+    template_path = os.path.join(workflow_sql_templates_path(),
+                                 make_sql_jinja2_filename(UnpaywallTelescope.MERGE_CHANGES_TEMPLATE))
+    return render_template(template_path, project_id=project_id, dataset_id=dataset_id, table_id=table_id,
+                           changes_table_id=changes_table_id, columns=columns)
+
+
+def merge_changefile(project_id: str, data_location: str, changefile: 'UnpaywallChangefile', uri: str,
+                     schema_file_path: str):
+    """ Make the release table of a changefile: the changefile is loaded into its own table, the most recent earlier
+    release table is copied to a staging table, the changes are merged into the staging table and the staging table
+    is copied to the release table of the changefile. Only the changed records are loaded and the copies are free, so
+    this is much cheaper than loading a full snapshot. The release table is only created once the merge has
+    succeeded, so a failed merge is retried by the next run rather than leaving a copy of the earlier release behind.
+    The changes and staging tables are deleted afterwards.
+
+    :param project_id: the Google Cloud project id.
+    :param data_location: the location of the BigQuery dataset.
+    :param changefile: the UnpaywallChangefile.
+    :param uri: the uri of the transformed changefile on Google Cloud Storage.
+    :param schema_file_path: the path of the schema of the changefile.
+    :return: None.
+    """
 
-    if stdout:
-        logging.info(stdout)
+    if UnpaywallTelescope.STORAGE_MODE != STORAGE_MODE_SHARDED:
+        raise AirflowException('Changefiles can only be merged into date sharded Unpaywall tables')
+
+    # Load the changed records
+    dataset_id = UnpaywallTelescope.DATASET_ID
+    changes_table_id = bigquery_partitioned_table_id(UnpaywallTelescope.CHANGES_TABLE_NAME, changefile.release_date)
+    staging_table_id = bigquery_partitioned_table_id(UnpaywallTelescope.STAGING_TABLE_NAME, changefile.release_date)
+    table_id = bigquery_partitioned_table_id(UnpaywallTelescope.DAG_ID, changefile.release_date)
+    try:
+        success = load_bigquery_table(uri, dataset_id, data_location, changes_table_id, schema_file_path,
+                                      SourceFormat.NEWLINE_DELIMITED_JSON)
+        if not success:
+            raise AirflowException(f'Error loading changefile {changefile.url} into {changes_table_id}')
+
+        # Find the most recent earlier release, from a snapshot or a changefile
+        suffixes = bigquery_table_suffixes(project_id, dataset_id, UnpaywallTelescope.DAG_ID,
+                                           end_date=changefile.release_date.subtract(days=1))
+        if not suffixes:
+            raise AirflowException(f'No Unpaywall release table to merge changefile {changefile.url} into, load a '
+                                   f'snapshot first')
+        previous_table_id = bigquery_partitioned_table_id(UnpaywallTelescope.DAG_ID, suffixes[0])
+
+        # Copy the earlier release to the staging table and merge the changes into it
+        success = copy_bigquery_table(f'{project_id}.{dataset_id}.{previous_table_id}',
+                                      f'{project_id}.{dataset_id}.{staging_table_id}', data_location)
+        if not success:
+            raise AirflowException(f'Error copying {previous_table_id} to {staging_table_id}')
+
+        query = make_merge_changes_query(project_id, dataset_id, staging_table_id, changes_table_id,
+                                         schema_file_path)
+        run_bigquery_query(query)
+
+        # Publish the merged release
+        success = copy_bigquery_table(f'{project_id}.{dataset_id}.{staging_table_id}',
+                                      f'{project_id}.{dataset_id}.{table_id}', data_location)
+        if not success:
+            raise AirflowException(f'Error copying {staging_table_id} to {table_id}')
+        logging.info(f'Merged {changes_table_id} into {table_id}, a copy of {previous_table_id}')
+    finally:
+        for temp_table_id in (changes_table_id, staging_table_id):
+            delete_bigquery_table(f'{project_id}.{dataset_id}.{temp_table_id}')
+
+
+def transform_release(release: 'UnpaywallRelease', bucket_name: str = None, num_shards: int = cpu_count(),
+                      read_size: int = DEFAULT_READ_SIZE) -> str:
+    """ Transforms release by replacing a specific '-' with '_'. The release is decompressed and transformed straight
+    from the downloaded file, see transform_release_shards.
 
-    if stderr:
-        raise AirflowException(f"bash command failed for {release.url}: {stderr}")
+    :param release: Instance of UnpaywallRelease class
+    :param bucket_name: when given, the release is streamed to its blob on this Google Cloud Storage bucket, so that
+    neither the extracted nor the transformed release are saved locally.
+    :param num_shards: the number of gzipped JSON Lines shards that the release is split into when it is saved locally.
+    :param read_size: the number of bytes to read at a time.
+    :return: the blob name when the release is streamed to the bucket, otherwise the folder of the shards.
+    """
 
+    if bucket_name is not None:
+        blob_name = release.get_blob_name_transform()
+        with gzip.open(release.filepath_download, 'rb') as f_in:
+            with CloudStorageSink(bucket_name, blob_name) as sink:
+                transform_stream(f_in, sink, read_size=read_size)
+        logging.info(f'Success transforming release: {release.url}, streamed to: {blob_name}')
+        return blob_name
+
+    transform_release_shards(release.filepath_download, release.path_transform_shards, num_shards,
+                             read_size=read_size)
     logging.info(f'Success transforming release: {release.url}')
 
-    return release.filepath_transform
+    return release.path_transform_shards
+
+
+def transform_block(block: bytes) -> bytes:
+    """ Transform a block of Unpaywall JSON Lines by replacing a specific '-' with '_'.
+
+    :param block: the block of lines.
+    :return: the transformed block.
+    """
+
+    return block.replace(b'authenticated-orcid', b'authenticated_orcid')
+
+
+def line_blocks(f_in: BinaryIO, read_size: int = DEFAULT_READ_SIZE) -> Iterator[bytes]:
+    """ Read a stream in blocks that are cut at the last full line, so that a line is never split between two blocks.
+
+    :param f_in: the input stream.
+    :param read_size: the number of bytes to read at a time.
+    :return: an iterator of blocks of whole lines.
+    """
+
+    remainder = b''
+    while True:
+        block = f_in.read(read_size)
+        if not block:
+            break
+        data = remainder + block
+        end = data.rfind(b'\n') + 1
+        if end > 0:
+            yield data[:end]
+        remainder = data[end:]
+    if remainder:
+        yield remainder
+
+
+def transform_stream(f_in: BinaryIO, f_out: BinaryIO, read_size: int = DEFAULT_READ_SIZE):
+    """ Transform a stream of Unpaywall JSON Lines by replacing a specific '-' with '_'. The data is read in blocks
+    that are cut at the last full line, so that a match is never split between two blocks.
+
+    :param f_in: the input stream.
+    :param f_out: the output stream.
+    :param read_size: the number of bytes to read at a time.
+    :return: None.
+    """
+
+    for block in line_blocks(f_in, read_size):
+        f_out.write(transform_block(block))
+
+
+@contextlib.contextmanager
+def open_gzip_stream(file_path: str) -> Iterator[BinaryIO]:
+    """ Open a gzipped file as a stream of decompressed bytes. The file is decompressed by pigz in a separate process
+    when it is installed, so that decompression runs in parallel with the reader, and by the gzip module otherwise.
+
+    :param file_path: the path of the gzipped file.
+    :return: a context manager that gives the decompressed stream.
+    """
+
+    if shutil.which('pigz') is None:
+        with gzip.open(file_path, 'rb') as f:
+            yield f
+        return
+
+    proc = subprocess.Popen(['pigz', '-dc', file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield proc.stdout
+    finally:
+        # Closing the pipe stops pigz if the stream wasn't read to the end
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode('utf-8')
+        proc.wait()
+    if proc.returncode != 0:
+        raise AirflowException(f"pigz failed for {file_path}: {stderr}")
+
+
+def transform_shard(blocks: multiprocessing.Queue, file_path: str):
+    """ Transform the blocks of a shard and write them to a gzipped JSON Lines file, until None is received.
+
+    :param blocks: the queue of blocks of lines.
+    :param file_path: the path of the shard.
+    :return: None.
+    """
+
+    with gzip.open(file_path, 'wb', compresslevel=TRANSFORM_COMPRESS_LEVEL) as f:
+        for block in iter(blocks.get, None):
+            f.write(transform_block(block))
+
+
+def transform_release_shards(input_file_path: str, output_path: str, num_shards: int,
+                             read_size: int = DEFAULT_READ_SIZE) -> List[str]:
+    """ Decompress, transform and recompress an Unpaywall release in a single pass. The decompressed lines are read in
+    line-aligned blocks, which are dealt in turn to one worker process per shard. Each worker transforms its blocks and
+    writes them to a gzipped JSON Lines shard, so that only the compressed shards are saved and BigQuery can load them
+    in parallel.
+
+    :param input_file_path: the path of the gzipped release.
+    :param output_path: the folder to save the shards in.
+    :param num_shards: the number of shards.
+    :param read_size: the number of bytes in each block.
+    :return: the paths of the shards.
+    """
+
+    os.makedirs(output_path, exist_ok=True)
+    file_paths = [os.path.join(output_path, f'{i}.jsonl.gz') for i in range(num_shards)]
+    queues = [multiprocessing.Queue(maxsize=2) for _ in range(num_shards)]
+    workers = [multiprocessing.Process(target=transform_shard, args=(queue, file_path))
+               for queue, file_path in zip(queues, file_paths)]
+    for worker in workers:
+        worker.start()
+
+    def put(i: int, block: Optional[bytes]):
+        # Wait for space on the queue of the worker, stopping if the worker has failed
+        while True:
+            try:
+                queues[i].put(block, timeout=1.)
+                return
+            except queue.Full:
+                if not workers[i].is_alive():
+                    raise AirflowException(f'Transform worker for {file_paths[i]} exited with code '
+                                           f'{workers[i].exitcode}')
+
+    try:
+        with open_gzip_stream(input_file_path) as f_in:
+            for i, block in enumerate(line_blocks(f_in, read_size)):
+                put(i % num_shards, block)
+
+        for i in range(num_shards):
+            put(i, None)
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+    failed = [file_path for worker, file_path in zip(workers, file_paths) if worker.exitcode != 0]
+    if failed:
+        raise AirflowException(f'Transform workers failed for {input_file_path}: {failed}')
+
+    return file_paths
 
 
 class UnpaywallRelease:
@@ -164,11 +444,21 @@ class UnpaywallRelease:
         self.filepath_download = self.get_filepath_download()
         self.filepath_extract = self.get_filepath_extract()
         self.filepath_transform = self.get_filepath_transform()
+        self.path_transform_shards = self.get_path_transform_shards()
 
     @property
     def url(self):
         return f'{UnpaywallTelescope.TELESCOPE_URL}{self.file_name}'
 
+    @property
+    def file_prefix(self) -> str:
+        """ The prefix of the names of the files of the release.
+
+        :return: the prefix.
+        """
+
+        return UnpaywallTelescope.DAG_ID
+
     @staticmethod
     def parse_release_date(file_name: str) -> Pendulum:
         """ Parses a release date from a file name.
@@ -187,7 +477,7 @@ class UnpaywallRelease:
         """
 
         date_str = self.release_date.strftime("%Y_%m_%d")
-        compressed_file_name = f"{UnpaywallTelescope.DAG_ID}_{date_str}.jsonl.gz"
+        compressed_file_name = f"{self.file_prefix}_{date_str}.jsonl.gz"
         download_dir = telescope_path(SubFolder.downloaded, UnpaywallTelescope.DAG_ID)
         path = os.path.join(download_dir, compressed_file_name)
 
@@ -200,7 +490,7 @@ class UnpaywallRelease:
         """
 
         date_str = self.release_date.strftime("%Y_%m_%d")
-        decompressed_file_name = f"{UnpaywallTelescope.DAG_ID}_{date_str}.jsonl"
+        decompressed_file_name = f"{self.file_prefix}_{date_str}.jsonl"
         extract_dir = telescope_path(SubFolder.extracted, UnpaywallTelescope.DAG_ID)
         path = os.path.join(extract_dir, decompressed_file_name)
 
@@ -213,12 +503,73 @@ class UnpaywallRelease:
         """
 
         date_str = self.release_date.strftime("%Y_%m_%d")
-        decompressed_file_name = f"{UnpaywallTelescope.DAG_ID}_{date_str}.jsonl"
+        decompressed_file_name = f"{self.file_prefix}_{date_str}.jsonl"
         transform_dir = telescope_path(SubFolder.transformed, UnpaywallTelescope.DAG_ID)
         path = os.path.join(transform_dir, decompressed_file_name)
 
         return path
 
+    def get_path_transform_shards(self) -> str:
+        """ Gives path to the folder of the gzipped shards of the transformed release.
+
+        :return: absolute folder path
+        """
+
+        date_str = self.release_date.strftime("%Y_%m_%d")
+        transform_dir = telescope_path(SubFolder.transformed, UnpaywallTelescope.DAG_ID)
+        path = os.path.join(transform_dir, f"{self.file_prefix}_{date_str}")
+
+        return path
+
+    def get_blob_prefix_transform_shards(self) -> str:
+        """ Gives the prefix of the blobs of the shards of the transformed release on the transform bucket.
+
+        :return: blob prefix
+        """
+
+        return f'telescopes/unpaywall/{os.path.basename(self.path_transform_shards)}'
+
+    def get_blob_name_transform(self) -> str:
+        """ Gives the name of the blob of the transformed release on the transform bucket.
+
+        :return: blob name
+        """
+
+        return f'telescopes/unpaywall/{os.path.basename(self.filepath_transform)}'
+
+
+class UnpaywallChangefile(UnpaywallRelease):
+    """ A changefile of the Unpaywall data feed, which holds the records that changed during a week or a day. """
+
+    def __init__(self, file_name: str, last_modified: Pendulum, release_date: Pendulum, url: str):
+        self._url = url
+        super().__init__(file_name, last_modified, release_date)
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def file_prefix(self) -> str:
+        """ The prefix of the names of the files of the changefile.
+
+        :return: the prefix.
+        """
+
+        return UnpaywallTelescope.CHANGES_TABLE_NAME
+
+    @staticmethod
+    def parse_release_date(file_name: str) -> Pendulum:
+        """ Parses the release date of a changefile from its file name: the last date in the name, which is the end
+        of the period of a weekly changefile, e.g. changed_dois_with_versions_2021-01-01T080001_to_2021-01-08T080001.
+
+        :return: date.
+        """
+
+        date = re.findall(r'\d{4}-\d{2}-\d{2}', file_name)[-1]
+
+        return pendulum.parse(date)
+
 
 class UnpaywallTelescope:
     """ A container for holding the constants and static functions for the Unpaywall telescope. """
@@ -231,6 +582,29 @@ class UnpaywallTelescope:
     TELESCOPE_URL = 'https://unpaywall-data-snapshots.s3-us-west-2.amazonaws.com/'
     RETRIES = 3
 
+    # The BigQuery storage mode of the Unpaywall releases
+    STORAGE_MODE = STORAGE_MODE_SHARDED
+
+    # Whether the transform task streams the transformed releases straight to the transform bucket, rather than
+    # transforming them into local gzipped shards for the upload_transformed task to upload. Streamed releases are not
+    # compressed, so that BigQuery can load them in parallel.
+    STREAM_TRANSFORMED = False
+
+    # The number of gzipped shards, and worker processes, that each release is transformed into when it isn't streamed.
+    # BigQuery loads the shards in parallel.
+    TRANSFORM_SHARDS = cpu_count()
+    MAX_PROCESSES = cpu_count()
+
+    # Whether each release is made incrementally from a changefile of the Unpaywall data feed, which is merged into a
+    # copy of the most recent release table, rather than loaded from a full snapshot, see merge_changefile. Requires
+    # the unpaywall connection, with the data feed API key as its password, and a release table to start from.
+    INCREMENTAL = False
+    CHANGEFILES_URL = 'https://api.unpaywall.org/feed/changefiles'
+    CHANGEFILES_INTERVAL = 'week'
+    CHANGES_TABLE_NAME = 'unpaywall_changes'
+    STAGING_TABLE_NAME = 'unpaywall_staging'
+    MERGE_CHANGES_TEMPLATE = 'merge_unpaywall_changes'
+
     TASK_ID_CHECK_DEPENDENCIES = "check_dependencies"
     TASK_ID_LIST = "list_releases"
     TASK_ID_STOP = "stop_dag"
@@ -255,8 +629,9 @@ class UnpaywallTelescope:
         vars_valid = check_variables(AirflowVars.DATA_PATH, AirflowVars.PROJECT_ID,
                                      AirflowVars.DATA_LOCATION, AirflowVars.DOWNLOAD_BUCKET,
                                      AirflowVars.TRANSFORM_BUCKET)
-        if not vars_valid:
-            raise AirflowException('Required variables are missing')
+        conns_valid = check_connections(AirflowConns.UNPAYWALL) if UnpaywallTelescope.INCREMENTAL else True
+        if not vars_valid or not conns_valid:
+            raise AirflowException('Required variables or connections are missing')
 
     @staticmethod
     def list_releases(**kwargs):
@@ -277,7 +652,11 @@ class UnpaywallTelescope:
         # List releases between a start and end date
         execution_date = kwargs['execution_date']
         next_execution_date = kwargs['next_execution_date']
-        releases_list = list_releases(execution_date, next_execution_date)
+        if UnpaywallTelescope.INCREMENTAL:
+            api_key = BaseHook.get_connection(AirflowConns.UNPAYWALL).password
+            releases_list = list_changefiles(execution_date, next_execution_date, api_key)
+        else:
+            releases_list = list_releases(execution_date, next_execution_date)
         logging.info(f'Releases between {execution_date} and {next_execution_date}:\n{releases_list}\n')
 
         # Check if the BigQuery table exists for each release to see if the workflow needs to process
@@ -323,6 +702,9 @@ class UnpaywallTelescope:
             if environment == 'test':
                 debug_file_path = os.path.join(test_data_path(), 'telescopes', 'unpaywall.jsonl.gz')
                 shutil.copy(debug_file_path, release.filepath_download)
+            elif UnpaywallTelescope.INCREMENTAL:
+                api_key = BaseHook.get_connection(AirflowConns.UNPAYWALL).password
+                download_changefile(release, api_key)
             else:
                 download_release(release)
 
@@ -350,7 +732,8 @@ class UnpaywallTelescope:
 
     @staticmethod
     def extract(**kwargs):
-        """ Unzip release to new file.
+        """ The releases are no longer unzipped to new files, the transform task decompresses them while it transforms
+        them.
 
         :param kwargs: the context passed from the PythonOperator. See
         https://airflow.apache.org/docs/stable/macros-ref.html
@@ -358,17 +741,12 @@ class UnpaywallTelescope:
         :return: None.
         """
 
-        # Pull messages
-        ti: TaskInstance = kwargs['ti']
-        releases_list = pull_releases(ti)
-
-        # Extract each release
-        for release in releases_list:
-            extract_release(release)
+        logging.info('Skipping extract as the transform task decompresses the releases from the downloaded files')
 
     @staticmethod
     def transform(**kwargs):
-        """ Transform release with sed command and save to new file.
+        """ Transform release into gzipped shards, or stream it to the transform bucket when STREAM_TRANSFORMED is
+        set.
 
         :param kwargs: the context passed from the PythonOperator. See
         https://airflow.apache.org/docs/stable/macros-ref.html
@@ -381,8 +759,9 @@ class UnpaywallTelescope:
         releases_list = pull_releases(ti)
 
         # Transform each release
+        bucket_name = Variable.get(AirflowVars.TRANSFORM_BUCKET) if UnpaywallTelescope.STREAM_TRANSFORMED else None
         for release in releases_list:
-            transform_release(release)
+            transform_release(release, bucket_name=bucket_name, num_shards=UnpaywallTelescope.TRANSFORM_SHARDS)
 
     @staticmethod
     def upload_transformed(**kwargs):
@@ -394,6 +773,11 @@ class UnpaywallTelescope:
         :return: None.
         """
 
+        # The transform task streamed the releases to the transform bucket already
+        if UnpaywallTelescope.STREAM_TRANSFORMED:
+            logging.info('Skipping upload as the transformed releases were streamed to the transform bucket')
+            return
+
         # Pull messages
         ti: TaskInstance = kwargs['ti']
         releases_list = pull_releases(ti)
@@ -401,10 +785,16 @@ class UnpaywallTelescope:
         # Get variables
         bucket_name = Variable.get(AirflowVars.TRANSFORM_BUCKET)
 
-        # Upload each release
+        # Upload the shards of each release
         for release in releases_list:
-            blob_name = f'telescopes/unpaywall/{os.path.basename(release.filepath_transform)}'
-            upload_file_to_cloud_storage(bucket_name, blob_name, file_path=release.filepath_transform)
+            file_paths = sorted(glob.glob(os.path.join(release.path_transform_shards, '*.jsonl.gz')))
+            blob_prefix = release.get_blob_prefix_transform_shards()
+            blob_names = [f'{blob_prefix}/{os.path.basename(file_path)}' for file_path in file_paths]
+            success = upload_files_to_cloud_storage(bucket_name, blob_names, file_paths,
+                                                    max_processes=UnpaywallTelescope.MAX_PROCESSES,
+                                                    retries=UnpaywallTelescope.RETRIES)
+            if not success:
+                raise AirflowException(f'Error uploading the transformed shards of {release.url}')
 
     @staticmethod
     def load_to_bq(**kwargs):
@@ -430,11 +820,11 @@ class UnpaywallTelescope:
                                 UnpaywallTelescope.DESCRIPTION)
 
         for release in releases_list:
-            # Get blob name
-            blob_name = f'telescopes/unpaywall/{os.path.basename(release.filepath_transform)}'
-
-            # Get release_date
-            table_id = bigquery_partitioned_table_id(UnpaywallTelescope.DAG_ID, release.release_date)
+            # Get blob name, the shards are loaded in parallel with a wildcard
+            if UnpaywallTelescope.STREAM_TRANSFORMED:
+                blob_name = release.get_blob_name_transform()
+            else:
+                blob_name = f'{release.get_blob_prefix_transform_shards()}/*'
 
             # Select schema file based on release date
             analysis_schema_path = schema_path()
@@ -444,11 +834,16 @@ class UnpaywallTelescope:
                               f'table_name={UnpaywallTelescope.DAG_ID}, release_date={release.release_date}')
                 exit(os.EX_CONFIG)
 
-            # Load BigQuery table
+            # Load BigQuery table, or merge the changefile into a copy of the previous release table
             uri = f"gs://{bucket_name}/{blob_name}"
             logging.info(f"URI: {uri}")
-            load_bigquery_table(uri, UnpaywallTelescope.DATASET_ID, data_location, table_id, schema_file_path,
-                                SourceFormat.NEWLINE_DELIMITED_JSON)
+            if UnpaywallTelescope.INCREMENTAL:
+                merge_changefile(project_id, data_location, release, uri, schema_file_path)
+            else:
+                load_bigquery_release_table(uri, UnpaywallTelescope.DATASET_ID, data_location,
+                                            UnpaywallTelescope.DAG_ID, release.release_date, schema_file_path,
+                                            SourceFormat.NEWLINE_DELIMITED_JSON,
+                                            storage_mode=UnpaywallTelescope.STORAGE_MODE)
 
     @staticmethod
     def cleanup(**kwargs):
@@ -476,6 +871,6 @@ class UnpaywallTelescope:
                 logging.warning(f"No such file or directory {release.filepath_extract}: {e}")
 
             try:
-                pathlib.Path(release.filepath_transform).unlink()
+                shutil.rmtree(release.path_transform_shards)
             except FileNotFoundError as e:
-                logging.warning(f"No such file or directory {release.filepath_transform}: {e}")
+                logging.warning(f"No such file or directory {release.path_transform_shards}: {e}")
@@ -14,13 +14,16 @@
 
 # Author: Richard Hosking, James Diprose
 
+import dataclasses
 import logging
 import os
-from typing import List
+from typing import Dict, List
 
 import pendulum
 from airflow.exceptions import AirflowException
 from airflow.models import Variable
+from airflow.models.taskinstance import TaskInstance
+from google.cloud import bigquery
 from pendulum import Pendulum
 
 from observatory.dags.config import workflow_sql_templates_path
@@ -29,10 +32,12 @@ from observatory.dags.telescopes.fundref import FundrefTelescope
 from observatory.dags.telescopes.grid import GridTelescope
 from observatory.dags.telescopes.mag import MagTelescope
 from observatory.dags.telescopes.unpaywall import UnpaywallTelescope
-from observatory.platform.utils.config_utils import AirflowVars, check_variables
-from observatory.platform.utils.gc_utils import (bigquery_partitioned_table_id, create_bigquery_table_from_query,
-                                                 run_bigquery_query, create_bigquery_dataset, copy_bigquery_table,
-                                                 create_bigquery_view)
+from observatory.platform.utils.bigquery_jobs import BigQueryJobManager
+from observatory.platform.utils.config_utils import AirflowVars, bigquery_bytes_budget, check_variables
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_PARTITIONED, STORAGE_MODE_SHARDED,
+                                                 bigquery_partitioned_table_id, bigquery_release_table_id,
+                                                 bigquery_table_suffixes, create_bigquery_table_from_query,
+                                                 prepare_table_query, create_bigquery_dataset)
 from observatory.platform.utils.jinja2_utils import render_template, make_sql_jinja2_filename
 
 
@@ -48,7 +53,7 @@ def set_task_state(success: bool, task_id: str):
 def select_table_suffixes(project_id: str, dataset_id: str, table_id: str, end_date: pendulum.Date,
                           limit: int = 1) -> List:
     """ Returns a list of table suffix dates, sorted from the most recent to the oldest date. By default it returns
-    the first result.
+    the first result. The suffixes are found from the cached tables of the dataset, see bigquery_table_suffixes.
 
     :param project_id: the Google Cloud project id.
     :param dataset_id: the BigQuery dataset id.
@@ -58,16 +63,7 @@ def select_table_suffixes(project_id: str, dataset_id: str, table_id: str, end_d
     :return:
     """
 
-    template_path = os.path.join(workflow_sql_templates_path(), make_sql_jinja2_filename('select_table_suffixes'))
-    query = render_template(template_path,
-                            project_id=project_id,
-                            dataset_id=dataset_id,
-                            table_id=table_id,
-                            end_date=end_date.strftime('%Y-%m-%d'),
-                            limit=limit)
-    rows = run_bigquery_query(query)
-    suffixes = [row['suffix'] for row in rows]
-    return suffixes
+    return bigquery_table_suffixes(project_id, dataset_id, table_id, end_date=end_date)[:limit]
 
 
 def create_aggregate_table(project_id: str, release_date: Pendulum, aggregation_field: str, group_by_time_field: str, table_id: str,
@@ -84,6 +80,20 @@ def create_aggregate_table(project_id: str, release_date: Pendulum, aggregation_
     :return: None.
     """
 
+    args = make_aggregate_table(project_id, release_date, aggregation_field, group_by_time_field, table_id,
+                                data_location, task_id)
+    success = create_bigquery_table_from_query(**args)
+
+    set_task_state(success, task_id)
+
+
+def make_aggregate_table(project_id: str, release_date: Pendulum, aggregation_field: str, group_by_time_field: str,
+                         table_id: str, data_location: str, task_id: str) -> Dict:
+    """ Make the arguments of create_bigquery_table_from_query for an aggregate table, see create_aggregate_table.
+
+    :return: the arguments.
+    """
+
     # Create processed dataset
     template_path = os.path.join(workflow_sql_templates_path(), DoiWorkflow.AGGREGATE_DOI_FILENAME)
     sql = render_template(template_path,
@@ -93,15 +103,16 @@ def create_aggregate_table(project_id: str, release_date: Pendulum, aggregation_
                           group_by_time_field=group_by_time_field)
 
     processed_table_id = bigquery_partitioned_table_id(table_id, release_date)
-    success = create_bigquery_table_from_query(sql=sql,
-                                               project_id=project_id,
-                                               dataset_id=DoiWorkflow.OBSERVATORY_DATASET_ID,
-                                               table_id=processed_table_id,
-                                               location=data_location,
-                                               cluster=True,
-                                               clustering_fields=['id'])
-
-    set_task_state(success, task_id)
+    return dict(sql=sql,
+                project_id=project_id,
+                dataset_id=DoiWorkflow.OBSERVATORY_DATASET_ID,
+                table_id=processed_table_id,
+                location=data_location,
+                template=os.path.basename(template_path),
+                cluster=True,
+                clustering_fields=['id'],
+                bytes_budget=bigquery_bytes_budget(task_id),
+                reuse_results=DoiWorkflow.REUSE_RESULTS)
 
 
 class DoiWorkflow:
@@ -129,6 +140,33 @@ class DoiWorkflow:
     TASK_ID_CREATE_SUBREGION = 'create_subregion'
     TASK_ID_COPY_TABLES = 'copy_tables'
     TASK_ID_CREATE_VIEWS = 'create_views'
+    TASK_ID_PREPROCESS = 'preprocess'
+    TASK_ID_CREATE_ENTITIES = 'create_entities'
+
+    # The tasks that run before create_doi and the aggregate tables that are created from the doi table. When FAN_OUT
+    # is True, the BigQuery jobs of each group are run together from a single task, see run_steps. This replaces the
+    # task of each table with the preprocess and create_entities tasks, which changes the task ids of the DAG, so
+    # the task history and retries of single tables are lost.
+    PREPROCESSING_TASK_IDS = [TASK_ID_EXTEND_GRID, TASK_ID_AGGREGATE_CROSSREF_EVENTS, TASK_ID_AGGREGATE_ORCID,
+                              TASK_ID_AGGREGATE_MAG, TASK_ID_AGGREGATE_UNPAYWALL, TASK_ID_EXTEND_CROSSREF_FUNDERS,
+                              TASK_ID_AGGREGATE_OPEN_CITATIONS]
+    ENTITY_TASK_IDS = [TASK_ID_CREATE_COUNTRY, TASK_ID_CREATE_FUNDER, TASK_ID_CREATE_GROUP, TASK_ID_CREATE_INSTITUTION,
+                       TASK_ID_CREATE_AUTHOR, TASK_ID_CREATE_JOURNAL, TASK_ID_CREATE_PUBLISHER, TASK_ID_CREATE_REGION,
+                       TASK_ID_CREATE_SUBREGION]
+    FAN_OUT = False
+
+    # The aggregation field and table id of each aggregate table
+    ENTITY_AGGREGATIONS = {
+        TASK_ID_CREATE_COUNTRY: ('countries', 'country'),
+        TASK_ID_CREATE_FUNDER: ('funders', 'funder'),
+        TASK_ID_CREATE_GROUP: ('groupings', 'group'),
+        TASK_ID_CREATE_INSTITUTION: ('institutions', 'institution'),
+        TASK_ID_CREATE_AUTHOR: ('authors', 'author'),
+        TASK_ID_CREATE_JOURNAL: ('journals', 'journal'),
+        TASK_ID_CREATE_PUBLISHER: ('publishers', 'publisher'),
+        TASK_ID_CREATE_REGION: ('regions', 'region'),
+        TASK_ID_CREATE_SUBREGION: ('subregions', 'subregion')
+    }
 
     PROCESSED_DATASET_ID = 'observatory_intermediate'
     PROCESSED_DATASET_DESCRIPTION = 'Intermediate processing dataset for the Academic Observatory.'
@@ -137,6 +175,14 @@ class DoiWorkflow:
     OBSERVATORY_DATASET_ID = 'observatory'
     OBSERVATORY_DATASET_ID_DATASET_DESCRIPTION = 'The Academic Observatory dataset.'
     AGGREGATE_DOI_FILENAME = make_sql_jinja2_filename('aggregate_doi')
+    # Copy the table of a previous run instead of running a query when the query and its input tables are unchanged.
+    # Queries over wildcard tables, such as create_doi, are always run, see query_input_fingerprint
+    REUSE_RESULTS = False
+
+    # How the aggregated Unpaywall releases are stored in the intermediate dataset, STORAGE_MODE_SHARDED or
+    # STORAGE_MODE_PARTITIONED. The Unpaywall history of each DOI is found with a wildcard query over the shards, or a
+    # scan of the partitioned table. Existing shards can be moved with migrate_shards_to_partitions.
+    STORAGE_MODE = STORAGE_MODE_SHARDED
     TOPIC_NAME = 'message'
 
     @staticmethod
@@ -174,6 +220,67 @@ class DoiWorkflow:
         create_bigquery_dataset(project_id, DoiWorkflow.OBSERVATORY_DATASET_ID, data_location,
                                 DoiWorkflow.OBSERVATORY_DATASET_ID_DATASET_DESCRIPTION)
 
+    @staticmethod
+    def preprocess(**kwargs):
+        """ Run the BigQuery jobs of all of the pre-processing tasks at once, see run_steps.
+
+        :param kwargs: the context passed from the PythonOperator. See
+        https://airflow.apache.org/docs/stable/macros-ref.html
+        for a list of the keyword arguments that are passed to this argument.
+        :return: None.
+        """
+
+        DoiWorkflow.run_steps(DoiWorkflow.PREPROCESSING_TASK_IDS, **kwargs)
+
+    @staticmethod
+    def create_entities(**kwargs):
+        """ Create all of the aggregate tables at once, see run_steps.
+
+        :param kwargs: the context passed from the PythonOperator. See
+        https://airflow.apache.org/docs/stable/macros-ref.html
+        for a list of the keyword arguments that are passed to this argument.
+        :return: None.
+        """
+
+        DoiWorkflow.run_steps(DoiWorkflow.ENTITY_TASK_IDS, **kwargs)
+
+    @staticmethod
+    def run_steps(task_ids: List[str], **kwargs):
+        """ Run the queries of several steps from a single task: each query is prepared with a dry run, then all of
+        the queries are submitted to a BigQueryJobManager, which runs them concurrently and waits for them together.
+        The result of each step is pushed as an XCom, keyed by the task id of the step.
+
+        :param task_ids: the task ids of the steps, PREPROCESSING_TASK_IDS or ENTITY_TASK_IDS.
+        :param kwargs: the context passed from the PythonOperator.
+        :return: None.
+        """
+
+        # Get variables
+        project_id = Variable.get(AirflowVars.PROJECT_ID)
+        data_location = Variable.get(AirflowVars.DATA_LOCATION)
+        release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
+        ti: TaskInstance = kwargs['ti']
+
+        # Prepare and submit the query of each step
+        manager = BigQueryJobManager()
+        for task_id in task_ids:
+            if task_id in DoiWorkflow.ENTITY_AGGREGATIONS:
+                aggregation_field, table_id = DoiWorkflow.ENTITY_AGGREGATIONS[task_id]
+                args = make_aggregate_table(project_id, release_date, aggregation_field, 'published_year', table_id,
+                                            data_location, task_id)
+            else:
+                args = getattr(DoiWorkflow, f'make_{task_id}')(project_id, data_location, release_date)
+            manager.submit_table_query(task_id, project_id, prepare_table_query(**args))
+
+        # Wait for the jobs and report the status of each step
+        results = manager.run()
+        for result in results:
+            ti.xcom_push(result.name, dataclasses.asdict(result))
+            if not result.success:
+                logging.error(f'{result.name} failed: {result.errors}')
+
+        set_task_state(all([result.success for result in results]), ti.task_id)
+
     @staticmethod
     def extend_grid(**kwargs):
         """ Extend a GRID Release with a list of home_repos and iso3166 information.
@@ -187,8 +294,23 @@ class DoiWorkflow:
         # Get variables
         project_id = Variable.get(AirflowVars.PROJECT_ID)
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
-
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
+
+        # Create processed table
+        args = DoiWorkflow.make_extend_grid(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_EXTEND_GRID)
+
+    @staticmethod
+    def make_extend_grid(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the extend_grid task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         grid_release_date = select_table_suffixes(project_id, GridTelescope.DATASET_ID, GridTelescope.DAG_ID,
                                                   release_date)
         if len(grid_release_date):
@@ -204,13 +326,15 @@ class DoiWorkflow:
                               grid_release_date=grid_release_date)
 
         processed_table_id = bigquery_partitioned_table_id('grid_extended', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_EXTEND_GRID)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_EXTEND_GRID),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def aggregate_crossref_events(**kwargs):
@@ -227,6 +351,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_aggregate_crossref_events(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_CROSSREF_EVENTS)
+
+    @staticmethod
+    def make_aggregate_crossref_events(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the aggregate_crossref_events task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Create processed table
         template_path = os.path.join(workflow_sql_templates_path(),
                                      make_sql_jinja2_filename(DoiWorkflow.TASK_ID_AGGREGATE_CROSSREF_EVENTS))
@@ -234,13 +373,15 @@ class DoiWorkflow:
         # TODO: perhaps only include records up until the end date of this query?
 
         processed_table_id = bigquery_partitioned_table_id('crossref_events', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_CROSSREF_EVENTS)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_AGGREGATE_CROSSREF_EVENTS),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def aggregate_orcid(**kwargs):
@@ -257,19 +398,36 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_aggregate_orcid(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_ORCID)
+
+    @staticmethod
+    def make_aggregate_orcid(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the aggregate_orcid task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Create processed table
         template_path = os.path.join(workflow_sql_templates_path(),
                                      make_sql_jinja2_filename(DoiWorkflow.TASK_ID_AGGREGATE_ORCID))
         sql = render_template(template_path, project_id=project_id)
 
         processed_table_id = bigquery_partitioned_table_id('orcid', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_ORCID)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_AGGREGATE_ORCID),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def aggregate_mag(**kwargs):
@@ -286,6 +444,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_aggregate_mag(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_MAG)
+
+    @staticmethod
+    def make_aggregate_mag(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the aggregate_mag task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Get last MAG release date before current end date
         table_id = 'Affiliations'
         mag_release_date = select_table_suffixes(project_id, MagTelescope.DATASET_ID, table_id, release_date)
@@ -302,13 +475,15 @@ class DoiWorkflow:
                               release_date=mag_release_date)
 
         processed_table_id = bigquery_partitioned_table_id(MagTelescope.DAG_ID, release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_MAG)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_AGGREGATE_MAG),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def aggregate_unpaywall(**kwargs):
@@ -325,6 +500,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_aggregate_unpaywall(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_UNPAYWALL)
+
+    @staticmethod
+    def make_aggregate_unpaywall(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the aggregate_unpaywall task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Get last Unpaywall release date before current end date
         unpaywall_release_date = select_table_suffixes(project_id, UnpaywallTelescope.DATASET_ID,
                                                        UnpaywallTelescope.DAG_ID, release_date)
@@ -340,14 +530,22 @@ class DoiWorkflow:
                               project_id=project_id,
                               release_date=unpaywall_release_date)
 
-        processed_table_id = bigquery_partitioned_table_id(UnpaywallTelescope.DAG_ID, release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
-
-        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_UNPAYWALL)
+        processed_table_id = bigquery_release_table_id(UnpaywallTelescope.DAG_ID, release_date,
+                                                       DoiWorkflow.STORAGE_MODE)
+        args = dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_AGGREGATE_UNPAYWALL),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
+
+        # Write the release into its partition. Input fingerprints are labels of whole tables, so results are not
+        # reused between partitions.
+        if DoiWorkflow.STORAGE_MODE == STORAGE_MODE_PARTITIONED:
+            args.update(partition=True, require_partition_filter=False, reuse_results=False)
+        return args
 
     @staticmethod
     def extend_crossref_funders(**kwargs):
@@ -364,6 +562,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_extend_crossref_funders(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_EXTEND_CROSSREF_FUNDERS)
+
+    @staticmethod
+    def make_extend_crossref_funders(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the extend_crossref_funders task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Get last Funref and Crossref Metadata release dates before current end date
         fundref_release_date = select_table_suffixes(project_id, FundrefTelescope.DATASET_ID,
                                                      FundrefTelescope.DAG_ID, release_date)
@@ -385,13 +598,15 @@ class DoiWorkflow:
                               fundref_release_date=fundref_release_date)
 
         processed_table_id = bigquery_partitioned_table_id('crossref_funders_extended', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_EXTEND_CROSSREF_FUNDERS)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_EXTEND_CROSSREF_FUNDERS),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def aggregate_open_citations(**kwargs):
@@ -408,6 +623,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_aggregate_open_citations(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_OPEN_CITATIONS)
+
+    @staticmethod
+    def make_aggregate_open_citations(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the aggregate_open_citations task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Get last Open Citations release date before current end date
         open_citations_release_date = select_table_suffixes(project_id, 'open_citations',
                                                             'open_citations', release_date)
@@ -424,13 +654,15 @@ class DoiWorkflow:
                               release_date=open_citations_release_date)
 
         processed_table_id = bigquery_partitioned_table_id('open_citations', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_OPEN_CITATIONS)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_AGGREGATE_OPEN_CITATIONS),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def aggregate_wos(**kwargs):
@@ -447,6 +679,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_aggregate_wos(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_WOS)
+
+    @staticmethod
+    def make_aggregate_wos(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the aggregate_wos task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Create
         template_path = os.path.join(workflow_sql_templates_path(),
                                      make_sql_jinja2_filename(DoiWorkflow.TASK_ID_AGGREGATE_WOS))
@@ -455,13 +702,15 @@ class DoiWorkflow:
         # TODO: only include records up until the end date
 
         processed_table_id = bigquery_partitioned_table_id('wos', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_WOS)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_AGGREGATE_WOS),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def aggregate_scopus(**kwargs):
@@ -478,6 +727,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_aggregate_scopus(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_SCOPUS)
+
+    @staticmethod
+    def make_aggregate_scopus(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the aggregate_scopus task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Create processed dataset
         template_path = os.path.join(workflow_sql_templates_path(),
                                      make_sql_jinja2_filename(DoiWorkflow.TASK_ID_AGGREGATE_SCOPUS))
@@ -485,13 +749,15 @@ class DoiWorkflow:
                               project_id=project_id)
 
         processed_table_id = bigquery_partitioned_table_id('scopus', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_AGGREGATE_SCOPUS)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_AGGREGATE_SCOPUS),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def create_doi(**kwargs):
@@ -508,6 +774,21 @@ class DoiWorkflow:
         data_location = Variable.get(AirflowVars.DATA_LOCATION)
         release_date = kwargs['next_execution_date'].subtract(microseconds=1).date()
 
+        # Create processed table
+        args = DoiWorkflow.make_create_doi(project_id, data_location, release_date)
+        success = create_bigquery_table_from_query(**args)
+        set_task_state(success, DoiWorkflow.TASK_ID_CREATE_DOI)
+
+    @staticmethod
+    def make_create_doi(project_id: str, data_location: str, release_date: pendulum.Date) -> Dict:
+        """ Make the arguments of create_bigquery_table_from_query for the create_doi task.
+
+        :param project_id: the Google Cloud project id.
+        :param data_location: the location of the BigQuery datasets.
+        :param release_date: the release date of the workflow run.
+        :return: the arguments.
+        """
+
         # Get last Crossref Metadata release date before current end date
         crossref_metadata_release_date = select_table_suffixes(project_id, CrossrefMetadataTelescope.DATASET_ID,
                                                                CrossrefMetadataTelescope.DAG_ID, release_date)
@@ -523,16 +804,19 @@ class DoiWorkflow:
                               project_id=project_id,
                               dataset_id=DoiWorkflow.PROCESSED_DATASET_ID,
                               release_date=release_date,
-                              crossref_metadata_release_date=crossref_metadata_release_date)
+                              crossref_metadata_release_date=crossref_metadata_release_date,
+                              unpaywall_partitioned=DoiWorkflow.STORAGE_MODE == STORAGE_MODE_PARTITIONED)
 
         processed_table_id = bigquery_partitioned_table_id('doi', release_date)
-        success = create_bigquery_table_from_query(sql=sql,
-                                                   project_id=project_id,
-                                                   dataset_id=DoiWorkflow.OBSERVATORY_DATASET_ID,
-                                                   table_id=processed_table_id,
-                                                   location=data_location)
 
-        set_task_state(success, DoiWorkflow.TASK_ID_CREATE_DOI)
+        return dict(sql=sql,
+                    project_id=project_id,
+                    dataset_id=DoiWorkflow.OBSERVATORY_DATASET_ID,
+                    table_id=processed_table_id,
+                    location=data_location,
+                    template=os.path.basename(template_path),
+                    bytes_budget=bigquery_bytes_budget(DoiWorkflow.TASK_ID_CREATE_DOI),
+                    reuse_results=DoiWorkflow.REUSE_RESULTS)
 
     @staticmethod
     def create_country(**kwargs):
@@ -742,23 +1026,27 @@ class DoiWorkflow:
                        'subregion']
 
         # Copy the latest data for display in the dashboards
-        results = []
+        manager = BigQueryJobManager()
+        job_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
         for table_name in table_names:
             source_table_id = f'{project_id}.observatory.{bigquery_partitioned_table_id(table_name, release_date)}'
             destination_table_id = f'{project_id}.{DoiWorkflow.DASHBOARDS_DATASET_ID}.{table_name}'
-            success = copy_bigquery_table(source_table_id, destination_table_id, data_location)
-            if not success:
-                logging.error(f'Issue copying table: {source_table_id} to {destination_table_id}')
+            manager.submit_copy(table_name, project_id, data_location, source_table_id, destination_table_id,
+                                job_config)
 
-            results.append(success)
+        results = manager.run()
+        for result in results:
+            if not result.success:
+                logging.error(f'Issue copying table: {result.name}: {result.errors}')
 
-        if not all(results):
+        if not all([result.success for result in results]):
             raise ValueError('Problem copying tables')
 
     @staticmethod
     def create_views(**kwargs):
         # Get variables
         project_id = Variable.get(AirflowVars.PROJECT_ID)
+        data_location = Variable.get(AirflowVars.DATA_LOCATION)
         table_names = ['country', 'funder', 'group', 'institution', 'publisher', 'subregion']
 
         # Create processed dataset
@@ -766,10 +1054,19 @@ class DoiWorkflow:
         template_path = os.path.join(workflow_sql_templates_path(), make_sql_jinja2_filename('comparison_view'))
 
         # Create views
+        manager = BigQueryJobManager()
         for table_name in table_names:
             view_name = f'{table_name}_comparison'
             query = render_template(template_path,
                                     project_id=project_id,
                                     dataset_id=dataset_id,
                                     table_id=table_name)
-            create_bigquery_view(project_id, dataset_id, view_name, query)
+            manager.submit_view(view_name, project_id, data_location, dataset_id, view_name, query)
+
+        results = manager.run()
+        for result in results:
+            if not result.success:
+                logging.error(f'Issue creating view: {result.name}: {result.errors}')
+
+        if not all([result.success for result in results]):
+            raise ValueError('Problem creating views')
@@ -0,0 +1,437 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import logging
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Union
+
+import pendulum
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud import bigquery
+
+from observatory.platform.utils.bigquery_telemetry import job_statistics
+from observatory.platform.utils.gc_utils import (TableQuery, bigquery_client, flush_bigquery_telemetry,
+                                                 invalidate_bigquery_table, record_bigquery_job,
+                                                 set_input_fingerprint)
+
+# The types of job that a BigQueryJobManager runs.
+Job = Union[bigquery.LoadJob, bigquery.CopyJob, bigquery.QueryJob]
+
+# The maximum number of jobs that a BigQueryJobManager runs at once in each project.
+DEFAULT_MAX_JOBS_PER_PROJECT = 10
+
+# The number of seconds that a BigQueryJobManager waits before its first poll of running jobs.
+DEFAULT_POLL_INTERVAL = 1.
+
+# The maximum number of seconds that a BigQueryJobManager waits between polls of running jobs.
+DEFAULT_MAX_POLL_INTERVAL = 30.
+
+# The number of polls in a row in which no jobs finish after which a BigQueryJobManager reloads each running job,
+# in case the jobs.list requests don't return them.
+DEFAULT_RELOAD_AFTER_POLLS = 5
+
+# The maximum number of seconds that a BigQueryJobManager waits for its jobs to finish, jobs that are still running
+# then are cancelled.
+DEFAULT_TIMEOUT = 12 * 60 * 60.
+
+
+@dataclass
+class JobResult:
+    """ The outcome of a BigQuery job run by a BigQueryJobManager.
+
+    :param name: the name that the job was submitted with.
+    :param job_id: the BigQuery job id, None if the job could not be created.
+    :param project_id: the project that the job ran in.
+    :param location: the location that the job ran in.
+    :param job_type: the type of job: load, copy, query or extract.
+    :param success: whether the job finished without errors.
+    :param errors: the error messages of the job.
+    :param bytes_processed: the bytes that a query processed or that a load job read.
+    :param bytes_billed: the bytes that a query was billed for.
+    :param slot_millis: the slot milliseconds that the job used.
+    :param duration: the seconds between the job starting and ending.
+    """
+
+    name: str
+    job_id: Optional[str]
+    project_id: str
+    location: Optional[str]
+    job_type: Optional[str] = None
+    success: bool = False
+    errors: List[str] = field(default_factory=list)
+    bytes_processed: Optional[int] = None
+    bytes_billed: Optional[int] = None
+    slot_millis: Optional[int] = None
+    duration: Optional[float] = None
+
+    @staticmethod
+    def from_job(name: str, job: Job) -> 'JobResult':
+        """ Make a JobResult from a finished job.
+
+        :param name: the name that the job was submitted with.
+        :param job: the job.
+        :return: the JobResult.
+        """
+
+        return JobResult(name, job.job_id, job.project, job.location, job_type=job.job_type,
+                         success=job.error_result is None, **job_statistics(job))
+
+
+@dataclass
+class _JobSpec:
+    """ A job that has been submitted to a BigQueryJobManager. """
+
+    name: str
+    project_id: str
+    location: Optional[str]
+    create: Optional[Callable[[bigquery.Client, str], Job]]
+    callback: Optional[Callable[[JobResult], None]] = None
+    template: Optional[str] = None
+    job: Optional[Job] = None
+
+
+class BigQueryJobManager:
+    """ Runs many BigQuery jobs without blocking on each one.
+
+    Jobs are submitted with submit_load, submit_copy, submit_query, submit_table_query and submit and are created
+    when run is called, up to a maximum number of concurrent jobs in each project. Running jobs are polled in batches:
+    one jobs.list request per project finds the jobs that have finished since the last poll, and only those jobs are
+    reloaded. The interval between polls grows while no jobs finish, and after a number of polls in which no jobs
+    finish each running job is reloaded. Jobs that haven't finished by the timeout are cancelled and reported as
+    failed.
+    """
+
+    def __init__(self, max_jobs_per_project: int = DEFAULT_MAX_JOBS_PER_PROJECT,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, max_poll_interval: float = DEFAULT_MAX_POLL_INTERVAL,
+                 backoff_multiplier: float = 2., reload_after_polls: int = DEFAULT_RELOAD_AFTER_POLLS,
+                 timeout: Optional[float] = DEFAULT_TIMEOUT):
+        """ Create a BigQueryJobManager.
+
+        :param max_jobs_per_project: the maximum number of jobs that run at once in each project.
+        :param poll_interval: the seconds to wait before the first poll, and after a poll in which jobs finished.
+        :param max_poll_interval: the maximum seconds to wait between polls.
+        :param backoff_multiplier: the factor that the poll interval grows by after a poll in which no jobs finished.
+        :param reload_after_polls: the number of polls in a row in which no jobs finish after which each running job
+        is reloaded.
+        :param timeout: the maximum seconds that run waits for the jobs to finish, None to wait forever.
+        """
+
+        self.max_jobs_per_project = max_jobs_per_project
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff_multiplier = backoff_multiplier
+        self.reload_after_polls = reload_after_polls
+        self.timeout = timeout
+        self._jobs: Dict[str, _JobSpec] = OrderedDict()
+        self._pending: Dict[str, Deque[_JobSpec]] = dict()
+        self._running: Dict[str, Dict[str, _JobSpec]] = dict()
+        self._results: Dict[str, JobResult] = dict()
+
+    def submit(self, name: str, project_id: str, location: Optional[str],
+               create: Callable[[bigquery.Client, str], Job],
+               callback: Callable[[JobResult], None] = None, template: str = None) -> None:
+        """ Submit a job. The job is created when run is called.
+
+        :param name: a unique name for the job, which the result is keyed by.
+        :param project_id: the project to run the job in.
+        :param location: the location to run the job in.
+        :param create: a function that creates the job, called with a client and a job id prefix.
+        :param callback: a function that is called with the result of the job when it finishes.
+        :param template: the name of the SQL template that a query was made from, for telemetry.
+        :return: None.
+        """
+
+        self._check_name(name)
+        spec = _JobSpec(name, project_id, location, create, callback=callback, template=template)
+        self._jobs[name] = spec
+        self._pending.setdefault(project_id, deque()).append(spec)
+
+    def submit_result(self, name: str, result: JobResult) -> None:
+        """ Record the result of a job that does not need to run, e.g. because it failed before it was created or
+        because its output already exists. The result is returned by run in submission order with the other results.
+
+        :param name: a unique name for the job.
+        :param result: the result.
+        :return: None.
+        """
+
+        self._check_name(name)
+        self._jobs[name] = _JobSpec(name, result.project_id, result.location, create=None)
+        self._results[name] = result
+
+    def _check_name(self, name: str) -> None:
+        if name in self._jobs:
+            raise ValueError(f'BigQueryJobManager.submit: a job named {name} has already been submitted')
+
+    def submit_load(self, name: str, project_id: str, location: str, uri: str, table_id: str,
+                    job_config: bigquery.LoadJobConfig) -> None:
+        """ Submit a job that loads files from Cloud Storage into a table.
+
+        :param name: a unique name for the job.
+        :param project_id: the project to run the job in.
+        :param location: the location to run the job in.
+        :param uri: the Cloud Storage URI of the files, which may contain a wildcard.
+        :param table_id: the fully qualified id of the destination table.
+        :param job_config: the load job configuration.
+        :return: None.
+        """
+
+        self.submit(name, project_id, location,
+                    lambda client, prefix: client.load_table_from_uri(uri, table_id, job_id_prefix=prefix,
+                                                                      location=location, job_config=job_config))
+
+    def submit_copy(self, name: str, project_id: str, location: str, source_table_id: str,
+                    destination_table_id: str, job_config: bigquery.CopyJobConfig = None) -> None:
+        """ Submit a job that copies a table.
+
+        :param name: a unique name for the job.
+        :param project_id: the project to run the job in.
+        :param location: the location to run the job in.
+        :param source_table_id: the fully qualified id of the source table.
+        :param destination_table_id: the fully qualified id of the destination table.
+        :param job_config: the copy job configuration.
+        :return: None.
+        """
+
+        self.submit(name, project_id, location,
+                    lambda client, prefix: client.copy_table(source_table_id, destination_table_id,
+                                                             job_id_prefix=prefix, location=location,
+                                                             job_config=job_config))
+
+    def submit_query(self, name: str, project_id: str, location: Optional[str], sql: str,
+                     job_config: bigquery.QueryJobConfig = None, template: str = None) -> None:
+        """ Submit a query job.
+
+        :param name: a unique name for the job.
+        :param project_id: the project to run the job in.
+        :param location: the location to run the job in.
+        :param sql: the query.
+        :param job_config: the query job configuration.
+        :param template: the name of the SQL template that the query was made from, for telemetry.
+        :return: None.
+        """
+
+        self.submit(name, project_id, location,
+                    lambda client, prefix: client.query(sql, job_config=job_config, job_id_prefix=prefix,
+                                                        location=location), template=template)
+
+    def submit_table_query(self, name: str, project_id: str, table_query: TableQuery) -> None:
+        """ Submit a query that creates a table, prepared with prepare_table_query. Queries that must not run are
+        recorded as failed, queries whose table already exists as succeeded, and queries whose results can be reused
+        are submitted as copies. The input fingerprint of the table is recorded when the job succeeds.
+
+        :param name: a unique name for the job.
+        :param project_id: the project to run the job in.
+        :param table_query: the prepared query.
+        :return: None.
+        """
+
+        location = table_query.location
+        if table_query.error is not None:
+            self.submit_result(name, JobResult(name, None, project_id, location, errors=[table_query.error]))
+            return
+        if table_query.skip:
+            self.submit_result(name, JobResult(name, None, project_id, location, success=True))
+            return
+
+        def callback(result: JobResult):
+            if result.success and table_query.fingerprint is not None:
+                set_input_fingerprint(bigquery_client(project_id, location), table_query.destination,
+                                      table_query.fingerprint)
+
+        if table_query.reuse_table is not None:
+            copy_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+            create = (lambda client, prefix: client.copy_table(table_query.reuse_table, table_query.destination,
+                                                               job_id_prefix=prefix, location=location,
+                                                               job_config=copy_config))
+        else:
+            create = (lambda client, prefix: client.query(table_query.sql, job_config=table_query.job_config,
+                                                          job_id_prefix=prefix, location=location))
+        self.submit(name, project_id, location, create, callback=callback, template=table_query.template)
+
+    def submit_view(self, name: str, project_id: str, location: Optional[str], dataset_id: str, view_name: str,
+                    query: str) -> None:
+        """ Submit a job that creates or replaces a view, with a DDL statement so that views are created as jobs too.
+
+        :param name: a unique name for the job.
+        :param project_id: the project to run the job in, which the view is created in.
+        :param location: the location to run the job in.
+        :param dataset_id: the dataset to create the view in.
+        :param view_name: the name of the view.
+        :param query: the query of the view, in standard SQL.
+        :return: None.
+        """
+
+        sql = f'CREATE OR REPLACE VIEW `{project_id}.{dataset_id}.{view_name}` AS\n{query}'
+        self.submit_query(name, project_id, location, sql, bigquery.QueryJobConfig(use_legacy_sql=False))
+
+    def run(self) -> List[JobResult]:
+        """ Create the submitted jobs and wait for them all to finish.
+
+        :return: the results of the jobs, in the order that they were submitted.
+        """
+
+        func_name = self.run.__name__
+        min_creation_time = pendulum.now('UTC').subtract(minutes=1)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        interval = self.poll_interval
+        idle_polls = 0
+        logging.info(f'{func_name}: running {len(self._pending_specs())} BigQuery jobs, at most '
+                     f'{self.max_jobs_per_project} at once per project')
+
+        try:
+            self._start_jobs()
+            while self._num_running() > 0:
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._cancel_jobs(f'timed out after {self.timeout} seconds')
+                    break
+
+                time.sleep(interval if deadline is None else max(0., min(interval, deadline - time.monotonic())))
+
+                # Reload each running job when no jobs have been found to finish for a while, in case the jobs.list
+                # requests miss them, e.g. because of clock skew
+                reload_all = idle_polls + 1 >= self.reload_after_polls
+                num_finished = self._poll(min_creation_time, reload_all=reload_all)
+                if num_finished > 0:
+                    self._start_jobs()
+                    interval = self.poll_interval
+                    idle_polls = 0
+                else:
+                    interval = min(interval * self.backoff_multiplier, self.max_poll_interval)
+                    idle_polls = 0 if reload_all else idle_polls + 1
+        finally:
+            # Airflow task processes leave without running atexit handlers, so the telemetry of the jobs is written now
+            flush_bigquery_telemetry()
+
+        results = [self._results[name] for name in self._jobs.keys() if name in self._results]
+        num_failed = len([result for result in results if not result.success])
+        logging.info(f'{func_name}: {len(results) - num_failed} BigQuery jobs succeeded, {num_failed} failed')
+        return results
+
+    def _pending_specs(self) -> List[_JobSpec]:
+        return [spec for specs in self._pending.values() for spec in specs]
+
+    def _num_running(self) -> int:
+        return sum(len(running) for running in self._running.values())
+
+    def _start_jobs(self) -> None:
+        """ Create pending jobs until each project has the maximum number of jobs running.
+
+        :return: None.
+        """
+
+        for project_id, pending in self._pending.items():
+            running = self._running.setdefault(project_id, dict())
+            while pending and len(running) < self.max_jobs_per_project:
+                spec = pending.popleft()
+                prefix = re.sub(r'[^a-zA-Z0-9_-]', '_', spec.name) + '_'
+                try:
+                    spec.job = spec.create(bigquery_client(spec.project_id, spec.location), prefix)
+                except Exception as e:
+                    # Any error is reported as the result of the job, so that the other jobs still run
+                    logging.error(f'BigQueryJobManager: could not create job {spec.name}: {e}')
+                    self._results[spec.name] = JobResult(spec.name, None, spec.project_id, spec.location,
+                                                         errors=[str(e)])
+                    continue
+
+                logging.info(f'BigQueryJobManager: created job {spec.name}: {spec.job.job_id}')
+                running[spec.job.job_id] = spec
+
+    def _cancel_jobs(self, error: str) -> None:
+        """ Cancel the running jobs and report them, and the jobs that haven't been created yet, as failed.
+
+        :param error: why the jobs were cancelled.
+        :return: None.
+        """
+
+        for running in self._running.values():
+            for spec in running.values():
+                logging.error(f'BigQueryJobManager: cancelling job {spec.name}: {error}')
+                try:
+                    spec.job.cancel()
+                except GoogleAPICallError as e:
+                    logging.warning(f'BigQueryJobManager: could not cancel job {spec.name}: {e}')
+                self._results[spec.name] = JobResult(spec.name, spec.job.job_id, spec.project_id, spec.location,
+                                                     job_type=spec.job.job_type, errors=[error])
+            running.clear()
+
+        for pending in self._pending.values():
+            for spec in pending:
+                logging.error(f'BigQueryJobManager: not creating job {spec.name}: {error}')
+                self._results[spec.name] = JobResult(spec.name, None, spec.project_id, spec.location, errors=[error])
+            pending.clear()
+
+    def _poll(self, min_creation_time: pendulum.Pendulum, reload_all: bool = False) -> int:
+        """ Find the running jobs that have finished, with one jobs.list request per project, and reload them.
+
+        :param min_creation_time: the earliest time that the jobs could have been created.
+        :param reload_all: whether to reload each running job instead of listing the jobs that have finished.
+        :return: the number of jobs that finished.
+        """
+
+        num_finished = 0
+        for project_id, running in self._running.items():
+            if not running:
+                continue
+
+            client = bigquery_client(project_id)
+            if reload_all:
+                logging.info(f'BigQueryJobManager: no jobs found to finish recently, polling {len(running)} jobs in '
+                             f'{project_id} one by one')
+                done_ids = set(running.keys())
+            else:
+                try:
+                    done_ids = {job.job_id for job in client.list_jobs(project=project_id, state_filter='done',
+                                                                       min_creation_time=min_creation_time)}
+                except GoogleAPICallError as e:
+                    logging.warning(f'BigQueryJobManager: could not list jobs in {project_id}, polling jobs one by '
+                                    f'one: {e}')
+                    done_ids = set(running.keys())
+
+            for job_id in done_ids.intersection(running.keys()):
+                spec = running[job_id]
+                try:
+                    spec.job.reload()
+                except GoogleAPICallError as e:
+                    logging.warning(f'BigQueryJobManager: could not reload job {spec.name}: {e}')
+                    continue
+
+                if spec.job.state != 'DONE':
+                    continue
+
+                result = JobResult.from_job(spec.name, spec.job)
+                record_bigquery_job(spec.job, template=spec.template)
+                if result.success:
+                    logging.info(f'BigQueryJobManager: job {spec.name} succeeded: {result}')
+                else:
+                    logging.error(f'BigQueryJobManager: job {spec.name} failed: {result}')
+                self._results[spec.name] = result
+                del running[job_id]
+
+                # The job may have created or replaced a table, so the cached tables of its dataset are out of date
+                invalidate_bigquery_table(getattr(spec.job, 'destination', None))
+                invalidate_bigquery_table(getattr(spec.job, 'ddl_target_table', None))
+                if spec.callback is not None:
+                    try:
+                        spec.callback(result)
+                    except GoogleAPICallError as e:
+                        logging.warning(f'BigQueryJobManager: callback of job {spec.name} failed: {e}')
+                num_finished += 1
+
+        return num_finished
@@ -0,0 +1,128 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import logging
+from typing import Dict, List
+
+import pendulum
+from google.cloud import bigquery
+
+from observatory.platform.utils.bigquery_jobs import BigQueryJobManager, JobResult
+from observatory.platform.utils.gc_utils import (STORAGE_MODE_PARTITIONED, bigquery_client, bigquery_dataset_tables,
+                                                 bigquery_partitioned_release_table_name,
+                                                 bigquery_partitioned_table_id, bigquery_release_table_id,
+                                                 bigquery_table_suffixes, create_bigquery_release_view,
+                                                 invalidate_bigquery_dataset_tables)
+
+# The maximum number of shards that migrate_shards_to_partitions copies at once.
+DEFAULT_MIGRATION_JOBS = 4
+
+
+def partition_row_counts(project_id: str, dataset_id: str, table_name: str) -> Dict[str, int]:
+    """ Count the rows of each partition of an ingestion-time partitioned table. Only the partition pseudo column is
+    read, so the query processes no bytes.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param table_name: the name of the partitioned table.
+    :return: the number of rows keyed by the date suffix of the partition, e.g. 20201006.
+    """
+
+    sql = (f"SELECT FORMAT_DATE('%Y%m%d', _PARTITIONDATE) AS suffix, COUNT(*) AS num_rows "
+           f"FROM `{project_id}.{dataset_id}.{table_name}` GROUP BY suffix")
+    rows = bigquery_client(project_id).query(sql).result()
+    return {row['suffix']: row['num_rows'] for row in rows}
+
+
+def migrate_shards_to_partitions(project_id: str, dataset_id: str, table_name: str, location: str,
+                                 start_date: pendulum.Date = None, end_date: pendulum.Date = None,
+                                 replace_shards: bool = False,
+                                 max_jobs: int = DEFAULT_MIGRATION_JOBS) -> List[JobResult]:
+    """ Copy the date sharded tables of a table, e.g. unpaywall20201006, into the partitions of an ingestion-time
+    partitioned table, e.g. unpaywall_partitioned$20201006, see STORAGE_MODE_PARTITIONED. The partitioned table is
+    created with the schema of the most recent shard and fields of older shards that it doesn't have are added. Its
+    name doesn't match wildcard queries over the shards, e.g. unpaywall2*, so migrating doesn't change their results.
+
+    When replace_shards is True, each shard whose partition has the same number of rows is deleted and replaced with a
+    compatibility view of the same name, see create_bigquery_release_view. Wildcard queries over the shards must be
+    changed to query the partitioned table before the shards are replaced, because views can't be queried with
+    wildcard tables.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param table_name: the name of the table without the date suffix.
+    :param location: the location of the dataset.
+    :param start_date: the date of the earliest shard to migrate.
+    :param end_date: the date of the latest shard to migrate.
+    :param replace_shards: whether to replace the migrated shards with compatibility views.
+    :param max_jobs: the maximum number of shards to copy at once.
+    :return: the results of the copy jobs, one per shard, named after the shards.
+    """
+
+    func_name = migrate_shards_to_partitions.__name__
+    client = bigquery_client(project_id, location)
+
+    # Find the shards, skipping the compatibility views of shards that have already been replaced
+    tables = bigquery_dataset_tables(project_id, dataset_id, ttl=0)
+    suffixes = [suffix for suffix in bigquery_table_suffixes(project_id, dataset_id, table_name, start_date=start_date,
+                                                             end_date=end_date, ttl=0)
+                if tables[bigquery_partitioned_table_id(table_name, suffix)].table_type == 'TABLE']
+    logging.info(f'{func_name}: migrating {len(suffixes)} shards of {project_id}.{dataset_id}.{table_name}')
+    if not suffixes:
+        return []
+
+    # Create the partitioned table with the schema of the most recent shard
+    latest = client.get_table(f'{project_id}.{dataset_id}.{bigquery_partitioned_table_id(table_name, suffixes[0])}')
+    partitioned_table_name = bigquery_partitioned_release_table_name(table_name)
+    table = bigquery.Table(f'{project_id}.{dataset_id}.{partitioned_table_name}', schema=latest.schema)
+    table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY)
+    client.create_table(table, exists_ok=True)
+
+    # Copy each shard into its partition. Query jobs are used rather than copy jobs, so that shards with older schemas
+    # can be written to the table.
+    manager = BigQueryJobManager(max_jobs_per_project=max_jobs)
+    for suffix in suffixes:
+        shard_id = bigquery_partitioned_table_id(table_name, suffix)
+        partition_id = bigquery_release_table_id(table_name, suffix, STORAGE_MODE_PARTITIONED)
+        job_config = bigquery.QueryJobConfig(
+            destination=f'{project_id}.{dataset_id}.{partition_id}',
+            use_legacy_sql=False,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION,
+                                   bigquery.SchemaUpdateOption.ALLOW_FIELD_RELAXATION]
+        )
+        manager.submit_query(shard_id, project_id, location, f'SELECT * FROM `{project_id}.{dataset_id}.{shard_id}`',
+                             job_config)
+    results = manager.run()
+
+    # Replace the shards whose partitions are complete with compatibility views
+    if replace_shards:
+        row_counts = partition_row_counts(project_id, dataset_id, partitioned_table_name)
+        for suffix, result in zip(suffixes, results):
+            shard_id = bigquery_partitioned_table_id(table_name, suffix)
+            shard = client.get_table(f'{project_id}.{dataset_id}.{shard_id}')
+            num_rows = row_counts.get(suffix.strftime('%Y%m%d'), 0)
+            if not result.success or num_rows != shard.num_rows:
+                logging.error(f'{func_name}: not replacing {shard_id}, the shard has {shard.num_rows} rows and its '
+                              f'partition {num_rows}: {result.errors}')
+                continue
+
+            client.delete_table(shard)
+            create_bigquery_release_view(project_id, dataset_id, table_name, suffix)
+            logging.info(f'{func_name}: replaced {shard_id} with a view of its partition')
+        invalidate_bigquery_dataset_tables(project_id, dataset_id)
+
+    return results
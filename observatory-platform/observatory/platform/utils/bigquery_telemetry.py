@@ -0,0 +1,237 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import json
+import logging
+import os
+import threading
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import pendulum
+from google.cloud import bigquery
+
+# The environment variables that configure where the records of BigQuery jobs are written, see
+# gc_utils.init_bigquery_telemetry: a dataset, as project_id.dataset_id, or a local JSON Lines file.
+TELEMETRY_DATASET_ENV = 'BIGQUERY_TELEMETRY_DATASET'
+TELEMETRY_FILE_ENV = 'BIGQUERY_TELEMETRY_FILE'
+
+# The table in the telemetry dataset that the records are appended to.
+TELEMETRY_TABLE_ID = 'bigquery_jobs'
+
+# The number of records that a TelemetryRecorder buffers before it writes them.
+DEFAULT_TELEMETRY_BATCH_SIZE = 100
+
+# The schema of the telemetry table, which is partitioned by the day that each job was created.
+TELEMETRY_SCHEMA = [
+    bigquery.SchemaField('job_id', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('project_id', 'STRING'),
+    bigquery.SchemaField('location', 'STRING'),
+    bigquery.SchemaField('job_type', 'STRING'),
+    bigquery.SchemaField('dag_id', 'STRING'),
+    bigquery.SchemaField('task_id', 'STRING'),
+    bigquery.SchemaField('template', 'STRING'),
+    bigquery.SchemaField('success', 'BOOLEAN'),
+    bigquery.SchemaField('error', 'STRING'),
+    bigquery.SchemaField('created', 'TIMESTAMP', mode='REQUIRED'),
+    bigquery.SchemaField('started', 'TIMESTAMP'),
+    bigquery.SchemaField('ended', 'TIMESTAMP'),
+    bigquery.SchemaField('duration', 'FLOAT'),
+    bigquery.SchemaField('bytes_processed', 'INTEGER'),
+    bigquery.SchemaField('bytes_billed', 'INTEGER'),
+    bigquery.SchemaField('slot_millis', 'INTEGER'),
+    bigquery.SchemaField('cache_hit', 'BOOLEAN')
+]
+
+
+def job_statistics(job) -> Dict:
+    """ Get the statistics of a finished BigQuery job.
+
+    :param job: the job.
+    :return: the bytes processed, bytes billed, slot milliseconds, duration in seconds and error messages of the job.
+    """
+
+    statistics = job._properties.get('statistics', {})
+    bytes_processed = None
+    if 'query' in statistics:
+        bytes_processed = statistics['query'].get('totalBytesProcessed')
+    elif 'load' in statistics:
+        bytes_processed = statistics['load'].get('inputFileBytes')
+    bytes_billed = statistics.get('query', {}).get('totalBytesBilled')
+    slot_millis = statistics.get('totalSlotMs')
+
+    errors = []
+    if job.error_result is not None:
+        errors = [error.get('message', str(error)) for error in (job.errors or [job.error_result])]
+
+    duration = None
+    if job.started is not None and job.ended is not None:
+        duration = (job.ended - job.started).total_seconds()
+
+    return dict(bytes_processed=None if bytes_processed is None else int(bytes_processed),
+                bytes_billed=None if bytes_billed is None else int(bytes_billed),
+                slot_millis=None if slot_millis is None else int(slot_millis),
+                duration=duration, errors=errors)
+
+
+@dataclass
+class JobRecord:
+    """ The telemetry record of a BigQuery job.
+
+    :param job_id: the BigQuery job id.
+    :param project_id: the project that the job ran in.
+    :param location: the location that the job ran in.
+    :param job_type: the type of job: load, copy, query or extract.
+    :param dag_id: the Airflow DAG that ran the job.
+    :param task_id: the Airflow task that ran the job.
+    :param template: the name of the SQL template that the query was made from.
+    :param success: whether the job finished without errors.
+    :param error: the error messages of the job.
+    :param created: when the job was created, as an ISO 8601 timestamp.
+    :param started: when the job started.
+    :param ended: when the job ended.
+    :param duration: the seconds between the job starting and ending.
+    :param bytes_processed: the bytes that a query processed or that a load job read.
+    :param bytes_billed: the bytes that a query was billed for.
+    :param slot_millis: the slot milliseconds that the job used.
+    :param cache_hit: whether a query was answered from the query cache.
+    """
+
+    job_id: str
+    project_id: Optional[str]
+    location: Optional[str]
+    job_type: Optional[str]
+    dag_id: Optional[str]
+    task_id: Optional[str]
+    template: Optional[str]
+    success: bool
+    error: Optional[str]
+    created: str
+    started: Optional[str] = None
+    ended: Optional[str] = None
+    duration: Optional[float] = None
+    bytes_processed: Optional[int] = None
+    bytes_billed: Optional[int] = None
+    slot_millis: Optional[int] = None
+    cache_hit: Optional[bool] = None
+
+    @staticmethod
+    def from_job(job, template: str = None) -> 'JobRecord':
+        """ Make a JobRecord from a finished job. The DAG and task ids are read from the environment variables that
+        Airflow sets while a task runs.
+
+        :param job: the job.
+        :param template: the name of the SQL template that the query was made from.
+        :return: the JobRecord.
+        """
+
+        statistics = job_statistics(job)
+        errors = statistics.pop('errors')
+        created = job.created or pendulum.now('UTC')
+        return JobRecord(job.job_id, job.project, job.location, job.job_type,
+                         os.environ.get('AIRFLOW_CTX_DAG_ID'), os.environ.get('AIRFLOW_CTX_TASK_ID'), template,
+                         success=job.error_result is None, error='; '.join(errors) or None,
+                         created=created.isoformat(),
+                         started=None if job.started is None else job.started.isoformat(),
+                         ended=None if job.ended is None else job.ended.isoformat(),
+                         cache_hit=getattr(job, 'cache_hit', None), **statistics)
+
+
+class JsonlTelemetrySink:
+    """ Appends telemetry records to a local JSON Lines file. """
+
+    def __init__(self, file_path: str):
+        """ Create a JsonlTelemetrySink.
+
+        :param file_path: the path of the file.
+        """
+
+        self.file_path = file_path
+
+    def write(self, records: List[JobRecord]) -> None:
+        with open(self.file_path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(asdict(record)) + '\n')
+
+
+class BigQueryTelemetrySink:
+    """ Appends telemetry records to a BigQuery table with a load job, which is created if it doesn't exist. """
+
+    def __init__(self, client: bigquery.Client, table_id: str):
+        """ Create a BigQueryTelemetrySink.
+
+        :param client: the BigQuery client.
+        :param table_id: the fully qualified id of the table.
+        """
+
+        self.client = client
+        self.table_id = table_id
+
+    def write(self, records: List[JobRecord]) -> None:
+        job_config = bigquery.LoadJobConfig(
+            schema=TELEMETRY_SCHEMA,
+            create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            time_partitioning=bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field='created')
+        )
+        rows = [asdict(record) for record in records]
+        self.client.load_table_from_json(rows, self.table_id, job_config=job_config).result()
+
+
+class TelemetryRecorder:
+    """ Buffers telemetry records and writes them to a sink in batches. """
+
+    def __init__(self, sink, batch_size: int = DEFAULT_TELEMETRY_BATCH_SIZE):
+        """ Create a TelemetryRecorder.
+
+        :param sink: the sink to write the records to, e.g. a JsonlTelemetrySink or BigQueryTelemetrySink.
+        :param batch_size: the number of records to buffer before they are written.
+        """
+
+        self.sink = sink
+        self.batch_size = batch_size
+        self._records: List[JobRecord] = []
+        self._lock = threading.Lock()
+
+    def record(self, record: JobRecord) -> None:
+        """ Add a record, writing the buffered records when the batch is full.
+
+        :param record: the record.
+        :return: None.
+        """
+
+        with self._lock:
+            self._records.append(record)
+            full = len(self._records) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Write the buffered records. Records that can't be written are logged and dropped, so that telemetry never
+        fails a workflow.
+
+        :return: None.
+        """
+
+        with self._lock:
+            records, self._records = self._records, []
+        if not records:
+            return
+
+        try:
+            self.sink.write(records)
+        except Exception as e:
+            logging.warning(f'TelemetryRecorder: could not write {len(records)} records: {e}')
@@ -21,7 +21,7 @@ import logging
 import os
 import pathlib
 from enum import Enum
-from typing import Union
+from typing import Optional, Union
 
 import airflow
 import pendulum
@@ -32,6 +32,8 @@ from natsort import natsorted
 from pendulum import Pendulum
 
 from observatory.platform.utils.airflow_utils import AirflowVariable
+from observatory.platform.utils.file_utils import ChecksumIndex
+from observatory.platform.utils.gc_utils import BUDGET_ACTION_FAIL, BytesBudget
 
 # The path where data is saved on the system
 data_path = None
@@ -51,12 +53,14 @@ class AirflowVars:
     TERRAFORM_ORGANIZATION = "terraform_organization"
     DAGS_MODULE_NAMES = "dags_module_names"
     KIBANA_SPACES = "kibana_spaces"
+    BIGQUERY_BYTES_BUDGETS = "bigquery_bytes_budgets"
 
 
 class AirflowConns:
     """ Common Airflow Connection names used with the Observatory Platform """
 
     CROSSREF = "crossref"
+    UNPAYWALL = "unpaywall"
     MAG_RELEASES_TABLE = "mag_releases_table"
     MAG_SNAPSHOTS_CONTAINER = "mag_snapshots_container"
     TERRAFORM = "terraform"
@@ -193,6 +197,26 @@ def check_variables(*variables):
     return is_valid
 
 
+def bigquery_bytes_budget(task_id: str) -> Optional[BytesBudget]:
+    """ Get the maximum number of bytes that the BigQuery query of a task is expected to process, from the optional
+    bigquery_bytes_budgets Airflow Variable. The Variable is a JSON object with a default budget, per task budgets and
+    the action to take when a budget is exceeded, e.g.
+    {"action": "fail", "default": 1000000000000, "tasks": {"create_doi": 5000000000000}}
+
+    :param task_id: the Airflow task id.
+    :return: the budget of the task, or None if it has no budget.
+    """
+
+    budgets = AirflowVariable.get(AirflowVars.BIGQUERY_BYTES_BUDGETS, default_var=None, deserialize_json=True)
+    if budgets is None:
+        return None
+
+    max_bytes = budgets.get('tasks', {}).get(task_id, budgets.get('default'))
+    if max_bytes is None:
+        return None
+    return BytesBudget(int(max_bytes), action=budgets.get('action', BUDGET_ACTION_FAIL))
+
+
 def check_connections(*connections):
     """ Checks whether all given airflow connections exist.
 
@@ -230,7 +254,8 @@ class SubFolder(Enum):
 
 
 def telescope_path(sub_folder: SubFolder, name: str) -> str:
-    """ Return a path for saving telescope data. Create it if it doesn't exist.
+    """ Return a path for saving telescope data. Create it if it doesn't exist and register it as the directory of a
+    checksum index, which is created when the first checksum of a file in it is saved, see ChecksumIndex.register.
 
     :param sub_folder: the name of the sub folder for the telescope
     :param name: the name of the telescope.
@@ -248,6 +273,7 @@ def telescope_path(sub_folder: SubFolder, name: str) -> str:
     path = os.path.join(data_path, 'telescopes', sub_folder.value, name)
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
+    ChecksumIndex.register(path)
 
     return path
 
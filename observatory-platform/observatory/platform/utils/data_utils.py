@@ -47,7 +47,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import hashlib
 import os
 import shutil
 import tarfile
@@ -55,7 +54,6 @@ import zipfile
 from contextlib import closing
 
 import six
-import sys
 from six.moves.urllib.error import HTTPError
 from six.moves.urllib.error import URLError
 from six.moves.urllib.request import urlopen
@@ -65,46 +63,58 @@ try:
 except ImportError:
     import Queue as queue
 
+from observatory.platform.utils.file_utils import DEFAULT_HASH_READ_SIZE, file_checksums, open_checksummed
 from observatory.platform.utils.progbar_utils import Progbar
 
-if sys.version_info[0] == 2:
-    def urlretrieve(url, filename, reporthook=None, data=None):
-        """Replacement for `urlretrieve` for Python 2.
-        Under Python 2, `urlretrieve` relies on `FancyURLopener` from legacy
-        `urllib` module, known to have issues with proxy management.
-        # Arguments
-            url: url to retrieve.
-            filename: where to store the retrieved data locally.
-            reporthook: a hook function that will be called once
-                on establishment of the network connection and once
-                after each block read thereafter.
-                The hook will be passed three arguments;
-                a count of blocks transferred so far,
-                a block size in bytes, and the total size of the file.
-            data: `data` argument passed to `urlopen`.
-        """
-
-        def chunk_read(response, chunk_size=8192, reporthook=None):
-            content_type = response.info().get('Content-Length')
-            total_size = -1
-            if content_type is not None:
-                total_size = int(content_type.strip())
-            count = 0
-            while True:
-                chunk = response.read(chunk_size)
-                count += 1
-                if reporthook is not None:
-                    reporthook(count, chunk_size, total_size)
-                if chunk:
-                    yield chunk
-                else:
-                    break
-
-        with closing(urlopen(url, data)) as response, open(filename, 'wb') as fd:
-            for chunk in chunk_read(response, reporthook=reporthook):
-                fd.write(chunk)
-else:
-    from six.moves.urllib.request import urlretrieve
+def urlretrieve_checksummed(url, filename, reporthook=None, data=None, algorithms=('crc32c',),
+                            chunk_size=1024 * 1024):
+    """Retrieves a URL into a file, computing checksums of the data as it is written.
+    The crc32c checksum is saved in the checksum index that covers the file, so
+    that the file does not need to be read again to be validated or uploaded.
+    # Arguments
+        url: url to retrieve.
+        filename: where to store the retrieved data locally.
+        reporthook: a hook function that will be called once
+            on establishment of the network connection and once
+            after each block read thereafter.
+            The hook will be passed three arguments;
+            a count of blocks transferred so far,
+            a block size in bytes, and the total size of the file.
+        data: `data` argument passed to `urlopen`.
+        algorithms: the checksum algorithms to compute, e.g. 'crc32c', 'md5' and 'sha256'.
+        chunk_size: Bytes to read at a time.
+    # Returns
+        The checksums of the file.
+    """
+    with closing(urlopen(url, data)) as response, open_checksummed(filename, algorithms=algorithms) as fd:
+        content_length = response.info().get('Content-Length')
+        total_size = -1
+        if content_length is not None:
+            total_size = int(content_length.strip())
+        count = 0
+        while True:
+            chunk = response.read(chunk_size)
+            count += 1
+            if reporthook is not None:
+                reporthook(count, chunk_size, total_size)
+            if not chunk:
+                break
+            fd.write(chunk)
+    return fd.checksums
+
+
+def _hash_algorithm(file_hash, algorithm='auto'):
+    """Resolves the hash algorithm of a file hash.
+    # Arguments
+        file_hash: The expected hash string of the file.
+        algorithm: Hash algorithm, one of 'auto', 'sha256', or 'md5'.
+            The default 'auto' detects the hash algorithm in use.
+    # Returns
+        'sha256' or 'md5'
+    """
+    if (algorithm == 'sha256') or (algorithm == 'auto' and len(file_hash) == 64):
+        return 'sha256'
+    return 'md5'
 
 
 def _extract_archive(file_path, path='.', archive_format='auto'):
@@ -183,6 +193,9 @@ def get_file(fname,
             md5 hash of the file for verification
         file_hash: The expected hash string of the file after download.
             The sha256 and md5 hash algorithms are both supported.
+            A cached file that doesn't match the hash is downloaded
+            again, and a downloaded file that doesn't match the hash
+            is deleted and an exception is raised.
         cache_subdir: Subdirectory under the Keras cache dir where the file is
             saved. If an absolute path `/path/to/folder` is
             specified the file will be saved at that location.
@@ -200,6 +213,10 @@ def get_file(fname,
 
     # Returns
         Path to the downloaded file
+
+    # Raises
+        Exception: if the file could not be downloaded, or if a hash was
+            given and the downloaded file doesn't match it.
     """  # noqa
     if cache_dir is None:
         if 'KERAS_HOME' in os.environ:
@@ -223,6 +240,7 @@ def get_file(fname,
         fpath = os.path.join(datadir, fname)
 
     download = False
+    hasher = _hash_algorithm(file_hash, hash_algorithm) if file_hash is not None else None
     if os.path.exists(fpath):
         # File found; verify integrity if a hash was provided.
         if file_hash is not None:
@@ -249,12 +267,20 @@ def get_file(fname,
                     total_size = None
                 ProgressTracker.progbar = Progbar(total_size)
             else:
-                ProgressTracker.progbar.update(count * block_size)
+                current = count * block_size
+                if total_size != -1:
+                    current = min(current, total_size)
+                ProgressTracker.progbar.update(current)
 
         error_msg = 'URL fetch failure on {} : {} -- {}'
         try:
             try:
-                urlretrieve(origin, fpath, dl_progress)
+                # The file hash is computed while the file is downloaded
+                algorithms = ('crc32c', hasher) if hasher is not None else ('crc32c',)
+                checksums = urlretrieve_checksummed(origin, fpath, dl_progress, algorithms=algorithms)
+                if hasher is not None and checksums.hexdigest(hasher) != str(file_hash):
+                    raise Exception('The downloaded file {} does not match the {} file hash {}'.format(
+                        fpath, hasher, file_hash))
             except HTTPError as e:
                 raise Exception(error_msg.format(origin, e.code, e.msg))
             except URLError as e:
@@ -276,7 +302,7 @@ def get_file(fname,
     return fpath, download
 
 
-def _hash_file(fpath, algorithm='sha256', chunk_size=65535):
+def _hash_file(fpath, algorithm='sha256', chunk_size=DEFAULT_HASH_READ_SIZE):
     """Calculates a file sha256 or md5 hash.
 
     # Example
@@ -296,19 +322,15 @@ def _hash_file(fpath, algorithm='sha256', chunk_size=65535):
     # Returns
         The file hash
     """
-    if (algorithm == 'sha256') or (algorithm == 'auto' and len(hash) == 64):
-        hasher = hashlib.sha256()
+    if algorithm == 'sha256':
+        hasher = 'sha256'
     else:
-        hasher = hashlib.md5()
-
-    with open(fpath, 'rb') as fpath_file:
-        for chunk in iter(lambda: fpath_file.read(chunk_size), b''):
-            hasher.update(chunk)
+        hasher = 'md5'
 
-    return hasher.hexdigest()
+    return file_checksums(fpath, algorithms=(hasher,), read_size=chunk_size).hexdigest(hasher)
 
 
-def validate_file(fpath, file_hash, algorithm='auto', chunk_size=65535):
+def validate_file(fpath, file_hash, algorithm='auto', chunk_size=DEFAULT_HASH_READ_SIZE):
     """Validates a file against a sha256 or md5 hash.
     # Arguments
         fpath: path to the file being validated
@@ -320,11 +342,7 @@ def validate_file(fpath, file_hash, algorithm='auto', chunk_size=65535):
     # Returns
         Whether the file is valid
     """
-    if ((algorithm == 'sha256') or
-            (algorithm == 'auto' and len(file_hash) == 64)):
-        hasher = 'sha256'
-    else:
-        hasher = 'md5'
+    hasher = _hash_algorithm(file_hash, algorithm)
 
     if str(_hash_file(fpath, hasher, chunk_size)) == str(file_hash):
         return True
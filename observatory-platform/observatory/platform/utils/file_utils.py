@@ -0,0 +1,861 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import base64
+import codecs
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import cpu_count
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+import google_crc32c
+from google_crc32c import Checksum as Crc32cChecksum
+
+# The number of bytes read at a time when hashing a file.
+DEFAULT_HASH_READ_SIZE = 8 * 1024 * 1024
+
+# The reversed CRC32C (Castagnoli) polynomial.
+CRC32C_POLYNOMIAL = 0x82F63B78
+
+# The reversed CRC32 polynomial, used by gzip and zlib.
+CRC32_POLYNOMIAL = 0xEDB88320
+
+# The magic number and flags of a gzip member header, see RFC 1952.
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_FHCRC, GZIP_FEXTRA, GZIP_FNAME, GZIP_FCOMMENT = 0x02, 0x04, 0x08, 0x10
+
+# The gzip compression level of the files that telescopes transform, which trades a little size for much faster
+# compression than the default of 9.
+TRANSFORM_COMPRESS_LEVEL = 6
+
+# The name of the sidecar checksum index file that is kept in each telescope directory.
+CHECKSUM_INDEX_FILE_NAME = '.checksum_index.sqlite3'
+
+# The directories in which a checksum index has been found, mapped to the index, see ChecksumIndex.find.
+_checksum_indexes: Dict[str, 'ChecksumIndex'] = dict()
+# The directories whose checksum index is created when the first checksum is saved, see ChecksumIndex.register.
+_checksum_index_roots: Set[str] = set()
+_checksum_indexes_lock = threading.Lock()
+
+
+def hex_to_base64_str(hex_str: bytes) -> str:
+    """ Covert a hexadecimal string into a base64 encoded string. Removes trailing newline character.
+
+    :param hex_str: the hexadecimal encoded string.
+    :return: the base64 encoded string.
+    """
+
+    string = codecs.decode(hex_str, 'hex')
+    base64 = codecs.encode(string, 'base64')
+    return base64.decode('utf8').rstrip('\n')
+
+
+def crc32c_hardware_accelerated() -> bool:
+    """ Whether crc32c checksums are computed by the compiled google-crc32c extension, which uses the SSE4.2 / ARMv8
+    crc32c instructions when the CPU has them, rather than the much slower pure Python fallback.
+
+    :return: whether crc32c checksums are accelerated.
+    """
+
+    return google_crc32c.implementation == 'c'
+
+
+class Checksums:
+    """ Computes one or more checksums of a stream of bytes in a single pass. Supports 'crc32c' and the algorithms
+    of hashlib, such as 'md5' and 'sha256'. """
+
+    def __init__(self, algorithms: Tuple[str, ...] = ('crc32c',)):
+        """ Create a Checksums.
+
+        :param algorithms: the names of the checksum algorithms.
+        """
+
+        self.algorithms = tuple(algorithms)
+        self._hashers = {algorithm: Crc32cChecksum() if algorithm == 'crc32c' else hashlib.new(algorithm)
+                         for algorithm in self.algorithms}
+        self.size = 0
+
+    def update(self, data: bytes):
+        """ Update the checksums with the next chunk of data.
+
+        :param data: the data.
+        :return: None.
+        """
+
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        for hasher in self._hashers.values():
+            hasher.update(data)
+        self.size += len(data)
+
+    def digest(self, algorithm: str = 'crc32c') -> bytes:
+        return self._hashers[algorithm].digest()
+
+    def hexdigest(self, algorithm: str = 'crc32c') -> str:
+        digest = self._hashers[algorithm].hexdigest()
+        return digest.decode('utf-8') if isinstance(digest, bytes) else digest
+
+    def base64(self, algorithm: str = 'crc32c') -> str:
+        """ Get a checksum base64 encoded, the form that Google Cloud Storage uses for crc32c and md5 hashes.
+
+        :param algorithm: the name of the checksum algorithm.
+        :return: the base64 encoded checksum.
+        """
+
+        return base64.b64encode(self.digest(algorithm)).decode('utf-8')
+
+
+def file_checksums(file_path: str, algorithms: Tuple[str, ...] = ('crc32c',),
+                   read_size: int = DEFAULT_HASH_READ_SIZE) -> Checksums:
+    """ Compute one or more checksums of a file in a single pass, reading the file in large chunks.
+
+    :param file_path: the path to the file.
+    :param algorithms: the names of the checksum algorithms, see Checksums.
+    :param read_size: the number of bytes to read at a time.
+    :return: the checksums.
+    """
+
+    checksums = Checksums(algorithms)
+    with open(file_path, 'rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(read_size), b''):
+            checksums.update(chunk)
+    return checksums
+
+
+class ChecksumStream:
+    """ Wraps a binary file-like object, computing checksums of the data as it is written to or read from the stream,
+    so that files get their checksums without being read again.
+
+    When file_path is given and the checksums include crc32c, the checksum is saved in the checksum index that covers
+    the file when the stream is closed.
+    """
+
+    def __init__(self, stream: BinaryIO, algorithms: Tuple[str, ...] = ('crc32c',), file_path: str = None):
+        """ Create a ChecksumStream.
+
+        :param stream: the stream to wrap.
+        :param algorithms: the names of the checksum algorithms, see Checksums.
+        :param file_path: the path of the file that is being written, if any.
+        """
+
+        self.stream = stream
+        self.checksums = Checksums(algorithms)
+        self.file_path = file_path
+
+    def write(self, data: bytes) -> int:
+        written = self.stream.write(data)
+        self.checksums.update(data)
+        return written
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.checksums.update(data)
+        return data
+
+    def close(self):
+        if not self.stream.closed:
+            self.stream.close()
+            if self.file_path is not None and 'crc32c' in self.checksums.algorithms:
+                update_checksum_index(self.file_path, self.checksums.base64('crc32c'))
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
+    def __enter__(self) -> 'ChecksumStream':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_checksummed(file_path: str, algorithms: Tuple[str, ...] = ('crc32c',)) -> ChecksumStream:
+    """ Open a file for writing in binary mode, computing checksums of the data as it is written. The crc32c checksum
+    is saved in the checksum index that covers the file when the file is closed.
+
+    :param file_path: the path to the file.
+    :param algorithms: the names of the checksum algorithms, see Checksums.
+    :return: the stream.
+    """
+
+    return ChecksumStream(open(file_path, 'wb'), algorithms=algorithms, file_path=file_path)
+
+
+def crc32c_base64_hash(file_path: str, chunk_size: int = DEFAULT_HASH_READ_SIZE) -> str:
+    """ Create a base64 crc32c checksum of a file.
+
+    :param file_path: the path to the file.
+    :param chunk_size: the size of each chunk to check.
+    :return: the checksum.
+    """
+
+    return file_checksums(file_path, read_size=chunk_size).base64('crc32c')
+
+
+def _gf2_matrix_times(matrix: List[int], vector: int) -> int:
+    """ Multiply a 32x32 GF(2) matrix by a 32 bit vector.
+
+    :param matrix: the matrix, one 32 bit integer per column.
+    :param vector: the vector.
+    :return: the product.
+    """
+
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(matrix: List[int]) -> List[int]:
+    """ Square a 32x32 GF(2) matrix.
+
+    :param matrix: the matrix, one 32 bit integer per column.
+    :return: the squared matrix.
+    """
+
+    return [_gf2_matrix_times(matrix, matrix[n]) for n in range(32)]
+
+
+def crc32c_combine(crc1: int, crc2: int, len2: int) -> int:
+    """ Combine the CRC32C checksums of two consecutive blocks of data into the CRC32C checksum of the concatenated
+    data, without reading the data again. A port of zlib's crc32_combine for the Castagnoli polynomial.
+
+    :param crc1: the checksum of the first block.
+    :param crc2: the checksum of the second block.
+    :param len2: the length of the second block in bytes.
+    :return: the checksum of the first block followed by the second block.
+    """
+
+    return _crc_combine(crc1, crc2, len2, CRC32C_POLYNOMIAL)
+
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    """ Combine the CRC32 checksums of two consecutive blocks of data into the CRC32 checksum of the concatenated data,
+    like zlib's crc32_combine.
+
+    :param crc1: the checksum of the first block.
+    :param crc2: the checksum of the second block.
+    :param len2: the length of the second block in bytes.
+    :return: the checksum of the first block followed by the second block.
+    """
+
+    return _crc_combine(crc1, crc2, len2, CRC32_POLYNOMIAL)
+
+
+def _crc_combine(crc1: int, crc2: int, len2: int, polynomial: int) -> int:
+    """ Combine the checksums of two consecutive blocks of data for a reflected 32 bit CRC.
+
+    :param crc1: the checksum of the first block.
+    :param crc2: the checksum of the second block.
+    :param len2: the length of the second block in bytes.
+    :param polynomial: the reversed polynomial of the CRC.
+    :return: the checksum of the first block followed by the second block.
+    """
+
+    if len2 <= 0:
+        return crc1
+
+    # Operator for one zero bit, then two and four zero bits
+    odd = [polynomial] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+
+    # Apply len2 zero bytes to crc1, squaring the operator for each bit of len2
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+
+    return crc1 ^ crc2
+
+
+def crc32c_to_base64_str(crc: int) -> str:
+    """ Convert a CRC32C checksum into the base64 encoded big-endian form that Cloud Storage uses.
+
+    :param crc: the checksum.
+    :return: the base64 encoded checksum.
+    """
+
+    return hex_to_base64_str(f'{crc:08x}'.encode('utf-8'))
+
+
+class FileSlice:
+    """ A read only, seekable view of a byte range of a file, which computes the CRC32C checksum of the range as it
+    is read. Positions are relative to the start of the range, so that it can be handed to the upload functions of
+    a Blob as if it were a whole file. """
+
+    def __init__(self, file_path: str, offset: int, size: int):
+        """ Create a FileSlice.
+
+        :param file_path: the path to the file.
+        :param offset: the offset of the first byte of the range.
+        :param size: the number of bytes in the range.
+        """
+
+        self.file_path = file_path
+        self.offset = offset
+        self.size = size
+        self._file = open(file_path, 'rb')
+        self._file.seek(offset)
+        self._position = 0
+        self._checksum = Crc32cChecksum()
+        self._checksum_position = 0
+
+    @property
+    def crc32c(self) -> int:
+        """ The CRC32C checksum of the range, valid once the whole range has been read.
+
+        :return: the checksum.
+        """
+
+        return int.from_bytes(self._checksum.digest(), 'big')
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.size - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self._file.read(size)
+
+        # Only checksum bytes that have not been checksummed before, as uploads re-read data after a seek when they
+        # recover from errors
+        end = self._position + len(data)
+        if end > self._checksum_position >= self._position:
+            self._checksum.update(data[self._checksum_position - self._position:])
+            self._checksum_position = end
+        self._position = end
+        return data
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, position: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self.size
+        self._position = max(0, min(position, self.size))
+        self._file.seek(self.offset + self._position)
+        return self._position
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> 'FileSlice':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FileSliceWriter:
+    """ A write only view of a byte range of a file, which writes with positional writes so that several byte ranges
+    of the same file can be written concurrently, and computes the CRC32C checksum of the range as it is written. """
+
+    def __init__(self, fd: int, offset: int):
+        """ Create a FileSliceWriter.
+
+        :param fd: a file descriptor of the file, opened for writing.
+        :param offset: the offset of the first byte of the range.
+        """
+
+        self.fd = fd
+        self.offset = offset
+        self._position = 0
+        self._checksum = Crc32cChecksum()
+
+    @property
+    def crc32c(self) -> int:
+        """ The CRC32C checksum of the bytes that have been written.
+
+        :return: the checksum.
+        """
+
+        return int.from_bytes(self._checksum.digest(), 'big')
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.offset + self._position)
+            self._position += written
+            view = view[written:]
+        self._checksum.update(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+
+def split_byte_ranges(size: int, slices: int) -> List[Tuple[int, int]]:
+    """ Split a number of bytes into contiguous byte ranges of equal size, the last range holds any remainder.
+
+    :param size: the number of bytes.
+    :param slices: the number of ranges, at most size.
+    :return: (offset, size) tuples.
+    """
+
+    slices = max(1, min(slices, size))
+    slice_size = size // slices
+    ranges = [(i * slice_size, slice_size) for i in range(slices - 1)]
+    ranges.append(((slices - 1) * slice_size, size - (slices - 1) * slice_size))
+    return ranges
+
+
+def crc32c_combine_all(crcs: List[int], sizes: List[int]) -> int:
+    """ Combine the CRC32C checksums of consecutive blocks of data into the CRC32C checksum of the concatenated data.
+
+    :param crcs: the checksums of the blocks.
+    :param sizes: the sizes of the blocks in bytes.
+    :return: the checksum of the concatenated data.
+    """
+
+    crc = crcs[0]
+    for crc2, size2 in zip(crcs[1:], sizes[1:]):
+        crc = crc32c_combine(crc, crc2, size2)
+    return crc
+
+
+def _hash_file_with_stat(file_path: str) -> Tuple[str, os.stat_result, str]:
+    """ Hash a file, recording the stat of the file from before it was hashed. Used by ChecksumIndex.warm.
+
+    :param file_path: the path to the file.
+    :return: the file path, the stat of the file and the base64 crc32c checksum.
+    """
+
+    stat = os.stat(file_path)
+    return file_path, stat, crc32c_base64_hash(file_path)
+
+
+class ChecksumIndex:
+    """ A persistent index of the crc32c checksums of the files in a directory, stored in a sqlite database next to
+    the files. A checksum is keyed on the path of the file relative to the directory and is only used while the inode,
+    size and modification time of the file are unchanged, so an unchanged file is never hashed twice.
+
+    The index can be shared between threads and processes: each process opens its own connection to the database.
+    """
+
+    def __init__(self, directory: str):
+        """ Create a ChecksumIndex.
+
+        :param directory: the directory that the index covers, the index is stored in CHECKSUM_INDEX_FILE_NAME in
+        this directory.
+        """
+
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, CHECKSUM_INDEX_FILE_NAME)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create(directory: str) -> 'ChecksumIndex':
+        """ Create the checksum index of a directory if it does not exist yet.
+
+        :param directory: the directory.
+        :return: the index.
+        """
+
+        index = ChecksumIndex(directory)
+        if not os.path.exists(index.path):
+            index._connection()
+        return index
+
+    @staticmethod
+    def register(directory: str):
+        """ Register a directory whose checksum index is created when the first checksum of a file in the directory is
+        saved, see find. Nothing is written to the directory until then.
+
+        :param directory: the directory.
+        :return: None.
+        """
+
+        with _checksum_indexes_lock:
+            _checksum_index_roots.add(os.path.abspath(directory))
+
+    @staticmethod
+    def find(file_path: str, create: bool = False) -> Optional['ChecksumIndex']:
+        """ Find the checksum index that covers a file, by searching the directory of the file and its parents. Only
+        indexes that have been found are remembered, so an index created later, e.g. by another process, is found by
+        the next search.
+
+        :param file_path: the path to the file.
+        :param create: whether to create the index of a registered directory that covers the file when it doesn't
+        exist yet, see register.
+        :return: the index or None if the file is not covered by an index.
+        """
+
+        directory = os.path.dirname(os.path.abspath(file_path))
+        with _checksum_indexes_lock:
+            index = _checksum_indexes.get(directory)
+            if index is not None and os.path.isfile(index.path):
+                return index
+
+            search_dir = directory
+            while True:
+                if os.path.isfile(os.path.join(search_dir, CHECKSUM_INDEX_FILE_NAME)) or \
+                        (create and search_dir in _checksum_index_roots):
+                    index = ChecksumIndex(search_dir)
+                    _checksum_indexes[directory] = index
+                    return index
+                parent = os.path.dirname(search_dir)
+                if parent == search_dir:
+                    _checksum_indexes.pop(directory, None)
+                    return None
+                search_dir = parent
+
+    def __getstate__(self) -> Dict:
+        return {'directory': self.directory, 'path': self.path}
+
+    def __setstate__(self, state: Dict):
+        self.__init__(state['directory'])
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Get the connection to the index database for this process, creating the database if necessary.
+
+        :return: the connection.
+        """
+
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, inode INTEGER, '
+                               'size INTEGER, mtime_ns INTEGER, crc32c TEXT)')
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _key(self, file_path: str) -> str:
+        return os.path.relpath(os.path.abspath(file_path), self.directory)
+
+    def get(self, file_path: str, stat: os.stat_result = None) -> Optional[str]:
+        """ Get the checksum of a file from the index.
+
+        :param file_path: the path to the file.
+        :param stat: the stat of the file, if None the file is stat'ed.
+        :return: the base64 crc32c checksum or None if the file is not in the index or has changed since it was
+        indexed.
+        """
+
+        if stat is None:
+            stat = os.stat(file_path)
+
+        with self._lock:
+            row = self._connection().execute('SELECT inode, size, mtime_ns, crc32c FROM checksums WHERE path = ?',
+                                             (self._key(file_path),)).fetchone()
+
+        if row is not None and tuple(row[:3]) == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return row[3]
+        return None
+
+    def put(self, file_path: str, crc32c: str, stat: os.stat_result = None):
+        """ Save the checksum of a file in the index.
+
+        :param file_path: the path to the file.
+        :param crc32c: the base64 crc32c checksum of the file.
+        :param stat: the stat of the file when it was hashed, if None the file is stat'ed.
+        :return: None.
+        """
+
+        self.put_many([(file_path, stat if stat is not None else os.stat(file_path), crc32c)])
+
+    def put_many(self, entries: List[Tuple[str, os.stat_result, str]]):
+        """ Save the checksums of several files in the index in a single transaction.
+
+        :param entries: (file path, stat of the file when it was hashed, base64 crc32c checksum) tuples.
+        :return: None.
+        """
+
+        rows = [(self._key(file_path), stat.st_ino, stat.st_size, stat.st_mtime_ns, crc32c)
+                for file_path, stat, crc32c in entries]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany('INSERT OR REPLACE INTO checksums (path, inode, size, mtime_ns, crc32c) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+            conn.commit()
+
+    def crc32c(self, file_path: str) -> str:
+        """ Get the checksum of a file, hashing the file and saving the checksum only if it is not in the index.
+
+        :param file_path: the path to the file.
+        :return: the base64 crc32c checksum.
+        """
+
+        stat = os.stat(file_path)
+        checksum = self.get(file_path, stat=stat)
+        if checksum is None:
+            checksum = crc32c_base64_hash(file_path)
+            self.put(file_path, checksum, stat=stat)
+        return checksum
+
+    def warm(self, file_paths: List[str] = None, max_workers: int = cpu_count()) -> int:
+        """ Hash the files that are not in the index yet, in parallel, and save their checksums.
+
+        :param file_paths: the files to index, if None all files in the directory are indexed.
+        :param max_workers: the maximum number of processes to hash files with.
+        :return: the number of files that were hashed.
+        """
+
+        func_name = self.warm.__name__
+
+        if file_paths is None:
+            file_paths = []
+            for root, dirs, files in os.walk(self.directory):
+                for file_name in files:
+                    if not file_name.startswith(CHECKSUM_INDEX_FILE_NAME):
+                        file_paths.append(os.path.join(root, file_name))
+
+        to_hash = [file_path for file_path in file_paths if self.get(file_path) is None]
+        logging.info(f'{func_name}: directory={self.directory}, files={len(file_paths)}, to_hash={len(to_hash)}')
+
+        if to_hash:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                entries = list(executor.map(_hash_file_with_stat, to_hash))
+            self.put_many(entries)
+
+        return len(to_hash)
+
+    def close(self):
+        """ Close the connection to the index database.
+
+        :return: None.
+        """
+
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def indexed_crc32c_base64_hash(file_path: str) -> str:
+    """ Get the base64 crc32c checksum of a file, using the checksum index that covers the file if there is one.
+
+    :param file_path: the path to the file.
+    :return: the checksum.
+    """
+
+    index = ChecksumIndex.find(file_path, create=True)
+    if index is None:
+        return crc32c_base64_hash(file_path)
+    return index.crc32c(file_path)
+
+
+def update_checksum_index(file_path: str, crc32c: str):
+    """ Save the known checksum of a file, for example one verified during a transfer, in the checksum index that
+    covers the file. Does nothing when the file is not covered by an index.
+
+    :param file_path: the path to the file.
+    :param crc32c: the base64 crc32c checksum of the file.
+    :return: None.
+    """
+
+    index = ChecksumIndex.find(file_path, create=True)
+    if index is not None:
+        index.put(file_path, crc32c)
+
+
+@dataclass
+class GzipMember:
+    """ A member of a gzip file. A gzip file is a series of members, each with a header, a deflate stream and a
+    trailer, see RFC 1952. Files made by gzip have a single member, parallel compressors such as pigz and bgzip
+    write many. """
+
+    offset: int
+    compressed_size: int
+    crc32: int
+    isize: int
+    uncompressed_size: int
+
+
+def _read_gzip_header(f: BinaryIO) -> Tuple[int, Optional[int]]:
+    """ Read the header of a gzip member from the current position of a file.
+
+    :param f: the file.
+    :return: the length of the header and, for BGZF blocks, the total size of the member from the BSIZE subfield.
+    """
+
+    header = f.read(10)
+    if len(header) < 10 or header[:2] != GZIP_MAGIC or header[2] != 8:
+        raise ValueError(f'Not a gzip member at offset {f.tell() - len(header)}')
+
+    flags = header[3]
+    length = 10
+    block_size = None
+    if flags & GZIP_FEXTRA:
+        extra_length = int.from_bytes(f.read(2), 'little')
+        extra = f.read(extra_length)
+        length += 2 + extra_length
+
+        # Subfields are SI1 SI2 LEN DATA, BGZF stores the member size minus one in the BC subfield
+        i = 0
+        while i + 4 <= len(extra):
+            subfield_length = int.from_bytes(extra[i + 2:i + 4], 'little')
+            if extra[i:i + 2] == b'BC' and subfield_length == 2:
+                block_size = int.from_bytes(extra[i + 4:i + 6], 'little') + 1
+            i += 4 + subfield_length
+    for flag in (GZIP_FNAME, GZIP_FCOMMENT):
+        if flags & flag:
+            while True:
+                c = f.read(1)
+                length += 1
+                if not c or c == b'\0':
+                    break
+    if flags & GZIP_FHCRC:
+        f.read(2)
+        length += 2
+    return length, block_size
+
+
+def gzip_trailer(file_path: str) -> Tuple[int, int]:
+    """ Read the trailer at the end of a gzip file, which holds the CRC32 and ISIZE (the uncompressed size modulo
+    2^32) of the last member. For a single member file, these describe the whole file. Only the last 8 bytes of the
+    file are read.
+
+    :param file_path: the path to the gzip file.
+    :return: the CRC32 and ISIZE.
+    """
+
+    with open(file_path, 'rb') as f:
+        f.seek(-8, os.SEEK_END)
+        trailer = f.read(8)
+    return int.from_bytes(trailer[:4], 'little'), int.from_bytes(trailer[4:], 'little')
+
+
+def gzip_members(file_path: str, read_size: int = DEFAULT_HASH_READ_SIZE) -> List[GzipMember]:
+    """ List the members of a gzip file with the CRC32 and ISIZE from their trailers.
+
+    The end of a member is only known once its deflate stream has been inflated, so members are inflated in process
+    and the inflated data is discarded. BGZF blocks record their size in the header, so they are skipped with seeks
+    instead.
+
+    :param file_path: the path to the gzip file.
+    :param read_size: the number of bytes to read at a time.
+    :return: the members.
+    """
+
+    file_size = os.path.getsize(file_path)
+    members = []
+    with open(file_path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header_length, block_size = _read_gzip_header(f)
+
+            if block_size is not None:
+                f.seek(offset + block_size - 8)
+                trailer = f.read(8)
+                compressed_size = block_size
+                uncompressed_size = None
+            else:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                uncompressed_size = 0
+                while not decompressor.eof:
+                    data = f.read(read_size)
+                    if not data:
+                        raise ValueError(f'Truncated gzip member at offset {offset} of {file_path}')
+
+                    # Bound the inflated data held in memory at once
+                    while data and not decompressor.eof:
+                        uncompressed_size += len(decompressor.decompress(data, read_size))
+                        data = decompressor.unconsumed_tail
+
+                # The trailer follows the deflate stream, part of it may have been read already
+                unused = decompressor.unused_data
+                trailer = (unused + f.read(max(0, 8 - len(unused))))[:8]
+                end = f.tell() - len(unused) + 8 if len(unused) >= 8 else f.tell()
+                compressed_size = end - offset
+
+            if len(trailer) < 8:
+                raise ValueError(f'Truncated gzip trailer at offset {offset} of {file_path}')
+            crc32 = int.from_bytes(trailer[:4], 'little')
+            isize = int.from_bytes(trailer[4:], 'little')
+            members.append(GzipMember(offset, compressed_size, crc32, isize,
+                                      isize if uncompressed_size is None else uncompressed_size))
+            offset += compressed_size
+
+            # Skip zero padding after the last member, which some tools write
+            if offset < file_size:
+                f.seek(offset)
+                if f.read(2) != GZIP_MAGIC:
+                    break
+    return members
+
+
+def gzip_crc32(file_path: str, single_member: bool = False) -> int:
+    """ Get the CRC32 of the uncompressed contents of a gzip file, combined from the CRC32s of all of its members.
+
+    :param file_path: the path to the gzip file.
+    :param single_member: whether the file is known to have a single member, in which case only its trailer is read.
+    :return: the CRC32.
+    """
+
+    if single_member:
+        return gzip_trailer(file_path)[0]
+
+    crc = 0
+    for member in gzip_members(file_path):
+        crc = crc32_combine(crc, member.crc32, member.uncompressed_size)
+    return crc
+
+
+def gzip_file_crc(file_path: str, single_member: bool = False) -> str:
+    """ Get the crc of a gzip file, as the hex string printed by gzip -l.
+
+    :param file_path: the path to the file.
+    :param single_member: whether the file is known to have a single member, in which case only its trailer is read.
+    :return: the crc.
+    """
+
+    return f'{gzip_crc32(file_path, single_member=single_member):08x}'
+
+
+def gzip_files_crc(directory: str, pattern: str = '**/*.gz', single_member: bool = False,
+                   max_workers: int = cpu_count()) -> Dict[str, str]:
+    """ Get the crcs of the gzip files in a directory, see gzip_file_crc. Files are read in a thread pool, since zlib
+    releases the GIL while inflating.
+
+    :param directory: the directory.
+    :param pattern: the glob pattern of the files, relative to the directory.
+    :param single_member: whether the files are known to have a single member each.
+    :param max_workers: the number of threads.
+    :return: the crcs, keyed by file path.
+    """
+
+    file_paths = sorted(glob.glob(os.path.join(directory, pattern), recursive=True))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        crcs = executor.map(lambda file_path: gzip_file_crc(file_path, single_member=single_member), file_paths)
+        return dict(zip(file_paths, crcs))
@@ -0,0 +1,1176 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import asyncio
+import base64
+import json
+import logging
+import mimetypes
+import os
+import random
+import re
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import aiohttp
+import google.auth
+import google.auth.transport.requests
+from google_crc32c import Checksum as Crc32cChecksum
+
+from observatory.platform.utils.file_utils import (FileSliceWriter, crc32c_combine_all, crc32c_to_base64_str,
+                                                   split_byte_ranges, update_checksum_index)
+
+# The chunk size to use when uploading / downloading a blob in multiple parts, must be a multiple of 256 KB.
+DEFAULT_CHUNK_SIZE = 256 * 1024 * 4
+
+# The maximum number of HTTP connections kept open to each host.
+DEFAULT_POOL_SIZE = 128
+
+# The maximum number of requests that a GcsTransferEngine has in flight at once. This is an upper bound, the
+# AdaptiveConcurrencyLimiter of the engine adapts the number of requests in flight to the throughput that is achieved.
+DEFAULT_MAX_CONNECTIONS = 128
+
+# The number of measurement windows whose ConcurrencyStats an AdaptiveConcurrencyLimiter keeps in its history.
+DEFAULT_LIMITER_HISTORY_SIZE = 100
+
+# The maximum number of uploads and downloads that a GcsTransferEngine has in progress at once. Each one holds an open
+# file, so this bounds the number of file descriptors in use no matter how many files are transferred.
+DEFAULT_MAX_TRANSFERS = 256
+
+# Files at least this large are uploaded by upload_files_to_cloud_storage as parallel composite uploads.
+DEFAULT_PARALLEL_UPLOAD_THRESHOLD = 150 * 1024 * 1024
+
+# The default number of slices that a parallel composite upload is split into.
+DEFAULT_PARALLEL_UPLOAD_SLICES = 8
+
+# Blobs at least this large are downloaded by download_blobs_from_cloud_storage as parallel sliced downloads.
+DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD = 150 * 1024 * 1024
+
+# The default number of byte ranges that a parallel sliced download is split into.
+DEFAULT_PARALLEL_DOWNLOAD_SLICES = 8
+
+# The maximum number of source objects that can be composed into a blob with a single compose request.
+MAX_COMPOSE_COMPONENTS = 32
+
+# The HTTP status codes of Cloud Storage requests that are retried.
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# The OAuth scope that the transfer engine requests.
+STORAGE_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+
+
+class TransferError(Exception):
+    """ A Cloud Storage request failed. """
+
+    def __init__(self, message: str, status: int = None, retryable: bool = False):
+        """ Create a TransferError.
+
+        :param message: the error message.
+        :param status: the HTTP status code of the response, if any.
+        :param retryable: whether the request can be retried.
+        """
+
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+@dataclass
+class ObjectInfo:
+    """ The metadata of a Cloud Storage object that is needed to transfer it. Has the same size and crc32c attributes
+    as google.cloud.storage.Blob, so it can be used with diff_transfer_manifest. """
+
+    name: str
+    size: int
+    crc32c: Optional[str] = None
+    generation: Optional[int] = None
+
+    @staticmethod
+    def from_resource(resource: Dict) -> 'ObjectInfo':
+        """ Make an ObjectInfo from a Cloud Storage JSON API object resource.
+
+        :param resource: the resource.
+        :return: the ObjectInfo.
+        """
+
+        generation = resource.get('generation')
+        return ObjectInfo(resource['name'], int(resource.get('size', 0)), crc32c=resource.get('crc32c'),
+                          generation=int(generation) if generation is not None else None)
+
+
+class TransferJournal:
+    """ A durable, append-only journal of the transfers made by a task run, so that a retry of the task can continue
+    where the previous attempt stopped. Each line of the journal is a JSON record of one of:
+
+    * a listing of the objects within a prefix, so that a retry does not list the prefix again.
+    * an object or a component of a composite upload that was transferred, with the size and modification time of the
+      local file and its crc32c checksum, so that a retry skips it without any remote calls while the file is
+      unchanged.
+    * the session URI of a resumable upload that was started, so that a retry continues the upload from the last
+      offset committed by the session.
+
+    Records are flushed and synced to disk as they are written. A torn last line, from a process that was killed
+    while writing it, is ignored when the journal is loaded.
+    """
+
+    def __init__(self, path: str):
+        """ Create a TransferJournal, loading the records that have already been written to the journal file.
+
+        :param path: the path to the journal file.
+        """
+
+        self.path = path
+        self._listings: Dict[Tuple[str, str], Dict[str, ObjectInfo]] = dict()
+        self._completed: Dict[Tuple[str, str], Dict] = dict()
+        self._sessions: Dict[Tuple[str, str], Dict] = dict()
+        self._file = None
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning(f'TransferJournal: ignoring incomplete record in {path}')
+                        continue
+                    self._apply(record)
+
+    def _apply(self, record: Dict):
+        key = (record['bucket'], record.get('name', record.get('prefix')))
+        event = record['event']
+        if event == 'listed':
+            self._listings[key] = {item['name']: ObjectInfo(**item) for item in record['objects']}
+        elif event == 'completed':
+            self._completed[key] = record
+            self._sessions.pop(key, None)
+        elif event == 'session':
+            self._sessions[key] = record
+
+    def _append(self, record: Dict):
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._apply(record)
+
+    @staticmethod
+    def _file_state(file_path: str, offset: int, length: int) -> Dict:
+        stat = os.stat(file_path)
+        return {'file_path': os.path.abspath(file_path), 'file_size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'offset': offset, 'length': length}
+
+    @staticmethod
+    def _matches(record: Optional[Dict], file_path: str, offset: int, length: int) -> bool:
+        if record is None or not os.path.exists(file_path):
+            return False
+        state = TransferJournal._file_state(file_path, offset, length)
+        return all(record.get(key) == value for key, value in state.items())
+
+    def listing(self, bucket_name: str, prefix: str) -> Optional[Dict[str, ObjectInfo]]:
+        """ Get the objects within a prefix that were listed by a previous attempt.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param prefix: the prefix.
+        :return: the objects keyed by name, or None if the prefix has not been listed.
+        """
+
+        return self._listings.get((bucket_name, prefix))
+
+    def record_listing(self, bucket_name: str, prefix: str, objects: Dict[str, ObjectInfo]):
+        """ Record the objects within a prefix.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param prefix: the prefix.
+        :param objects: the objects keyed by name.
+        :return: None.
+        """
+
+        self._append({'event': 'listed', 'bucket': bucket_name, 'prefix': prefix,
+                      'objects': [info.__dict__ for info in objects.values()]})
+
+    def completed(self, bucket_name: str, blob_name: str, file_path: str, offset: int = 0,
+                  length: int = None) -> Optional[str]:
+        """ Get the crc32c checksum of a transfer that a previous attempt completed, provided that the local file has
+        not changed since.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the local file.
+        :param offset: the offset of the byte range of the file that was transferred.
+        :param length: the length of the byte range, defaults to the size of the file.
+        :return: the base64 crc32c checksum, or None if the transfer has not been completed.
+        """
+
+        record = self._completed.get((bucket_name, blob_name))
+        if length is None and os.path.exists(file_path):
+            length = os.path.getsize(file_path)
+        if self._matches(record, file_path, offset, length):
+            return record['crc32c']
+        return None
+
+    def record_completed(self, bucket_name: str, blob_name: str, file_path: str, crc32c: str, offset: int = 0,
+                         length: int = None):
+        """ Record a completed transfer.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the local file.
+        :param crc32c: the base64 crc32c checksum of the transferred bytes.
+        :param offset: the offset of the byte range of the file that was transferred.
+        :param length: the length of the byte range, defaults to the size of the file.
+        :return: None.
+        """
+
+        if length is None:
+            length = os.path.getsize(file_path)
+        record = {'event': 'completed', 'bucket': bucket_name, 'name': blob_name, 'crc32c': crc32c}
+        record.update(self._file_state(file_path, offset, length))
+        self._append(record)
+
+    def session(self, bucket_name: str, blob_name: str, file_path: str, offset: int, length: int) -> Optional[str]:
+        """ Get the resumable upload session that a previous attempt started for a byte range of a file, provided
+        that the local file has not changed since.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the local file.
+        :param offset: the offset of the byte range of the file.
+        :param length: the length of the byte range.
+        :return: the session URI or None.
+        """
+
+        record = self._sessions.get((bucket_name, blob_name))
+        if self._matches(record, file_path, offset, length):
+            return record['session_uri']
+        return None
+
+    def record_session(self, bucket_name: str, blob_name: str, file_path: str, offset: int, length: int,
+                       session_uri: str):
+        """ Record a resumable upload session that was started for a byte range of a file.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the local file.
+        :param offset: the offset of the byte range of the file.
+        :param length: the length of the byte range.
+        :param session_uri: the session URI.
+        :return: None.
+        """
+
+        record = {'event': 'session', 'bucket': bucket_name, 'name': blob_name, 'session_uri': session_uri}
+        record.update(self._file_state(file_path, offset, length))
+        self._append(record)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> 'TransferJournal':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def storage_api_endpoint() -> str:
+    """ Get the endpoint of the Cloud Storage JSON API, which is the emulator set with STORAGE_EMULATOR_HOST if any.
+
+    :return: the endpoint.
+    """
+
+    return os.environ.get('STORAGE_EMULATOR_HOST', 'https://storage.googleapis.com').rstrip('/')
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """ Calculate how long to wait before retrying a request, using exponential backoff with full jitter.
+
+    :param attempt: the number of attempts that have failed so far, starting at 1.
+    :param base: the maximum delay after the first failed attempt in seconds.
+    :param maximum: the maximum delay in seconds.
+    :return: the delay in seconds.
+    """
+
+    return random.uniform(0, min(maximum, base * 2 ** (attempt - 1)))
+
+
+def blob_name_prefixes(blob_names: List[str]) -> Tuple[List[str], List[str]]:
+    """ Find the directory prefixes that need to be listed to find the objects with the given names: the parent
+    directory of each name, leaving out directories that are within another directory of the list. Names that are not
+    within a directory are returned separately, as only a listing of the whole bucket would find them.
+
+    :param blob_names: the names of the objects.
+    :return: the directory prefixes, each ending with a slash, and the names that are not within a directory.
+    """
+
+    prefixes = []
+    for prefix in sorted({name[:name.rindex('/') + 1] for name in blob_names if '/' in name}):
+        # Sorted prefixes that start with an earlier prefix follow it directly
+        if not prefixes or not prefix.startswith(prefixes[-1]):
+            prefixes.append(prefix)
+    return prefixes, [name for name in blob_names if '/' not in name]
+
+
+def read_file_range(file_path: str, offset: int, size: int) -> bytes:
+    """ Read a byte range of a file.
+
+    :param file_path: the path to the file.
+    :param offset: the offset of the first byte of the range.
+    :param size: the number of bytes in the range.
+    :return: the bytes, which are fewer than size when the file ends before the range does.
+    """
+
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def checksum_file_range(file_path: str, offset: int, size: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Crc32cChecksum:
+    """ Compute the CRC32C checksum of a byte range of a file.
+
+    :param file_path: the path to the file.
+    :param offset: the offset of the first byte of the range.
+    :param size: the number of bytes in the range.
+    :param chunk_size: the number of bytes to read at a time.
+    :return: the checksum, which can be updated with the bytes that follow the range.
+    """
+
+    checksum = Crc32cChecksum()
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    return checksum
+
+
+@dataclass
+class ConcurrencyStats:
+    """ The operating point of an AdaptiveConcurrencyLimiter over one measurement window. """
+
+    limit: int
+    in_flight: int
+    throughput: float
+    requests: int
+    errors: int
+    throttled: int
+
+
+class AdaptiveConcurrencyLimiter:
+    """ Limits the number of requests in flight, adapting the limit to the aggregate throughput with AIMD (additive
+    increase, multiplicative decrease), in the style of TCP congestion control.
+
+    Throughput is measured over windows of a fixed duration. After a window in which requests were throttled (429 or
+    503) or failed with other retryable errors, the limit is multiplied by decrease_factor. Otherwise, when the limit
+    was reached during the window and the throughput rose by more than tolerance compared to the previous window, the
+    limit is increased: doubled until the first decrease (slow start) and increased by one after that. When throughput
+    has stopped rising, the limit is held.
+
+    The operating point of each window is logged and passed to an optional metrics hook, and the operating points of
+    the most recent windows are kept in history. When adaptive is False the limit is fixed at max_limit and only the
+    metrics are reported.
+
+    Use it as an async context manager around each request:
+
+        async with limiter:
+            ...
+            limiter.record_bytes(len(chunk))
+    """
+
+    def __init__(self, max_limit: int = DEFAULT_MAX_CONNECTIONS, initial_limit: int = 4, min_limit: int = 1,
+                 adaptive: bool = True, decrease_factor: float = 0.5, tolerance: float = 0.05, window: float = 1.,
+                 metrics_hook: Callable[[ConcurrencyStats], None] = None,
+                 history_size: int = DEFAULT_LIMITER_HISTORY_SIZE):
+        """ Create an AdaptiveConcurrencyLimiter.
+
+        :param max_limit: the maximum number of requests in flight.
+        :param initial_limit: the number of requests in flight allowed at first.
+        :param min_limit: the minimum number of requests in flight.
+        :param adaptive: whether to adapt the limit, otherwise it is fixed at max_limit.
+        :param decrease_factor: the factor that the limit is multiplied by after errors.
+        :param tolerance: the relative rise in throughput between windows that counts as rising.
+        :param window: the duration of a measurement window in seconds.
+        :param metrics_hook: a function that is called with the ConcurrencyStats of each window.
+        :param history_size: the number of most recent windows whose ConcurrencyStats are kept in history.
+        """
+
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.adaptive = adaptive
+        self.limit = float(min(max(initial_limit, self.min_limit), max_limit) if adaptive else max_limit)
+        self.decrease_factor = decrease_factor
+        self.tolerance = tolerance
+        self.window = window
+        self.metrics_hook = metrics_hook
+        self.history: Deque[ConcurrencyStats] = deque(maxlen=history_size)
+        self._slow_start = True
+        self._in_flight = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._last_throughput = 0.
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now: float):
+        self._window_start = now
+        self._bytes = 0
+        self._requests = 0
+        self._errors = 0
+        self._throttled = 0
+        self._saturated = False
+
+    @property
+    def in_flight(self) -> int:
+        """ The number of requests in flight. """
+
+        return self._in_flight
+
+    async def __aenter__(self) -> 'AdaptiveConcurrencyLimiter':
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+            if self._in_flight >= int(self.limit):
+                self._saturated = True
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._in_flight -= 1
+        self._requests += 1
+        self._update()
+        async with self._condition:
+            self._condition.notify_all()
+
+    def record_bytes(self, num_bytes: int):
+        """ Record bytes that were transferred.
+
+        :param num_bytes: the number of bytes.
+        :return: None.
+        """
+
+        self._bytes += num_bytes
+
+    def record_error(self, status: int = None):
+        """ Record a request that failed with a retryable error.
+
+        :param status: the HTTP status code of the response, if any.
+        :return: None.
+        """
+
+        self._errors += 1
+        if status in (429, 503):
+            self._throttled += 1
+
+    def _update(self):
+        """ Adapt the limit and report the operating point when a measurement window has ended.
+
+        :return: None.
+        """
+
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+
+        throughput = self._bytes / elapsed
+        if self.adaptive:
+            if self._errors:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self._slow_start = False
+            elif self._saturated and throughput > self._last_throughput * (1 + self.tolerance):
+                self.limit = min(self.max_limit, self.limit * 2 if self._slow_start else self.limit + 1)
+
+        stats = ConcurrencyStats(limit=int(self.limit), in_flight=self._in_flight, throughput=throughput,
+                                 requests=self._requests, errors=self._errors, throttled=self._throttled)
+        self.history.append(stats)
+        logging.info(f'AdaptiveConcurrencyLimiter: throughput={throughput / 1024 / 1024:.2f}MB/s, '
+                     f'limit={stats.limit}, in_flight={stats.in_flight}, requests={stats.requests}, '
+                     f'errors={stats.errors}, throttled={stats.throttled}')
+        if self.metrics_hook is not None:
+            self.metrics_hook(stats)
+
+        self._last_throughput = throughput
+        self._reset_window(now)
+
+
+class GcsTransferEngine:
+    """ Transfers files to and from Google Cloud Storage with many concurrent requests on a single asyncio event loop.
+
+    The number of requests in flight is bounded by an AdaptiveConcurrencyLimiter, which can adapt the bound to the
+    throughput that is achieved, and connections are pooled and kept alive per host. The number of uploads and
+    downloads in progress is bounded separately, so that transferring many files does not hold a file descriptor and
+    a buffer for each of them. Requests that fail with connection errors, timeouts or retryable HTTP status codes are
+    retried with jittered exponential backoff. File I/O and checksums run in the default executor, so that they don't
+    block the event loop. Large files are transferred as parallel sliced downloads and parallel composite
+    uploads, with CRC32C checksums computed while the data is transferred.
+
+    Use it as an async context manager:
+
+        async with GcsTransferEngine() as engine:
+            await engine.upload_file(bucket_name, blob_name, file_path)
+    """
+
+    def __init__(self, max_connections: int = DEFAULT_MAX_CONNECTIONS, pool_size: int = DEFAULT_POOL_SIZE,
+                 retries: int = 3, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 parallel_upload_threshold: int = DEFAULT_PARALLEL_UPLOAD_THRESHOLD,
+                 parallel_upload_slices: int = DEFAULT_PARALLEL_UPLOAD_SLICES,
+                 parallel_download_threshold: int = DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD,
+                 parallel_download_slices: int = DEFAULT_PARALLEL_DOWNLOAD_SLICES,
+                 backoff_base: float = 1., backoff_max: float = 32., endpoint: str = None,
+                 journal: TransferJournal = None, adaptive_concurrency: bool = False,
+                 metrics_hook: Callable[[ConcurrencyStats], None] = None,
+                 max_transfers: int = DEFAULT_MAX_TRANSFERS):
+        """ Create a GcsTransferEngine.
+
+        :param max_connections: the maximum number of requests in flight at once. With adaptive_concurrency, the upper
+        bound of the number of requests in flight.
+        :param pool_size: the maximum number of connections to each host.
+        :param retries: the number of times to try each request.
+        :param chunk_size: the chunk size to use when uploading a file in multiple parts and when reading responses,
+        must be a multiple of 256 KB.
+        :param parallel_upload_threshold: files of at least this many bytes are uploaded as parallel composite uploads.
+        :param parallel_upload_slices: the number of slices that each parallel composite upload is split into.
+        :param parallel_download_threshold: blobs of at least this many bytes are downloaded as parallel sliced
+        downloads.
+        :param parallel_download_slices: the number of slices that each parallel sliced download is split into.
+        :param backoff_base: the maximum delay after the first failed attempt of a request in seconds.
+        :param backoff_max: the maximum delay between attempts of a request in seconds.
+        :param endpoint: the Cloud Storage JSON API endpoint, defaults to storage_api_endpoint().
+        :param journal: an optional TransferJournal. Transfers and components of composite uploads that it records as
+        completed are skipped, resumable upload sessions that it records are resumed and the progress of new transfers
+        is recorded in it. Components of failed composite uploads are kept so that a retry can reuse them.
+        :param adaptive_concurrency: whether to adapt the number of requests in flight to the throughput, see
+        AdaptiveConcurrencyLimiter.
+        :param metrics_hook: a function that is called with the ConcurrencyStats of each measurement window.
+        :param max_transfers: the maximum number of uploads and downloads in progress at once.
+        """
+
+        self.max_connections = max_connections
+        self.pool_size = pool_size
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.parallel_upload_threshold = parallel_upload_threshold
+        self.parallel_upload_slices = min(parallel_upload_slices, MAX_COMPOSE_COMPONENTS)
+        self.parallel_download_threshold = parallel_download_threshold
+        self.parallel_download_slices = parallel_download_slices
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.endpoint = endpoint if endpoint is not None else storage_api_endpoint()
+        self.journal = journal
+        self.adaptive_concurrency = adaptive_concurrency
+        self.metrics_hook = metrics_hook
+        self.max_transfers = max_transfers
+        self.limiter: Optional[AdaptiveConcurrencyLimiter] = None
+        self._transfers: Optional[asyncio.Semaphore] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._credentials = None
+        self._credentials_lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self) -> 'GcsTransferEngine':
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.pool_size)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.limiter = AdaptiveConcurrencyLimiter(max_limit=self.max_connections, adaptive=self.adaptive_concurrency,
+                                                  metrics_hook=self.metrics_hook)
+        self._credentials_lock = asyncio.Lock()
+        self._transfers = asyncio.Semaphore(self.max_transfers)
+        if 'STORAGE_EMULATOR_HOST' not in os.environ:
+            self._credentials, _ = google.auth.default(scopes=[STORAGE_SCOPE])
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._session.close()
+        self._session = None
+
+    async def _auth_headers(self) -> Dict[str, str]:
+        """ Get the authorization headers for a request, refreshing the access token in a thread when it has expired.
+
+        :return: the headers.
+        """
+
+        headers = {}
+        if self._credentials is not None:
+            async with self._credentials_lock:
+                if not self._credentials.valid:
+                    loop = asyncio.get_event_loop()
+                    await loop.run_in_executor(None, self._credentials.refresh,
+                                               google.auth.transport.requests.Request())
+            self._credentials.apply(headers)
+        return headers
+
+    def _object_url(self, bucket_name: str, blob_name: str, download: bool = False) -> str:
+        prefix = '/download' if download else ''
+        return f'{self.endpoint}{prefix}/storage/v1/b/{quote(bucket_name, safe="")}/o/{quote(blob_name, safe="")}'
+
+    def _upload_url(self, bucket_name: str) -> str:
+        return f'{self.endpoint}/upload/storage/v1/b/{quote(bucket_name, safe="")}/o'
+
+    async def _with_retries(self, description: str, attempt_func: Callable[[], Awaitable]):
+        """ Run one attempt of a request at a time until it succeeds, retrying connection errors, timeouts and
+        retryable HTTP status codes with jittered exponential backoff. Each attempt holds a slot of the engine's
+        concurrency limiter and retryable errors are reported to it.
+
+        :param description: a description of the request for logging.
+        :param attempt_func: a coroutine function that makes one attempt of the request.
+        :return: the result of the successful attempt.
+        """
+
+        for attempt in range(1, self.retries + 1):
+            try:
+                async with self.limiter:
+                    return await attempt_func()
+            except (aiohttp.ClientError, asyncio.TimeoutError, TransferError) as e:
+                if isinstance(e, TransferError) and not e.retryable:
+                    raise
+                self.limiter.record_error(e.status if isinstance(e, TransferError) else None)
+                if attempt == self.retries:
+                    raise
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                logging.warning(f'{description}: retrying after error: try={attempt}, delay={delay:.2f}s, '
+                                f'exception={e}')
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _check_response(response: aiohttp.ClientResponse, ok_statuses: Tuple[int, ...] = (200,)):
+        """ Raise a TransferError when a response does not have one of the expected statuses.
+
+        :param response: the response.
+        :param ok_statuses: the expected statuses.
+        :return: None.
+        """
+
+        if response.status not in ok_statuses:
+            body = await response.text()
+            raise TransferError(f'{response.method} {response.url} failed: status={response.status}, body={body}',
+                                status=response.status, retryable=response.status in RETRYABLE_STATUS_CODES)
+
+    async def list_objects(self, bucket_name: str, prefix: str) -> Dict[str, ObjectInfo]:
+        """ List the objects within a prefixed path.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param prefix: the prefixed path on the bucket.
+        :return: the objects, keyed by name.
+        """
+
+        url = f'{self.endpoint}/storage/v1/b/{quote(bucket_name, safe="")}/o'
+        objects = dict()
+        page_token = None
+        while True:
+            params = {'prefix': prefix, 'fields': 'items(name,size,crc32c,generation),nextPageToken'}
+            if page_token is not None:
+                params['pageToken'] = page_token
+
+            async def attempt():
+                async with self._session.get(url, params=params, headers=await self._auth_headers()) as response:
+                    await self._check_response(response)
+                    return await response.json()
+
+            page = await self._with_retries(f'list_objects {bucket_name}/{prefix}', attempt)
+            for resource in page.get('items', []):
+                info = ObjectInfo.from_resource(resource)
+                objects[info.name] = info
+            page_token = page.get('nextPageToken')
+            if page_token is None:
+                return objects
+
+    async def get_object(self, bucket_name: str, blob_name: str) -> Optional[ObjectInfo]:
+        """ Get the metadata of an object.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :return: the object, or None when it does not exist.
+        """
+
+        params = {'fields': 'name,size,crc32c,generation'}
+
+        async def attempt() -> Optional[ObjectInfo]:
+            async with self._session.get(self._object_url(bucket_name, blob_name), params=params,
+                                         headers=await self._auth_headers()) as response:
+                await self._check_response(response, (200, 404))
+                if response.status == 404:
+                    return None
+                return ObjectInfo.from_resource(await response.json())
+
+        return await self._with_retries(f'get_object {bucket_name}/{blob_name}', attempt)
+
+    async def find_objects(self, bucket_name: str, blob_names: List[str]) -> Dict[str, ObjectInfo]:
+        """ Find the objects with the given names that exist. The parent directories of the names are listed, see
+        blob_name_prefixes, and objects that are not within a directory are fetched one at a time, so that neither the
+        whole bucket nor unrelated directories that share a prefix with the names are listed.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_names: the names of the objects.
+        :return: the objects that exist, keyed by name.
+        """
+
+        prefixes, names = blob_name_prefixes(blob_names)
+        listings = await asyncio.gather(*[self.list_objects(bucket_name, prefix) for prefix in prefixes])
+        infos = await asyncio.gather(*[self.get_object(bucket_name, name) for name in names])
+
+        wanted = set(blob_names)
+        objects = dict()
+        for listing in listings:
+            objects.update({name: info for name, info in listing.items() if name in wanted})
+        objects.update({info.name: info for info in infos if info is not None})
+        return objects
+
+    async def delete_object(self, bucket_name: str, blob_name: str):
+        """ Delete an object, ignoring objects that do not exist.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :return: None.
+        """
+
+        async def attempt():
+            async with self._session.delete(self._object_url(bucket_name, blob_name),
+                                            headers=await self._auth_headers()) as response:
+                await self._check_response(response, (200, 204, 404))
+
+        await self._with_retries(f'delete_object {bucket_name}/{blob_name}', attempt)
+
+    async def _download_range(self, bucket_name: str, info: ObjectInfo, fd: int, offset: int, size: int,
+                              whole: bool) -> int:
+        """ Download a byte range of an object into the same byte range of a file.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param info: the object.
+        :param fd: a file descriptor of the file, opened for writing.
+        :param offset: the offset of the first byte of the range.
+        :param size: the number of bytes in the range.
+        :param whole: whether the range is the whole object, in which case no Range header is sent.
+        :return: the crc32c checksum of the range.
+        """
+
+        url = self._object_url(bucket_name, info.name, download=True)
+        params = {'alt': 'media'}
+        if info.generation is not None:
+            params['generation'] = str(info.generation)
+
+        async def attempt() -> int:
+            loop = asyncio.get_event_loop()
+            headers = await self._auth_headers()
+            if not whole:
+                headers['Range'] = f'bytes={offset}-{offset + size - 1}'
+            writer = FileSliceWriter(fd, offset)
+            async with self._session.get(url, params=params, headers=headers) as response:
+                await self._check_response(response, (200,) if whole else (206,))
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    await loop.run_in_executor(None, writer.write, chunk)
+                    self.limiter.record_bytes(len(chunk))
+            if writer.tell() != size:
+                raise TransferError(f'Downloaded {writer.tell()} bytes of {info.name}, expected {size}',
+                                    retryable=True)
+            return writer.crc32c
+
+        return await self._with_retries(f'download {bucket_name}/{info.name} bytes={offset}+{size}', attempt)
+
+    async def download_object(self, bucket_name: str, info: ObjectInfo, file_path: str) -> bool:
+        """ Download an object to a file. Objects of at least parallel_download_threshold bytes are downloaded as
+        parallel sliced downloads: the file is preallocated and byte ranges are fetched concurrently and written to
+        their positions in the file. The CRC32C checksum of the file is computed while it is written and checked
+        against the checksum of the object.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param info: the object, see list_objects.
+        :param file_path: the file path where the object should be saved.
+        :return: whether the download was successful or not.
+        """
+
+        func_name = self.download_object.__name__
+
+        if self.journal is not None and info.crc32c is not None and \
+                self.journal.completed(bucket_name, info.name, file_path) == info.crc32c:
+            logging.info(f'{func_name}: already downloaded according to the transfer journal: blob_name={info.name}')
+            return True
+
+        slices = self.parallel_download_slices if info.size >= self.parallel_download_threshold else 1
+        ranges = split_byte_ranges(info.size, slices) if info.size > 0 else []
+
+        # The file is only opened once a transfer slot is free, so that waiting downloads don't hold file descriptors
+        async with self._transfers:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+                fd = os.open(file_path, os.O_WRONLY | os.O_CREAT, 0o666)
+            except OSError as e:
+                logging.error(f'{func_name}: download failed: bucket_name={bucket_name}, blob_name={info.name}, '
+                              f'file_path={file_path}, exception={e}')
+                return False
+
+            try:
+                os.ftruncate(fd, info.size)
+                crcs = await asyncio.gather(*[self._download_range(bucket_name, info, fd, offset, size,
+                                                                   len(ranges) == 1)
+                                              for offset, size in ranges])
+            except (aiohttp.ClientError, asyncio.TimeoutError, TransferError, OSError) as e:
+                logging.error(f'{func_name}: download failed: bucket_name={bucket_name}, blob_name={info.name}, '
+                              f'file_path={file_path}, exception={e}')
+                return False
+            finally:
+                os.close(fd)
+
+        actual_hash = crc32c_to_base64_str(crc32c_combine_all(crcs, [size for _, size in ranges]) if crcs else 0)
+        files_match = info.crc32c is None or info.crc32c == actual_hash
+        logging.info(f'{func_name}: blob_name={info.name}, slices={len(ranges)}, files_match={files_match}, '
+                     f'expected_hash={info.crc32c}, actual_hash={actual_hash}')
+        if files_match:
+            update_checksum_index(file_path, actual_hash)
+            if self.journal is not None:
+                self.journal.record_completed(bucket_name, info.name, file_path, actual_hash)
+        return files_match
+
+    async def _upload_multipart(self, bucket_name: str, blob_name: str, file_path: str, offset: int, size: int,
+                                content_type: str) -> Tuple[Dict, int]:
+        """ Upload a byte range of a file as an object in a single multipart request. The range is read by each
+        attempt once it holds a slot of the concurrency limiter, so that uploads waiting for a slot don't hold their
+        data in memory.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the file.
+        :param offset: the offset of the first byte of the range.
+        :param size: the number of bytes in the range.
+        :param content_type: the content type of the object.
+        :return: the object resource and the crc32c checksum of the bytes that were sent.
+        """
+
+        boundary = uuid.uuid4().hex
+        metadata = json.dumps({'name': blob_name, 'contentType': content_type}).encode('utf-8')
+        head = b''.join([f'--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'.encode('utf-8'),
+                         metadata, f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n\r\n'.encode('utf-8')])
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+        def read_body() -> Tuple[bytes, int]:
+            data = read_file_range(file_path, offset, size)
+            if len(data) != size:
+                raise TransferError(f'Read {len(data)} bytes of {file_path}, expected {size}')
+            return b''.join([head, data, tail]), int.from_bytes(Crc32cChecksum(data).digest(), 'big')
+
+        async def attempt() -> Tuple[Dict, int]:
+            body, crc = await asyncio.get_event_loop().run_in_executor(None, read_body)
+            headers = await self._auth_headers()
+            headers['Content-Type'] = f'multipart/related; boundary={boundary}'
+            async with self._session.post(self._upload_url(bucket_name), params={'uploadType': 'multipart'},
+                                          data=body, headers=headers) as response:
+                await self._check_response(response)
+                self.limiter.record_bytes(size)
+                return await response.json(), crc
+
+        return await self._with_retries(f'upload {bucket_name}/{blob_name}', attempt)
+
+    async def start_resumable_upload(self, bucket_name: str, blob_name: str, content_type: str) -> str:
+        """ Start a resumable upload session.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param content_type: the content type of the object.
+        :return: the session URI.
+        """
+
+        async def attempt() -> str:
+            headers = await self._auth_headers()
+            headers['X-Upload-Content-Type'] = content_type
+            async with self._session.post(self._upload_url(bucket_name), params={'uploadType': 'resumable'},
+                                          json={'name': blob_name, 'contentType': content_type},
+                                          headers=headers) as response:
+                await self._check_response(response)
+                return response.headers['Location']
+
+        return await self._with_retries(f'start resumable upload {bucket_name}/{blob_name}', attempt)
+
+    @staticmethod
+    def _committed_offset(response: aiohttp.ClientResponse) -> int:
+        """ Get the number of bytes that a resumable upload session has committed from a 308 response.
+
+        :param response: the response.
+        :return: the number of bytes committed.
+        """
+
+        match = re.match(r'bytes=0-(\d+)', response.headers.get('Range', ''))
+        return int(match.group(1)) + 1 if match else 0
+
+    async def query_resumable_upload(self, session_uri: str, total: int) -> Tuple[int, Optional[Dict]]:
+        """ Query how many bytes a resumable upload session has committed.
+
+        :param session_uri: the session URI.
+        :param total: the size of the object in bytes.
+        :return: the number of bytes committed and the object resource if the upload is complete.
+        """
+
+        async def attempt() -> Tuple[int, Optional[Dict]]:
+            headers = await self._auth_headers()
+            headers['Content-Range'] = f'bytes */{total}'
+            async with self._session.put(session_uri, headers=headers) as response:
+                await self._check_response(response, (200, 201, 308))
+                if response.status == 308:
+                    return self._committed_offset(response), None
+                return total, await response.json()
+
+        return await self._with_retries(f'query resumable upload {session_uri}', attempt)
+
+    async def _upload_resumable(self, blob_name: str, session_uri: str, file_path: str, offset: int, size: int,
+                                committed: int = 0) -> Tuple[Dict, int]:
+        """ Upload a byte range of a file in chunks to a resumable upload session. When a chunk fails, the number of
+        bytes committed by the session is queried and the upload continues from there.
+
+        :param blob_name: the name of the object.
+        :param session_uri: the session URI.
+        :param file_path: the path to the file.
+        :param offset: the offset of the first byte of the range.
+        :param size: the number of bytes in the range.
+        :param committed: the number of bytes already committed by the session.
+        :return: the object resource and the crc32c checksum of the range.
+        """
+
+        func_name = self._upload_resumable.__name__
+        loop = asyncio.get_event_loop()
+
+        # Bytes committed before this call were sent by an earlier attempt, so they are checksummed from the file. The
+        # bytes sent from here on are checksummed as the session commits them.
+        checksum = await loop.run_in_executor(None, checksum_file_range, file_path, offset, committed,
+                                              self.chunk_size)
+        hashed = committed
+        data, start = b'', committed
+
+        async def commit(position: int):
+            nonlocal hashed
+            if not hashed <= position <= start + len(data):
+                raise TransferError(f'Resumable upload of {blob_name} committed {position} bytes, expected between '
+                                    f'{hashed} and {start + len(data)}')
+            await loop.run_in_executor(None, checksum.update, data[hashed - start:position - start])
+            hashed = position
+
+        failures = 0
+        while True:
+            headers = await self._auth_headers()
+            try:
+                async with self.limiter:
+                    start = committed
+                    data = await loop.run_in_executor(None, read_file_range, file_path, offset + start,
+                                                      min(self.chunk_size, size - start))
+                    end = start + len(data)
+                    headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}' if data else f'bytes */{size}'
+                    async with self._session.put(session_uri, data=data, headers=headers) as response:
+                        await self._check_response(response, (200, 201, 308))
+                        self.limiter.record_bytes(len(data))
+                        if response.status == 308:
+                            committed = self._committed_offset(response)
+                            await commit(committed)
+                            continue
+                        resource = await response.json()
+                await commit(size)
+                return resource, int.from_bytes(checksum.digest(), 'big')
+            except (aiohttp.ClientError, asyncio.TimeoutError, TransferError) as e:
+                failures += 1
+                if isinstance(e, TransferError) and not e.retryable:
+                    raise
+                self.limiter.record_error(e.status if isinstance(e, TransferError) else None)
+                if failures >= self.retries:
+                    raise
+                delay = backoff_delay(failures, self.backoff_base, self.backoff_max)
+                logging.warning(f'{func_name}: retrying chunk of {blob_name} after error: try={failures}, '
+                                f'delay={delay:.2f}s, exception={e}')
+                await asyncio.sleep(delay)
+                committed, resource = await self.query_resumable_upload(session_uri, size)
+                await commit(committed)
+                if resource is not None:
+                    return resource, int.from_bytes(checksum.digest(), 'big')
+
+    async def _upload_range(self, bucket_name: str, blob_name: str, file_path: str, offset: int, size: int,
+                            content_type: str) -> Tuple[Dict, int]:
+        """ Upload a byte range of a file as an object, with a single multipart request when the range fits in one
+        chunk and with a resumable upload otherwise.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the file.
+        :param offset: the offset of the first byte of the range.
+        :param size: the number of bytes in the range.
+        :param content_type: the content type of the object.
+        :return: the object resource and the crc32c checksum of the range.
+        """
+
+        if size <= self.chunk_size:
+            return await self._upload_multipart(bucket_name, blob_name, file_path, offset, size, content_type)
+
+        # Resume the session of a previous attempt, unless it has expired
+        if self.journal is not None:
+            session_uri = self.journal.session(bucket_name, blob_name, file_path, offset, size)
+            if session_uri is not None:
+                try:
+                    committed, resource = await self.query_resumable_upload(session_uri, size)
+                    logging.info(f'_upload_range: resuming upload of {blob_name} from byte {committed}')
+                    return await self._upload_resumable(blob_name, session_uri, file_path, offset, size,
+                                                        committed=committed)
+                except TransferError as e:
+                    if e.status not in (404, 410):
+                        raise
+                    logging.info(f'_upload_range: resumable upload session of {blob_name} has expired: {e}')
+
+        session_uri = await self.start_resumable_upload(bucket_name, blob_name, content_type)
+        if self.journal is not None:
+            self.journal.record_session(bucket_name, blob_name, file_path, offset, size, session_uri)
+        return await self._upload_resumable(blob_name, session_uri, file_path, offset, size)
+
+    async def _upload_component(self, bucket_name: str, blob_name: str, file_path: str, offset: int, size: int,
+                                content_type: str) -> int:
+        """ Upload a byte range of a file as a component of a composite upload, skipping components that the journal
+        records as uploaded.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the component object.
+        :param file_path: the path to the file.
+        :param offset: the offset of the first byte of the range.
+        :param size: the number of bytes in the range.
+        :param content_type: the content type of the object.
+        :return: the crc32c checksum of the range.
+        """
+
+        if self.journal is not None:
+            crc32c = self.journal.completed(bucket_name, blob_name, file_path, offset, size)
+            if crc32c is not None:
+                return int.from_bytes(base64.b64decode(crc32c), 'big')
+
+        resource, crc = await self._upload_range(bucket_name, blob_name, file_path, offset, size, content_type)
+        actual_hash = crc32c_to_base64_str(crc)
+        if resource.get('crc32c') != actual_hash:
+            raise TransferError(f'checksum mismatch for component {blob_name}: expected_hash={resource.get("crc32c")}, '
+                                f'actual_hash={actual_hash}')
+        if self.journal is not None:
+            self.journal.record_completed(bucket_name, blob_name, file_path, actual_hash, offset, size)
+        return crc
+
+    async def compose_objects(self, bucket_name: str, blob_name: str, source_names: List[str],
+                              content_type: str) -> Dict:
+        """ Compose objects into a new object.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the composed object.
+        :param source_names: the names of the objects to compose, at most MAX_COMPOSE_COMPONENTS.
+        :param content_type: the content type of the composed object.
+        :return: the object resource.
+        """
+
+        request = {'sourceObjects': [{'name': name} for name in source_names],
+                   'destination': {'contentType': content_type}}
+
+        async def attempt() -> Dict:
+            async with self._session.post(f'{self._object_url(bucket_name, blob_name)}/compose', json=request,
+                                          headers=await self._auth_headers()) as response:
+                await self._check_response(response)
+                return await response.json()
+
+        return await self._with_retries(f'compose {bucket_name}/{blob_name}', attempt)
+
+    async def upload_file(self, bucket_name: str, blob_name: str, file_path: str) -> bool:
+        """ Upload a file as an object. Files of at least parallel_upload_threshold bytes are uploaded as parallel
+        composite uploads: byte ranges are uploaded concurrently as temporary component objects, which are composed
+        into the object and then deleted. The CRC32C checksum of the file is computed while it is read and checked
+        against the checksum of the uploaded object.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the file.
+        :return: whether the upload was successful or not.
+        """
+
+        func_name = self.upload_file.__name__
+
+        if self.journal is not None and self.journal.completed(bucket_name, blob_name, file_path) is not None:
+            logging.info(f'{func_name}: already uploaded according to the transfer journal: blob_name={blob_name}')
+            return True
+
+        # The file is only read once a transfer slot is free
+        async with self._transfers:
+            return await self._upload_file(bucket_name, blob_name, file_path)
+
+    async def _upload_file(self, bucket_name: str, blob_name: str, file_path: str) -> bool:
+        """ Upload a file as an object, see upload_file.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the object.
+        :param file_path: the path to the file.
+        :return: whether the upload was successful or not.
+        """
+
+        func_name = self.upload_file.__name__
+
+        size = os.path.getsize(file_path)
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        slices = self.parallel_upload_slices if size >= self.parallel_upload_threshold else 1
+        ranges = split_byte_ranges(size, slices) if size > 0 else [(0, 0)]
+        component_names = [f'{blob_name}.component{i:02d}' for i in range(len(ranges))] if len(ranges) > 1 else []
+
+        success = False
+        try:
+            if component_names:
+                crcs = await asyncio.gather(*[self._upload_component(bucket_name, name, file_path, offset, length,
+                                                                     content_type)
+                                              for name, (offset, length) in zip(component_names, ranges)])
+                crc = crc32c_combine_all(crcs, [length for _, length in ranges])
+                resource = await self.compose_objects(bucket_name, blob_name, component_names, content_type)
+            else:
+                resource, crc = await self._upload_range(bucket_name, blob_name, file_path, 0, size, content_type)
+        except (aiohttp.ClientError, asyncio.TimeoutError, TransferError, OSError) as e:
+            logging.error(f'{func_name}: upload failed: bucket_name={bucket_name}, blob_name={blob_name}, '
+                          f'file_path={file_path}, exception={e}')
+            return False
+        else:
+            success = True
+        finally:
+            # With a journal, the components of a failed upload are kept so that a retry can reuse them
+            if component_names and (success or self.journal is None):
+                await asyncio.gather(*[self.delete_object(bucket_name, name) for name in component_names],
+                                     return_exceptions=True)
+
+        actual_hash = crc32c_to_base64_str(crc)
+        files_match = resource.get('crc32c') == actual_hash
+        logging.info(f'{func_name}: blob_name={blob_name}, slices={len(ranges)}, files_match={files_match}, '
+                     f'expected_hash={resource.get("crc32c")}, actual_hash={actual_hash}')
+        if files_match:
+            update_checksum_index(file_path, actual_hash)
+            if self.journal is not None:
+                self.journal.record_completed(bucket_name, blob_name, file_path, actual_hash)
+        return files_match
+
+
+async def transfer_all(transfers: List[Tuple[str, Awaitable[bool]]], func_name: str) -> bool:
+    """ Run transfers concurrently, logging whether each one succeeded.
+
+    :param transfers: (message, transfer coroutine) pairs.
+    :param func_name: the name of the calling function, for logging.
+    :return: whether all transfers succeeded.
+    """
+
+    async def run(msg: str, transfer: Awaitable[bool]) -> bool:
+        success = await transfer
+        if success:
+            logging.info(f'{func_name}: success, {msg}')
+        else:
+            logging.info(f'{func_name}: failed, {msg}')
+        return success
+
+    results = await asyncio.gather(*[run(msg, transfer) for msg, transfer in transfers])
+    return all(results)
@@ -14,77 +14,395 @@
 
 # Author: James Diprose
 
-import codecs
+import asyncio
+import atexit
+import datetime
+import hashlib
+import io
 import json
 import logging
-import multiprocessing
+import mimetypes
 import os
+import queue
 import re
-import subprocess
+import threading
 import time
-from concurrent.futures import as_completed, ProcessPoolExecutor
+import zlib
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
 from multiprocessing import BoundedSemaphore, cpu_count
-from subprocess import Popen
-from typing import List, Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import google.auth
 import pendulum
-from google_crc32c import Checksum as Crc32cChecksum
-from google.api_core.exceptions import Conflict, BadRequest
+import requests
+from google.api_core.exceptions import Conflict, BadRequest, GoogleAPICallError
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage, bigquery
 from google.cloud.bigquery import SourceFormat, LoadJobConfig, LoadJob, QueryJob
 from google.cloud.exceptions import NotFound
 from google.cloud.storage import Blob
+from google_crc32c import Checksum as Crc32cChecksum
 from googleapiclient import discovery as gcp_api
 from pendulum import Pendulum
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ChunkedEncodingError
 
-from observatory.platform.utils.proc_utils import wait_for_process
+# The BigQuery Storage Read API and Arrow are optional, install them with pip install observatory-platform[bigquery]
+try:
+    import pyarrow
+    from google.cloud import bigquery_storage_v1
+except ImportError:
+    pyarrow = None
+    bigquery_storage_v1 = None
+
+from observatory.platform.utils.bigquery_telemetry import (BigQueryTelemetrySink, DEFAULT_TELEMETRY_BATCH_SIZE,
+                                                          JobRecord, JsonlTelemetrySink, TELEMETRY_DATASET_ENV,
+                                                          TELEMETRY_FILE_ENV, TELEMETRY_TABLE_ID, TelemetryRecorder)
+from observatory.platform.utils.file_utils import (crc32c_base64_hash, crc32c_combine, crc32c_combine_all,
+                                                   crc32c_to_base64_str, FileSlice, FileSliceWriter, gzip_file_crc,
+                                                   hex_to_base64_str, indexed_crc32c_base64_hash, open_checksummed,
+                                                   split_byte_ranges, update_checksum_index)
+from observatory.platform.utils.gc_transfer import (ConcurrencyStats, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CONNECTIONS,
+                                                    DEFAULT_MAX_TRANSFERS, DEFAULT_POOL_SIZE,
+                                                    DEFAULT_PARALLEL_DOWNLOAD_SLICES,
+                                                    DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD,
+                                                    DEFAULT_PARALLEL_UPLOAD_SLICES, DEFAULT_PARALLEL_UPLOAD_THRESHOLD,
+                                                    GcsTransferEngine, MAX_COMPOSE_COMPONENTS, ObjectInfo,
+                                                    RETRYABLE_STATUS_CODES, STORAGE_SCOPE, TransferError,
+                                                    TransferJournal,
+                                                    backoff_delay, storage_api_endpoint, transfer_all)
+
+# The Cloud Storage clients that have been created, one per process, see storage_client.
+_storage_clients = dict()
+_storage_clients_lock = threading.Lock()
+_storage_pool_size = DEFAULT_POOL_SIZE
+
+# The HTTP sessions for requests to the Cloud Storage JSON API that have been created, one per process, see
+# storage_session.
+_storage_sessions: Dict[int, requests.Session] = dict()
+
+# The BigQuery clients that have been created, keyed by process id, project id and location, and the authorized HTTP
+# session that the clients of each process share, see bigquery_client.
+_bigquery_clients: Dict[Tuple[int, Optional[str], Optional[str]], bigquery.Client] = dict()
+_bigquery_sessions: Dict[int, Tuple[AuthorizedSession, Optional[str]]] = dict()
+_bigquery_clients_lock = threading.Lock()
+_bigquery_pool_size = DEFAULT_POOL_SIZE
+
+# The BigQuery Storage Read API clients that have been created, one per process, see bigquery_read_client.
+_bigquery_read_clients = dict()
+
+# The tables of each dataset that have been listed, keyed by project id and dataset id, with the time that they were
+# listed, see bigquery_dataset_tables.
+_dataset_tables: Dict[Tuple[str, str], Tuple[float, Dict[str, bigquery.table.TableListItem]]] = dict()
+_dataset_tables_lock = threading.Lock()
+
+# The recorder of the telemetry of BigQuery jobs of each process, None when telemetry is off, see bigquery_telemetry.
+_bigquery_telemetry: Dict[int, Optional[TelemetryRecorder]] = dict()
+
+# The number of seconds that the tables of a dataset are cached for before they are listed again.
+DEFAULT_TABLE_METADATA_TTL = 300.
+
+# The maximum number of parallel streams that stream_bigquery_query reads a query result with.
+DEFAULT_READ_STREAMS = 8
+
+# The number of rows per page that stream_bigquery_query reads when it falls back to the REST API.
+DEFAULT_QUERY_PAGE_SIZE = 10000
+
+# The actions that create_bigquery_table_from_query can take when a query is estimated to process more bytes than its
+# budget: fail before running the query, or log a warning and run it.
+BUDGET_ACTION_FAIL = 'fail'
+BUDGET_ACTION_WARN = 'warn'
+
+
+# How the releases of a table are stored in BigQuery, the STORAGE_MODE of each telescope: as one date sharded table
+# per release, e.g. unpaywall20201006, or as one ingestion-time partitioned table with a partition per release,
+# written through partition decorators, e.g. unpaywall_partitioned$20201006, with a view per release that keeps
+# queries of the date sharded table names working. See load_bigquery_release_table and bigquery_release_table_id.
+# Existing date sharded tables are moved to a partitioned table with bigquery_partitions.migrate_shards_to_partitions.
+STORAGE_MODE_SHARDED = 'sharded'
+STORAGE_MODE_PARTITIONED = 'partitioned'
+
+# The suffix of the name of the partitioned table of a table in STORAGE_MODE_PARTITIONED. The partitioned table lives
+# next to the date sharded tables, so its name must not match wildcard queries over the shards, e.g. unpaywall2*.
+PARTITIONED_TABLE_SUFFIX = '_partitioned'
+
+# The label of a table created by create_bigquery_table_from_query that records the fingerprint of the query inputs.
+INPUT_FINGERPRINT_LABEL = 'input_fingerprint'
+
+# The maximum number of referenced tables that a dry run lists, queries that reference more can't be fingerprinted.
+MAX_REFERENCED_TABLES = 50
+
+
+@dataclass
+class BytesBudget:
+    """ The maximum number of bytes that a query is expected to process.
+
+    :param max_bytes: the maximum number of bytes.
+    :param action: what to do when a dry run estimates that the query will process more bytes, BUDGET_ACTION_FAIL or
+    BUDGET_ACTION_WARN.
+    """
+
+    max_bytes: int
+    action: str = BUDGET_ACTION_FAIL
+
+
+def make_storage_client(pool_size: int = DEFAULT_POOL_SIZE) -> storage.Client:
+    """ Make a Cloud Storage client with an HTTP connection pool of a given size.
+
+    When the STORAGE_EMULATOR_HOST environment variable is set, the client talks to the emulator anonymously.
+
+    :param pool_size: the maximum number of HTTP connections that the client keeps open.
+    :return: the client.
+    """
+
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+        client = storage.Client(project=os.environ.get('GOOGLE_CLOUD_PROJECT'), credentials=AnonymousCredentials())
+    else:
+        client = storage.Client()
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    client._http.mount('https://', adapter)
+    client._http.mount('http://', adapter)
+    return client
+
+
+def init_storage_client(pool_size: int = DEFAULT_POOL_SIZE) -> None:
+    """ Initialise the Cloud Storage client for the current process. Used as the initializer of the process pools
+    that transfer files, so that each worker authenticates and opens its connection pool once, rather than once per
+    blob.
+
+    :param pool_size: the maximum number of HTTP connections that the client keeps open.
+    :return: None.
+    """
+
+    global _storage_pool_size
+
+    with _storage_clients_lock:
+        _storage_pool_size = pool_size
+        _storage_clients[os.getpid()] = make_storage_client(pool_size)
+
+
+def storage_client() -> storage.Client:
+    """ Get the Cloud Storage client for the current process, creating it if it doesn't exist yet.
+
+    Clients are kept per process id because a client's connection pool must not be shared with a forked child
+    process.
+
+    :return: the client.
+    """
+
+    pid = os.getpid()
+    with _storage_clients_lock:
+        client = _storage_clients.get(pid)
+        if client is None:
+            client = make_storage_client(_storage_pool_size)
+            _storage_clients[pid] = client
+    return client
+
+
+def make_storage_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """ Make an HTTP session for requests to the Cloud Storage JSON API, authorized with the application default
+    credentials, with an HTTP connection pool of a given size.
+
+    When the STORAGE_EMULATOR_HOST environment variable is set, the session talks to the emulator anonymously.
+
+    :param pool_size: the maximum number of HTTP connections that the session keeps open.
+    :return: the session.
+    """
+
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+        session = requests.Session()
+    else:
+        credentials, _ = google.auth.default(scopes=[STORAGE_SCOPE])
+        session = AuthorizedSession(credentials)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def storage_session() -> requests.Session:
+    """ Get the HTTP session for requests to the Cloud Storage JSON API of the current process, creating it if it
+    doesn't exist yet. Sessions are kept per process id, like the clients of storage_client.
+
+    :return: the session.
+    """
+
+    pid = os.getpid()
+    with _storage_clients_lock:
+        session = _storage_sessions.get(pid)
+        if session is None:
+            session = make_storage_session(_storage_pool_size)
+            _storage_sessions[pid] = session
+    return session
+
+
+def make_bigquery_session(pool_size: int = DEFAULT_POOL_SIZE) -> Tuple[AuthorizedSession, Optional[str]]:
+    """ Make an authorized HTTP session for BigQuery clients from the application default credentials, with an HTTP
+    connection pool of a given size.
+
+    :param pool_size: the maximum number of HTTP connections that the session keeps open.
+    :return: the session and the default project id of the credentials.
+    """
+
+    credentials, project_id = google.auth.default(scopes=bigquery.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session, project_id
+
+
+def init_bigquery_clients(pool_size: int = DEFAULT_POOL_SIZE) -> None:
+    """ Discard the BigQuery clients of the current process, so that new clients are created with an HTTP connection
+    pool of a given size.
+
+    :param pool_size: the maximum number of HTTP connections that the clients of the process keep open.
+    :return: None.
+    """
+
+    global _bigquery_pool_size
+
+    pid = os.getpid()
+    with _bigquery_clients_lock:
+        _bigquery_pool_size = pool_size
+        _bigquery_sessions.pop(pid, None)
+        _bigquery_read_clients.pop(pid, None)
+        for key in [key for key in _bigquery_clients.keys() if key[0] == pid]:
+            del _bigquery_clients[key]
+
 
-# The chunk size to use when uploading / downloading a blob in multiple parts, must be a multiple of 256 KB.
-DEFAULT_CHUNK_SIZE = 256 * 1024 * 4
+def bigquery_client(project_id: str = None, location: str = None) -> bigquery.Client:
+    """ Get the BigQuery client of the current process for a project and location, creating it if it doesn't exist
+    yet.
 
+    The clients of a process share one authorized HTTP session, so the application default credentials are discovered
+    and refreshed once and connections are kept alive between calls. Clients are kept per process id because a
+    connection pool must not be shared with a forked child process.
 
-def gzip_file_crc(file_path: str) -> str:
-    """ Get the crc of a gzip file.
+    :param project_id: the Google Cloud project id, defaults to the project of the application default credentials.
+    :param location: the default location of the jobs that the client runs.
+    :return: the client.
+    """
+
+    pid = os.getpid()
+    key = (pid, project_id, location)
+    with _bigquery_clients_lock:
+        client = _bigquery_clients.get(key)
+        if client is None:
+            if pid not in _bigquery_sessions:
+                _bigquery_sessions[pid] = make_bigquery_session(_bigquery_pool_size)
+            session, default_project_id = _bigquery_sessions[pid]
+            client = bigquery.Client(project=project_id or default_project_id, credentials=session.credentials,
+                                     _http=session, location=location)
+            _bigquery_clients[key] = client
+    return client
+
+
+def bigquery_read_client() -> Optional['bigquery_storage_v1.BigQueryReadClient']:
+    """ Get the BigQuery Storage Read API client of the current process, creating it if it doesn't exist yet. The
+    client uses the credentials of the session that the BigQuery clients of the process share.
+
+    :return: the client, or None if the BigQuery Storage package isn't installed.
+    """
 
-    :param file_path: the path to the file.
-    :return: the crc.
+    if bigquery_storage_v1 is None:
+        return None
+
+    pid = os.getpid()
+    with _bigquery_clients_lock:
+        client = _bigquery_read_clients.get(pid)
+        if client is None:
+            if pid not in _bigquery_sessions:
+                _bigquery_sessions[pid] = make_bigquery_session(_bigquery_pool_size)
+            session, _ = _bigquery_sessions[pid]
+            client = bigquery_storage_v1.BigQueryReadClient(credentials=session.credentials)
+            _bigquery_read_clients[pid] = client
+    return client
+
+
+def init_bigquery_telemetry(sink=None,
+                            batch_size: int = DEFAULT_TELEMETRY_BATCH_SIZE) -> Optional[TelemetryRecorder]:
+    """ Configure where the current process records the telemetry of the BigQuery jobs that the helpers in this module
+    run, see record_bigquery_job. Without a sink, the BIGQUERY_TELEMETRY_FILE environment variable selects a local
+    JSON Lines file and the BIGQUERY_TELEMETRY_DATASET environment variable, as project_id.dataset_id, selects a
+    BigQuery dataset. When neither is set, telemetry is off.
+
+    Buffered records are written when a batch is full and when flush_bigquery_telemetry is called, which the helpers
+    in this module and BigQueryJobManager.run do once their jobs have finished. They are also written when the
+    process exits normally, but not when it leaves through os._exit, as Airflow task processes do.
+
+    :param sink: the sink to write records to, e.g. a JsonlTelemetrySink or BigQueryTelemetrySink.
+    :param batch_size: the number of records that are buffered before they are written.
+    :return: the recorder, None when telemetry is off.
     """
 
-    proc: Popen = subprocess.Popen(['gzip', '-vl', file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, error = wait_for_process(proc)
-    return output.splitlines()[1].split(' ')[1].strip()
+    if sink is None:
+        file_path = os.environ.get(TELEMETRY_FILE_ENV)
+        dataset = os.environ.get(TELEMETRY_DATASET_ENV)
+        if file_path:
+            sink = JsonlTelemetrySink(file_path)
+        elif dataset:
+            project_id, dataset_id = dataset.split('.')
+            sink = BigQueryTelemetrySink(bigquery_client(project_id), f'{project_id}.{dataset_id}.{TELEMETRY_TABLE_ID}')
 
+    recorder = None
+    if sink is not None:
+        recorder = TelemetryRecorder(sink, batch_size=batch_size)
+        atexit.register(recorder.flush)
 
-def hex_to_base64_str(hex_str: bytes) -> str:
-    """ Covert a hexadecimal string into a base64 encoded string. Removes trailing newline character.
+    previous = _bigquery_telemetry.get(os.getpid())
+    if previous is not None:
+        previous.flush()
+    _bigquery_telemetry[os.getpid()] = recorder
+    return recorder
 
-    :param hex_str: the hexadecimal encoded string.
-    :return: the base64 encoded string.
+
+def bigquery_telemetry() -> Optional[TelemetryRecorder]:
+    """ Get the telemetry recorder of the current process, configuring it from the environment if it hasn't been
+    configured yet, see init_bigquery_telemetry.
+
+    :return: the recorder, None when telemetry is off.
     """
 
-    string = codecs.decode(hex_str, 'hex')
-    base64 = codecs.encode(string, 'base64')
-    return base64.decode('utf8').rstrip('\n')
+    pid = os.getpid()
+    if pid not in _bigquery_telemetry:
+        init_bigquery_telemetry()
+    return _bigquery_telemetry[pid]
 
 
-def crc32c_base64_hash(file_path: str, chunk_size: int = 8 * 1024) -> str:
-    """ Create a base64 crc32c checksum of a file.
+def flush_bigquery_telemetry() -> None:
+    """ Write the buffered telemetry records of the current process, if telemetry is on. Telemetry never fails the
+    caller, errors are logged.
 
-    :param file_path: the path to the file.
-    :param chunk_size: the size of each chunk to check.
-    :return: the checksum.
+    :return: None.
     """
 
-    hash_alg = Crc32cChecksum()
+    recorder = _bigquery_telemetry.get(os.getpid())
+    if recorder is not None:
+        recorder.flush()
+
 
-    with open(file_path, 'rb') as f:
-        chunk = f.read(chunk_size)
-        while chunk:
-            hash_alg.update(chunk)
-            chunk = f.read(chunk_size)
-    return hex_to_base64_str(hash_alg.hexdigest())
+def record_bigquery_job(job, template: str = None) -> None:
+    """ Record the telemetry of a finished BigQuery job: its ids, the Airflow DAG and task that ran it, the bytes that
+    it processed and was billed for, the slot milliseconds that it used, its duration and whether it was a cache hit.
+    Telemetry never fails the caller, errors are logged.
+
+    :param job: the job.
+    :param template: the name of the SQL template that the query was made from.
+    :return: None.
+    """
+
+    try:
+        recorder = bigquery_telemetry()
+        if recorder is not None:
+            recorder.record(JobRecord.from_job(job, template=template))
+    except Exception as e:
+        logging.warning(f'record_bigquery_job: could not record job {job.job_id}: {e}')
 
 
 def table_name_from_blob(blob_name: str, file_extension: str):
@@ -112,26 +430,116 @@ class TransferStatus(Enum):
     failed = 'FAILED'
 
 
-def bigquery_table_exists(project_id: str, dataset_id: str, table_name: str) -> bool:
-    """ Checks whether a BigQuery table exists or not.
+def bigquery_dataset_tables(project_id: str, dataset_id: str,
+                            ttl: float = DEFAULT_TABLE_METADATA_TTL) -> Dict[str, bigquery.table.TableListItem]:
+    """ Get the tables of a BigQuery dataset. The tables are listed with one paginated tables.list request and cached
+    for ttl seconds, so that existence checks and table suffix lookups on the same dataset don't each make a request.
+    The helpers in this module that create tables clear the cache of the dataset, see
+    invalidate_bigquery_dataset_tables.
 
     :param project_id: the Google Cloud project id.
     :param dataset_id: the BigQuery dataset id.
-    :param table_name: the name of the table.
-    :return: whether the table exists or not.
+    :param ttl: the maximum age in seconds of cached tables, 0 to always list the tables.
+    :return: the tables keyed by table id, empty if the dataset doesn't exist.
     """
 
-    client = bigquery.Client(project_id)
-    dataset = bigquery.Dataset(f'{project_id}.{dataset_id}')
-    table = dataset.table(table_name)
-    table_exists = True
+    key = (project_id, dataset_id)
+    now = time.monotonic()
+    with _dataset_tables_lock:
+        cached = _dataset_tables.get(key)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1]
 
+    client = bigquery_client(project_id)
     try:
-        client.get_table(table)
+        tables = {table.table_id: table for table in client.list_tables(f'{project_id}.{dataset_id}')}
     except NotFound:
-        table_exists = False
+        tables = dict()
+
+    with _dataset_tables_lock:
+        _dataset_tables[key] = (now, tables)
+    return tables
+
+
+def invalidate_bigquery_dataset_tables(project_id: str = None, dataset_id: str = None) -> None:
+    """ Clear the cached tables of a dataset, all of the datasets of a project, or all datasets, see
+    bigquery_dataset_tables.
+
+    :param project_id: the Google Cloud project id, None for all projects.
+    :param dataset_id: the BigQuery dataset id, None for all datasets of the project.
+    :return: None.
+    """
+
+    with _dataset_tables_lock:
+        for key in list(_dataset_tables.keys()):
+            if project_id is None or (key[0] == project_id and dataset_id in (None, key[1])):
+                del _dataset_tables[key]
+
+
+def invalidate_bigquery_table(table: Union[str, bigquery.TableReference, None]) -> None:
+    """ Clear the cached tables of the dataset that a table belongs to, after the table was created or modified.
+
+    :param table: the fully qualified table id or table reference, ignored when None.
+    :return: None.
+    """
+
+    if table is None:
+        return
+    if isinstance(table, str):
+        table = bigquery.TableReference.from_string(table)
+    invalidate_bigquery_dataset_tables(table.project, table.dataset_id)
 
-    return table_exists
+
+def bigquery_table_exists(project_id: str, dataset_id: str, table_name: str,
+                          ttl: float = DEFAULT_TABLE_METADATA_TTL) -> bool:
+    """ Checks whether a BigQuery table exists or not, from the cached tables of the dataset, see
+    bigquery_dataset_tables.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param table_name: the name of the table.
+    :param ttl: the maximum age in seconds of the cached tables.
+    :return: whether the table exists or not.
+    """
+
+    return table_name in bigquery_dataset_tables(project_id, dataset_id, ttl=ttl)
+
+
+def bigquery_table_suffixes(project_id: str, dataset_id: str, table_name: str, start_date: pendulum.Date = None,
+                            end_date: pendulum.Date = None,
+                            ttl: float = DEFAULT_TABLE_METADATA_TTL) -> List[pendulum.Date]:
+    """ Get the date suffixes of the shards of a date sharded table, see bigquery_partitioned_table_id, from the cached
+    tables of the dataset.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param table_name: the name of the table without the date suffix.
+    :param start_date: the earliest suffix to return, inclusive. Datetimes are compared by their date.
+    :param end_date: the latest suffix to return, inclusive. Datetimes are compared by their date.
+    :param ttl: the maximum age in seconds of the cached tables.
+    :return: the suffixes, sorted from the most recent to the oldest.
+    """
+
+    # Compare dates with dates, a date can't be compared with a datetime
+    if isinstance(start_date, datetime.datetime):
+        start_date = start_date.date()
+    if isinstance(end_date, datetime.datetime):
+        end_date = end_date.date()
+
+    pattern = re.compile(fr'{re.escape(table_name)}(\d{{8}})')
+    suffixes = []
+    for table_id in bigquery_dataset_tables(project_id, dataset_id, ttl=ttl).keys():
+        match = pattern.fullmatch(table_id)
+        if match is None:
+            continue
+        digits = match.group(1)
+        try:
+            suffix = pendulum.Date(int(digits[:4]), int(digits[4:6]), int(digits[6:]))
+        except ValueError:
+            continue
+        if (start_date is None or suffix >= start_date) and (end_date is None or suffix <= end_date):
+            suffixes.append(suffix)
+    return sorted(suffixes, reverse=True)
 
 
 def bigquery_partitioned_table_id(table_name, datetime: Pendulum) -> str:
@@ -144,6 +552,102 @@ def bigquery_partitioned_table_id(table_name, datetime: Pendulum) -> str:
     return f"{table_name}{datetime.strftime('%Y%m%d')}"
 
 
+def bigquery_partitioned_release_table_name(table_name: str) -> str:
+    """ Make the name of the partitioned table that holds the releases of a table in STORAGE_MODE_PARTITIONED, e.g.
+    unpaywall_partitioned.
+
+    :param table_name: the name of the table.
+    :return: the name of the partitioned table.
+    """
+
+    return f'{table_name}{PARTITIONED_TABLE_SUFFIX}'
+
+
+def bigquery_release_table_id(table_name: str, release_date: Pendulum,
+                              storage_mode: str = STORAGE_MODE_SHARDED) -> str:
+    """ Make the id of the table that a release is written to: a date sharded table, or the partition of the release
+    in a partitioned table, addressed with a partition decorator, see bigquery_partitioned_release_table_name.
+
+    :param table_name: the name of the table.
+    :param release_date: the release date.
+    :param storage_mode: STORAGE_MODE_SHARDED or STORAGE_MODE_PARTITIONED.
+    :return: the table id.
+    """
+
+    if storage_mode == STORAGE_MODE_PARTITIONED:
+        return f"{bigquery_partitioned_release_table_name(table_name)}${release_date.strftime('%Y%m%d')}"
+    elif storage_mode == STORAGE_MODE_SHARDED:
+        return bigquery_partitioned_table_id(table_name, release_date)
+    raise ValueError(f'bigquery_release_table_id: unknown storage_mode={storage_mode}')
+
+
+def release_view_query(project_id: str, dataset_id: str, table_name: str, release_date: Pendulum) -> str:
+    """ Make the query of a view that selects the partition of a release from a partitioned table.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param table_name: the name of the table, see bigquery_partitioned_release_table_name.
+    :param release_date: the release date.
+    :return: the query.
+    """
+
+    partitioned_table_name = bigquery_partitioned_release_table_name(table_name)
+    return (f"SELECT * FROM `{project_id}.{dataset_id}.{partitioned_table_name}` "
+            f"WHERE _PARTITIONDATE = DATE('{release_date.strftime('%Y-%m-%d')}')")
+
+
+def create_bigquery_release_view(project_id: str, dataset_id: str, table_name: str, release_date: Pendulum) -> None:
+    """ Create a compatibility view for a release stored in a partitioned table. The view has the name of the date
+    sharded table of the release, e.g. unpaywall20201006, so that queries, existence checks and table suffix lookups
+    that use sharded table names keep working. Views can't be queried with wildcard tables, so wildcard queries over
+    the releases must query the partitioned table instead.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param table_name: the name of the table, see bigquery_partitioned_release_table_name.
+    :param release_date: the release date.
+    :return: None.
+    """
+
+    view_name = bigquery_partitioned_table_id(table_name, release_date)
+    create_bigquery_view(project_id, dataset_id, view_name,
+                         release_view_query(project_id, dataset_id, table_name, release_date))
+
+
+def load_bigquery_release_table(uri: str, dataset_id: str, location: str, table_name: str, release_date: Pendulum,
+                                schema_file_path: str, source_format: str,
+                                storage_mode: str = STORAGE_MODE_SHARDED, **kwargs) -> bool:
+    """ Load a release into BigQuery. In STORAGE_MODE_SHARDED the release is loaded into its own date sharded table.
+    In STORAGE_MODE_PARTITIONED it replaces the partition of the release in an ingestion-time partitioned table, fields
+    that were added to the schema since earlier releases are added to the table, and a compatibility view is created,
+    see create_bigquery_release_view.
+
+    :param uri: the uri of the objects to load from Google Cloud Storage into BigQuery.
+    :param dataset_id: BigQuery dataset id.
+    :param location: location of the BigQuery dataset.
+    :param table_name: the name of the table, without a date suffix.
+    :param release_date: the release date.
+    :param schema_file_path: path on local file system to BigQuery table schema.
+    :param source_format: the format of the data to load into BigQuery.
+    :param storage_mode: STORAGE_MODE_SHARDED or STORAGE_MODE_PARTITIONED.
+    :param kwargs: the other arguments of load_bigquery_table.
+    :return: whether the release was loaded successfully or not.
+    """
+
+    table_id = bigquery_release_table_id(table_name, release_date, storage_mode)
+    if storage_mode == STORAGE_MODE_PARTITIONED:
+        kwargs.update(partition=True, partition_field=None, partition_type=bigquery.TimePartitioningType.DAY,
+                      require_partition_filter=False,
+                      schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION,
+                                             bigquery.SchemaUpdateOption.ALLOW_FIELD_RELAXATION])
+
+    success = load_bigquery_table(uri, dataset_id, location, table_id, schema_file_path, source_format, **kwargs)
+    if success and storage_mode == STORAGE_MODE_PARTITIONED:
+        project_id = bigquery_client(location=location).project
+        create_bigquery_release_view(project_id, dataset_id, table_name, release_date)
+    return success
+
+
 def create_bigquery_dataset(project_id: str, dataset_id: str, location: str, description: str = '') -> None:
     """ Create a BigQuery dataset.
 
@@ -161,7 +665,7 @@ def create_bigquery_dataset(project_id: str, dataset_id: str, location: str, des
     dataset_ref = f'{project_id}.{dataset_id}'
 
     # Make dataset handle
-    client = bigquery.Client()
+    client = bigquery_client()
     dataset = bigquery.Dataset(dataset_ref)
 
     # Set properties
@@ -176,12 +680,65 @@ def create_bigquery_dataset(project_id: str, dataset_id: str, location: str, des
         logging.warning(f"{func_name}: dataset already exists dataset_ref={dataset_ref}, exception={e}")
 
 
+def make_load_job_config(schema_file_path: str, source_format: str, csv_field_delimiter: str = ',',
+                         csv_quote_character: str = '"', csv_allow_quoted_newlines: bool = False,
+                         csv_skip_leading_rows: int = 0, partition: bool = False,
+                         partition_field: Union[None, str] = None,
+                         partition_type: str = bigquery.TimePartitioningType.DAY, require_partition_filter=True,
+                         write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE,
+                         schema_update_options: List[str] = None) -> LoadJobConfig:
+    """ Make the configuration of a job that loads a BigQuery table from objects on Google Cloud Storage.
+
+    :param schema_file_path: path on local file system to BigQuery table schema.
+    :param source_format: the format of the data to load into BigQuery.
+    :param csv_field_delimiter: the field delimiter character for data in CSV format.
+    :param csv_quote_character: the quote character for data in CSV format.
+    :param csv_allow_quoted_newlines: whether to allow quoted newlines for data in CSV format.
+    :param csv_skip_leading_rows: the number of leading rows to skip for data in CSV format.
+    :param partition: whether to partition the table.
+    :param partition_field: the name of the partition field.
+    :param partition_type: the type of partitioning.
+    :param require_partition_filter: whether the partition filter is required or not when querying the table.
+    :param write_disposition: whether to append, overwrite or throw an error when data already exists in the table.
+    :param schema_update_options: how the schema of an existing table may be updated by the load, e.g.
+    bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION.
+    :return: the load job configuration.
+    """
+
+    job_config = LoadJobConfig()
+
+    # Set global options
+    job_config.source_format = source_format
+    job_config.schema = bigquery_client().schema_from_json(schema_file_path)
+    job_config.write_disposition = write_disposition
+    if schema_update_options:
+        job_config.schema_update_options = schema_update_options
+
+    # Set CSV options
+    if source_format == SourceFormat.CSV:
+        job_config.field_delimiter = csv_field_delimiter
+        job_config.quote_character = csv_quote_character
+        job_config.allow_quoted_newlines = csv_allow_quoted_newlines
+        job_config.skip_leading_rows = csv_skip_leading_rows
+
+    # Set partitioning settings
+    if partition:
+        job_config.time_partitioning = bigquery.TimePartitioning(
+            type_=partition_type,
+            field=partition_field,
+            require_partition_filter=require_partition_filter
+        )
+
+    return job_config
+
+
 def load_bigquery_table(uri: str, dataset_id: str, location: str, table: str, schema_file_path: str,
                         source_format: str, csv_field_delimiter: str = ',', csv_quote_character: str = '"',
                         csv_allow_quoted_newlines: bool = False, csv_skip_leading_rows: int = 0,
                         partition: bool = False, partition_field: Union[None, str] = None,
                         partition_type: str = bigquery.TimePartitioningType.DAY, require_partition_filter=True,
-                        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE) -> bool:
+                        write_disposition: str = bigquery.WriteDisposition.WRITE_TRUNCATE,
+                        schema_update_options: List[str] = None) -> bool:
     """ Load a BigQuery table from an object on Google Cloud Storage.
 
     :param uri: the uri of the object to load from Google Cloud Storage into BigQuery.
@@ -200,6 +757,7 @@ def load_bigquery_table(uri: str, dataset_id: str, location: str, table: str, sc
     :param require_partition_filter: whether the partition filter is required or not when querying the table.
     :param write_disposition: whether to append, overwrite or throw an error when data already exists in the table.
     Default is to overwrite.
+    :param schema_update_options: how the schema of an existing table may be updated by the load.
     :return:
     """
 
@@ -210,32 +768,20 @@ def load_bigquery_table(uri: str, dataset_id: str, location: str, table: str, sc
           f'schema_file_path={schema_file_path}, source_format={source_format}'
     logging.info(f"{func_name}: load bigquery table {msg}")
 
-    client = bigquery.Client()
+    client = bigquery_client(location=location)
     dataset = client.dataset(dataset_id)
 
     # Create load job
-    job_config = LoadJobConfig()
-
-    # Set global options
-    job_config.source_format = source_format
-    job_config.schema = client.schema_from_json(schema_file_path)
-    job_config.write_disposition = write_disposition
-
-    # Set CSV options
-    if source_format == SourceFormat.CSV:
-        job_config.field_delimiter = csv_field_delimiter
-        job_config.quote_character = csv_quote_character
-        job_config.allow_quoted_newlines = csv_allow_quoted_newlines
-        job_config.skip_leading_rows = csv_skip_leading_rows
-
-    # Set partitioning settings
-    if partition:
-        job_config.time_partitioning = bigquery.TimePartitioning(
-            type_=partition_type,
-            field=partition_field,
-            require_partition_filter=require_partition_filter
-        )
-
+    job_config = make_load_job_config(schema_file_path, source_format, csv_field_delimiter=csv_field_delimiter,
+                                      csv_quote_character=csv_quote_character,
+                                      csv_allow_quoted_newlines=csv_allow_quoted_newlines,
+                                      csv_skip_leading_rows=csv_skip_leading_rows, partition=partition,
+                                      partition_field=partition_field, partition_type=partition_type,
+                                      require_partition_filter=require_partition_filter,
+                                      write_disposition=write_disposition,
+                                      schema_update_options=schema_update_options)
+
+    load_job = None
     try:
         load_job: LoadJob = client.load_table_from_uri(
             uri,
@@ -245,6 +791,7 @@ def load_bigquery_table(uri: str, dataset_id: str, location: str, table: str, sc
         )
         result = load_job.result()
         state = result.state == 'DONE'
+        invalidate_bigquery_table(load_job.destination)
 
         if load_job.state == 'DONE' and load_job.error_result:
             logging.error(load_job.errors)
@@ -254,6 +801,10 @@ def load_bigquery_table(uri: str, dataset_id: str, location: str, table: str, sc
         logging.error(f"{func_name}: load bigquery table failed: {e}")
         state = False
 
+    if load_job is not None:
+        record_bigquery_job(load_job)
+        flush_bigquery_telemetry()
+
     return state
 
 
@@ -264,12 +815,137 @@ def run_bigquery_query(query: str) -> List:
     :return: the results.
     """
 
-    client = bigquery.Client()
+    client = bigquery_client()
     query_job = client.query(query)
     rows = query_job.result()
+    record_bigquery_job(query_job)
+    flush_bigquery_telemetry()
     return list(rows)
 
 
+def stream_bigquery_query(query: str, location: str = None, max_streams: int = DEFAULT_READ_STREAMS,
+                          page_size: int = DEFAULT_QUERY_PAGE_SIZE, as_dataframe: bool = False,
+                          use_storage_api: bool = True) -> Iterator:
+    """ Run a BigQuery query and stream the results as Arrow record batches or pandas DataFrames, so that results that
+    don't fit in memory can be processed. Use run_bigquery_query for small results.
+
+    The results are read with parallel streams of the BigQuery Storage Read API, in which case the batches are not in
+    the order of the query. When the BigQuery Storage package isn't installed or a read session can't be created, the
+    results are read page by page from the REST API instead, in order.
+
+    :param query: the query to run.
+    :param location: the location to run the query in.
+    :param max_streams: the maximum number of parallel streams to read the results with.
+    :param page_size: the number of rows per page when reading the results with the REST API.
+    :param as_dataframe: whether to yield pandas DataFrames instead of Arrow record batches.
+    :param use_storage_api: whether to read the results with the BigQuery Storage Read API when it is available.
+    :return: an iterator of record batches or DataFrames.
+    """
+
+    if pyarrow is None:
+        raise ImportError('stream_bigquery_query requires pyarrow, install it with '
+                          'pip install observatory-platform[bigquery]')
+
+    func_name = stream_bigquery_query.__name__
+    client = bigquery_client(location=location)
+    query_job = client.query(query, location=location)
+    rows = query_job.result(page_size=page_size)
+    record_bigquery_job(query_job)
+    flush_bigquery_telemetry()
+
+    batches = None
+    read_client = bigquery_read_client() if use_storage_api else None
+    if read_client is not None and query_job.destination is not None:
+        table = query_job.destination
+        requested_session = bigquery_storage_v1.types.ReadSession(
+            table=f'projects/{table.project}/datasets/{table.dataset_id}/tables/{table.table_id}',
+            data_format=bigquery_storage_v1.enums.DataFormat.ARROW)
+        try:
+            session = read_client.create_read_session(f'projects/{client.project}', requested_session,
+                                                      max_stream_count=max_streams)
+            logging.info(f'{func_name}: reading {rows.total_rows} rows with {len(session.streams)} streams')
+            batches = read_streams_as_arrow(read_client, session)
+        except GoogleAPICallError as e:
+            logging.warning(f'{func_name}: could not create a read session, reading with the REST API: {e}')
+
+    if batches is None:
+        logging.info(f'{func_name}: reading {rows.total_rows} rows with the REST API')
+        batches = read_pages_as_arrow(rows)
+
+    for batch in batches:
+        yield batch.to_pandas() if as_dataframe else batch
+
+
+def read_streams_as_arrow(read_client: 'bigquery_storage_v1.BigQueryReadClient',
+                          session: 'bigquery_storage_v1.types.ReadSession') -> Iterator['pyarrow.RecordBatch']:
+    """ Read the streams of a BigQuery Storage read session in parallel threads.
+
+    :param read_client: the BigQuery Storage Read API client.
+    :param session: the read session.
+    :return: an iterator of the record batches of all streams, in the order that they are read.
+    """
+
+    streams = list(session.streams)
+    if not streams:
+        return
+
+    batches = queue.Queue(maxsize=len(streams) * 2)
+    stop = threading.Event()
+    stream_done = object()
+
+    def put(item) -> bool:
+        # Give up when the consumer has stopped reading, so that the threads don't block forever on a full queue
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_stream(stream_name: str):
+        try:
+            reader = read_client.read_rows(stream_name)
+            for page in reader.rows(session).pages:
+                if not put(page.to_arrow()):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(stream_done)
+
+    with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+        for stream in streams:
+            executor.submit(read_stream, stream.name)
+
+        try:
+            num_remaining = len(streams)
+            while num_remaining > 0:
+                item = batches.get()
+                if item is stream_done:
+                    num_remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+
+def read_pages_as_arrow(rows: bigquery.table.RowIterator) -> Iterator['pyarrow.RecordBatch']:
+    """ Read the rows of a query result page by page from the REST API, converting each page to a record batch.
+
+    :param rows: the rows of the query result.
+    :return: an iterator of record batches, one per page.
+    """
+
+    names = [field.name for field in rows.schema]
+    for page in rows.pages:
+        page_rows = list(page)
+        arrays = [pyarrow.array([row[i] for row in page_rows]) for i in range(len(names))]
+        yield pyarrow.RecordBatch.from_arrays(arrays, names=names)
+
+
 def copy_bigquery_table(source_table_id: str, destination_table_id: str, data_location: str) -> bool:
     """ Copy a BigQuery table.
 
@@ -279,14 +955,29 @@ def copy_bigquery_table(source_table_id: str, destination_table_id: str, data_lo
     :return: whether the table was copied successfully or not.
     """
 
-    client = bigquery.Client()
+    client = bigquery_client(location=data_location)
     job_config = bigquery.CopyJobConfig()
     job_config.write_disposition = "WRITE_TRUNCATE"
     job = client.copy_table(source_table_id, destination_table_id, location=data_location, job_config=job_config)
     result = job.result()
+    invalidate_bigquery_table(destination_table_id)
+    record_bigquery_job(job)
+    flush_bigquery_telemetry()
     return result.done()
 
 
+def delete_bigquery_table(table_id: str) -> None:
+    """ Delete a BigQuery table, ignoring tables that do not exist.
+
+    :param table_id: the id of the table, including the project name and dataset id.
+    :return: None.
+    """
+
+    client = bigquery_client()
+    client.delete_table(table_id, not_found_ok=True)
+    invalidate_bigquery_table(table_id)
+
+
 def create_bigquery_view(project_id: str, dataset_id: str, view_name: str, query: str) -> None:
     """ Create a BigQuery view.
 
@@ -297,39 +988,56 @@ def create_bigquery_view(project_id: str, dataset_id: str, view_name: str, query
     :return: None
     """
 
-    client = bigquery.Client()
+    client = bigquery_client()
     dataset = bigquery.DatasetReference(project_id, dataset_id)
     view_ref = dataset.table(view_name)
     view = bigquery.Table(view_ref)
     view.view_query = query
     view = client.create_table(view, exists_ok=True)
+    invalidate_bigquery_table(view_ref)
+
+
+@dataclass
+class TableQuery:
+    """ A query that creates a table, prepared with prepare_table_query.
+
+    :param sql: the query.
+    :param destination: the table that the query creates.
+    :param location: the location to run the query in.
+    :param job_config: the configuration of the query job.
+    :param estimated_bytes: the bytes that a dry run estimated the query will process.
+    :param fingerprint: the input fingerprint of the query, set when results are reused.
+    :param reuse_table: a table created from the same query and inputs, to copy instead of running the query.
+    :param skip: whether the destination table was already created from the same query and inputs.
+    :param error: why the query must not be run, e.g. the dry run failed or the estimate exceeds the budget.
+    :param template: the name of the SQL template that the query was made from, for telemetry.
+    """
 
-
-def create_bigquery_table_from_query(sql: str, project_id: str, dataset_id: str, table_id: str, location: str,
-                                     description: str = '', labels=None,
-                                     query_parameters=None,
-                                     partition: bool = False, partition_field: Union[None, str] = None,
-                                     partition_type: str = bigquery.TimePartitioningType.DAY,
-                                     require_partition_filter=True, cluster: bool = False,
-                                     clustering_fields=None) -> bool:
-    """ Create a BigQuery dataset from a provided query.
-
-    :param sql: the sql query to be executed
-    :param labels: labels to place on the new table
-    :param project_id: the Google Cloud project id
-    :param dataset_id: the BigQuery dataset id
-    :param table_id: the BigQuery table id
-    :param location: the location where the dataset will be stored:
-    https://cloud.google.com/compute/docs/regions-zones/#locations
-    :param query_parameters: parameters for a parametrised query.
-    :param description: a description for the dataset
-    :param partition: whether to partition the table.
-    :param partition_field: the name of the partition field.
-    :param partition_type: the type of partitioning.
-    :param require_partition_filter: whether the partition filter is required or not when querying the table.
-    :param cluster: whether to cluster the table or not.
-    :param clustering_fields: what fields to cluster on.
-    :return:
+    sql: str
+    destination: bigquery.TableReference
+    location: str
+    job_config: bigquery.QueryJobConfig
+    estimated_bytes: Optional[int] = None
+    fingerprint: Optional[str] = None
+    reuse_table: Optional[bigquery.TableReference] = None
+    skip: bool = False
+    error: Optional[str] = None
+    template: Optional[str] = None
+
+
+def prepare_table_query(sql: str, project_id: str, dataset_id: str, table_id: str, location: str,
+                        description: str = '', labels=None,
+                        query_parameters=None,
+                        partition: bool = False, partition_field: Union[None, str] = None,
+                        partition_type: str = bigquery.TimePartitioningType.DAY,
+                        require_partition_filter=True, cluster: bool = False,
+                        clustering_fields=None, bytes_budget: BytesBudget = None,
+                        dry_run: bool = True, reuse_results: bool = False, template: str = None) -> TableQuery:
+    """ Prepare a query that creates a BigQuery table without running it: make the job configuration, estimate the
+    bytes that the query will process with a dry run, check the estimate against the budget and look for a table
+    created from the same query and inputs. See create_bigquery_table_from_query for the parameters.
+
+    :return: the prepared query.
     """
 
     # Handle mutable default arguments
@@ -340,24 +1048,17 @@ def create_bigquery_table_from_query(sql: str, project_id: str, dataset_id: str,
     if clustering_fields is None:
         clustering_fields = []
 
-    func_name = create_bigquery_dataset.__name__
+    func_name = prepare_table_query.__name__
     msg = f'project_id={project_id}, dataset_id={dataset_id}, location={location}, table={table_id}'
-    logging.info(f"{func_name}: create bigquery table from query, {msg}")
-
-    # Make the dataset reference
-    dataset_ref = f'{project_id}.{dataset_id}'
 
     # Make dataset handle
-    client = bigquery.Client()
-    dataset = bigquery.Dataset(dataset_ref)
-
-    # Set properties
-    dataset.location = location
-    dataset.description = description
+    client = bigquery_client(location=location)
+    dataset = bigquery.Dataset(f'{project_id}.{dataset_id}')
+    destination = dataset.table(table_id)
 
     job_config = bigquery.QueryJobConfig(
         allow_large_results=True,
-        destination=dataset.table(table_id),
+        destination=destination,
         description=description,
         labels=labels,
         use_legacy_sql=False,
@@ -376,16 +1077,208 @@ def create_bigquery_table_from_query(sql: str, project_id: str, dataset_id: str,
     if cluster:
         job_config.clustering_fields = clustering_fields
 
-    query_job: QueryJob = client.query(sql, job_config=job_config)
+    table_query = TableQuery(sql, destination, location, job_config, template=template)
+
+    # Estimate the bytes that the query will process, a dry run is free and fails fast when the query is invalid
+    dry_run_job = None
+    if dry_run or bytes_budget is not None or reuse_results:
+        dry_run_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, use_legacy_sql=False,
+                                                 query_parameters=query_parameters)
+        try:
+            dry_run_job: QueryJob = client.query(sql, job_config=dry_run_config)
+        except BadRequest as e:
+            logging.error(f"{func_name}: dry run of query failed, {msg}: {e}")
+            table_query.error = f'dry run of query failed: {e}'
+            return table_query
+        table_query.estimated_bytes = dry_run_job.total_bytes_processed
+        logging.info(f"{func_name}: dry run estimated bytes processed={table_query.estimated_bytes}, {msg}")
+
+    # Check the estimate against the budget
+    estimated_bytes = table_query.estimated_bytes
+    if bytes_budget is not None and estimated_bytes is not None and estimated_bytes > bytes_budget.max_bytes:
+        budget_msg = f'estimated bytes processed={estimated_bytes} exceeds budget={bytes_budget.max_bytes}'
+        if bytes_budget.action == BUDGET_ACTION_WARN:
+            logging.warning(f"{func_name}: {budget_msg}, {msg}")
+        else:
+            logging.error(f"{func_name}: not running query, {budget_msg}, {msg}")
+            table_query.error = budget_msg
+            return table_query
+
+    # Reuse a table that was created from the same query and inputs
+    if reuse_results:
+        table_query.fingerprint = query_input_fingerprint(client, sql, job_config, dry_run_job.referenced_tables)
+        if table_query.fingerprint is None:
+            logging.info(f"{func_name}: the inputs of the query can't be fingerprinted, running query, {msg}")
+            return table_query
+
+        previous = find_table_with_fingerprint(project_id, dataset_id, table_query.fingerprint, prefer=table_id)
+        if previous is not None:
+            if previous.table_id != table_id:
+                logging.info(f"{func_name}: inputs unchanged, copying {previous.table_id} instead of running query, "
+                             f"{msg}")
+                table_query.reuse_table = previous.reference
+            else:
+                logging.info(f"{func_name}: inputs unchanged since table was created, not running query, {msg}")
+                table_query.skip = True
+
+    return table_query
+
+
+def create_bigquery_table_from_query(sql: str, project_id: str, dataset_id: str, table_id: str, location: str,
+                                     description: str = '', labels=None,
+                                     query_parameters=None,
+                                     partition: bool = False, partition_field: Union[None, str] = None,
+                                     partition_type: str = bigquery.TimePartitioningType.DAY,
+                                     require_partition_filter=True, cluster: bool = False,
+                                     clustering_fields=None, bytes_budget: BytesBudget = None,
+                                     dry_run: bool = True, reuse_results: bool = False, template: str = None) -> bool:
+    """ Create a BigQuery dataset from a provided query.
+
+    :param sql: the sql query to be executed
+    :param labels: labels to place on the new table
+    :param project_id: the Google Cloud project id
+    :param dataset_id: the BigQuery dataset id
+    :param table_id: the BigQuery table id
+    :param location: the location where the dataset will be stored:
+    https://cloud.google.com/compute/docs/regions-zones/#locations
+    :param query_parameters: parameters for a parametrised query.
+    :param description: a description for the dataset
+    :param partition: whether to partition the table.
+    :param partition_field: the name of the partition field.
+    :param partition_type: the type of partitioning.
+    :param require_partition_filter: whether the partition filter is required or not when querying the table.
+    :param cluster: whether to cluster the table or not.
+    :param clustering_fields: what fields to cluster on.
+    :param bytes_budget: the maximum number of bytes that the query is expected to process, checked with a dry run.
+    :param dry_run: whether to estimate the bytes that the query will process with a dry run before running it.
+    :param reuse_results: whether to copy a table in the dataset that was created from the same query and inputs
+    instead of running the query, see query_input_fingerprint. Only use with deterministic queries.
+    :param template: the name of the SQL template that the query was made from, recorded with the telemetry of the job.
+    :return: whether the table was created successfully or not.
+    """
+
+    func_name = create_bigquery_table_from_query.__name__
+    msg = f'project_id={project_id}, dataset_id={dataset_id}, location={location}, table={table_id}'
+    logging.info(f"{func_name}: create bigquery table from query, {msg}")
+
+    table_query = prepare_table_query(sql, project_id, dataset_id, table_id, location, description=description,
+                                      labels=labels, query_parameters=query_parameters, partition=partition,
+                                      partition_field=partition_field, partition_type=partition_type,
+                                      require_partition_filter=require_partition_filter, cluster=cluster,
+                                      clustering_fields=clustering_fields, bytes_budget=bytes_budget,
+                                      dry_run=dry_run, reuse_results=reuse_results, template=template)
+    if table_query.error is not None:
+        return False
+    if table_query.skip:
+        return True
+
+    client = bigquery_client(location=location)
+    if table_query.reuse_table is not None:
+        copy_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        copy_job = client.copy_table(table_query.reuse_table, table_query.destination, location=location,
+                                     job_config=copy_config)
+        copy_job.result()
+        invalidate_bigquery_table(table_query.destination)
+        record_bigquery_job(copy_job, template=table_query.template)
+        flush_bigquery_telemetry()
+        set_input_fingerprint(client, table_query.destination, table_query.fingerprint)
+        return True
+
+    query_job: QueryJob = client.query(sql, job_config=table_query.job_config)
     query_job.result()
     success = query_job.done()
-    logging.info(f"{func_name}: create bigquery table from query {msg}: {success}")
+    invalidate_bigquery_table(table_query.destination)
+    record_bigquery_job(query_job, template=table_query.template)
+    flush_bigquery_telemetry()
+    logging.info(f"{func_name}: create bigquery table from query {msg}: {success}, "
+                 f"estimated bytes processed={table_query.estimated_bytes}, "
+                 f"bytes processed={query_job.total_bytes_processed}, bytes billed={query_job.total_bytes_billed}")
+
+    if success and table_query.fingerprint is not None:
+        set_input_fingerprint(client, table_query.destination, table_query.fingerprint)
+
     return success
 
 
+def query_input_fingerprint(client: bigquery.Client, sql: str, job_config: bigquery.QueryJobConfig,
+                            referenced_tables: List[bigquery.TableReference]) -> Optional[str]:
+    """ Make a fingerprint of the inputs of a query: the SQL, the job configuration apart from the destination, and the
+    last modified time and number of rows of each table that the query references. Queries with the same fingerprint
+    create the same table, as long as they are deterministic.
+
+    A dry run lists at most MAX_REFERENCED_TABLES referenced tables, so queries that reference that many tables, or
+    that query wildcard tables whose matches can grow past the limit, are not fingerprinted.
+
+    :param client: the BigQuery client.
+    :param sql: the query.
+    :param job_config: the configuration of the query job.
+    :param referenced_tables: the tables that the query references, from a dry run of the query.
+    :return: the fingerprint, which is a valid BigQuery label value, or None if the inputs can't all be listed.
+    """
+
+    wildcard = re.search(r'`[^`]*\*`', sql) or any('*' in reference.table_id for reference in referenced_tables)
+    if wildcard or len(referenced_tables) >= MAX_REFERENCED_TABLES:
+        return None
+
+    config = job_config.to_api_repr().get('query', {})
+    config.pop('destinationTable', None)
+
+    digest = hashlib.sha256()
+    digest.update(sql.encode('utf-8'))
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+    for reference in sorted(referenced_tables, key=lambda ref: (ref.project, ref.dataset_id, ref.table_id)):
+        table = client.get_table(reference)
+        digest.update(f'{reference.project}.{reference.dataset_id}.{reference.table_id}:'
+                      f'{table.modified.isoformat()}:{table.num_rows}'.encode('utf-8'))
+
+    # Label values are at most 63 characters long
+    return digest.hexdigest()[:63]
+
+
+def find_table_with_fingerprint(project_id: str, dataset_id: str, fingerprint: str, prefer: str = None,
+                                ttl: float = DEFAULT_TABLE_METADATA_TTL) -> Optional[bigquery.table.TableListItem]:
+    """ Find a table in a dataset that was created from a query with a given input fingerprint, from the cached tables
+    of the dataset, see bigquery_dataset_tables.
+
+    :param project_id: the Google Cloud project id.
+    :param dataset_id: the BigQuery dataset id.
+    :param fingerprint: the input fingerprint.
+    :param prefer: the id of the table to return if it has the fingerprint, before any other table.
+    :param ttl: the maximum age in seconds of the cached tables.
+    :return: the preferred table, otherwise the most recently created table with the fingerprint, or None if no table
+    has the fingerprint.
+    """
+
+    matches = [table for table in bigquery_dataset_tables(project_id, dataset_id, ttl=ttl).values()
+               if (table.labels or {}).get(INPUT_FINGERPRINT_LABEL) == fingerprint]
+    for table in matches:
+        if table.table_id == prefer:
+            return table
+    if not matches:
+        return None
+    return max(matches, key=lambda table: (table.created or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
+                                           table.table_id))
+
+
+def set_input_fingerprint(client: bigquery.Client, table_ref: bigquery.TableReference, fingerprint: str) -> None:
+    """ Record the input fingerprint of the query that created a table in the labels of the table.
+
+    :param client: the BigQuery client.
+    :param table_ref: the table.
+    :param fingerprint: the input fingerprint.
+    :return: None.
+    """
+
+    table = client.get_table(table_ref)
+    table.labels = {**(table.labels or {}), INPUT_FINGERPRINT_LABEL: fingerprint}
+    client.update_table(table, ['labels'])
+    invalidate_bigquery_table(table_ref)
+
+
 def download_blob_from_cloud_storage(bucket_name: str, blob_name: str, file_path: str, retries: int = 3,
                                      connection_sem: BoundedSemaphore = None,
-                                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
+                                     chunk_size: int = DEFAULT_CHUNK_SIZE, slices: int = 1,
+                                     check_existing: bool = True) -> bool:
     """ Download a blob to a file.
 
     :param bucket_name: the name of the Google Cloud storage bucket.
@@ -394,6 +1287,10 @@ def download_blob_from_cloud_storage(bucket_name: str, blob_name: str, file_path
     :param retries: the number of times to retry downloading the blob.
     :param connection_sem: a BoundedSemaphore to limit the number of download connections that can run at once.
     :param chunk_size: the chunk size to use when downloading a blob in multiple parts, must be a multiple of 256 KB.
+    :param slices: when greater than 1, the blob is downloaded as a parallel sliced download with this many slices,
+    see download_blob_from_cloud_storage_sliced.
+    :param check_existing: whether to skip the download when the file already exists and matches the blob. Set to
+    False when the caller has already compared the file with the blob, see diff_transfer_manifest.
     :return: whether the download was successful or not.
     """
 
@@ -401,23 +1298,22 @@ def download_blob_from_cloud_storage(bucket_name: str, blob_name: str, file_path
     logging.info(f"{func_name}: {file_path}")
 
     # Get blob
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
+    bucket = storage_client().bucket(bucket_name)
     blob: Blob = bucket.blob(blob_name)
 
     # State
     download = True
     success = False
 
-    # Get hash for blob, have to call reload
-    blob.reload()
-    expected_hash = blob.crc32c
-
     # Check if file exists and check hash
-    if os.path.exists(file_path):
+    if check_existing and os.path.exists(file_path):
+        # Get hash for blob, have to call reload
+        blob.reload()
+        expected_hash = blob.crc32c
+
         # Check file's hash
         logging.info(f'{func_name}: file exists, checking hash {file_path}')
-        actual_hash = crc32c_base64_hash(file_path)
+        actual_hash = indexed_crc32c_base64_hash(file_path)
 
         # Compare hashes
         files_match = expected_hash == actual_hash
@@ -434,14 +1330,22 @@ def download_blob_from_cloud_storage(bucket_name: str, blob_name: str, file_path
         if connection_sem is not None:
             connection_sem.acquire()
 
-        for i in range(0, retries):
-            try:
-                blob.chunk_size = chunk_size
-                blob.download_to_filename(file_path)
-                success = True
-                break
-            except ChunkedEncodingError as e:
-                logging.error(f'{func_name}: exception downloading file: try={i}, file_path={file_path}, exception={e}')
+        if slices > 1:
+            success = download_blob_from_cloud_storage_sliced(bucket_name, blob_name, file_path, slices=slices,
+                                                              retries=retries, chunk_size=chunk_size,
+                                                              blob=blob if blob.size is not None else None)
+        else:
+            for i in range(0, retries):
+                try:
+                    # Compute the crc32c checksum while the file is written, it is saved in the checksum index
+                    blob.chunk_size = chunk_size
+                    with open_checksummed(file_path) as f:
+                        blob.download_to_file(f)
+                    success = True
+                    break
+                except ChunkedEncodingError as e:
+                    logging.error(f'{func_name}: exception downloading file: try={i}, file_path={file_path}, '
+                                  f'exception={e}')
 
         # Release connection semaphore
         if connection_sem is not None:
@@ -450,118 +1354,269 @@ def download_blob_from_cloud_storage(bucket_name: str, blob_name: str, file_path
     return success
 
 
+def download_blob_from_cloud_storage_sliced(bucket_name: str, blob_name: str, file_path: str,
+                                            slices: int = DEFAULT_PARALLEL_DOWNLOAD_SLICES, retries: int = 3,
+                                            chunk_size: int = DEFAULT_CHUNK_SIZE, blob: Blob = None) -> bool:
+    """ Download a blob to a file as a parallel sliced download. The file is preallocated and byte ranges of the blob
+    are downloaded concurrently, each written straight to its position in the file. The CRC32C checksum of the file
+    is checked against the blob's checksum by combining the checksums of the slices, which are computed while the
+    slices are written, so the file is not read again.
+
+    :param bucket_name: the name of the Google Cloud storage bucket.
+    :param blob_name: the path to the blob.
+    :param file_path: the file path where the blob should be saved.
+    :param slices: the number of byte ranges to split the blob into.
+    :param retries: the number of times to retry downloading a slice if an error occurs.
+    :param chunk_size: the chunk size to use when downloading a slice in multiple parts, must be a multiple of 256 KB.
+    :param blob: the blob with its metadata already loaded, if None the metadata is fetched.
+    :return: whether the download was successful or not.
+    """
+
+    func_name = download_blob_from_cloud_storage_sliced.__name__
+
+    bucket = storage_client().bucket(bucket_name)
+    if blob is None:
+        blob = bucket.blob(blob_name)
+        blob.reload()
+
+    # Split the blob into byte ranges
+    blob_size = blob.size
+    ranges = split_byte_ranges(blob_size, slices)
+    slices = len(ranges)
+    logging.info(f'{func_name}: bucket_name={bucket_name}, blob_name={blob_name}, file_path={file_path}, '
+                 f'blob_size={blob_size}, slices={slices}')
+
+    def download_slice(fd: int, offset: int, size: int) -> Union[None, int]:
+        # Pin the generation so that every slice comes from the same version of the blob
+        slice_blob = bucket.blob(blob_name, chunk_size=chunk_size, generation=blob.generation)
+        for i in range(0, retries):
+            try:
+                writer = FileSliceWriter(fd, offset)
+                if size > 0:
+                    slice_blob.download_to_file(writer, start=offset, end=offset + size - 1, checksum=None)
+                if writer.tell() == size:
+                    return writer.crc32c
+                logging.error(f'{func_name}: slice size mismatch: try={i}, offset={offset}, expected_size={size}, '
+                              f'actual_size={writer.tell()}')
+            except ChunkedEncodingError as e:
+                logging.error(f'{func_name}: exception downloading slice: try={i}, offset={offset}, exception={e}')
+        return None
+
+    # Preallocate the file and download the slices in parallel
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        os.ftruncate(fd, blob_size)
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            futures = [executor.submit(download_slice, fd, offset, size) for offset, size in ranges]
+            crcs = [future.result() for future in futures]
+    finally:
+        os.close(fd)
+
+    if any(crc is None for crc in crcs):
+        return False
+
+    # Check the combined checksum of the slices against the checksum of the blob
+    actual_hash = crc32c_to_base64_str(crc32c_combine_all(crcs, [size for _, size in ranges]))
+    files_match = blob.crc32c == actual_hash
+    logging.info(f'{func_name}: files_match={files_match}, expected_hash={blob.crc32c}, actual_hash={actual_hash}')
+    if files_match:
+        update_checksum_index(file_path, actual_hash)
+    return files_match
+
+
+def list_blob_manifest(bucket_name: str, prefix: str) -> Dict[str, Blob]:
+    """ List the blobs within a prefixed path with a single paged listing. The listing includes the size and checksums
+    of every blob, so the blobs can be compared with local files without a metadata request per blob.
+
+    :param bucket_name: the name of the Google Cloud storage bucket.
+    :param prefix: the prefixed path on the bucket, where blobs will be searched for.
+    :return: the blobs, keyed by blob name.
+    """
+
+    bucket = storage_client().bucket(bucket_name)
+    return {blob.name: blob for blob in bucket.list_blobs(prefix=prefix)}
+
+
+def diff_transfer_manifest(manifest: Dict[str, Union[Blob, ObjectInfo]], transfers: List[Tuple[str, str]],
+                           executor: Executor = None) -> List[Tuple[str, str]]:
+    """ Find the transfers that need to be made because the local file and the blob differ. The sizes are compared
+    first and a file is only hashed when its size matches the size of its blob.
+
+    :param manifest: the blobs, keyed by blob name, see list_blob_manifest and GcsTransferEngine.list_objects.
+    :param transfers: (blob name, file path) pairs.
+    :param executor: an executor to hash the files with, if None the files are hashed in this process.
+    :return: the (blob name, file path) pairs where the file and the blob differ.
+    """
+
+    func_name = diff_transfer_manifest.__name__
+
+    # Compare sizes
+    delta = []
+    to_hash = []
+    for blob_name, file_path in transfers:
+        blob = manifest.get(blob_name)
+        if blob is None or not os.path.isfile(file_path) or os.path.getsize(file_path) != blob.size:
+            delta.append((blob_name, file_path))
+        else:
+            to_hash.append((blob_name, file_path))
+
+    # Compare hashes of the files with matching sizes
+    file_paths = [file_path for _, file_path in to_hash]
+    if executor is not None:
+        hashes = executor.map(indexed_crc32c_base64_hash, file_paths)
+    else:
+        hashes = map(indexed_crc32c_base64_hash, file_paths)
+    for (blob_name, file_path), actual_hash in zip(to_hash, hashes):
+        if manifest[blob_name].crc32c != actual_hash:
+            delta.append((blob_name, file_path))
+
+    logging.info(f'{func_name}: transfers={len(transfers)}, hashed={len(to_hash)}, delta={len(delta)}')
+    return delta
+
+
 def download_blobs_from_cloud_storage(bucket_name: str, prefix: str, destination_path: str,
-                                      max_processes: int = cpu_count(), max_connections: int = cpu_count(),
-                                      retries: int = 3, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
+                                      max_processes: int = cpu_count(),
+                                      max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                                      retries: int = 3, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                      pool_size: int = DEFAULT_POOL_SIZE,
+                                      parallel_download_threshold: int = DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD,
+                                      parallel_download_slices: int = DEFAULT_PARALLEL_DOWNLOAD_SLICES,
+                                      journal_path: str = None, adaptive_concurrency: bool = True,
+                                      metrics_hook: Callable[[ConcurrencyStats], None] = None,
+                                      max_transfers: int = DEFAULT_MAX_TRANSFERS) -> bool:
     """ Download all blobs on a Google Cloud Storage bucket that are within a prefixed path, to a destination on the
-    local file system.
+    local file system. The blobs are downloaded concurrently by a GcsTransferEngine.
 
     :param bucket_name: the name of the Google Cloud storage bucket.
     :param prefix: the prefixed path on the bucket, where blobs will be searched for.
     :param destination_path: the destination on the local file system to download files too.
-    :param max_processes: the maximum number of processes.
-    :param max_connections: the maximum number of download connections at once.
-    :param retries: the number of times to retry downloading the blob.
+    :param max_processes: the maximum number of processes used to hash existing files.
+    :param max_connections: the maximum number of download requests in flight at once.
+    :param retries: the number of times to try each request.
     :param chunk_size: the chunk size to use when downloading a blob in multiple parts, must be a multiple of 256 KB.
+    :param pool_size: the maximum number of HTTP connections to each host.
+    :param parallel_download_threshold: blobs of at least this many bytes are downloaded as parallel sliced downloads.
+    :param parallel_download_slices: the number of slices that each parallel sliced download is split into.
+    :param journal_path: the path to a TransferJournal file. When given, a retry reuses the listing of the blobs and
+    skips the blobs that a previous attempt downloaded, without making any requests for them.
+    :param adaptive_concurrency: whether to adapt the number of requests in flight, up to max_connections, to the
+    throughput that is achieved, see AdaptiveConcurrencyLimiter.
+    :param metrics_hook: a function that is called with the throughput and concurrency of each measurement window.
+    :param max_transfers: the maximum number of blobs downloaded at once, which bounds the number of open files.
     :return: whether the files were downloaded successfully or not.
     """
 
     func_name = download_blobs_from_cloud_storage.__name__
 
-    # Get bucket
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-
-    # List blobs
-    blobs: List[Blob] = list(bucket.list_blobs(prefix=prefix))
-    logging.info(f"{func_name}: {blobs}")
-
-    # Download each blob in parallel
-    manager = multiprocessing.Manager()
-    connection_sem = manager.BoundedSemaphore(value=max_connections)
-    with ProcessPoolExecutor(max_workers=max_processes) as executor:
-        # Create tasks
-        futures = []
-        futures_msgs = {}
-        for blob in blobs:
-            # Save files to destination path, remove blobs_path from blob name
-            filename = f'{os.path.normpath(destination_path)}{blob.name.replace(prefix, "")}'
-            msg = f'bucket_name={bucket_name}, blob_name={blob.name}, filename={filename}'
-            logging.info(f'{func_name}: {msg}')
-
-            # Create directory
-            dirname = os.path.dirname(filename)
-            os.makedirs(dirname, exist_ok=True)
-
-            future = executor.submit(download_blob_from_cloud_storage, bucket_name, blob.name, filename,
-                                     retries=retries, connection_sem=connection_sem, chunk_size=chunk_size)
-            futures.append(future)
-            futures_msgs[future] = msg
-
-        # Wait for completed tasks
-        results = []
-        for future in as_completed(futures):
-            success = future.result()
-            results.append(success)
-            msg = futures_msgs[future]
-
-            if success:
-                logging.info(f'{func_name}: success, {msg}')
-            else:
-                logging.info(f'{func_name}: failed, {msg}')
-
-    return all(results)
+    async def download(journal: TransferJournal = None) -> bool:
+        async with GcsTransferEngine(max_connections=max_connections, pool_size=pool_size, retries=retries,
+                                     chunk_size=chunk_size, parallel_download_threshold=parallel_download_threshold,
+                                     parallel_download_slices=parallel_download_slices, journal=journal,
+                                     adaptive_concurrency=adaptive_concurrency, metrics_hook=metrics_hook,
+                                     max_transfers=max_transfers) as engine:
+            # List blobs, or reuse the listing of a previous attempt
+            manifest = journal.listing(bucket_name, prefix) if journal is not None else None
+            if manifest is None:
+                manifest = await engine.list_objects(bucket_name, prefix)
+                if journal is not None:
+                    journal.record_listing(bucket_name, prefix, manifest)
+            logging.info(f"{func_name}: {list(manifest.values())}")
+
+            # Save files to destination path, remove blobs_path from blob name. Only download blobs that differ from
+            # the files that have already been downloaded.
+            transfers = [(blob_name, f'{os.path.normpath(destination_path)}{blob_name.replace(prefix, "")}')
+                         for blob_name in manifest.keys()]
+            if journal is not None:
+                transfers = [(blob_name, filename) for blob_name, filename in transfers
+                             if journal.completed(bucket_name, blob_name, filename) != manifest[blob_name].crc32c]
+            with ProcessPoolExecutor(max_workers=max_processes) as executor:
+                delta = diff_transfer_manifest(manifest, transfers, executor=executor)
+
+            # Download each blob concurrently
+            downloads = []
+            for blob_name, filename in delta:
+                msg = f'bucket_name={bucket_name}, blob_name={blob_name}, filename={filename}'
+                logging.info(f'{func_name}: {msg}')
+                downloads.append((msg, engine.download_object(bucket_name, manifest[blob_name], filename)))
+            return await transfer_all(downloads, func_name)
+
+    if journal_path is None:
+        return asyncio.run(download())
+    with TransferJournal(journal_path) as journal:
+        return asyncio.run(download(journal))
 
 
 def upload_files_to_cloud_storage(bucket_name: str, blob_names: List[str], file_paths: List[str],
-                                  max_processes: int = cpu_count(), max_connections: int = cpu_count(),
-                                  retries: int = 3, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
-    """ Upload a list of files to Google Cloud storage.
+                                  max_processes: int = cpu_count(), max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                                  retries: int = 3, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                  pool_size: int = DEFAULT_POOL_SIZE,
+                                  parallel_upload_threshold: int = DEFAULT_PARALLEL_UPLOAD_THRESHOLD,
+                                  parallel_upload_slices: int = DEFAULT_PARALLEL_UPLOAD_SLICES,
+                                  journal_path: str = None, adaptive_concurrency: bool = True,
+                                  metrics_hook: Callable[[ConcurrencyStats], None] = None,
+                                  max_transfers: int = DEFAULT_MAX_TRANSFERS) -> bool:
+    """ Upload a list of files to Google Cloud storage. The files are uploaded concurrently by a GcsTransferEngine.
 
     :param bucket_name: the name of the Google Cloud storage bucket.
     :param blob_names: the destination paths of blobs where the files will be uploaded.
     :param file_paths: the paths of the files to upload as blobs.
-    :param max_processes: the maximum number of processes.
-    :param max_connections: the maximum number of upload connections at once.
-    :param retries: the number of times to retry uploading a file if an error occurs.
+    :param max_processes: the maximum number of processes used to hash the files.
+    :param max_connections: the maximum number of upload requests in flight at once.
+    :param retries: the number of times to try each request.
     :param chunk_size: the chunk size to use when uploading a blob in multiple parts, must be a multiple of 256 KB.
+    :param pool_size: the maximum number of HTTP connections to each host.
+    :param parallel_upload_threshold: files of at least this many bytes are uploaded as parallel composite uploads.
+    :param parallel_upload_slices: the number of slices that each parallel composite upload is split into.
+    :param journal_path: the path to a TransferJournal file. When given, a retry skips the files that a previous
+    attempt uploaded without making any requests for them, and resumes partially uploaded files.
+    :param adaptive_concurrency: whether to adapt the number of requests in flight, up to max_connections, to the
+    throughput that is achieved, see AdaptiveConcurrencyLimiter.
+    :param metrics_hook: a function that is called with the throughput and concurrency of each measurement window.
+    :param max_transfers: the maximum number of files uploaded at once, which bounds the number of open files.
     :return: whether the files were uploaded successfully or not.
     """
 
     func_name = upload_files_to_cloud_storage.__name__
     logging.info(f'{func_name}: uploading files')
 
-    # Upload each file in parallel
-    manager = multiprocessing.Manager()
-    connection_sem = manager.BoundedSemaphore(value=max_connections)
-    with ProcessPoolExecutor(max_workers=max_processes) as executor:
-        # Create tasks
-        futures = []
-        futures_msgs = {}
-        for blob_name, file_path in zip(blob_names, file_paths):
-            msg = f'{func_name}: bucket_name={bucket_name}, blob_name={blob_name}, file_path={str(file_path)}'
-            logging.info(f"{func_name}: {msg}")
-            future = executor.submit(upload_file_to_cloud_storage, bucket_name, blob_name, file_path=str(file_path),
-                                     retries=retries, connection_sem=connection_sem, chunk_size=chunk_size)
-            futures.append(future)
-            futures_msgs[future] = msg
-
-        # Wait for completed tasks
-        results = []
-        for future in as_completed(futures):
-            success = future.result()
-            results.append(success)
-            msg = futures_msgs[future]
-            if success:
-                logging.info(f'{func_name}: success, {msg}')
-            else:
-                logging.info(f'{func_name}: failed, {msg}')
-
-    return all(results)
+    async def upload(journal: TransferJournal = None) -> bool:
+        transfers = [(blob_name, str(file_path)) for blob_name, file_path in zip(blob_names, file_paths)]
+        if journal is not None:
+            transfers = [(blob_name, file_path) for blob_name, file_path in transfers
+                         if journal.completed(bucket_name, blob_name, file_path) is None]
+            if not transfers:
+                logging.info(f'{func_name}: all files were uploaded according to the transfer journal')
+                return True
+
+        async with GcsTransferEngine(max_connections=max_connections, pool_size=pool_size, retries=retries,
+                                     chunk_size=chunk_size, parallel_upload_threshold=parallel_upload_threshold,
+                                     parallel_upload_slices=parallel_upload_slices, journal=journal,
+                                     adaptive_concurrency=adaptive_concurrency, metrics_hook=metrics_hook,
+                                     max_transfers=max_transfers) as engine:
+            # Find the blobs that have already been uploaded, listing the directories of the blob names
+            manifest = await engine.find_objects(bucket_name, [blob_name for blob_name, _ in transfers])
+
+            # Only upload files that differ from the blobs that have already been uploaded
+            with ProcessPoolExecutor(max_workers=max_processes) as executor:
+                delta = diff_transfer_manifest(manifest, transfers, executor=executor)
+
+            # Upload each file concurrently
+            uploads = []
+            for blob_name, file_path in delta:
+                msg = f'bucket_name={bucket_name}, blob_name={blob_name}, file_path={file_path}'
+                logging.info(f'{func_name}: {msg}')
+                uploads.append((msg, engine.upload_file(bucket_name, blob_name, file_path)))
+            return await transfer_all(uploads, func_name)
+
+    if journal_path is None:
+        return asyncio.run(upload())
+    with TransferJournal(journal_path) as journal:
+        return asyncio.run(upload(journal))
 
 
 def upload_file_to_cloud_storage(bucket_name: str, blob_name: str, file_path: str, retries: int = 3,
-                                 connection_sem: BoundedSemaphore = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
+                                 connection_sem: BoundedSemaphore = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                 slices: int = 1, check_existing: bool = True) -> bool:
     """ Upload a file to Google Cloud Storage.
 
     :param bucket_name: the name of the Google Cloud Storage bucket.
@@ -570,6 +1625,10 @@ def upload_file_to_cloud_storage(bucket_name: str, blob_name: str, file_path: st
     :param retries: the number of times to retry uploading a file if an error occurs.
     :param connection_sem: a BoundedSemaphore to limit the number of upload connections that can run at once.
     :param chunk_size: the chunk size to use when uploading a blob in multiple parts, must be a multiple of 256 KB.
+    :param slices: when greater than 1, the file is uploaded as a parallel composite upload with this many slices,
+    see upload_file_to_cloud_storage_sliced.
+    :param check_existing: whether to skip the upload when the blob already exists and matches the file. Set to
+    False when the caller has already compared the file with the blob, see diff_transfer_manifest.
     :return: whether the upload was successful or not.
     """
     func_name = upload_file_to_cloud_storage.__name__
@@ -580,18 +1639,17 @@ def upload_file_to_cloud_storage(bucket_name: str, blob_name: str, file_path: st
     success = False
 
     # Get blob
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
+    bucket = storage_client().bucket(bucket_name)
     blob = bucket.blob(blob_name)
 
     # Check if blob exists already and matches the file we are uploading
-    if blob.exists():
+    if check_existing and blob.exists():
         # Get blob hash
         blob.reload()
         expected_hash = blob.crc32c
 
         # Check file hash
-        actual_hash = crc32c_base64_hash(file_path)
+        actual_hash = indexed_crc32c_base64_hash(file_path)
 
         # Compare hashes
         files_match = expected_hash == actual_hash
@@ -610,14 +1668,33 @@ def upload_file_to_cloud_storage(bucket_name: str, blob_name: str, file_path: st
         if connection_sem is not None:
             connection_sem.acquire()
 
-        for i in range(0, retries):
-            try:
-                blob.chunk_size = chunk_size
-                blob.upload_from_filename(file_path)
-                success = True
-                break
-            except ChunkedEncodingError as e:
-                logging.error(f'{func_name}: exception uploading file: try={i}, exception={e}')
+        if slices > 1:
+            success = upload_file_to_cloud_storage_sliced(bucket_name, blob_name, file_path, slices=slices,
+                                                          retries=retries, chunk_size=chunk_size)
+        else:
+            for i in range(0, retries):
+                try:
+                    # Compute the crc32c checksum while the file is read and check it against the uploaded blob
+                    blob.chunk_size = chunk_size
+                    content_type, _ = mimetypes.guess_type(file_path)
+                    with FileSlice(file_path, 0, os.path.getsize(file_path)) as file_slice:
+                        blob.upload_from_file(file_slice, size=file_slice.size, content_type=content_type)
+                        actual_hash = crc32c_to_base64_str(file_slice.crc32c)
+                    success = blob.crc32c == actual_hash
+                    logging.info(f'{func_name}: files_match={success}, expected_hash={blob.crc32c}, '
+                                 f'actual_hash={actual_hash}')
+                    if success:
+                        update_checksum_index(file_path, actual_hash)
+                        break
+
+                    # The blob was corrupted in transit, delete it and try again
+                    logging.error(f'{func_name}: uploaded blob does not match file: try={i}')
+                    try:
+                        blob.delete()
+                    except NotFound:
+                        pass
+                except ChunkedEncodingError as e:
+                    logging.error(f'{func_name}: exception uploading file: try={i}, exception={e}')
 
         # Release connection semaphore
         if connection_sem is not None:
@@ -626,6 +1703,297 @@ def upload_file_to_cloud_storage(bucket_name: str, blob_name: str, file_path: st
     return success
 
 
+def upload_file_to_cloud_storage_sliced(bucket_name: str, blob_name: str, file_path: str,
+                                        slices: int = DEFAULT_PARALLEL_UPLOAD_SLICES, retries: int = 3,
+                                        chunk_size: int = DEFAULT_CHUNK_SIZE) -> bool:
+    """ Upload a file to Google Cloud Storage as a parallel composite upload. The file is split into byte ranges,
+    which are uploaded concurrently as temporary component blobs, composed into the final blob on the server and then
+    deleted. The CRC32C checksum of the composed blob is checked against a checksum combined from the checksums of the
+    slices, which are computed while the slices are uploaded.
+
+    :param bucket_name: the name of the Google Cloud Storage bucket.
+    :param blob_name: the name of the blob to save.
+    :param file_path: the path of the file to upload.
+    :param slices: the number of slices to split the file into, at most MAX_COMPOSE_COMPONENTS.
+    :param retries: the number of times to retry uploading a slice if an error occurs.
+    :param chunk_size: the chunk size to use when uploading a slice in multiple parts, must be a multiple of 256 KB.
+    :return: whether the upload was successful or not.
+    """
+
+    func_name = upload_file_to_cloud_storage_sliced.__name__
+
+    # Split the file into byte ranges
+    file_size = os.path.getsize(file_path)
+    ranges = split_byte_ranges(file_size, min(slices, MAX_COMPOSE_COMPONENTS))
+    slices = len(ranges)
+    logging.info(f'{func_name}: bucket_name={bucket_name}, blob_name={blob_name}, file_path={file_path}, '
+                 f'file_size={file_size}, slices={slices}')
+
+    bucket = storage_client().bucket(bucket_name)
+    components = [bucket.blob(f'{blob_name}.component{i:02d}') for i in range(slices)]
+
+    def upload_slice(component: Blob, offset: int, size: int) -> Union[None, int]:
+        for i in range(0, retries):
+            try:
+                with FileSlice(file_path, offset, size) as file_slice:
+                    component.chunk_size = chunk_size
+                    component.upload_from_file(file_slice, size=size)
+                    return file_slice.crc32c
+            except ChunkedEncodingError as e:
+                logging.error(f'{func_name}: exception uploading slice: try={i}, blob_name={component.name}, '
+                              f'exception={e}')
+        return None
+
+    success = False
+    try:
+        # Upload the slices in parallel
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            futures = [executor.submit(upload_slice, component, offset, size)
+                       for component, (offset, size) in zip(components, ranges)]
+            crcs = [future.result() for future in futures]
+
+        if all(crc is not None for crc in crcs):
+            # Compose the slices into the final blob
+            blob = bucket.blob(blob_name)
+            blob.compose(components)
+
+            # Check the checksum of the composed blob
+            expected_hash = crc32c_to_base64_str(crc32c_combine_all(crcs, [size for _, size in ranges]))
+            success = blob.crc32c == expected_hash
+            logging.info(f'{func_name}: files_match={success}, expected_hash={expected_hash}, '
+                         f'actual_hash={blob.crc32c}')
+            if not success:
+                blob.delete()
+    finally:
+        # Delete the component blobs
+        for component in components:
+            try:
+                component.delete()
+            except NotFound:
+                pass
+
+    return success
+
+
+class CloudStorageSink(io.RawIOBase):
+    """ A writable binary stream that uploads the data written to it to a Google Cloud Storage blob, so that data can
+    be transformed straight into a bucket without saving it to a local file first.
+
+    The data is optionally gzip compressed as it is written and is uploaded in chunks with a resumable upload, so at
+    most one chunk is held in memory. The CRC32C checksum of the uploaded data is computed as it is written and checked
+    against the checksum of the blob when the stream is closed. When a chunk fails, the number of bytes committed by
+    the upload session is queried and the upload continues from there.
+
+    The blob is only created when the stream is closed. When the stream is used as a context manager and an exception
+    is raised, or when the stream is garbage collected without being closed, the upload is cancelled instead.
+    """
+
+    def __init__(self, bucket_name: str, blob_name: str, content_type: str = None, compress: bool = False,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, retries: int = 3):
+        """ Create a CloudStorageSink and start a resumable upload session.
+
+        :param bucket_name: the name of the Google Cloud Storage bucket.
+        :param blob_name: the name of the blob to save.
+        :param content_type: the content type of the blob, guessed from the blob name by default.
+        :param compress: whether to gzip compress the data as it is written.
+        :param chunk_size: the chunk size to use when uploading the blob, must be a multiple of 256 KB.
+        :param retries: the number of times to try each request.
+        """
+
+        super().__init__()
+        if chunk_size % (256 * 1024) != 0:
+            raise ValueError(f'chunk_size must be a multiple of 256 KB: {chunk_size}')
+
+        self.bucket_name = bucket_name
+        self.blob_name = blob_name
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.resource = None
+        self._buffer = bytearray()
+        self._offset = 0
+        self._size = 0
+        self._checksum = Crc32cChecksum()
+        self._compressor = zlib.compressobj(wbits=31) if compress else None
+        self._http = storage_session()
+
+        if content_type is None:
+            content_type = 'application/gzip' if compress else mimetypes.guess_type(blob_name)[0]
+        content_type = content_type or 'application/octet-stream'
+        url = f'{storage_api_endpoint()}/upload/storage/v1/b/{bucket_name}/o'
+        response = self._request(lambda: self._http.post(url, params={'uploadType': 'resumable'},
+                                                         json={'name': blob_name, 'contentType': content_type},
+                                                         headers={'X-Upload-Content-Type': content_type}))
+        self._session_uri = response.headers['Location']
+
+    @property
+    def size(self) -> int:
+        """ The number of bytes written to the blob, after compression. """
+
+        return self._size
+
+    @property
+    def crc32c(self) -> str:
+        """ The base64 encoded CRC32C checksum of the bytes written to the blob, after compression. """
+
+        return hex_to_base64_str(self._checksum.hexdigest())
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        """ Write data to the blob.
+
+        :param b: the data.
+        :return: the number of bytes written.
+        """
+
+        if self.closed:
+            raise ValueError('write to closed CloudStorageSink')
+
+        data = bytes(b)
+        length = len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._append(data)
+        return length
+
+    def _append(self, data: bytes):
+        self._checksum.update(data)
+        self._buffer += data
+        self._size += len(data)
+        while len(self._buffer) >= self.chunk_size:
+            self._upload_chunk(final=False)
+
+    def _request(self, send: Callable, ok_statuses: Tuple[int, ...] = (200,)):
+        """ Send a request, retrying connection errors and retryable status codes with jittered exponential backoff.
+
+        :param send: a function that sends the request and returns the response.
+        :param ok_statuses: the status codes of successful responses.
+        :return: the response.
+        """
+
+        for attempt in range(1, self.retries + 1):
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                error = TransferError(f'{self.blob_name}: {e}', retryable=True)
+            else:
+                if response.status_code in ok_statuses:
+                    return response
+                error = TransferError(f'{self.blob_name}: HTTP {response.status_code}: {response.text}',
+                                      status=response.status_code,
+                                      retryable=response.status_code in RETRYABLE_STATUS_CODES)
+            if not error.retryable or attempt >= self.retries:
+                raise error
+            delay = backoff_delay(attempt, 1., 32.)
+            logging.warning(f'CloudStorageSink: retrying request after error: try={attempt}, delay={delay:.2f}s, '
+                            f'exception={error}')
+            time.sleep(delay)
+
+    def _commit(self, response):
+        """ Drop the data that a 308 response of the upload session says has been committed from the buffer.
+
+        :param response: the response.
+        :return: None.
+        """
+
+        match = re.match(r'bytes=0-(\d+)', response.headers.get('Range', ''))
+        committed = int(match.group(1)) + 1 if match else 0
+        if not self._offset <= committed <= self._offset + len(self._buffer):
+            raise TransferError(f'{self.blob_name}: the upload session committed {committed} bytes, expected between '
+                                f'{self._offset} and {self._offset + len(self._buffer)}')
+        del self._buffer[:committed - self._offset]
+        self._offset = committed
+
+    def _upload_chunk(self, final: bool):
+        """ Upload the next chunk of the buffer to the upload session, or the rest of the buffer when final.
+
+        :param final: whether this is the last chunk of the blob.
+        :return: None.
+        """
+
+        total = str(self._offset + len(self._buffer)) if final else '*'
+        attempts = 0
+
+        def send():
+            nonlocal attempts
+            attempts += 1
+
+            # After a failed attempt, query the bytes committed by the session, so that the upload continues from there
+            if attempts > 1:
+                status = self._http.put(self._session_uri, headers={'Content-Range': f'bytes */{total}'})
+                if status.status_code != 308:
+                    return status
+                self._commit(status)
+
+            data = bytes(self._buffer) if final else bytes(self._buffer[:self.chunk_size])
+            content_range = f'bytes {self._offset}-{self._offset + len(data) - 1}/{total}' if data else \
+                f'bytes */{total}'
+            return self._http.put(self._session_uri, data=data, headers={'Content-Range': content_range})
+
+        response = self._request(send, (200, 201, 308))
+        if response.status_code == 308:
+            self._commit(response)
+        else:
+            self.resource = response.json()
+            self._buffer.clear()
+
+    def close(self):
+        """ Upload the rest of the data and create the blob, checking its CRC32C checksum.
+
+        :return: None.
+        """
+
+        if self.closed:
+            return
+
+        try:
+            if self._compressor is not None:
+                self._append(self._compressor.flush())
+            while self.resource is None:
+                self._upload_chunk(final=True)
+        finally:
+            super().close()
+
+        expected_hash = self.resource.get('crc32c')
+        files_match = expected_hash == self.crc32c
+        logging.info(f'CloudStorageSink: blob_name={self.blob_name}, size={self._size}, files_match={files_match}, '
+                     f'expected_hash={expected_hash}, actual_hash={self.crc32c}')
+        if not files_match:
+            raise TransferError(f'{self.blob_name}: checksum mismatch, expected_hash={expected_hash}, '
+                                f'actual_hash={self.crc32c}')
+
+    def abort(self):
+        """ Cancel the upload without creating the blob.
+
+        :return: None.
+        """
+
+        if self.closed:
+            return
+
+        try:
+            self._http.delete(self._session_uri)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'CloudStorageSink: could not cancel upload of {self.blob_name}: {e}')
+        finally:
+            super().close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __del__(self):
+        # IOBase.__del__ closes the stream, which would create a blob from the data written so far, so a sink that is
+        # dropped without being closed, e.g. after an error, cancels the upload instead
+        try:
+            self.abort()
+        except Exception:
+            pass
+
+
 def azure_to_google_cloud_storage_transfer(azure_storage_account_name: str, azure_sas_token: str, azure_container: str,
                                            include_prefixes: List[str], gc_project_id: str, gc_bucket: str,
                                            description: str, start_date: Pendulum = pendulum.utcnow()) \
@@ -78,6 +78,20 @@ def delete_msg_files(ti: TaskInstance, topic: str, task_id: str, msg_key: str =
             logging.warning(f"No such file or directory {file}: {e}")
 
 
+def transfer_journal_path(directory: str, ti: TaskInstance, name: str) -> str:
+    """ Get the path of the TransferJournal of a task run. The path is the same for every try of the task run, so
+    that a retry can continue the transfers where the previous try stopped.
+
+    :param directory: the directory to keep the journal in.
+    :param ti: the TaskInstance.
+    :param name: a name for the transfers, e.g. the release that they belong to.
+    :return: the path to the journal file.
+    """
+
+    execution_date = ti.execution_date.strftime('%Y%m%dT%H%M%S')
+    return os.path.join(directory, f'.{ti.dag_id}.{ti.task_id}.{execution_date}.{name}.journal')
+
+
 def get_as_list(base: dict, target):
     """ Helper function that returns the target as a list.
 
@@ -0,0 +1,160 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+""" Benchmark of per-call BigQuery clients versus the cached per-process clients, against a mocked transport that
+returns canned BigQuery REST responses. The number of credential discoveries, token refreshes, authorized sessions and
+connection pools created during a simulated workflow run are counted.
+
+Run with: python -m tests.benchmarks.benchmark_bigquery_client --num-tables 50 --auth-latency 0.05
+"""
+
+import argparse
+import json
+import time
+from unittest.mock import patch
+from urllib.parse import urlparse
+
+import google.auth
+import requests
+from google.auth.credentials import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+
+from observatory.platform.utils import gc_utils
+from observatory.platform.utils.gc_utils import (bigquery_table_exists, copy_bigquery_table, create_bigquery_dataset,
+                                                 create_bigquery_view, init_bigquery_clients, make_bigquery_session)
+
+PROJECT_ID = 'benchmark-project'
+
+
+class Counters:
+    """ The number of expensive objects and operations made during a run. """
+
+    def __init__(self):
+        self.auth = 0
+        self.refreshes = 0
+        self.sessions = 0
+        self.pools = 0
+        self.requests = 0
+
+
+counters = Counters()
+
+
+class FakeCredentials(Credentials):
+    """ Credentials that count token refreshes and wait to stand in for a token request. """
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    def refresh(self, request):
+        counters.refreshes += 1
+        time.sleep(self.latency)
+        self.token = 'token'
+
+
+class FakeBigQueryAdapter(HTTPAdapter):
+    """ A transport adapter that returns canned BigQuery REST responses instead of sending requests. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        counters.pools += 1
+
+    def send(self, request, **kwargs):
+        counters.requests += 1
+        path = urlparse(request.url).path.split('/bigquery/v2/')[-1].split('/')
+        if 'jobs' in path:
+            body = {'jobReference': {'projectId': PROJECT_ID, 'jobId': 'job', 'location': 'US'},
+                    'configuration': {'copy': {}}, 'status': {'state': 'DONE'}}
+        elif 'tables' in path:
+            table_id = path[-1] if request.method == 'GET' else json.loads(request.body)['tableReference']['tableId']
+            body = {'tableReference': {'projectId': PROJECT_ID, 'datasetId': path[3], 'tableId': table_id}}
+        else:
+            dataset_id = json.loads(request.body)['datasetReference']['datasetId']
+            body = {'datasetReference': {'projectId': PROJECT_ID, 'datasetId': dataset_id}}
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps(body).encode()
+        response.request = request
+        response.url = request.url
+        return response
+
+
+def per_call_client(project_id: str = None, location: str = None) -> bigquery.Client:
+    """ Make a client the way gc_utils did before the cached clients: new credentials and a new session per call. """
+
+    session, default_project_id = make_bigquery_session()
+    return bigquery.Client(project=project_id or default_project_id, credentials=session.credentials, _http=session,
+                           location=location)
+
+
+def workflow_run(num_tables: int):
+    """ Simulate the BigQuery calls of a workflow run: a dataset is created and for each table the source is checked,
+    copied and a view is created on it.
+
+    :param num_tables: the number of tables.
+    :return: None.
+    """
+
+    create_bigquery_dataset(PROJECT_ID, 'benchmark', 'US')
+    for i in range(num_tables):
+        bigquery_table_exists(PROJECT_ID, 'benchmark', f'table{i}')
+        copy_bigquery_table(f'{PROJECT_ID}.benchmark.table{i}', f'{PROJECT_ID}.copy.table{i}', 'US')
+        create_bigquery_view(PROJECT_ID, 'benchmark', f'view{i}', f'SELECT * FROM benchmark.table{i}')
+
+
+def run(num_tables: int, auth_latency: float):
+    """ Run the benchmark and print the results.
+
+    :param num_tables: the number of tables in the simulated workflow run.
+    :param auth_latency: the seconds that each token refresh takes.
+    :return: None.
+    """
+
+    def default(scopes=None, **kwargs):
+        counters.auth += 1
+        return FakeCredentials(auth_latency), PROJECT_ID
+
+    def authorized_session(*args, **kwargs):
+        counters.sessions += 1
+        return AuthorizedSession(*args, **kwargs)
+
+    print(f'{num_tables} tables, {num_tables * 3 + 1} BigQuery calls, token refresh latency {auth_latency}s')
+    print(f'{"mode":<18}{"seconds":>9}{"auth":>7}{"refreshes":>11}{"sessions":>10}{"pools":>7}{"requests":>10}')
+    with patch.object(google.auth, 'default', default), \
+            patch.object(gc_utils, 'AuthorizedSession', authorized_session), \
+            patch.object(gc_utils, 'HTTPAdapter', FakeBigQueryAdapter):
+        for name, factory in [('per-call client', per_call_client), ('cached client', gc_utils.bigquery_client)]:
+            init_bigquery_clients()
+            counters.__init__()
+            with patch.object(gc_utils, 'bigquery_client', factory):
+                start = time.perf_counter()
+                workflow_run(num_tables)
+                duration = time.perf_counter() - start
+            print(f'{name:<18}{duration:>9.2f}{counters.auth:>7}{counters.refreshes:>11}{counters.sessions:>10}'
+                  f'{counters.pools:>7}{counters.requests:>10}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark cached BigQuery clients.')
+    parser.add_argument('--num-tables', type=int, default=50)
+    parser.add_argument('--auth-latency', type=float, default=0.05)
+    args = parser.parse_args()
+    run(args.num_tables, args.auth_latency)
@@ -0,0 +1,167 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+""" Benchmark of the Crossref Metadata transform: the mawk pipeline that it replaced, one thread per file, versus the
+native transformer in a process pool. The items of the test fixture are repeated to make a release of the given size.
+When the fixture isn't available, e.g. it is a Git LFS pointer, a synthetic item is used instead.
+
+Run with: python -m tests.benchmarks.benchmark_crossref_transform --num-files 16 --items-per-file 500 --max-workers 4
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from observatory.dags.telescopes.crossref_metadata import orjson, transform_release
+from observatory.platform.utils.config_utils import SubFolder
+from tests.observatory.test_utils import test_fixtures_path
+
+# The mawk pipeline that transformed each file before the native transformer
+MAWK_CMD = 'mawk \'BEGIN {FS="\\":";RS=",\\"";OFS=FS;ORS=RS} {for (i=1; i<=NF;i++) if(i != NF) gsub("-", "_", $i)}1\'' \
+           ' {input_file_path} | ' \
+           'mawk \'!/^\\}$|^\\]$|,\\"$/{gsub("\\[\\[", "[");gsub("]]", "]");gsub(/,[ \\t]*$/,"");' \
+           'gsub("\\"timestamp\\":_", "\\"timestamp\\":");gsub("\\"date_parts\\":\\[null]", "\\"date_parts\\":[]");' \
+           'gsub(/^\\{\\"items\\":\\[/,"");print}\' > {output_file_path}'
+
+SYNTHETIC_ITEM = {
+    'DOI': '10.1000/benchmark', 'type': 'journal-article', 'publisher': 'Benchmark Publisher',
+    'title': ['A synthetic item for benchmarking the Crossref Metadata transform'], 'reference-count': 2,
+    'is-referenced-by-count': 10, 'container-title': ['Journal of Benchmarks'], 'ISSN': ['0000-0000'],
+    'indexed': {'date-parts': [[2020, 5, 1]], 'date-time': '2020-05-01T00:00:00Z', 'timestamp': 1588291200000},
+    'published-print': {'date-parts': [[2019, 12]]}, 'published-online': {'date-parts': [[None]]},
+    'author': [{'given': 'Jo-Ann', 'family': 'Smith', 'sequence': 'first', 'affiliation': [{'name': 'University'}]},
+               {'given': 'Li', 'family': 'Wei', 'sequence': 'additional', 'affiliation': []}],
+    'reference': [{'key': f'ref{i}', 'doi-asserted-by': 'crossref', 'DOI': f'10.1000/ref{i}'} for i in range(2)],
+    'link': [{'URL': 'https://example.com/article.pdf', 'content-type': 'application/pdf',
+              'content-version': 'vor', 'intended-application': 'text-mining'}]
+}
+
+
+class BenchmarkRelease:
+    """ A stand-in for a CrossrefMetadataRelease with temporary extract and transform folders. """
+
+    def __init__(self, path: str):
+        self.extract_path = os.path.join(path, SubFolder.extracted.value)
+        self.transform_path = os.path.join(path, SubFolder.transformed.value)
+
+
+def fixture_items() -> List[Dict]:
+    """ Read the items of the test fixture, or a synthetic item when the fixture can't be read.
+
+    :return: the items.
+    """
+
+    path = os.path.join(test_fixtures_path(), 'telescopes', 'crossref_metadata.json.tar.gz')
+    try:
+        items = []
+        with tarfile.open(path, 'r:gz') as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith('.json'):
+                    items += json.load(tar.extractfile(member))['items']
+        return items
+    except (OSError, tarfile.TarError):
+        return [SYNTHETIC_ITEM]
+
+
+def make_release(path: str, num_files: int, items_per_file: int) -> int:
+    """ Write the extracted files of a release in the format of the Crossref snapshot, one item per line.
+
+    :param path: the extract folder.
+    :param num_files: the number of files.
+    :param items_per_file: the number of items in each file.
+    :return: the total size of the files in bytes.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    items = fixture_items()
+    lines = [json.dumps(items[i % len(items)]) for i in range(items_per_file)]
+    data = ('{"items":[' + ',\n'.join(lines) + '\n]\n}\n').encode()
+    for i in range(num_files):
+        with open(os.path.join(path, f'{i}.json'), 'wb') as f:
+            f.write(data)
+    return len(data) * num_files
+
+
+def mawk_transform_release(release: BenchmarkRelease, max_workers: int):
+    """ Transform a release with the mawk pipeline, one thread per file.
+
+    :param release: the release.
+    :param max_workers: the number of threads.
+    :return: None.
+    """
+
+    os.makedirs(release.transform_path, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for file_name in os.listdir(release.extract_path):
+            cmd = MAWK_CMD.replace('{input_file_path}', os.path.join(release.extract_path, file_name)) \
+                .replace('{output_file_path}', os.path.join(release.transform_path, file_name + 'l'))
+            executor.submit(subprocess.run, cmd, shell=True, check=True, executable='/bin/bash')
+
+
+def time_transform(release: BenchmarkRelease, transform: Callable, max_workers: int) -> float:
+    """ Time a transform of a release.
+
+    :param release: the release.
+    :param transform: the transform function.
+    :param max_workers: the number of workers.
+    :return: the seconds taken.
+    """
+
+    shutil.rmtree(release.transform_path, ignore_errors=True)
+    start = time.perf_counter()
+    transform(release, max_workers=max_workers)
+    return time.perf_counter() - start
+
+
+def run(num_files: int, items_per_file: int, max_workers: int):
+    """ Run the benchmark and print the results.
+
+    :param num_files: the number of files in the release.
+    :param items_per_file: the number of items in each file.
+    :param max_workers: the number of threads or processes.
+    :return: None.
+    """
+
+    with tempfile.TemporaryDirectory() as path:
+        release = BenchmarkRelease(path)
+        size = make_release(release.extract_path, num_files, items_per_file)
+        num_items = num_files * items_per_file
+
+        print(f'{num_files} files, {num_items} items, {size / 2 ** 20:.1f} MiB, {max_workers} workers, '
+              f'orjson {"installed" if orjson is not None else "not installed"}')
+        print(f'{"transform":<12}{"seconds":>9}{"MiB/s":>9}{"items/s":>11}')
+        transforms = [('native', transform_release)]
+        if shutil.which('mawk') is not None:
+            transforms.insert(0, ('mawk', mawk_transform_release))
+        for name, transform in transforms:
+            duration = time_transform(release, transform, max_workers)
+            print(f'{name:<12}{duration:>9.2f}{size / 2 ** 20 / duration:>9.1f}{num_items / duration:>11.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Crossref Metadata transform.')
+    parser.add_argument('--num-files', type=int, default=16)
+    parser.add_argument('--items-per-file', type=int, default=500)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    run(args.num_files, args.items_per_file, args.max_workers)
@@ -0,0 +1,98 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+""" Benchmark of per-blob Cloud Storage clients versus the pooled per-process client, against a local FakeGcsServer.
+
+Run with: python -m tests.benchmarks.benchmark_storage_client --num-files 200 --connection-latency 0.02
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from observatory.platform.utils.gc_utils import (download_blob_from_cloud_storage, init_storage_client,
+                                                 upload_file_to_cloud_storage)
+from tests.observatory.fake_gcs_server import FakeGcsServer, make_emulator_env
+
+
+def per_blob_client_upload(bucket_name: str, blob_name: str, file_path: str):
+    """ Upload a file the way gc_utils did before the pooled client: a new client and bucket lookup per blob. """
+
+    client = storage.Client(project=os.environ['GOOGLE_CLOUD_PROJECT'], credentials=AnonymousCredentials())
+    bucket = client.get_bucket(bucket_name)
+    blob = bucket.blob(blob_name)
+    blob.exists()
+    blob.upload_from_filename(file_path)
+
+
+def per_blob_client_download(bucket_name: str, blob_name: str, file_path: str):
+    """ Download a blob the way gc_utils did before the pooled client: a new client per blob. """
+
+    client = storage.Client(project=os.environ['GOOGLE_CLOUD_PROJECT'], credentials=AnonymousCredentials())
+    blob = client.bucket(bucket_name).blob(blob_name)
+    blob.reload()
+    blob.download_to_filename(file_path)
+
+
+def run(num_files: int, file_size: int, connection_latency: float):
+    """ Run the benchmark and print the results.
+
+    :param num_files: the number of files to transfer in each direction.
+    :param file_size: the size of each file in bytes.
+    :param connection_latency: the seconds the server waits on each new connection, standing in for TLS and auth.
+    :return: None.
+    """
+
+    with FakeGcsServer(connection_latency=connection_latency) as server, tempfile.TemporaryDirectory() as tmp:
+        server.create_bucket('benchmark')
+        with patch.dict(os.environ, make_emulator_env(server)):
+            init_storage_client()
+            file_paths = []
+            for i in range(num_files):
+                file_path = os.path.join(tmp, f'{i}.bin')
+                with open(file_path, 'wb') as f:
+                    f.write(os.urandom(file_size))
+                file_paths.append(file_path)
+
+            cases = [('per-blob client', per_blob_client_upload, per_blob_client_download),
+                     ('pooled client', upload_file_to_cloud_storage, download_blob_from_cloud_storage)]
+            print(f'{num_files} files of {file_size} bytes, connection latency {connection_latency}s')
+            print(f'{"mode":<18}{"direction":<11}{"files/sec":>10}{"connections":>13}')
+            for name, upload, download in cases:
+                for direction, func in [('upload', upload), ('download', download)]:
+                    server.reset_stats()
+                    start = time.perf_counter()
+                    for i, file_path in enumerate(file_paths):
+                        if direction == 'upload':
+                            func('benchmark', f'{name}/{i}.bin', file_path)
+                        else:
+                            func('benchmark', f'{name}/{i}.bin', f'{file_path}.{name}')
+                    duration = time.perf_counter() - start
+                    print(f'{name:<18}{direction:<11}{num_files / duration:>10.1f}{server.num_connections:>13}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pooled Cloud Storage clients.')
+    parser.add_argument('--num-files', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=4 * 1024)
+    parser.add_argument('--connection-latency', type=float, default=0.02)
+    args = parser.parse_args()
+    run(args.num_files, args.file_size, args.connection_latency)
@@ -15,6 +15,8 @@
 # Author: Aniek Roelofs
 
 import glob
+import gzip
+import json
 import logging
 import os
 import shutil
@@ -30,6 +32,8 @@ from observatory.dags.telescopes.crossref_metadata import (
     CrossrefMetadataRelease,
     CrossrefMetadataTelescope,
     extract_release,
+    extract_transform_release,
+    transform_item,
     transform_release
 )
 from observatory.platform.utils.config_utils import telescope_path, SubFolder
@@ -52,6 +56,8 @@ class TestCrossrefMetadata(unittest.TestCase):
         self.crossref_release_exists_path = os.path.join(test_fixtures_path(), 'vcr_cassettes',
                                                          'crossref_release_exists.yaml')
         self.test_release_path = os.path.join(test_fixtures_path(), 'telescopes', 'crossref_metadata.json.tar.gz')
+        self.test_items_path = os.path.join(test_fixtures_path(), 'telescopes', 'crossref_metadata_items.json')
+        self.expected_items_path = os.path.join(test_fixtures_path(), 'telescopes', 'crossref_metadata_items.jsonl')
         self.year = 3000
         self.month = 1
         self.date = pendulum.datetime(year=3000, month=1, day=1)
@@ -63,9 +69,6 @@ class TestCrossrefMetadata(unittest.TestCase):
         self.extract_hashes = ['d7acd01f729d62fbbaffa50b534025b2', '634724e4c9f773ca3b5a81b20f0ff005',
                                '2392895c2dacd6176b140435e97e1840', 'd1157cf952d4694d4f4c08ee36a18116',
                                '4128088d14446682bde8a1a1bc5e15b5']
-        self.transform_hashes = ['5f27af4d3080b56484fa5567230aaf92', '10717291388b1c232416e720f6ec3f3d',
-                                 '92faa40aa9353c832cd66349d32950ad', 'c98c07927b6b978696ffaf81ee632bbb',
-                                 '92a3ac8f3110da83fcaede58e30f6ec3']
 
         # Turn logging to warning because vcr prints too much at info level
         logging.basicConfig()
@@ -198,9 +201,99 @@ class TestCrossrefMetadata(unittest.TestCase):
             self.assertTrue(success)
             self.assertTrue(os.path.exists(release.transform_path))
 
-            # Check files are correct
-            file_paths = natsorted(glob.glob(f'{release.transform_path}/*.jsonl'))
+            # Check files are correct: one item per line, without hyphens in keys and with flat date parts
+            file_paths = natsorted(glob.glob(f'{release.transform_path}/*.jsonl.gz'))
             self.assertEqual(self.num_files, len(file_paths))
 
-            for md5sum, file_path in zip(self.transform_hashes, file_paths):
-                self.assertEqual(md5sum, _hash_file(file_path, algorithm='md5'))
+            def check(value):
+                if isinstance(value, dict):
+                    for key, child in value.items():
+                        self.assertNotIn('-', key)
+                        if key == 'date_parts':
+                            self.assertTrue(all(isinstance(part, int) for part in child))
+                        check(child)
+                elif isinstance(value, list):
+                    for child in value:
+                        check(child)
+
+            for file_path in file_paths:
+                with gzip.open(file_path, 'rt') as f:
+                    items = [json.loads(line) for line in f]
+                self.assertTrue(len(items) > 0)
+                for item in items:
+                    self.assertIn('DOI', item)
+                    check(item)
+
+        # Check the transformed items against the expected items of a golden file
+        with CliRunner().isolated_filesystem():
+            release = CrossrefMetadataRelease(self.year, self.month)
+            os.makedirs(release.extract_path, exist_ok=True)
+            shutil.copyfile(self.test_items_path, os.path.join(release.extract_path, '0.json'))
+
+            success = transform_release(release)
+            self.assertTrue(success)
+
+            with gzip.open(os.path.join(release.transform_path, '0.jsonl.gz'), 'rt', encoding='utf-8') as f:
+                actual = [json.loads(line) for line in f]
+            with open(self.expected_items_path, encoding='utf-8') as f:
+                expected = [json.loads(line) for line in f]
+            self.assertEqual(expected, actual)
+
+    @patch('observatory.platform.utils.config_utils.airflow.models.Variable.get')
+    def test_extract_transform_release(self, mock_variable_get):
+        """ Test that extracting and transforming the release in a single pass makes the same files as extracting and
+        then transforming it, with and without pigz.
+
+        :return: None.
+        """
+
+        # Mock data variable
+        data_path = 'data'
+        mock_variable_get.return_value = data_path
+
+        with CliRunner().isolated_filesystem():
+            release = CrossrefMetadataRelease(self.year, self.month)
+
+            # 'download' release
+            shutil.copyfile(self.test_release_path, release.download_path)
+
+            # Extract and transform the release in two passes
+            self.assertTrue(extract_release(release))
+            self.assertTrue(transform_release(release))
+            expected = {}
+            for file_path in glob.glob(f'{release.transform_path}/*.jsonl.gz'):
+                with gzip.open(file_path) as f:
+                    expected[os.path.basename(file_path)] = f.read()
+            self.assertEqual(self.num_files, len(expected))
+            shutil.rmtree(release.extract_path)
+
+            for pigz in ['pigz', None]:
+                shutil.rmtree(release.transform_path)
+                with patch('observatory.dags.telescopes.crossref_metadata.shutil.which', return_value=pigz):
+                    self.assertTrue(extract_transform_release(release))
+
+                # No extracted files are written
+                self.assertFalse(os.path.exists(release.extract_path))
+                actual = {}
+                for file_path in glob.glob(f'{release.transform_path}/*.jsonl.gz'):
+                    with gzip.open(file_path) as f:
+                        actual[os.path.basename(file_path)] = f.read()
+                self.assertEqual(expected, actual)
+
+    def test_transform_item(self):
+        """ Test that the keys and dates of an item are transformed.
+
+        :return: None.
+        """
+
+        item = {'DOI': '10.1000/abc-def', 'reference-count': 2,
+                'indexed': {'date-parts': [[2020, 5, 1]], 'date-time': '2020-05-01T00:00:00Z', 'timestamp': -1000},
+                'published-print': {'date-parts': [[None]]},
+                'author': [{'given': 'Jo-Ann', 'ORCID': 'http://orcid.org/0000-0000-0000-0000'}],
+                'title': ['A well-known title']}
+        expected = {'DOI': '10.1000/abc-def', 'reference_count': 2,
+                    'indexed': {'date_parts': [2020, 5, 1], 'date_time': '2020-05-01T00:00:00Z', 'timestamp': -1000},
+                    'published_print': {'date_parts': []},
+                    'author': [{'given': 'Jo-Ann', 'ORCID': 'http://orcid.org/0000-0000-0000-0000'}],
+                    'title': ['A well-known title']}
+        self.assertEqual(expected, transform_item(item))
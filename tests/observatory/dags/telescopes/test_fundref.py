@@ -14,6 +14,7 @@
 
 # Author: Aniek Roelofs
 
+import gzip
 import logging
 import os
 import shutil
@@ -40,7 +41,8 @@ from observatory.dags.telescopes.fundref import (
 from observatory.platform.utils.config_utils import telescope_path, SubFolder
 from observatory.platform.utils.data_utils import _hash_file
 from observatory.platform.utils.gc_utils import gzip_file_crc
-from tests.observatory.test_utils import test_fixtures_path
+from tests.observatory.fake_gcs_server import FakeGcsServer, make_emulator_env
+from tests.observatory.test_utils import random_id, test_fixtures_path
 
 
 class TestFundref(unittest.TestCase):
@@ -236,6 +238,33 @@ class TestFundref(unittest.TestCase):
             self.assertEqual(self.fundref_test_transform_file_name, transform_file_name)
             self.assertEqual(self.fundref_test_transform_hash, gzip_file_crc(transform_file_path))
 
+    @patch('observatory.platform.utils.config_utils.airflow.models.Variable.get')
+    def test_transform_release_streamed(self, mock_variable_get):
+        """ Test that a release streamed to a bucket is the same as the release saved locally.
+
+        :return: None.
+        """
+
+        # Mock data variable
+        data_path = 'data'
+        mock_variable_get.return_value = data_path
+
+        with CliRunner().isolated_filesystem(), FakeGcsServer() as server:
+            release = FundrefRelease(self.fundref_test_url, self.fundref_test_date)
+            shutil.copyfile(self.fundref_test_path, release.filepath_download)
+            extract_release(release)
+
+            bucket_name = random_id()
+            server.create_bucket(bucket_name)
+            with patch.dict(os.environ, make_emulator_env(server)):
+                transform_release(release, bucket_name=bucket_name)
+            self.assertFalse(os.path.exists(release.filepath_transform))
+
+            transform_release(release)
+            blob = server.get_object(bucket_name, release.get_blob_name(SubFolder.transformed))
+            with gzip.open(release.filepath_transform, 'rb') as f:
+                self.assertEqual(f.read(), gzip.decompress(blob.data))
+
     @patch('observatory.platform.utils.config_utils.airflow.models.Variable.get')
     def test_parse_fundref_registry_rdf(self, mock_variable_get):
         """ Test that correct funders list and dictionary are returned when parsing funders registry.
@@ -15,19 +15,24 @@
 # Author: James Diprose
 
 import glob
+import gzip
+import json
 import logging
 import os
 import unittest
 from typing import List, Dict
+from unittest.mock import MagicMock, patch
 
+import pendulum
 import vcr
 from click.testing import CliRunner
 
-from observatory.dags.telescopes.grid import (list_grid_releases, download_grid_release, extract_grid_release,
-                                              transform_grid_release)
+from observatory.dags.telescopes.grid import (GridTelescope, list_grid_releases, download_grid_release,
+                                              extract_grid_release, grid_blob_name, transform_grid_release)
 from observatory.platform.utils.data_utils import _hash_file
 from observatory.platform.utils.gc_utils import gzip_file_crc
-from tests.observatory.test_utils import test_fixtures_path
+from tests.observatory.fake_gcs_server import FakeGcsServer, make_emulator_env
+from tests.observatory.test_utils import random_id, test_fixtures_path
 
 
 class TestGrid(unittest.TestCase):
@@ -146,3 +151,51 @@ class TestGrid(unittest.TestCase):
                 self.assertTrue(os.path.exists(file_path))
                 gzip_crc = gzip_file_crc(file_path)
                 self.assertEqual(self.grid_2020_03_15_transform_crc, gzip_crc)
+
+    def test_transform_grid_release_streamed(self):
+        """ Test that a GRID release streamed to a bucket is the same as the release saved locally.
+
+        :return: None.
+        """
+
+        institutes = [{'id': f'grid.{i}.1', 'name': f'Institute {i}', 'types': ['Education']} for i in range(1000)]
+        with CliRunner().isolated_filesystem(), FakeGcsServer() as server:
+            release_json_file = 'grid.json'
+            with open(release_json_file, 'w') as f:
+                json.dump({'version': 'release_2020_03_15', 'institutes': institutes}, f)
+
+            bucket_name = random_id()
+            server.create_bucket(bucket_name)
+            with patch.dict(os.environ, make_emulator_env(server)):
+                version, file_name, file_path = transform_grid_release(release_json_file, self.work_dir,
+                                                                       bucket_name=bucket_name)
+            self.assertFalse(os.path.exists(file_path))
+
+            transform_grid_release(release_json_file, self.work_dir)
+            blob = server.get_object(bucket_name, grid_blob_name(file_name))
+            with gzip.open(file_path, 'rb') as f:
+                self.assertEqual(f.read(), gzip.decompress(blob.data))
+
+    @patch('observatory.dags.telescopes.grid.upload_file_to_cloud_storage')
+    @patch('observatory.dags.telescopes.grid.Variable.get')
+    def test_upload_transformed(self, mock_variable_get, mock_upload):
+        """ Test that only the releases that weren't streamed to the transform bucket are uploaded.
+
+        :return: None.
+        """
+
+        mock_variable_get.return_value = 'bucket'
+        ti = MagicMock()
+        ti.xcom_pull.return_value = [
+            {'json_gz_file_name': 'grid_2020_03_15.jsonl.gz', 'json_gz_file_path': 'grid_2020_03_15.jsonl.gz',
+             'streamed': True},
+            {'json_gz_file_name': 'grid_2020_04_15.jsonl.gz', 'json_gz_file_path': 'grid_2020_04_15.jsonl.gz',
+             'streamed': False}
+        ]
+        GridTelescope.upload_transformed(ti=ti, execution_date=pendulum.datetime(2020, 5, 1))
+
+        mock_upload.assert_called_once_with('bucket', 'telescopes/grid/grid_2020_04_15.jsonl.gz',
+                                            file_path='grid_2020_04_15.jsonl.gz')
+        msgs_out = ti.xcom_push.call_args[0][1]
+        self.assertEqual(['telescopes/grid/grid_2020_03_15.jsonl.gz', 'telescopes/grid/grid_2020_04_15.jsonl.gz'],
+                         [msg['blob_name'] for msg in msgs_out])
@@ -203,6 +203,49 @@ class TestMag(unittest.TestCase):
             actual_files = natsort.natsorted(actual_files)
             self.assertEqual(expected_files, actual_files)
 
+    def test_transform_mag_release_shards(self):
+        """ Tests that transform_mag_release splits large files into shards at newlines and names the shards so that
+        each table is loaded with one wildcard.
+
+        :return: None.
+        """
+
+        with CliRunner().isolated_filesystem():
+            # Make a release with a small file and a large table that is split over two files
+            lines = [f'{i}\tName\x00 {i}\r\n'.encode() for i in range(100)]
+            files = {'mag/Affiliations.txt': lines[:2],
+                     'nlp/PaperAbstractsInvertedIndex.txt.1': lines[:60],
+                     'nlp/PaperAbstractsInvertedIndex.txt.2': lines[60:]}
+            input_release_path = os.path.join(self.extracted_folder, self.release_folder)
+            for file_name, file_lines in files.items():
+                file_path = os.path.join(input_release_path, file_name)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'wb') as f:
+                    f.writelines(file_lines)
+
+            # Transform release with shards that are smaller than the table files
+            output_release_path = os.path.join(self.transformed_folder, self.release_folder)
+            result = transform_mag_release(input_release_path, output_release_path, max_workers=2, shard_size=500)
+            self.assertTrue(result)
+
+            # Small files keep their names and the shards of the split table are numbered in order
+            actual_files = natsort.natsorted(os.listdir(output_release_path))
+            self.assertEqual('Affiliations.txt', actual_files[0])
+            shard_files = actual_files[1:]
+            self.assertGreater(len(shard_files), 2)
+            self.assertEqual([f'PaperAbstractsInvertedIndex.txt.{i}' for i in range(1, len(shard_files) + 1)],
+                             shard_files)
+
+            # Each shard ends at a newline and together the shards contain every cleaned line in order
+            data = b''
+            for file_name in shard_files:
+                with open(os.path.join(output_release_path, file_name), 'rb') as f:
+                    shard = f.read()
+                self.assertTrue(shard.endswith(b'\n'))
+                data += shard
+            expected_data = b''.join(lines).replace(b'\r', b'').replace(b'\x00', b'')
+            self.assertEqual(expected_data, data)
+
     def test_bq_load_mag_release(self):
         """ Tests that db_load_mag_release successfully loads a MAG release into BigQuery.
 
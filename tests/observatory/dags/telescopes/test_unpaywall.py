@@ -14,6 +14,9 @@
 
 # Author: Aniek Roelofs
 
+import gzip
+import hashlib
+import io
 import logging
 import os
 import shutil
@@ -25,15 +28,20 @@ import pendulum
 import vcr
 from click.testing import CliRunner
 
+from observatory.dags.config import schema_path
 from observatory.dags.telescopes.unpaywall import (
+    UnpaywallChangefile,
     UnpaywallRelease,
     UnpaywallTelescope,
-    extract_release,
+    download_changefile,
+    list_changefiles,
     list_releases,
-    transform_release
+    make_merge_changes_query,
+    transform_release,
+    transform_stream
 )
-from observatory.platform.utils.config_utils import telescope_path, SubFolder
-from observatory.platform.utils.data_utils import _hash_file
+from observatory.platform.utils.config_utils import find_schema, telescope_path, SubFolder
+from tests.observatory.fake_unpaywall_feed import FakeUnpaywallFeed
 from tests.observatory.test_utils import test_fixtures_path
 
 
@@ -63,8 +71,9 @@ class TestUnpaywall(unittest.TestCase):
         self.unpaywall_test_decompress_file_name = 'unpaywall_3000_01_27.jsonl'
         self.unpaywall_test_transform_file_name = 'unpaywall_3000_01_27.jsonl'
         self.unpaywall_test_download_hash = '90051478f7b6689838d58edfc2450cb3'
-        self.unpaywall_test_decompress_hash = 'fe4e72ce54c4bb236802ddbb3dbee905'
         self.unpaywall_test_transform_hash = '62cbb5af5a78d2e0769a28d976971cba'
+        self.changefile_name = 'changed_dois_with_versions_3000-01-20T080001_to_3000-01-27T080001.jsonl.gz'
+        self.changefile_download_file_name = 'unpaywall_changes_3000_01_27.jsonl.gz'
         self.start_date = pendulum.datetime(year=2018, month=3, day=29)
         self.end_date = pendulum.datetime(year=2020, month=4, day=29)
 
@@ -151,8 +160,8 @@ class TestUnpaywall(unittest.TestCase):
             self.assertEqual(os.path.join(path, self.unpaywall_test_transform_file_name), release.filepath_transform)
 
     @patch('observatory.platform.utils.config_utils.airflow.models.Variable.get')
-    def test_extract_release(self, mock_variable_get):
-        """ Test that the release is decompressed as expected.
+    def test_transform_release(self, mock_variable_get):
+        """ Test that the release is transformed into gzipped shards as expected, with and without pigz.
 
         :return: None.
         """
@@ -163,19 +172,85 @@ class TestUnpaywall(unittest.TestCase):
 
         with CliRunner().isolated_filesystem():
             release = UnpaywallRelease(self.unpaywall_test_file, self.unpaywall_test_date, self.unpaywall_test_date)
-            # 'download' release
             shutil.copyfile(self.unpaywall_test_path, release.filepath_download)
 
-            decompress_file_path = extract_release(release)
-            decompress_file_name = os.path.basename(decompress_file_path)
+            # The lines of the transformed release, in any order
+            with gzip.open(self.unpaywall_test_path, 'rb') as f_in:
+                with io.BytesIO() as f_out:
+                    transform_stream(f_in, f_out)
+                    expected = sorted(f_out.getvalue().splitlines())
+
+            for pigz in ['pigz', None]:
+                with patch('observatory.dags.telescopes.unpaywall.shutil.which', return_value=pigz):
+                    shards_path = transform_release(release, num_shards=3, read_size=1000)
+                self.assertEqual(release.path_transform_shards, shards_path)
+
+                # The lines are dealt between the shards
+                file_names = sorted(os.listdir(shards_path))
+                self.assertEqual(['0.jsonl.gz', '1.jsonl.gz', '2.jsonl.gz'], file_names)
+                lines = []
+                for file_name in file_names:
+                    with gzip.open(os.path.join(shards_path, file_name), 'rb') as f:
+                        shard_lines = f.read().splitlines()
+                    self.assertTrue(len(shard_lines) > 0)
+                    lines += shard_lines
+                self.assertEqual(expected, sorted(lines))
+                shutil.rmtree(shards_path)
+
+    def test_transform_stream(self):
+        """ Test that a release is transformed as expected when it is streamed in blocks that split lines.
+
+        :return: None.
+        """
+
+        with gzip.open(self.unpaywall_test_path, 'rb') as f_in:
+            with io.BytesIO() as f_out:
+                transform_stream(f_in, f_out, read_size=1000)
+                self.assertEqual(self.unpaywall_test_transform_hash, hashlib.md5(f_out.getvalue()).hexdigest())
+
+    def make_changefile(self, num_lines: int) -> bytes:
+        """ Make a changefile from the first lines of the test release.
+
+        :param num_lines: the number of lines.
+        :return: the gzipped changefile.
+        """
+
+        with gzip.open(self.unpaywall_test_path, 'rb') as f:
+            lines = [f.readline() for _ in range(num_lines)]
+        return gzip.compress(b''.join(lines))
+
+    def test_list_changefiles(self):
+        """ Test that the JSON Lines changefiles modified within the period are listed from the data feed.
+
+        :return: None.
+        """
 
-            self.assertTrue(os.path.exists(decompress_file_path))
-            self.assertEqual(self.unpaywall_test_decompress_file_name, decompress_file_name)
-            self.assertEqual(self.unpaywall_test_decompress_hash, _hash_file(decompress_file_path, algorithm='md5'))
+        with FakeUnpaywallFeed('api-key') as feed:
+            data = self.make_changefile(10)
+            feed.add_changefile(self.changefile_name, data, '3000-01-27T08:32:00')
+            feed.add_changefile(self.changefile_name.replace('.jsonl.gz', '.csv.gz'), data, '3000-01-27T08:32:00',
+                                filetype='csv')
+            feed.add_changefile('changed_dois_with_versions_3000-01-13T080001_to_3000-01-20T080001.jsonl.gz', data,
+                                '3000-01-20T08:32:00')
+
+            with patch.object(UnpaywallTelescope, 'CHANGEFILES_URL', feed.changefiles_url):
+                changefiles = list_changefiles(pendulum.datetime(3000, 1, 24), pendulum.datetime(3000, 1, 31),
+                                               'api-key')
+
+                self.assertEqual(1, len(changefiles))
+                changefile = changefiles[0]
+                self.assertIsInstance(changefile, UnpaywallChangefile)
+                self.assertEqual(self.unpaywall_test_date, changefile.release_date)
+                self.assertEqual(f'{feed.endpoint}/daily-feed/changefile/{self.changefile_name}', changefile.url)
+                self.assertIn('interval=week', feed.requests[0])
+
+                # A wrong API key is an error
+                with self.assertRaises(ConnectionError):
+                    list_changefiles(pendulum.datetime(3000, 1, 24), pendulum.datetime(3000, 1, 31), 'wrong-key')
 
     @patch('observatory.platform.utils.config_utils.airflow.models.Variable.get')
-    def test_transform_release(self, mock_variable_get):
-        """ Test that the release is transformed as expected.
+    def test_download_transform_changefile(self, mock_variable_get):
+        """ Test that a changefile is downloaded from the data feed and only its records are transformed.
 
         :return: None.
         """
@@ -184,14 +259,40 @@ class TestUnpaywall(unittest.TestCase):
         data_path = 'data'
         mock_variable_get.return_value = data_path
 
-        with CliRunner().isolated_filesystem():
-            release = UnpaywallRelease(self.unpaywall_test_file, self.unpaywall_test_date, self.unpaywall_test_date)
-            shutil.copyfile(self.unpaywall_test_path, release.filepath_download)
+        with CliRunner().isolated_filesystem(), FakeUnpaywallFeed('api-key') as feed:
+            data = self.make_changefile(10)
+            feed.add_changefile(self.changefile_name, data, '3000-01-27T08:32:00')
+
+            with patch.object(UnpaywallTelescope, 'CHANGEFILES_URL', feed.changefiles_url):
+                changefile = list_changefiles(pendulum.datetime(3000, 1, 24), pendulum.datetime(3000, 1, 31),
+                                              'api-key')[0]
+
+            # The changefile is saved under its own name, apart from the snapshot releases
+            file_path = download_changefile(changefile, 'api-key')
+            self.assertEqual(self.changefile_download_file_name, os.path.basename(file_path))
+            with open(file_path, 'rb') as f:
+                self.assertEqual(data, f.read())
+
+            shards_path = transform_release(changefile, num_shards=2, read_size=1000)
+            lines = []
+            for file_name in sorted(os.listdir(shards_path)):
+                with gzip.open(os.path.join(shards_path, file_name), 'rb') as f:
+                    lines += f.read().splitlines()
+            expected = gzip.decompress(data).replace(b'authenticated-orcid', b'authenticated_orcid').splitlines()
+            self.assertEqual(sorted(expected), sorted(lines))
+
+    def test_make_merge_changes_query(self):
+        """ Test that the changes are merged into the release table on their doi.
+
+        :return: None.
+        """
 
-            extract_release(release)
-            transform_file_path = transform_release(release)
-            transform_file_name = os.path.basename(transform_file_path)
+        schema_file_path = find_schema(schema_path(), UnpaywallTelescope.DAG_ID, self.unpaywall_test_date)
+        query = make_merge_changes_query('project', 'our_research', 'unpaywall30000127',
+                                         'unpaywall_changes30000127', schema_file_path)
 
-            self.assertTrue(os.path.exists(transform_file_path))
-            self.assertEqual(self.unpaywall_test_transform_file_name, transform_file_name)
-            self.assertEqual(self.unpaywall_test_transform_hash, _hash_file(transform_file_path, algorithm='md5'))
+        self.assertIn('MERGE `project.our_research.unpaywall30000127`', query)
+        self.assertIn('FROM `project.our_research.unpaywall_changes30000127`', query)
+        self.assertIn('ON target.doi = changes.doi', query)
+        self.assertIn('`is_oa` = changes.`is_oa`', query)
+        self.assertIn('INSERT (`best_oa_location`', query)
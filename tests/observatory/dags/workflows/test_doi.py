@@ -14,20 +14,36 @@
 
 # Author: James Diprose
 
+import importlib
 import os
 import unittest
+from unittest.mock import patch
 
 import pendulum
+from airflow import DAG
 from airflow.exceptions import AirflowException
 from google.cloud import bigquery
 
-from observatory.dags.workflows.doi import (select_table_suffixes,
+from observatory.dags.workflows.doi import (DoiWorkflow,
+                                            select_table_suffixes,
                                             set_task_state)
 from observatory.platform.utils.gc_utils import (create_bigquery_dataset, bigquery_partitioned_table_id,
                                                  create_bigquery_table_from_query)
 from tests.observatory.test_utils import random_id
 
 
+def load_doi_dag(fan_out: bool) -> DAG:
+    """ Load the DOI DAG with fan-out on or off.
+
+    :param fan_out: the value of DoiWorkflow.FAN_OUT.
+    :return: the DAG.
+    """
+
+    with patch.object(DoiWorkflow, 'FAN_OUT', fan_out):
+        module = importlib.reload(importlib.import_module('observatory.dags.dags.doi'))
+    return module.dag
+
+
 class TestDoi(unittest.TestCase):
     """ Tests for the functions used by the Doi workflow """
 
@@ -42,6 +58,37 @@ class TestDoi(unittest.TestCase):
         with self.assertRaises(AirflowException):
             set_task_state(False, 'my-task-id')
 
+    def test_dag_structure(self):
+        # Without fan-out, which is the default, each table is created by its own task
+        self.assertFalse(DoiWorkflow.FAN_OUT)
+        dag = load_doi_dag(False)
+        self.assertNotIn(DoiWorkflow.TASK_ID_PREPROCESS, dag.task_ids)
+        self.assertNotIn(DoiWorkflow.TASK_ID_CREATE_ENTITIES, dag.task_ids)
+        self.assertEqual({DoiWorkflow.TASK_ID_CREATE_DATASETS},
+                         dag.get_task(DoiWorkflow.TASK_ID_EXTEND_GRID).upstream_task_ids)
+        self.assertEqual(set(DoiWorkflow.PREPROCESSING_TASK_IDS),
+                         dag.get_task(DoiWorkflow.TASK_ID_CREATE_DOI).upstream_task_ids)
+        self.assertEqual(set(DoiWorkflow.ENTITY_TASK_IDS),
+                         dag.get_task(DoiWorkflow.TASK_ID_CREATE_DOI).downstream_task_ids)
+        self.assertEqual(set(DoiWorkflow.ENTITY_TASK_IDS),
+                         dag.get_task(DoiWorkflow.TASK_ID_COPY_TABLES).upstream_task_ids)
+
+        # With fan-out, the tables of each group are created by a single task
+        dag = load_doi_dag(True)
+        for task_id in DoiWorkflow.PREPROCESSING_TASK_IDS + DoiWorkflow.ENTITY_TASK_IDS:
+            self.assertNotIn(task_id, dag.task_ids)
+        self.assertEqual({DoiWorkflow.TASK_ID_CREATE_DATASETS},
+                         dag.get_task(DoiWorkflow.TASK_ID_PREPROCESS).upstream_task_ids)
+        self.assertEqual({DoiWorkflow.TASK_ID_PREPROCESS},
+                         dag.get_task(DoiWorkflow.TASK_ID_CREATE_DOI).upstream_task_ids)
+        self.assertEqual({DoiWorkflow.TASK_ID_CREATE_ENTITIES},
+                         dag.get_task(DoiWorkflow.TASK_ID_CREATE_DOI).downstream_task_ids)
+        self.assertEqual({DoiWorkflow.TASK_ID_COPY_TABLES},
+                         dag.get_task(DoiWorkflow.TASK_ID_CREATE_ENTITIES).downstream_task_ids)
+
+        # The DAG is left as it is configured
+        load_doi_dag(DoiWorkflow.FAN_OUT)
+
     def test_select_table_suffixes(self):
         client = bigquery.Client()
         dataset_id = random_id()
@@ -0,0 +1,454 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import base64
+import hashlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from google_crc32c import Checksum as Crc32cChecksum
+
+
+@dataclass
+class FakeObject:
+    """ An object stored in a FakeGcsServer bucket. """
+
+    name: str
+    data: bytes
+    generation: int
+    content_type: str = 'application/octet-stream'
+    updated: float = field(default_factory=time.time)
+
+    def resource(self, bucket_name: str) -> Dict:
+        """ Make the JSON API resource for the object.
+
+        :param bucket_name: the name of the bucket holding the object.
+        :return: the resource.
+        """
+
+        crc = Crc32cChecksum(self.data)
+        return {
+            'kind': 'storage#object',
+            'id': f'{bucket_name}/{self.name}/{self.generation}',
+            'name': self.name,
+            'bucket': bucket_name,
+            'generation': str(self.generation),
+            'metageneration': '1',
+            'contentType': self.content_type,
+            'size': str(len(self.data)),
+            'crc32c': base64.b64encode(crc.digest()).decode('utf-8'),
+            'md5Hash': base64.b64encode(hashlib.md5(self.data).digest()).decode('utf-8'),
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(self.updated))
+        }
+
+
+@dataclass
+class ResumableSession:
+    """ The state of a resumable upload session. """
+
+    bucket_name: str
+    name: str
+    content_type: str
+    data: bytearray = field(default_factory=bytearray)
+
+
+class FakeGcsServer:
+    """ A small in-process implementation of the Google Cloud Storage JSON API, for tests and benchmarks.
+
+    Supports getting buckets, listing, getting, downloading (including byte ranges), composing and deleting objects
+    and multipart, media and resumable uploads. Point the Google Cloud Storage clients at it by setting the
+    STORAGE_EMULATOR_HOST environment variable to FakeGcsServer.endpoint.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 0, connection_latency: float = 0.,
+                 page_size: int = 1000):
+        """ Create a FakeGcsServer.
+
+        :param host: the host to listen on.
+        :param port: the port to listen on, 0 picks a free port.
+        :param connection_latency: seconds to sleep when a new connection is accepted, used to emulate the cost of a
+        TLS and authentication handshake.
+        :param page_size: the maximum number of items returned by each page of an object listing.
+        """
+
+        self.host = host
+        self.port = port
+        self.connection_latency = connection_latency
+        self.page_size = page_size
+        self.buckets: Dict[str, Dict[str, FakeObject]] = {}
+        self.sessions: Dict[str, ResumableSession] = {}
+        self.requests: List[Tuple[str, str]] = []
+        self.num_connections = 0
+        self.fail_next: List[int] = []
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        """ The URL of the server.
+
+        :return: the URL.
+        """
+
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        """ Start the server in a background thread.
+
+        :return: None.
+        """
+
+        self._server = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the server.
+
+        :return: None.
+        """
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'FakeGcsServer':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def reset_stats(self):
+        """ Reset the request and connection counters.
+
+        :return: None.
+        """
+
+        with self._lock:
+            self.requests = []
+            self.num_connections = 0
+
+    def count_requests(self, method: str = None) -> int:
+        """ Count the requests received by the server.
+
+        :param method: only count requests with this HTTP method.
+        :return: the number of requests.
+        """
+
+        with self._lock:
+            return len([r for r in self.requests if method is None or r[0] == method])
+
+    def create_bucket(self, bucket_name: str):
+        """ Create a bucket.
+
+        :param bucket_name: the name of the bucket.
+        :return: None.
+        """
+
+        with self._lock:
+            self.buckets.setdefault(bucket_name, {})
+
+    def put_object(self, bucket_name: str, name: str, data: bytes,
+                   content_type: str = 'application/octet-stream') -> FakeObject:
+        """ Store an object in a bucket, creating the bucket if it does not exist.
+
+        :param bucket_name: the name of the bucket.
+        :param name: the name of the object.
+        :param data: the contents of the object.
+        :param content_type: the content type of the object.
+        :return: the object.
+        """
+
+        with self._lock:
+            self._generation += 1
+            obj = FakeObject(name, bytes(data), self._generation, content_type=content_type)
+            self.buckets.setdefault(bucket_name, {})[name] = obj
+            return obj
+
+    def get_object(self, bucket_name: str, name: str) -> Optional[FakeObject]:
+        """ Get an object from a bucket.
+
+        :param bucket_name: the name of the bucket.
+        :param name: the name of the object.
+        :return: the object or None if it does not exist.
+        """
+
+        with self._lock:
+            return self.buckets.get(bucket_name, {}).get(name)
+
+
+def _make_handler(server: FakeGcsServer):
+    """ Make a request handler class bound to a FakeGcsServer.
+
+    :param server: the FakeGcsServer.
+    :return: the request handler class.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with server._lock:
+                server.num_connections += 1
+            if server.connection_latency:
+                time.sleep(server.connection_latency)
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+        def _read_body(self) -> bytes:
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length) if length else b''
+
+        def _send(self, status: int, body: bytes = b'', headers: Dict = None,
+                  content_type: str = 'application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def _send_json(self, status: int, obj: Dict, headers: Dict = None):
+            self._send(status, json.dumps(obj).encode('utf-8'), headers=headers)
+
+        def _send_error(self, status: int, message: str):
+            self._send_json(status, {'error': {'code': status, 'message': message}})
+
+        def _dispatch(self, method: str):
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            parts = [unquote(part) for part in url.path.split('/') if part]
+            body = self._read_body()
+
+            with server._lock:
+                server.requests.append((method, self.path))
+                status = server.fail_next.pop(0) if server.fail_next else None
+            if status is not None:
+                self._send_error(status, 'Injected failure')
+                return
+
+            if parts[:3] == ['upload', 'storage', 'v1'] and len(parts) == 6:
+                bucket_name = parts[4]
+                if method == 'POST':
+                    self._upload(bucket_name, query, body)
+                elif method == 'PUT':
+                    self._resumable_chunk(query, body)
+                else:
+                    self._send_error(405, 'Method not allowed')
+                return
+
+            if parts[:1] == ['download']:
+                parts = parts[1:]
+                query['alt'] = 'media'
+
+            if parts[:2] != ['storage', 'v1'] or len(parts) < 4 or parts[2] != 'b':
+                self._send_error(404, f'Not found: {url.path}')
+                return
+
+            bucket_name = parts[3]
+            with server._lock:
+                bucket = server.buckets.get(bucket_name)
+            if bucket is None:
+                self._send_error(404, f'Bucket not found: {bucket_name}')
+                return
+
+            if len(parts) == 4 and method == 'GET':
+                self._send_json(200, {'kind': 'storage#bucket', 'id': bucket_name, 'name': bucket_name})
+            elif len(parts) == 5 and parts[4] == 'o' and method == 'GET':
+                self._list(bucket_name, bucket, query)
+            elif len(parts) == 7 and parts[6] == 'compose' and method == 'POST':
+                self._compose(bucket_name, parts[5], json.loads(body.decode('utf-8')))
+            elif len(parts) == 6:
+                obj = server.get_object(bucket_name, parts[5])
+                if obj is None:
+                    self._send_error(404, f'Object not found: {parts[5]}')
+                elif method == 'GET' and query.get('alt') == 'media':
+                    self._media(obj)
+                elif method == 'GET':
+                    self._send_json(200, obj.resource(bucket_name))
+                elif method == 'DELETE':
+                    with server._lock:
+                        bucket.pop(obj.name, None)
+                    self._send(204)
+                else:
+                    self._send_error(405, 'Method not allowed')
+            else:
+                self._send_error(404, f'Not found: {url.path}')
+
+        def _list(self, bucket_name: str, bucket: Dict[str, FakeObject], query: Dict):
+            prefix = query.get('prefix', '')
+            page_size = min(int(query.get('maxResults', server.page_size)), server.page_size)
+            with server._lock:
+                names = sorted(name for name in bucket.keys() if name.startswith(prefix))
+            start = int(query.get('pageToken', 0))
+            page = names[start:start + page_size]
+            items = [bucket[name].resource(bucket_name) for name in page if name in bucket]
+            response = {'kind': 'storage#objects', 'items': items}
+            if start + page_size < len(names):
+                response['nextPageToken'] = str(start + page_size)
+            self._send_json(200, response)
+
+        def _media(self, obj: FakeObject):
+            data = obj.data
+            range_header = self.headers.get('Range')
+            if range_header:
+                match = re.match(r'bytes=(\d+)-(\d*)', range_header)
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else len(data) - 1
+                end = min(end, len(data) - 1)
+                if start >= len(data):
+                    self._send_error(416, 'Requested range not satisfiable')
+                    return
+                headers = {'Content-Range': f'bytes {start}-{end}/{len(data)}'}
+                self._send(206, data[start:end + 1], headers=headers, content_type=obj.content_type)
+            else:
+                resource = obj.resource('')
+                headers = {'X-Goog-Hash': f"crc32c={resource['crc32c']},md5={resource['md5Hash']}",
+                           'X-Goog-Generation': str(obj.generation)}
+                self._send(200, data, headers=headers, content_type=obj.content_type)
+
+        def _upload(self, bucket_name: str, query: Dict, body: bytes):
+            upload_type = query.get('uploadType')
+            if upload_type == 'media':
+                obj = server.put_object(bucket_name, query['name'], body,
+                                        content_type=self.headers.get('Content-Type'))
+                self._send_json(200, obj.resource(bucket_name))
+            elif upload_type == 'multipart':
+                metadata, data = _parse_multipart(self.headers.get('Content-Type'), body)
+                name = query.get('name', metadata.get('name'))
+                content_type = metadata.get('contentType', 'application/octet-stream')
+                obj = server.put_object(bucket_name, name, data, content_type=content_type)
+                self._send_json(200, obj.resource(bucket_name))
+            elif upload_type == 'resumable':
+                metadata = json.loads(body.decode('utf-8')) if body else {}
+                name = query.get('name', metadata.get('name'))
+                content_type = self.headers.get('X-Upload-Content-Type',
+                                                metadata.get('contentType', 'application/octet-stream'))
+                upload_id = uuid.uuid4().hex
+                with server._lock:
+                    server.sessions[upload_id] = ResumableSession(bucket_name, name, content_type)
+                location = f'{server.endpoint}/upload/storage/v1/b/{quote(bucket_name, safe="")}/o?' \
+                           f'uploadType=resumable&upload_id={upload_id}'
+                self._send(200, headers={'Location': location})
+            else:
+                self._send_error(400, f'Unsupported uploadType: {upload_type}')
+
+        def _resumable_chunk(self, query: Dict, body: bytes):
+            with server._lock:
+                session = server.sessions.get(query.get('upload_id'))
+            if session is None:
+                self._send_error(404, 'Upload session not found')
+                return
+
+            content_range = self.headers.get('Content-Range', '')
+            match = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', content_range)
+            if match is None:
+                self._send_error(400, f'Invalid Content-Range: {content_range}')
+                return
+
+            if match.group(2) is not None:
+                start = int(match.group(2))
+                if start > len(session.data):
+                    self._send_error(400, 'Chunk does not follow the last committed byte')
+                    return
+                del session.data[start:]
+                session.data.extend(body)
+
+            total = match.group(4)
+            if total != '*' and len(session.data) == int(total):
+                obj = server.put_object(session.bucket_name, session.name, bytes(session.data),
+                                        content_type=session.content_type)
+                with server._lock:
+                    server.sessions.pop(query.get('upload_id'), None)
+                self._send_json(200, obj.resource(session.bucket_name))
+            else:
+                headers = {'Range': f'bytes=0-{len(session.data) - 1}'} if session.data else {}
+                self._send(308, headers=headers)
+
+        def _compose(self, bucket_name: str, name: str, request: Dict):
+            data = bytearray()
+            for source in request.get('sourceObjects', []):
+                obj = server.get_object(bucket_name, source['name'])
+                if obj is None:
+                    self._send_error(404, f"Source object not found: {source['name']}")
+                    return
+                data.extend(obj.data)
+            content_type = request.get('destination', {}).get('contentType') or 'application/octet-stream'
+            obj = server.put_object(bucket_name, name, bytes(data), content_type=content_type)
+            self._send_json(200, obj.resource(bucket_name))
+
+    return Handler
+
+
+def _parse_multipart(content_type: str, body: bytes) -> Tuple[Dict, bytes]:
+    """ Parse a multipart/related upload body into its metadata and data parts.
+
+    :param content_type: the Content-Type header of the request.
+    :param body: the body of the request.
+    :return: the metadata and the data.
+    """
+
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode('utf-8')
+    parts = body.split(b'--' + boundary)
+    contents = []
+    for part in parts[1:-1]:
+        _, _, content = part.partition(b'\r\n\r\n')
+        contents.append(content[:-2] if content.endswith(b'\r\n') else content)
+    metadata = json.loads(contents[0].decode('utf-8'))
+    return metadata, contents[1]
+
+
+def make_emulator_env(server: FakeGcsServer) -> Dict[str, str]:
+    """ Make the environment variables that point the Google Cloud Storage clients at a FakeGcsServer.
+
+    :param server: the FakeGcsServer.
+    :return: the environment variables.
+    """
+
+    return {'STORAGE_EMULATOR_HOST': server.endpoint, 'GOOGLE_CLOUD_PROJECT': os.environ.get('GOOGLE_CLOUD_PROJECT',
+                                                                                            'fake-project')}
@@ -0,0 +1,143 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeUnpaywallFeed:
+    """ A small in-process stand-in for the Unpaywall data feed API, for tests. It lists its changefiles at
+    /feed/changefiles and serves them at /daily-feed/changefile/<file name>, when given the right API key. Point the
+    Unpaywall telescope at it by setting UnpaywallTelescope.CHANGEFILES_URL to FakeUnpaywallFeed.changefiles_url.
+    """
+
+    def __init__(self, api_key: str, host: str = 'localhost', port: int = 0):
+        """ Create a FakeUnpaywallFeed.
+
+        :param api_key: the API key that requests must include.
+        :param host: the host to listen on.
+        :param port: the port to listen on, 0 picks a free port.
+        """
+
+        self.api_key = api_key
+        self.host = host
+        self.port = port
+        self.changefiles: Dict[str, Dict] = {}
+        self.requests: List[str] = []
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        """ The URL of the server.
+
+        :return: the URL.
+        """
+
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def changefiles_url(self) -> str:
+        """ The URL of the list of changefiles.
+
+        :return: the URL.
+        """
+
+        return f'{self.endpoint}/feed/changefiles'
+
+    def add_changefile(self, file_name: str, data: bytes, last_modified: str, filetype: str = 'jsonl'):
+        """ Add a changefile to the feed.
+
+        :param file_name: the name of the changefile.
+        :param data: the contents of the changefile.
+        :param last_modified: when the changefile was last modified, as an ISO 8601 timestamp.
+        :param filetype: the type of the changefile, jsonl or csv.
+        :return: None.
+        """
+
+        self.changefiles[file_name] = {'data': data, 'last_modified': last_modified, 'filetype': filetype}
+
+    def start(self):
+        """ Start the server in a background thread.
+
+        :return: None.
+        """
+
+        self._server = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the server.
+
+        :return: None.
+        """
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'FakeUnpaywallFeed':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def _make_handler(feed: FakeUnpaywallFeed):
+    """ Make the request handler class of a FakeUnpaywallFeed.
+
+    :param feed: the feed.
+    :return: the handler class.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status: int, body: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            feed.requests.append(self.path)
+            if parse_qs(url.query).get('api_key') != [feed.api_key]:
+                self.send(401, b'{"error": "invalid api_key"}', 'application/json')
+            elif url.path == '/feed/changefiles':
+                items = [{'filename': file_name, 'filetype': changefile['filetype'],
+                          'last_modified': changefile['last_modified'], 'size': len(changefile['data']),
+                          'url': f'{feed.endpoint}/daily-feed/changefile/{file_name}?api_key={feed.api_key}'}
+                         for file_name, changefile in feed.changefiles.items()]
+                self.send(200, json.dumps({'list': items}).encode(), 'application/json')
+            elif url.path.startswith('/daily-feed/changefile/') and \
+                    url.path.split('/')[-1] in feed.changefiles:
+                self.send(200, feed.changefiles[url.path.split('/')[-1]]['data'], 'application/octet-stream')
+            else:
+                self.send(404, b'{"error": "not found"}', 'application/json')
+
+    return Handler
@@ -0,0 +1,269 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import os
+import unittest
+from typing import Dict, List
+from unittest.mock import patch
+
+from click.testing import CliRunner
+from google.api_core.exceptions import BadRequest
+from google.cloud import bigquery
+
+from observatory.platform.utils.bigquery_jobs import BigQueryJobManager
+from observatory.platform.utils.bigquery_telemetry import JsonlTelemetrySink
+from observatory.platform.utils.gc_utils import TableQuery, init_bigquery_telemetry
+
+
+class FakeJob(bigquery.QueryJob):
+    """ A query job that finishes after being polled a number of times. """
+
+    def __init__(self, job_id: str, client: 'FakeClient', sql: str, polls: int):
+        super().__init__(job_id, sql, client)
+        self.polls = polls
+        self.sql = sql
+
+    def cancel(self, client=None, retry=None, timeout=None):
+        self._client.cancels.append(self.job_id)
+        return True
+
+    def reload(self, client=None, retry=None, timeout=None):
+        self._client.reloads += 1
+        if self.polls > 0:
+            return
+
+        statistics = {'totalSlotMs': '2000', 'startTime': 1000., 'endTime': 3500.,
+                      'query': {'totalBytesProcessed': '1024', 'totalBytesBilled': '10485760'}}
+        status = {'state': 'DONE'}
+        if 'error' in self.sql:
+            status['errorResult'] = {'reason': 'invalidQuery', 'message': 'Syntax error'}
+            status['errors'] = [status['errorResult']]
+        self._properties['statistics'] = statistics
+        self._properties['status'] = status
+
+
+class FakeClient:
+    """ A BigQuery client that runs FakeJobs and tracks how many run at once. """
+
+    def __init__(self, project: str, polls: List[int] = None):
+        self.project = project
+        self.polls = polls
+        self.jobs: Dict[str, FakeJob] = dict()
+        self.running = 0
+        self.max_running = 0
+        self.lists = 0
+        self.reloads = 0
+        self.copies = []
+        self.cancels = []
+        self.list_done = True
+
+    def query(self, sql, job_config=None, job_id_prefix=None, location=None):
+        if sql == 'invalid':
+            raise BadRequest('Invalid query')
+        if sql == 'crash':
+            raise RuntimeError('Connection reset')
+
+        polls = self.polls.pop(0) if self.polls else len(self.jobs) % 3 + 1
+        job = FakeJob(f'{job_id_prefix}{len(self.jobs)}', self, sql, polls=polls)
+        self.jobs[job.job_id] = job
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        return job
+
+    def copy_table(self, source, destination, job_id_prefix=None, location=None, job_config=None):
+        self.copies.append((source, destination))
+        return self.query(f'COPY {source}', job_id_prefix=job_id_prefix, location=location)
+
+    def list_jobs(self, project=None, state_filter=None, min_creation_time=None):
+        # Each call of list_jobs is one poll
+        self.lists += 1
+        done = []
+        for job in self.jobs.values():
+            if job.polls > 0:
+                job.polls -= 1
+                if job.polls == 0:
+                    self.running -= 1
+            if job.polls == 0:
+                done.append(job)
+
+        # When list_done is False the finished jobs are missing from the listing, e.g. because of clock skew
+        return done if self.list_done else []
+
+
+class TestBigQueryJobManager(unittest.TestCase):
+
+    def test_run(self):
+        clients = {'project-a': FakeClient('project-a'), 'project-b': FakeClient('project-b')}
+        sleeps: List[float] = []
+
+        with patch('observatory.platform.utils.bigquery_jobs.bigquery_client',
+                   lambda project_id=None, location=None: clients[project_id]), \
+                patch('observatory.platform.utils.bigquery_jobs.time.sleep', sleeps.append):
+            manager = BigQueryJobManager(max_jobs_per_project=3, poll_interval=1., max_poll_interval=4.)
+            for i in range(10):
+                manager.submit_query(f'a.{i}', 'project-a', 'US', 'SELECT 1')
+            manager.submit_query('b.0', 'project-b', 'US', 'SELECT error')
+            manager.submit_query('b.1', 'project-b', 'US', 'invalid')
+            manager.submit_query('b.2', 'project-b', 'US', 'crash')
+            with self.assertRaises(ValueError):
+                manager.submit_query('b.0', 'project-b', 'US', 'SELECT 1')
+            results = manager.run()
+
+        # The results are returned in the order that the jobs were submitted
+        self.assertEqual([f'a.{i}' for i in range(10)] + ['b.0', 'b.1', 'b.2'], [result.name for result in results])
+
+        # No more than the maximum number of jobs ran at once in each project
+        self.assertEqual(3, clients['project-a'].max_running)
+        self.assertEqual(10, len(clients['project-a'].jobs))
+
+        # Jobs are polled with one list request per project and only finished jobs are reloaded
+        self.assertEqual(len(sleeps), clients['project-a'].lists)
+        self.assertEqual(10, clients['project-a'].reloads)
+
+        # Results include statistics and errors
+        result = results[0]
+        self.assertTrue(result.success)
+        self.assertEqual('a_0_0', result.job_id)
+        self.assertEqual('query', result.job_type)
+        self.assertEqual(1024, result.bytes_processed)
+        self.assertEqual(10485760, result.bytes_billed)
+        self.assertEqual(2000, result.slot_millis)
+        self.assertEqual(2.5, result.duration)
+        self.assertFalse(results[10].success)
+        self.assertEqual(['Syntax error'], results[10].errors)
+        self.assertFalse(results[11].success)
+        self.assertIsNone(results[11].job_id)
+
+        # Errors other than API errors are reported too
+        self.assertFalse(results[12].success)
+        self.assertEqual(['Connection reset'], results[12].errors)
+
+    def test_poll_backoff(self):
+        client = FakeClient('project', polls=[5])
+        sleeps: List[float] = []
+
+        with patch('observatory.platform.utils.bigquery_jobs.bigquery_client',
+                   lambda project_id=None, location=None: client), \
+                patch('observatory.platform.utils.bigquery_jobs.time.sleep', sleeps.append):
+            manager = BigQueryJobManager(poll_interval=1., max_poll_interval=4., reload_after_polls=10)
+            manager.submit_query('slow', 'project', 'US', 'SELECT 1')
+            manager.run()
+
+        # The poll interval doubles up to the maximum while no jobs finish
+        self.assertEqual([1., 2., 4., 4., 4.], sleeps)
+
+    def test_reload_after_polls(self):
+        client = FakeClient('project', polls=[2])
+        client.list_done = False
+
+        with patch('observatory.platform.utils.bigquery_jobs.bigquery_client',
+                   lambda project_id=None, location=None: client), \
+                patch('observatory.platform.utils.bigquery_jobs.time.sleep'):
+            manager = BigQueryJobManager(reload_after_polls=3)
+            manager.submit_query('missing', 'project', 'US', 'SELECT 1')
+            results = manager.run()
+
+        # The job is never listed as done, so it is found to have finished by reloading it after 3 idle polls
+        self.assertTrue(results[0].success)
+        self.assertEqual(2, client.lists)
+        self.assertEqual(1, client.reloads)
+
+    def test_timeout(self):
+        client = FakeClient('project', polls=[1000, 1000])
+        clock = [0.]
+
+        def sleep(seconds: float):
+            clock[0] += seconds
+
+        with patch('observatory.platform.utils.bigquery_jobs.bigquery_client',
+                   lambda project_id=None, location=None: client), \
+                patch('observatory.platform.utils.bigquery_jobs.time.sleep', sleep), \
+                patch('observatory.platform.utils.bigquery_jobs.time.monotonic', lambda: clock[0]):
+            manager = BigQueryJobManager(max_jobs_per_project=1, max_poll_interval=30., timeout=100.)
+            manager.submit_query('running', 'project', 'US', 'SELECT 1')
+            manager.submit_query('pending', 'project', 'US', 'SELECT 2')
+            results = manager.run()
+
+        # The run stops at the timeout, the running job is cancelled and the pending job is never created
+        self.assertEqual(100., clock[0])
+        self.assertEqual(['running_0'], client.cancels)
+        self.assertEqual(1, len(client.jobs))
+        self.assertEqual(['running', 'pending'], [result.name for result in results])
+        self.assertEqual([False, False], [result.success for result in results])
+        self.assertEqual('running_0', results[0].job_id)
+        self.assertIsNone(results[1].job_id)
+        self.assertEqual(['timed out after 100.0 seconds'], results[1].errors)
+
+    def test_run_writes_telemetry(self):
+        with CliRunner().isolated_filesystem():
+            file_path = os.path.abspath('telemetry.jsonl')
+
+            # Run the jobs in a child process that leaves through os._exit, like an Airflow task, which skips the
+            # atexit handlers
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    client = FakeClient('project')
+                    init_bigquery_telemetry(JsonlTelemetrySink(file_path))
+                    with patch('observatory.platform.utils.bigquery_jobs.bigquery_client',
+                               lambda project_id=None, location=None: client), \
+                            patch('observatory.platform.utils.bigquery_jobs.time.sleep'):
+                        manager = BigQueryJobManager()
+                        manager.submit_query('a', 'project', 'US', 'SELECT 1')
+                        manager.submit_query('b', 'project', 'US', 'SELECT 2')
+                        manager.run()
+                    code = 0
+                finally:
+                    os._exit(code)
+
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(0, os.WEXITSTATUS(status))
+
+            # The records were written although the batch wasn't full
+            with open(file_path) as f:
+                self.assertEqual(2, len(f.readlines()))
+
+    def test_submit_table_query(self):
+        client = FakeClient('project')
+        dataset = bigquery.DatasetReference('project', 'dataset')
+
+        def table_query(table_id: str, **kwargs) -> TableQuery:
+            return TableQuery(f'SELECT {table_id}', dataset.table(table_id), 'US', bigquery.QueryJobConfig(), **kwargs)
+
+        with patch('observatory.platform.utils.bigquery_jobs.bigquery_client',
+                   lambda project_id=None, location=None: client), \
+                patch('observatory.platform.utils.bigquery_jobs.time.sleep'), \
+                patch('observatory.platform.utils.bigquery_jobs.set_input_fingerprint') as mock_set_fingerprint:
+            manager = BigQueryJobManager()
+            manager.submit_table_query('query', 'project', table_query('query', fingerprint='abc'))
+            manager.submit_table_query('over_budget', 'project', table_query('over_budget', error='exceeds budget'))
+            manager.submit_table_query('unchanged', 'project', table_query('unchanged', skip=True))
+            manager.submit_table_query('reuse', 'project', table_query('reuse', fingerprint='def',
+                                                                       reuse_table=dataset.table('previous')))
+            results = manager.run()
+
+        # Queries that must not run and tables that already exist are reported without creating jobs
+        self.assertEqual(['query', 'over_budget', 'unchanged', 'reuse'], [result.name for result in results])
+        self.assertEqual([True, False, True, True], [result.success for result in results])
+        self.assertEqual(['exceeds budget'], results[1].errors)
+        self.assertIsNone(results[2].job_id)
+        self.assertEqual(2, len(client.jobs))
+
+        # Reused results are copied and the fingerprints are recorded once the jobs succeed
+        self.assertEqual([(dataset.table('previous'), dataset.table('reuse'))], client.copies)
+        self.assertEqual([('query', 'abc'), ('reuse', 'def')],
+                         sorted([(call[0][1].table_id, call[0][2]) for call in mock_set_fingerprint.call_args_list]))
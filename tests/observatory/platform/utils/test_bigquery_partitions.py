@@ -0,0 +1,79 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pendulum
+from google.cloud import bigquery
+
+from observatory.platform.utils.bigquery_jobs import JobResult
+from observatory.platform.utils.bigquery_partitions import migrate_shards_to_partitions
+from observatory.platform.utils.gc_utils import invalidate_bigquery_dataset_tables
+
+
+class TestMigrateShardsToPartitions(unittest.TestCase):
+    """ Tests for migrate_shards_to_partitions, with a mocked BigQuery client and job manager. """
+
+    def setUp(self):
+        invalidate_bigquery_dataset_tables()
+        self.client = MagicMock()
+        self.tables = {'unpaywall20201006': 'TABLE', 'unpaywall20200901': 'TABLE', 'unpaywall20200801': 'VIEW',
+                       'unpaywall_partitioned': 'TABLE'}
+        self.client.list_tables.side_effect = lambda dataset: [bigquery.table.TableListItem({
+            'tableReference': {'projectId': 'project', 'datasetId': 'dataset', 'tableId': table_id}, 'type': type_})
+            for table_id, type_ in self.tables.items()]
+        self.client.get_table.side_effect = lambda table_id: MagicMock(table_id=table_id, num_rows=10, schema=[])
+
+    def migrate(self, row_counts, **kwargs):
+        submitted = []
+
+        def submit_query(manager, name, project_id, location, sql, job_config=None):
+            submitted.append((name, sql, job_config))
+
+        def run(manager):
+            return [JobResult(name, f'job_{name}', 'project', 'US', success=True) for name, _, _ in submitted]
+
+        with patch('observatory.platform.utils.bigquery_partitions.bigquery_client', return_value=self.client), \
+                patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client), \
+                patch('observatory.platform.utils.bigquery_partitions.BigQueryJobManager.submit_query', submit_query), \
+                patch('observatory.platform.utils.bigquery_partitions.BigQueryJobManager.run', run), \
+                patch('observatory.platform.utils.bigquery_partitions.partition_row_counts', return_value=row_counts), \
+                patch('observatory.platform.utils.bigquery_partitions.create_bigquery_release_view') as mock_view:
+            results = migrate_shards_to_partitions('project', 'dataset', 'unpaywall', 'US', **kwargs)
+        return submitted, results, mock_view
+
+    def test_migrate(self):
+        # Each shard is written to its partition and shards that were already replaced with views are skipped
+        submitted, results, mock_view = self.migrate({})
+        self.assertEqual(['unpaywall20201006', 'unpaywall20200901'], [result.name for result in results])
+        self.assertEqual(['project.dataset.unpaywall_partitioned$20201006',
+                          'project.dataset.unpaywall_partitioned$20200901'],
+                         [f'{config.destination.project}.{config.destination.dataset_id}.{config.destination.table_id}'
+                          for _, _, config in submitted])
+        self.assertEqual('SELECT * FROM `project.dataset.unpaywall20201006`', submitted[0][1])
+        table = self.client.create_table.call_args[0][0]
+        self.assertEqual('unpaywall_partitioned', table.table_id)
+        self.assertIsNone(table.time_partitioning.field)
+        self.client.delete_table.assert_not_called()
+        mock_view.assert_not_called()
+
+    def test_replace_shards(self):
+        # Only the shards whose partitions have all of their rows are replaced with views
+        _, _, mock_view = self.migrate({'20201006': 10, '20200901': 9}, replace_shards=True)
+        self.assertEqual(1, self.client.delete_table.call_count)
+        self.assertEqual('project.dataset.unpaywall20201006', self.client.delete_table.call_args[0][0].table_id)
+        mock_view.assert_called_once_with('project', 'dataset', 'unpaywall', pendulum.Date(2020, 10, 6))
@@ -0,0 +1,127 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import json
+import os
+import unittest
+from typing import List
+from unittest.mock import MagicMock, patch
+
+from click.testing import CliRunner
+from google.cloud import bigquery
+
+from observatory.platform.utils.bigquery_telemetry import (JobRecord, JsonlTelemetrySink, TELEMETRY_DATASET_ENV,
+                                                           TELEMETRY_FILE_ENV, TelemetryRecorder)
+from observatory.platform.utils.gc_utils import init_bigquery_telemetry, run_bigquery_query
+
+
+def make_query_job(job_id: str, error: bool = False) -> bigquery.QueryJob:
+    """ Make a finished query job.
+
+    :param job_id: the job id.
+    :param error: whether the job failed.
+    :return: the job.
+    """
+
+    job = bigquery.QueryJob(job_id, 'SELECT 1', MagicMock(project='project'))
+    job._properties['statistics'] = {'creationTime': 500., 'startTime': 1000., 'endTime': 3500.,
+                                     'totalSlotMs': '2000',
+                                     'query': {'totalBytesProcessed': '1024', 'totalBytesBilled': '10485760',
+                                               'cacheHit': False}}
+    job._properties['status'] = {'state': 'DONE'}
+    if error:
+        job._properties['status']['errorResult'] = {'reason': 'invalidQuery', 'message': 'Syntax error'}
+    return job
+
+
+class FailingSink:
+    """ A telemetry sink that can't be written to. """
+
+    def write(self, records: List[JobRecord]):
+        raise IOError('Sink unavailable')
+
+
+class TestBigQueryTelemetry(unittest.TestCase):
+
+    def read_records(self, file_path: str) -> List[dict]:
+        with open(file_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_job_record(self):
+        with patch.dict(os.environ, {'AIRFLOW_CTX_DAG_ID': 'doi', 'AIRFLOW_CTX_TASK_ID': 'create_doi'}):
+            record = JobRecord.from_job(make_query_job('job_1'), template='create_doi.sql.jinja2')
+
+        self.assertEqual('job_1', record.job_id)
+        self.assertEqual('project', record.project_id)
+        self.assertEqual('query', record.job_type)
+        self.assertEqual(('doi', 'create_doi', 'create_doi.sql.jinja2'), (record.dag_id, record.task_id,
+                                                                           record.template))
+        self.assertTrue(record.success)
+        self.assertIsNone(record.error)
+        self.assertEqual(2.5, record.duration)
+        self.assertEqual(1024, record.bytes_processed)
+        self.assertEqual(10485760, record.bytes_billed)
+        self.assertEqual(2000, record.slot_millis)
+        self.assertFalse(record.cache_hit)
+        self.assertTrue(record.created.startswith('1970-01-01T00:00:00.5'))
+
+        record = JobRecord.from_job(make_query_job('job_2', error=True))
+        self.assertFalse(record.success)
+        self.assertEqual('Syntax error', record.error)
+
+    def test_recorder(self):
+        with CliRunner().isolated_filesystem():
+            file_path = os.path.abspath('telemetry.jsonl')
+            recorder = TelemetryRecorder(JsonlTelemetrySink(file_path), batch_size=2)
+
+            # Records are written once a batch is full and the rest when the recorder is flushed
+            for i in range(3):
+                recorder.record(JobRecord.from_job(make_query_job(f'job_{i}')))
+            self.assertEqual(['job_0', 'job_1'], [record['job_id'] for record in self.read_records(file_path)])
+            recorder.flush()
+            self.assertEqual(['job_0', 'job_1', 'job_2'], [record['job_id'] for record in self.read_records(file_path)])
+
+        # Records that can't be written are dropped without raising an error
+        recorder = TelemetryRecorder(FailingSink(), batch_size=1)
+        with self.assertLogs(level='WARNING'):
+            recorder.record(JobRecord.from_job(make_query_job('job_3')))
+
+    def test_init_bigquery_telemetry(self):
+        with CliRunner().isolated_filesystem():
+            file_path = os.path.abspath('telemetry.jsonl')
+            client = MagicMock()
+            query_job = make_query_job('job_1')
+            query_job.result = MagicMock(return_value=[{'value': 1}])
+            client.query.return_value = query_job
+
+            try:
+                # The jobs that the helpers run are recorded in the file selected by the environment
+                with patch.dict(os.environ, {TELEMETRY_FILE_ENV: file_path}):
+                    recorder = init_bigquery_telemetry()
+                self.assertIsNotNone(recorder)
+
+                with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=client):
+                    self.assertEqual([{'value': 1}], run_bigquery_query('SELECT 1'))
+                recorder.flush()
+                records = self.read_records(file_path)
+                self.assertEqual(['job_1'], [record['job_id'] for record in records])
+                self.assertEqual(1024, records[0]['bytes_processed'])
+            finally:
+                # Telemetry is off when neither environment variable is set
+                env = {key: value for key, value in os.environ.items()
+                       if key not in (TELEMETRY_FILE_ENV, TELEMETRY_DATASET_ENV)}
+                with patch.dict(os.environ, env, clear=True):
+                    self.assertIsNone(init_bigquery_telemetry())
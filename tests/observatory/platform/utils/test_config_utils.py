@@ -25,6 +25,7 @@ from click.testing import CliRunner
 import tests.observatory.platform.utils as platform_utils_tests
 from observatory.platform.utils.config_utils import (
     SubFolder,
+    bigquery_bytes_budget,
     find_schema,
     observatory_home,
     telescope_path,
@@ -32,6 +33,7 @@ from observatory.platform.utils.config_utils import (
     terraform_credentials_path,
     test_data_path
 )
+from observatory.platform.utils.gc_utils import BytesBudget
 from tests.observatory.test_utils import test_fixtures_path
 
 
@@ -183,3 +185,18 @@ class TestConfigUtils(unittest.TestCase):
 
         actual_path = test_data_path()
         self.assertEqual(expected_path, actual_path)
+
+    @patch('observatory.platform.utils.config_utils.AirflowVariable.get')
+    def test_bigquery_bytes_budget(self, mock_variable_get):
+        # No budgets when the variable doesn't exist
+        mock_variable_get.return_value = None
+        self.assertIsNone(bigquery_bytes_budget('create_doi'))
+
+        # Tasks without their own budget have the default budget
+        mock_variable_get.return_value = {'action': 'warn', 'default': 1000, 'tasks': {'create_doi': 5000}}
+        self.assertEqual(BytesBudget(5000, 'warn'), bigquery_bytes_budget('create_doi'))
+        self.assertEqual(BytesBudget(1000, 'warn'), bigquery_bytes_budget('create_country'))
+
+        mock_variable_get.return_value = {'tasks': {'create_doi': 5000}}
+        self.assertEqual(BytesBudget(5000, 'fail'), bigquery_bytes_budget('create_doi'))
+        self.assertIsNone(bigquery_bytes_budget('create_country'))
@@ -0,0 +1,230 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import gzip
+import hashlib
+import os
+import pickle
+import struct
+import time
+import unittest
+import zlib
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from observatory.platform.utils.file_utils import (ChecksumIndex, CHECKSUM_INDEX_FILE_NAME, crc32c_base64_hash,
+                                                   indexed_crc32c_base64_hash, file_checksums, open_checksummed,
+                                                   ChecksumStream, crc32_combine, gzip_file_crc, gzip_files_crc,
+                                                   gzip_members, gzip_trailer)
+
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data = 'hello world'
+        self.expected_crc32c = 'yZRlqg=='
+
+    def test_file_checksums(self):
+        with CliRunner().isolated_filesystem():
+            data = os.urandom(1024 * 1024 + 3)
+            with open('test.bin', 'wb') as f:
+                f.write(data)
+
+            # Several checksums are computed in a single pass, independent of the read size
+            for read_size in [1000, 1024 * 1024, 16 * 1024 * 1024]:
+                checksums = file_checksums('test.bin', algorithms=('crc32c', 'md5', 'sha256'), read_size=read_size)
+                self.assertEqual(crc32c_base64_hash('test.bin'), checksums.base64('crc32c'))
+                self.assertEqual(hashlib.md5(data).hexdigest(), checksums.hexdigest('md5'))
+                self.assertEqual(hashlib.sha256(data).hexdigest(), checksums.hexdigest('sha256'))
+                self.assertEqual(len(data), checksums.size)
+
+            with open('test.txt', 'w') as f:
+                f.write(self.data)
+            self.assertEqual(self.expected_crc32c, crc32c_base64_hash('test.txt'))
+
+    def test_checksum_stream(self):
+        with CliRunner().isolated_filesystem():
+            ChecksumIndex.create('.')
+
+            # Checksums are computed while writing and saved in the checksum index
+            with patch('observatory.platform.utils.file_utils.crc32c_base64_hash') as mock_hash:
+                with open_checksummed('test.txt.gz', algorithms=('crc32c', 'md5')) as writer:
+                    with gzip.GzipFile(fileobj=writer, mode='wb') as gzip_file:
+                        gzip_file.write(self.data.encode())
+                self.assertEqual(writer.checksums.base64('crc32c'), indexed_crc32c_base64_hash('test.txt.gz'))
+                mock_hash.assert_not_called()
+
+            with open('test.txt.gz', 'rb') as f:
+                self.assertEqual(hashlib.md5(f.read()).hexdigest(), writer.checksums.hexdigest('md5'))
+            self.assertEqual(crc32c_base64_hash('test.txt.gz'), writer.checksums.base64('crc32c'))
+
+            # Checksums are computed while reading
+            with ChecksumStream(open('test.txt.gz', 'rb')) as f:
+                with gzip.GzipFile(fileobj=f, mode='rb') as gzip_file:
+                    self.assertEqual(self.data.encode(), gzip_file.read())
+            self.assertEqual(crc32c_base64_hash('test.txt.gz'), f.checksums.base64('crc32c'))
+
+
+class TestChecksumIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data = 'hello world'
+        self.expected_crc32c = 'yZRlqg=='
+
+    def test_crc32c(self):
+        with CliRunner().isolated_filesystem():
+            index = ChecksumIndex.create('.')
+            self.assertTrue(os.path.isfile(CHECKSUM_INDEX_FILE_NAME))
+            with open('test.txt', 'w') as f:
+                f.write(self.data)
+
+            # The file is hashed the first time only
+            with patch('observatory.platform.utils.file_utils.crc32c_base64_hash',
+                       wraps=crc32c_base64_hash) as mock_hash:
+                self.assertEqual(self.expected_crc32c, index.crc32c('test.txt'))
+                self.assertEqual(self.expected_crc32c, index.crc32c('test.txt'))
+                self.assertEqual(self.expected_crc32c, ChecksumIndex('.').crc32c('test.txt'))
+                self.assertEqual(1, mock_hash.call_count)
+
+                # A modified file is hashed again
+                time.sleep(0.01)
+                with open('test.txt', 'w') as f:
+                    f.write('hello there')
+                self.assertIsNone(index.get('test.txt'))
+                self.assertEqual(crc32c_base64_hash('test.txt'), index.crc32c('test.txt'))
+                self.assertEqual(2, mock_hash.call_count)
+
+    def test_find(self):
+        with CliRunner().isolated_filesystem():
+            os.makedirs('telescope/release')
+            file_path = os.path.join('telescope', 'release', 'test.txt')
+            with open(file_path, 'w') as f:
+                f.write(self.data)
+
+            # Files that are not covered by an index are hashed every time
+            self.assertIsNone(ChecksumIndex.find(file_path))
+            self.assertEqual(self.expected_crc32c, indexed_crc32c_base64_hash(file_path))
+
+            # The index in a parent directory covers the file
+            ChecksumIndex.create('telescope')
+            index = ChecksumIndex.find(file_path)
+            self.assertEqual(os.path.abspath('telescope'), index.directory)
+            self.assertEqual(self.expected_crc32c, indexed_crc32c_base64_hash(file_path))
+            self.assertEqual(self.expected_crc32c, index.get(file_path))
+
+            # The index can be sent to other processes
+            index = pickle.loads(pickle.dumps(index))
+            self.assertEqual(self.expected_crc32c, index.get(file_path))
+
+    def test_register(self):
+        with CliRunner().isolated_filesystem():
+            os.makedirs('registered')
+            file_path = os.path.join('registered', 'test.txt')
+            with open(file_path, 'w') as f:
+                f.write(self.data)
+
+            # The index of a registered directory is only created when a checksum is saved
+            ChecksumIndex.register('registered')
+            self.assertIsNone(ChecksumIndex.find(file_path))
+            self.assertFalse(os.path.exists(os.path.join('registered', CHECKSUM_INDEX_FILE_NAME)))
+            self.assertEqual(self.expected_crc32c, indexed_crc32c_base64_hash(file_path))
+            self.assertTrue(os.path.isfile(os.path.join('registered', CHECKSUM_INDEX_FILE_NAME)))
+            self.assertEqual(self.expected_crc32c, ChecksumIndex.find(file_path).get(file_path))
+
+            # Directories without an index are searched again, so an index created later is found
+            os.makedirs('other')
+            other_path = os.path.join('other', 'test.txt')
+            self.assertIsNone(ChecksumIndex.find(other_path))
+            ChecksumIndex('other').put_many([])
+            self.assertEqual(os.path.abspath('other'), ChecksumIndex.find(other_path).directory)
+
+    def test_warm(self):
+        with CliRunner().isolated_filesystem():
+            index = ChecksumIndex.create('.')
+            os.makedirs('folder')
+            file_paths = [os.path.join('folder', f'{i}.txt') for i in range(5)]
+            for file_path in file_paths:
+                with open(file_path, 'w') as f:
+                    f.write(self.data)
+
+            self.assertEqual(5, index.warm(max_workers=2))
+            self.assertEqual(0, index.warm(max_workers=2))
+            for file_path in file_paths:
+                self.assertEqual(self.expected_crc32c, index.get(file_path))
+
+
+def bgzf_block(data: bytes) -> bytes:
+    """ Compress data as a BGZF block, a gzip member that records its size in a BC extra subfield.
+
+    :param data: the data.
+    :return: the block.
+    """
+
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    extra = b'BC' + struct.pack('<HH', 2, len(deflated) + 25)
+    header = b'\x1f\x8b\x08\x04' + b'\x00' * 6 + struct.pack('<H', len(extra)) + extra
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class TestGzip(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data = os.urandom(100 * 1024) + b'hello world' * 100000
+        self.expected_crc = f'{zlib.crc32(self.data):08x}'
+
+    def test_crc32_combine(self):
+        crc = crc32_combine(zlib.crc32(self.data[:1000]), zlib.crc32(self.data[1000:]), len(self.data) - 1000)
+        self.assertEqual(zlib.crc32(self.data), crc)
+
+    def test_gzip_file_crc(self):
+        with CliRunner().isolated_filesystem():
+            parts = [self.data[:1000], self.data[1000:500000], self.data[500000:]]
+            with gzip.open('single.gz', 'wb') as f:
+                f.write(self.data)
+            with open('multi.gz', 'wb') as f:
+                for part in parts:
+                    f.write(gzip.compress(part))
+            with open('bgzf.gz', 'wb') as f:
+                for i in range(0, len(self.data), 60000):
+                    f.write(bgzf_block(self.data[i:i + 60000]))
+                f.write(bgzf_block(b''))
+
+            # Single member files can be read from the trailer alone
+            self.assertEqual((zlib.crc32(self.data), len(self.data)), gzip_trailer('single.gz'))
+            self.assertEqual(self.expected_crc, gzip_file_crc('single.gz', single_member=True))
+            self.assertEqual(self.expected_crc, gzip_file_crc('single.gz'))
+
+            # The CRC32s of the members of multi-member files are combined
+            members = gzip_members('multi.gz', read_size=1000)
+            self.assertEqual([zlib.crc32(part) for part in parts], [member.crc32 for member in members])
+            self.assertEqual([len(part) for part in parts], [member.isize for member in members])
+            self.assertEqual(os.path.getsize('multi.gz'), sum(member.compressed_size for member in members))
+            self.assertEqual(self.expected_crc, gzip_file_crc('multi.gz'))
+
+            # BGZF blocks are found with seeks without inflating them
+            with patch('observatory.platform.utils.file_utils.zlib.decompressobj') as mock_decompressobj:
+                self.assertEqual(self.expected_crc, gzip_file_crc('bgzf.gz'))
+                mock_decompressobj.assert_not_called()
+
+            # The files in a directory are checked in a thread pool
+            os.makedirs('folder')
+            os.rename('multi.gz', os.path.join('folder', 'multi.gz'))
+            expected = {'bgzf.gz': self.expected_crc, 'single.gz': self.expected_crc,
+                        os.path.join('folder', 'multi.gz'): self.expected_crc}
+            self.assertEqual(expected, {os.path.relpath(path): crc
+                                        for path, crc in gzip_files_crc('.', max_workers=2).items()})
@@ -0,0 +1,346 @@
+# Copyright 2020 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Author: James Diprose
+
+import asyncio
+import os
+import resource
+import time
+import unittest
+from typing import List
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from observatory.platform.utils.file_utils import crc32c_to_base64_str
+from observatory.platform.utils.gc_transfer import (AdaptiveConcurrencyLimiter, GcsTransferEngine, TransferJournal,
+                                                    backoff_delay, blob_name_prefixes)
+from observatory.platform.utils.gc_utils import download_blobs_from_cloud_storage, upload_files_to_cloud_storage
+from tests.observatory.fake_gcs_server import FakeGcsServer, make_emulator_env
+from tests.observatory.test_utils import random_id
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+    """ Tests for the AdaptiveConcurrencyLimiter, driven by a fake clock with one second measurement windows. """
+
+    def run_window(self, limiter: AdaptiveConcurrencyLimiter, clock: List[float], num_bytes: int,
+                   status: int = None):
+        """ Run a measurement window in which the limit is reached.
+
+        :param limiter: the limiter.
+        :param clock: the fake clock.
+        :param num_bytes: the number of bytes transferred in the window.
+        :param status: the status of a retryable error in the window, if any.
+        :return: None.
+        """
+
+        limit = int(limiter.limit)
+
+        async def request(i: int):
+            async with limiter:
+                await asyncio.sleep(0)
+                limiter.record_bytes(num_bytes // limit)
+                if i == 0 and status is not None:
+                    limiter.record_error(status)
+                if i == limit - 1:
+                    clock[0] += 1
+
+        async def run():
+            await asyncio.gather(*[request(i) for i in range(limit)])
+
+        asyncio.run(run())
+
+    def test_aimd(self):
+        clock = [0.]
+        stats = []
+        with patch('observatory.platform.utils.gc_transfer.time') as mock_time:
+            mock_time.monotonic = lambda: clock[0]
+            limiter = AdaptiveConcurrencyLimiter(max_limit=20, initial_limit=2, metrics_hook=stats.append)
+
+            # Slow start doubles the limit while throughput rises
+            self.run_window(limiter, clock, 1000)
+            self.assertEqual(4, limiter.limit)
+            self.run_window(limiter, clock, 2000)
+            self.assertEqual(8, limiter.limit)
+
+            # The limit is held when throughput stops rising
+            self.run_window(limiter, clock, 2000)
+            self.assertEqual(8, limiter.limit)
+
+            # The limit is halved after throttling and then increased additively
+            self.run_window(limiter, clock, 2000, status=429)
+            self.assertEqual(4, limiter.limit)
+            self.run_window(limiter, clock, 1000)
+            self.run_window(limiter, clock, 3000)
+            self.assertEqual(5, limiter.limit)
+
+            # The operating point of each window is reported
+            self.assertEqual(6, len(stats))
+            self.assertEqual(1, stats[3].throttled)
+            self.assertEqual(stats, list(limiter.history))
+
+            # Only the most recent windows are kept in history
+            limiter = AdaptiveConcurrencyLimiter(max_limit=20, initial_limit=2, history_size=2)
+            for _ in range(3):
+                self.run_window(limiter, clock, 1000)
+            self.assertEqual(2, len(limiter.history))
+
+            # The limit is fixed when not adaptive
+            limiter = AdaptiveConcurrencyLimiter(max_limit=10, adaptive=False)
+            self.run_window(limiter, clock, 1000, status=503)
+            self.assertEqual(10, limiter.limit)
+
+
+class TestGcsTransferEngine(unittest.TestCase):
+    """ Tests for the GcsTransferEngine, which run against a local FakeGcsServer. """
+
+    def setUp(self):
+        self.server = FakeGcsServer()
+        self.server.start()
+        self.bucket_name = random_id()
+        self.server.create_bucket(self.bucket_name)
+        self.env = patch.dict(os.environ, make_emulator_env(self.server))
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.server.stop()
+
+    def run_engine(self, func, **kwargs):
+        """ Run a coroutine function with a GcsTransferEngine.
+
+        :param func: the coroutine function, called with the engine.
+        :param kwargs: the arguments of the GcsTransferEngine.
+        :return: the result of the coroutine.
+        """
+
+        async def run():
+            async with GcsTransferEngine(backoff_base=0.01, **kwargs) as engine:
+                return await func(engine)
+
+        return asyncio.run(run())
+
+    def test_backoff_delay(self):
+        for attempt in range(1, 10):
+            delay = backoff_delay(attempt, 1., 32.)
+            self.assertTrue(0 <= delay <= min(32., 2 ** (attempt - 1)))
+
+    def test_blob_name_prefixes(self):
+        prefixes, names = blob_name_prefixes(['a/1.txt', 'a/b/2.txt', 'ab/3.txt', 'c/d/4.txt', 'top.txt'])
+        self.assertEqual(['a/', 'ab/', 'c/d/'], prefixes)
+        self.assertEqual(['top.txt'], names)
+
+    def test_find_objects(self):
+        self.server.put_object(self.bucket_name, 'data/1.txt', b'1')
+        self.server.put_object(self.bucket_name, 'data/2.txt', b'2')
+        self.server.put_object(self.bucket_name, 'top.txt', b'top')
+
+        # Only the objects with the given names are returned, objects that don't exist are left out
+        objects = self.run_engine(lambda engine: engine.find_objects(self.bucket_name,
+                                                                     ['data/1.txt', 'top.txt', 'missing.txt']))
+        self.assertEqual({'data/1.txt', 'top.txt'}, set(objects.keys()))
+        self.assertEqual(3, objects['top.txt'].size)
+
+    def test_upload_download(self):
+        with CliRunner().isolated_filesystem():
+            small, large = os.urandom(1000), os.urandom(300 * 1024 + 5)
+            for name, data in [('small.bin', small), ('large.bin', large)]:
+                with open(name, 'wb') as f:
+                    f.write(data)
+
+            # Large files are uploaded as composite uploads made of resumable uploads and downloaded in slices
+            async def transfer(engine: GcsTransferEngine):
+                uploaded = await asyncio.gather(engine.upload_file(self.bucket_name, 'small.bin', 'small.bin'),
+                                                engine.upload_file(self.bucket_name, 'large.bin', 'large.bin'))
+                objects = await engine.list_objects(self.bucket_name, '')
+                downloaded = await asyncio.gather(
+                    engine.download_object(self.bucket_name, objects['small.bin'], 'download/small.bin'),
+                    engine.download_object(self.bucket_name, objects['large.bin'], 'download/large.bin'))
+                return uploaded + downloaded
+
+            results = self.run_engine(transfer, chunk_size=256 * 1024, parallel_upload_threshold=100 * 1024,
+                                      parallel_upload_slices=2, parallel_download_threshold=100 * 1024,
+                                      parallel_download_slices=3)
+            self.assertEqual([True] * 4, results)
+
+            self.assertEqual({'small.bin', 'large.bin'}, set(self.server.buckets[self.bucket_name].keys()))
+            self.assertEqual(large, self.server.get_object(self.bucket_name, 'large.bin').data)
+            with open('download/small.bin', 'rb') as f:
+                self.assertEqual(small, f.read())
+            with open('download/large.bin', 'rb') as f:
+                self.assertEqual(large, f.read())
+            self.assertEqual(3, len([path for method, path in self.server.requests if method == 'GET' and
+                                     'large.bin' in path]))
+
+    def test_retries(self):
+        with CliRunner().isolated_filesystem():
+            with open('test.txt', 'w') as f:
+                f.write('hello world')
+
+            # Retryable errors are retried
+            self.server.fail_next = [503, 429]
+            self.assertTrue(self.run_engine(lambda engine: engine.upload_file(self.bucket_name, 'test.txt',
+                                                                              'test.txt')))
+            self.assertEqual(3, self.server.count_requests('POST'))
+
+            # Other errors fail straight away
+            self.server.reset_stats()
+            self.server.fail_next = [403]
+            self.assertFalse(self.run_engine(lambda engine: engine.upload_file(self.bucket_name, 'test.txt',
+                                                                               'test.txt')))
+            self.assertEqual(1, self.server.count_requests('POST'))
+
+            # Requests fail after the number of retries
+            self.server.reset_stats()
+            self.server.fail_next = [500, 500]
+            self.assertFalse(self.run_engine(lambda engine: engine.upload_file(self.bucket_name, 'test.txt',
+                                                                               'test.txt'), retries=2))
+
+    def test_resumable_upload_resumes(self):
+        with CliRunner().isolated_filesystem():
+            data = os.urandom(1024 * 1024 + 11)
+            with open('test.bin', 'wb') as f:
+                f.write(data)
+
+            # The second chunk fails: the committed offset of the session is queried and the upload continues
+            async def upload(engine: GcsTransferEngine):
+                session_uri = await engine.start_resumable_upload(self.bucket_name, 'test.bin',
+                                                                  'application/octet-stream')
+                self.server.reset_stats()
+                self.server.fail_next = [None, 503]
+                return await engine._upload_resumable('test.bin', session_uri, 'test.bin', 0, len(data))
+
+            resource, crc = self.run_engine(upload, chunk_size=256 * 1024)
+            self.assertEqual(data, self.server.get_object(self.bucket_name, 'test.bin').data)
+            self.assertEqual(resource['crc32c'], crc32c_to_base64_str(crc))
+
+            # 5 chunks, 1 failed chunk and 1 status query
+            self.assertEqual(7, self.server.count_requests('PUT'))
+
+    def test_transfer_journal(self):
+        with CliRunner().isolated_filesystem():
+            with open('test.txt', 'w') as f:
+                f.write('hello world')
+
+            with TransferJournal('test.journal') as journal:
+                self.assertIsNone(journal.completed(self.bucket_name, 'test.txt', 'test.txt'))
+                journal.record_session(self.bucket_name, 'test.txt', 'test.txt', 0, 11, 'http://session')
+                journal.record_completed(self.bucket_name, 'test.txt', 'test.txt', 'yZRlqg==')
+
+            # A torn record at the end of the journal is ignored
+            with open('test.journal', 'a') as f:
+                f.write('{"event": "completed", "buck')
+            journal = TransferJournal('test.journal')
+            self.assertEqual('yZRlqg==', journal.completed(self.bucket_name, 'test.txt', 'test.txt'))
+            self.assertIsNone(journal.session(self.bucket_name, 'test.txt', 'test.txt', 0, 11))
+
+            # A completed transfer of a file that has changed since is not skipped
+            time.sleep(0.01)
+            with open('test.txt', 'w') as f:
+                f.write('hello there')
+            self.assertIsNone(journal.completed(self.bucket_name, 'test.txt', 'test.txt'))
+
+    def test_journal_resumes_upload(self):
+        with CliRunner().isolated_filesystem():
+            data = os.urandom(1024 * 1024 + 11)
+            with open('test.bin', 'wb') as f:
+                f.write(data)
+
+            # The third chunk fails with an error that is not retried, so the upload fails
+            self.server.fail_next = [None, None, None, 403]
+            with TransferJournal('test.journal') as journal:
+                self.assertFalse(self.run_engine(lambda engine: engine.upload_file(self.bucket_name, 'test.bin',
+                                                                                   'test.bin'),
+                                                 chunk_size=256 * 1024, journal=journal))
+
+            # A retry resumes the session from the committed offset instead of starting the upload again
+            self.server.reset_stats()
+            with TransferJournal('test.journal') as journal:
+                self.assertTrue(self.run_engine(lambda engine: engine.upload_file(self.bucket_name, 'test.bin',
+                                                                                  'test.bin'),
+                                                chunk_size=256 * 1024, journal=journal))
+            self.assertEqual(data, self.server.get_object(self.bucket_name, 'test.bin').data)
+            self.assertEqual(0, self.server.count_requests('POST'))
+
+            # 1 status query and the 3 chunks that were not committed
+            self.assertEqual(4, self.server.count_requests('PUT'))
+
+    def test_journal_skips_completed(self):
+        with CliRunner().isolated_filesystem():
+            file_paths = []
+            for i in range(3):
+                file_path = os.path.join('upload', f'{i}.txt')
+                os.makedirs('upload', exist_ok=True)
+                with open(file_path, 'w') as f:
+                    f.write(f'hello world {i}')
+                file_paths.append(file_path)
+            blob_names = [f'data/{i}.txt' for i in range(3)]
+
+            # Transfers that a previous attempt completed are skipped without any requests
+            for _ in range(2):
+                self.server.reset_stats()
+                self.assertTrue(upload_files_to_cloud_storage(self.bucket_name, blob_names, file_paths,
+                                                              max_processes=1, journal_path='upload.journal'))
+            self.assertEqual([], self.server.requests)
+
+            for _ in range(2):
+                self.server.reset_stats()
+                self.assertTrue(download_blobs_from_cloud_storage(self.bucket_name, 'data', 'download',
+                                                                  max_processes=1, journal_path='download.journal'))
+            self.assertEqual([], self.server.requests)
+            with open(os.path.join('download', '2.txt')) as f:
+                self.assertEqual('hello world 2', f.read())
+
+    def test_adaptive_concurrency(self):
+        with CliRunner().isolated_filesystem():
+            with open('test.txt', 'w') as f:
+                f.write('hello world')
+
+            # Throttled requests are reported to the limiter
+            self.server.fail_next = [503]
+
+            async def upload(engine: GcsTransferEngine):
+                result = await engine.upload_file(self.bucket_name, 'test.txt', 'test.txt')
+                return result, engine.limiter
+
+            result, limiter = self.run_engine(upload, adaptive_concurrency=True)
+            self.assertTrue(result)
+            self.assertEqual(1, limiter._throttled)
+            self.assertEqual(11, limiter._bytes)
+
+    def test_many_files(self):
+        with CliRunner().isolated_filesystem():
+            num_files = 600
+            for i in range(num_files):
+                self.server.put_object(self.bucket_name, f'data/{i}.txt', f'hello world {i}'.encode())
+
+            # Downloads and uploads only open their files once a transfer slot is free, so transferring more files
+            # than the limit of open file descriptors succeeds
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+            try:
+                self.assertTrue(download_blobs_from_cloud_storage(self.bucket_name, 'data', 'download',
+                                                                  max_processes=1, max_connections=16,
+                                                                  max_transfers=32))
+                file_paths = [os.path.join('download', f'{i}.txt') for i in range(num_files)]
+                blob_names = [f'upload/{i}.txt' for i in range(num_files)]
+                self.assertTrue(upload_files_to_cloud_storage(self.bucket_name, blob_names, file_paths,
+                                                              max_processes=1, max_connections=16, max_transfers=32))
+            finally:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+            with open(os.path.join('download', f'{num_files - 1}.txt')) as f:
+                self.assertEqual(f'hello world {num_files - 1}', f.read())
+            self.assertEqual(b'hello world 0', self.server.get_object(self.bucket_name, 'upload/0.txt').data)
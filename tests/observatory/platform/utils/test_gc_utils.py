@@ -14,15 +14,26 @@
 
 # Author: James Diprose
 
+import gc
+import gzip
 import os
 import unittest
 from typing import Optional
+from unittest.mock import MagicMock, patch
 
 import pendulum
 from azure.storage.blob import BlobServiceClient, BlobClient
 from click.testing import CliRunner
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage, bigquery
 from google.cloud.bigquery import SourceFormat
+from google_crc32c import Checksum as Crc32cChecksum
+from google.api_core.exceptions import Forbidden
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 from observatory.platform.utils.gc_utils import (hex_to_base64_str, crc32c_base64_hash, bigquery_partitioned_table_id,
                                                  azure_to_google_cloud_storage_transfer, create_bigquery_dataset,
@@ -31,7 +42,18 @@ from observatory.platform.utils.gc_utils import (hex_to_base64_str, crc32c_base6
                                                  download_blobs_from_cloud_storage,
                                                  table_name_from_blob, run_bigquery_query,
                                                  copy_bigquery_table, create_bigquery_view, bigquery_table_exists,
-                                                 create_bigquery_table_from_query)
+                                                 create_bigquery_table_from_query, init_storage_client,
+                                                 storage_client, crc32c_combine, crc32c_to_base64_str, FileSlice,
+                                                 upload_file_to_cloud_storage_sliced,
+                                                 download_blob_from_cloud_storage_sliced, list_blob_manifest,
+                                                 diff_transfer_manifest, CloudStorageSink, bigquery_client,
+                                                 init_bigquery_clients, stream_bigquery_query, BytesBudget,
+                                                 BUDGET_ACTION_WARN, INPUT_FINGERPRINT_LABEL,
+                                                 bigquery_table_suffixes, invalidate_bigquery_dataset_tables,
+                                                 bigquery_release_table_id, STORAGE_MODE_PARTITIONED,
+                                                 find_table_with_fingerprint, MAX_REFERENCED_TABLES)
+from observatory.platform.utils.gc_transfer import TransferError
+from tests.observatory.fake_gcs_server import FakeGcsServer, make_emulator_env
 from tests.observatory.test_utils import random_id
 from tests.observatory.test_utils import test_fixtures_path
 
@@ -117,11 +139,589 @@ class TestGoogleCloudUtilsNoAuth(unittest.TestCase):
             actual_crc32c = crc32c_base64_hash(file_name)
             self.assertEqual(self.expected_crc32c, actual_crc32c)
 
+    def test_crc32c_combine(self):
+        data = os.urandom(100000)
+        expected = int.from_bytes(Crc32cChecksum(data).digest(), 'big')
+        for split in [0, 1, 4096, 65537, len(data)]:
+            crc1 = int.from_bytes(Crc32cChecksum(data[:split]).digest(), 'big')
+            crc2 = int.from_bytes(Crc32cChecksum(data[split:]).digest(), 'big')
+            self.assertEqual(expected, crc32c_combine(crc1, crc2, len(data) - split))
+
+        self.assertEqual(self.expected_crc32c, crc32c_to_base64_str(0xc99465aa))
+
+    def test_file_slice(self):
+        with CliRunner().isolated_filesystem():
+            with open('test.txt', 'w') as f:
+                f.write(self.data)
+
+            with FileSlice('test.txt', 6, 5) as file_slice:
+                self.assertEqual(b'wo', file_slice.read(2))
+                self.assertEqual(2, file_slice.tell())
+
+                # Re-reading after a seek does not change the checksum
+                file_slice.seek(0)
+                self.assertEqual(b'world', file_slice.read())
+                self.assertEqual(b'', file_slice.read())
+                self.assertEqual(int.from_bytes(Crc32cChecksum(b'world').digest(), 'big'), file_slice.crc32c)
+
     def test_bigquery_partitioned_table_id(self):
         expected = 'my_table20200315'
         actual = bigquery_partitioned_table_id('my_table', pendulum.datetime(year=2020, month=3, day=15))
         self.assertEqual(expected, actual)
 
+    def test_bigquery_release_table_id(self):
+        release_date = pendulum.datetime(year=2020, month=3, day=15)
+        self.assertEqual('my_table20200315', bigquery_release_table_id('my_table', release_date))
+        self.assertEqual('my_table_partitioned$20200315',
+                         bigquery_release_table_id('my_table', release_date, STORAGE_MODE_PARTITIONED))
+        with self.assertRaises(ValueError):
+            bigquery_release_table_id('my_table', release_date, 'unknown')
+
+    @patch('observatory.platform.utils.gc_utils.google.auth.default')
+    def test_bigquery_client(self, mock_default):
+        mock_default.return_value = (AnonymousCredentials(), 'my-project')
+        init_bigquery_clients(pool_size=4)
+
+        # Clients are cached per project and location and the credentials are discovered once
+        client = bigquery_client()
+        self.assertIs(client, bigquery_client())
+        self.assertEqual('my-project', client.project)
+        self.assertIsNot(client, bigquery_client(location='us'))
+        self.assertEqual('us', bigquery_client(location='us').location)
+        self.assertEqual('other-project', bigquery_client('other-project').project)
+        self.assertEqual(1, mock_default.call_count)
+
+        # The clients share one session with a connection pool of the given size
+        self.assertIs(client._http, bigquery_client('other-project')._http)
+        self.assertEqual(4, client._http.get_adapter('https://').poolmanager.connection_pool_kw['maxsize'])
+
+        # The clients are created again after the cache is reset
+        init_bigquery_clients()
+        self.assertIsNot(client, bigquery_client())
+        self.assertEqual(2, mock_default.call_count)
+
+
+class TestCreateBigQueryTableFromQuery(unittest.TestCase):
+    """ Tests for the dry run and bytes budget of create_bigquery_table_from_query, with a mocked BigQuery client. """
+
+    def setUp(self):
+        invalidate_bigquery_dataset_tables()
+        self.client = MagicMock()
+        self.dry_run_job = MagicMock(total_bytes_processed=5 * 1024 ** 4)
+        self.query_job = MagicMock(total_bytes_processed=5 * 1024 ** 4, total_bytes_billed=5 * 1024 ** 4)
+        self.query_job.done.return_value = True
+        self.client.query.side_effect = lambda sql, job_config: (self.dry_run_job if job_config.dry_run
+                                                                 else self.query_job)
+
+    def create_table(self, **kwargs) -> bool:
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client):
+            return create_bigquery_table_from_query('SELECT * FROM `project.dataset.table`', 'project', 'dataset',
+                                                    'table', 'US', **kwargs)
+
+    def test_dry_run(self):
+        # The estimate and the actual bytes processed are logged
+        with self.assertLogs(level='INFO') as logs:
+            self.assertTrue(self.create_table())
+        self.assertEqual(2, self.client.query.call_count)
+        self.assertTrue(self.client.query.call_args_list[0][1]['job_config'].dry_run)
+        self.assertIn(f'estimated bytes processed={5 * 1024 ** 4}, bytes processed={5 * 1024 ** 4}',
+                      logs.output[-1])
+
+        # The dry run can be skipped
+        self.client.query.reset_mock()
+        self.assertTrue(self.create_table(dry_run=False))
+        self.assertEqual(1, self.client.query.call_count)
+
+    def test_bytes_budget(self):
+        # The query isn't run when the estimate exceeds the budget
+        self.assertFalse(self.create_table(bytes_budget=BytesBudget(1024 ** 4)))
+        self.assertEqual(1, self.client.query.call_count)
+
+        # A warning is logged and the query is run when the action is to warn
+        self.client.query.reset_mock()
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertTrue(self.create_table(bytes_budget=BytesBudget(1024 ** 4, BUDGET_ACTION_WARN)))
+        self.assertIn('exceeds budget', logs.output[0])
+        self.assertEqual(2, self.client.query.call_count)
+
+        # Queries within budget are run
+        self.client.query.reset_mock()
+        self.assertTrue(self.create_table(bytes_budget=BytesBudget(10 * 1024 ** 4)))
+        self.assertEqual(2, self.client.query.call_count)
+
+    def test_reuse_results(self):
+        # Source tables and the tables in the destination dataset, keyed by table id
+        modified = pendulum.datetime(2020, 12, 1)
+        tables = {'project.source.mag20201101': MagicMock(modified=modified, num_rows=100)}
+        dataset_tables = []
+        self.dry_run_job.referenced_tables = [bigquery.TableReference.from_string('project.source.mag20201101')]
+
+        def get_table(ref):
+            table_id = f'{ref.project}.{ref.dataset_id}.{ref.table_id}'
+            if table_id not in tables:
+                tables[table_id] = MagicMock(labels={})
+            return tables[table_id]
+
+        def update_table(table, fields):
+            project_id, dataset_id, table_id = [key for key, value in tables.items() if value is table][0].split('.')
+            dataset_tables.append(bigquery.table.TableListItem({
+                'tableReference': {'projectId': project_id, 'datasetId': dataset_id, 'tableId': table_id},
+                'labels': dict(table.labels)}))
+
+        self.client.get_table.side_effect = get_table
+        self.client.update_table.side_effect = update_table
+        self.client.list_tables.side_effect = lambda dataset: list(dataset_tables)
+
+        def create_table(table_id: str) -> bool:
+            with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client):
+                return create_bigquery_table_from_query('SELECT * FROM `project.source.mag20201101`', 'project',
+                                                        'dataset', table_id, 'US', reuse_results=True)
+
+        # The first time the query is run and the fingerprint of its inputs is recorded
+        self.assertTrue(create_table('mag20201130'))
+        self.assertEqual(1, len([call for call in self.client.query.call_args_list
+                                 if not call[1]['job_config'].dry_run]))
+        fingerprint = dataset_tables[0].labels[INPUT_FINGERPRINT_LABEL]
+        self.assertTrue(0 < len(fingerprint) <= 63)
+
+        # When the inputs are unchanged the previous output is copied instead
+        self.client.query.reset_mock()
+        self.assertTrue(create_table('mag20201231'))
+        self.assertEqual(1, self.client.query.call_count)
+        source, destination = self.client.copy_table.call_args[0]
+        self.assertEqual('mag20201130', source.table_id)
+        self.assertEqual('mag20201231', destination.table_id)
+
+        # Rerunning with unchanged inputs does nothing
+        self.client.query.reset_mock()
+        self.client.copy_table.reset_mock()
+        self.assertTrue(create_table('mag20201231'))
+        self.client.copy_table.assert_not_called()
+        self.assertEqual(1, self.client.query.call_count)
+
+        # When a source table changes the query is run again
+        self.client.query.reset_mock()
+        tables['project.source.mag20201101'].num_rows = 101
+        self.assertTrue(create_table('mag20210131'))
+        self.assertEqual(2, self.client.query.call_count)
+        self.assertNotEqual(fingerprint, dataset_tables[-1].labels[INPUT_FINGERPRINT_LABEL])
+
+        # The bytes budget is checked before results are reused
+        self.client.query.reset_mock()
+        self.client.copy_table.reset_mock()
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client):
+            self.assertFalse(create_bigquery_table_from_query('SELECT * FROM `project.source.mag20201101`', 'project',
+                                                              'dataset', 'mag20210228', 'US', reuse_results=True,
+                                                              bytes_budget=BytesBudget(1024 ** 4)))
+        self.client.copy_table.assert_not_called()
+        self.assertEqual(1, self.client.query.call_count)
+
+        # Queries over wildcard tables or with more referenced tables than a dry run lists are always run
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client):
+            for sql, num_tables in [('SELECT * FROM `project.source.mag*`', 1),
+                                    ('SELECT * FROM `project.source.mag20201101`', MAX_REFERENCED_TABLES)]:
+                self.client.query.reset_mock()
+                self.dry_run_job.referenced_tables = [bigquery.TableReference.from_string(
+                    f'project.source.mag{i}') for i in range(num_tables)]
+                self.assertTrue(create_bigquery_table_from_query(sql, 'project', 'dataset', 'mag20210331', 'US',
+                                                                 reuse_results=True))
+                self.assertTrue(create_bigquery_table_from_query(sql, 'project', 'dataset', 'mag20210430', 'US',
+                                                                 reuse_results=True))
+                self.assertEqual(4, self.client.query.call_count)
+                self.client.copy_table.assert_not_called()
+
+    def test_find_table_with_fingerprint(self):
+        def table(table_id: str, created: int, fingerprint: str) -> bigquery.table.TableListItem:
+            return bigquery.table.TableListItem({
+                'tableReference': {'projectId': 'project', 'datasetId': 'dataset', 'tableId': table_id},
+                'creationTime': str(created), 'labels': {INPUT_FINGERPRINT_LABEL: fingerprint}})
+
+        self.client.list_tables.side_effect = lambda dataset: [table('doi20201201', 2000, 'abc'),
+                                                               table('doi20201101', 1000, 'abc'),
+                                                               table('doi20201001', 3000, 'def')]
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client):
+            # The most recently created table is chosen, no matter the order of the listing, unless another table is
+            # preferred
+            self.assertEqual('doi20201201', find_table_with_fingerprint('project', 'dataset', 'abc').table_id)
+            self.assertEqual('doi20201101', find_table_with_fingerprint('project', 'dataset', 'abc',
+                                                                        prefer='doi20201101').table_id)
+            self.assertIsNone(find_table_with_fingerprint('project', 'dataset', 'xyz'))
+
+        # The cached tables of the dataset are used
+        self.assertEqual(1, self.client.list_tables.call_count)
+
+
+class TestBigQueryTableMetadata(unittest.TestCase):
+    """ Tests for the cached table metadata of datasets, with a mocked BigQuery client. """
+
+    def setUp(self):
+        invalidate_bigquery_dataset_tables()
+        table_ids = ['mag20201109', 'mag20201012', 'mag20200914', 'mag_extra20201109', 'Papers20201109', 'mag']
+        self.client = MagicMock()
+        self.client.list_tables.side_effect = lambda dataset: [bigquery.table.TableListItem({
+            'tableReference': {'projectId': 'project', 'datasetId': 'mag', 'tableId': table_id}})
+            for table_id in table_ids]
+
+    def test_table_metadata(self):
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client), \
+                patch('observatory.platform.utils.gc_utils.time.monotonic') as mock_monotonic:
+            mock_monotonic.return_value = 1000.
+
+            # Existence checks and suffix lookups are answered from one listing of the dataset
+            self.assertTrue(bigquery_table_exists('project', 'mag', 'mag20201012'))
+            self.assertFalse(bigquery_table_exists('project', 'mag', 'mag20201207'))
+            expected = [pendulum.Date(2020, 11, 9), pendulum.Date(2020, 10, 12), pendulum.Date(2020, 9, 14)]
+            self.assertEqual(expected, bigquery_table_suffixes('project', 'mag', 'mag'))
+            self.assertEqual(expected[1:], bigquery_table_suffixes('project', 'mag', 'mag',
+                                                                   end_date=pendulum.datetime(2020, 10, 12, 12)))
+            self.assertEqual(expected[:2], bigquery_table_suffixes('project', 'mag', 'mag',
+                                                                   start_date=pendulum.Date(2020, 10, 1)))
+            self.assertEqual(1, self.client.list_tables.call_count)
+
+            # The tables are listed again once the cache has expired
+            mock_monotonic.return_value = 1400.
+            self.assertTrue(bigquery_table_exists('project', 'mag', 'mag20201012'))
+            self.assertEqual(2, self.client.list_tables.call_count)
+
+            # Creating a table in the dataset clears its cache
+            copy_bigquery_table('project.mag.mag20201109', 'project.mag.mag20201207', 'US')
+            self.assertTrue(bigquery_table_exists('project', 'mag', 'mag20201012'))
+            self.assertEqual(3, self.client.list_tables.call_count)
+
+
+class FakeReadStream:
+    """ A BigQuery Storage read stream that returns pages of record batches. """
+
+    def __init__(self, batches):
+        self.pages = [MagicMock(to_arrow=MagicMock(return_value=batch)) for batch in batches]
+
+    def rows(self, session):
+        return self
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class TestStreamBigQueryQuery(unittest.TestCase):
+    """ Tests for stream_bigquery_query, with mocked BigQuery and BigQuery Storage clients. """
+
+    def setUp(self):
+        self.rows = [bigquery.Row((i, f'doi{i}'), {'id': 0, 'doi': 1}) for i in range(6)]
+        self.query_job = MagicMock(destination=bigquery.TableReference.from_string('project.dataset.anon'))
+        self.query_job.result.return_value = MagicMock(schema=[bigquery.SchemaField('id', 'INTEGER'),
+                                                               bigquery.SchemaField('doi', 'STRING')],
+                                                       pages=[self.rows[:4], self.rows[4:]], total_rows=6)
+        self.client = MagicMock(project='project')
+        self.client.query.return_value = self.query_job
+
+    def test_storage_api(self):
+        streams = {f'stream{i}': [pyarrow.RecordBatch.from_arrays([pyarrow.array([i, i])], names=['id'])] * 2
+                   for i in range(3)}
+        session = MagicMock(streams=[MagicMock() for _ in streams])
+        for stream, name in zip(session.streams, streams.keys()):
+            stream.name = name
+        read_client = MagicMock()
+        read_client.create_read_session.return_value = session
+        read_client.read_rows.side_effect = lambda name: FakeReadStream(streams[name])
+
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client), \
+                patch('observatory.platform.utils.gc_utils.bigquery_read_client', return_value=read_client):
+            # The streams are read in parallel
+            batches = list(stream_bigquery_query('SELECT 1', max_streams=3))
+            self.assertEqual(6, len(batches))
+            self.assertEqual([0] * 4 + [1] * 4 + [2] * 4,
+                             sorted([value for batch in batches for value in batch.column(0).to_pylist()]))
+            self.assertEqual('projects/project/datasets/dataset/tables/anon',
+                             read_client.create_read_session.call_args[0][1].table)
+            self.assertEqual(3, read_client.create_read_session.call_args[1]['max_stream_count'])
+
+            # Errors in a stream are raised
+            read_client.read_rows.side_effect = RuntimeError('stream failed')
+            with self.assertRaises(RuntimeError):
+                list(stream_bigquery_query('SELECT 1'))
+
+    def test_rest_fallback(self):
+        read_client = MagicMock()
+        read_client.create_read_session.side_effect = Forbidden('BigQuery Storage API has not been used')
+
+        # The pages of the REST API are read when a read session can't be created
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client), \
+                patch('observatory.platform.utils.gc_utils.bigquery_read_client', return_value=read_client):
+            batches = list(stream_bigquery_query('SELECT 1'))
+        self.assertEqual([4, 2], [batch.num_rows for batch in batches])
+        self.assertEqual(['id', 'doi'], batches[0].schema.names)
+        self.assertEqual(['doi4', 'doi5'], batches[1].column(1).to_pylist())
+
+        # And when the BigQuery Storage package isn't installed
+        with patch('observatory.platform.utils.gc_utils.bigquery_client', return_value=self.client), \
+                patch('observatory.platform.utils.gc_utils.bigquery_read_client', return_value=None):
+            frames = list(stream_bigquery_query('SELECT 1', as_dataframe=True))
+        self.assertEqual(list(range(4)), frames[0]['id'].tolist())
+
+
+class TestGoogleCloudStorageEmulator(unittest.TestCase):
+    """ Tests for the Cloud Storage transfer functions that run against a local FakeGcsServer. """
+
+    def setUp(self):
+        self.server = FakeGcsServer()
+        self.server.start()
+        self.bucket_name = random_id()
+        self.server.create_bucket(self.bucket_name)
+        self.env = patch.dict(os.environ, make_emulator_env(self.server))
+        self.env.start()
+        init_storage_client()
+        self.data = 'hello world'
+        self.expected_crc32c = 'yZRlqg=='
+
+    def tearDown(self):
+        self.env.stop()
+        self.server.stop()
+
+    def test_storage_client(self):
+        # The same client is returned for every call in a process
+        client = storage_client()
+        self.assertIs(client, storage_client())
+
+        # The connection pool size is configurable
+        init_storage_client(pool_size=4)
+        client = storage_client()
+        adapter = client._http.get_adapter(self.server.endpoint)
+        self.assertEqual(4, adapter._pool_maxsize)
+
+    def test_upload_download_blob_reuses_connections(self):
+        with CliRunner().isolated_filesystem():
+            num_files = 5
+            file_paths = []
+            for i in range(num_files):
+                file_path = f'{i}.txt'
+                file_paths.append(file_path)
+                with open(file_path, 'w') as f:
+                    f.write(self.data)
+
+            for file_path in file_paths:
+                self.assertTrue(upload_file_to_cloud_storage(self.bucket_name, f'upload/{file_path}', file_path))
+            for file_path in file_paths:
+                self.assertTrue(download_blob_from_cloud_storage(self.bucket_name, f'upload/{file_path}',
+                                                                 f'download_{file_path}'))
+                self.assertEqual(self.expected_crc32c, crc32c_base64_hash(f'download_{file_path}'))
+
+            # All requests in this process were sent over a single kept alive connection
+            self.assertEqual(1, self.server.num_connections)
+
+    def test_upload_download_blobs_from_cloud_storage(self):
+        with CliRunner().isolated_filesystem():
+            upload_folder_name = random_id()
+            file_paths = [os.path.join(upload_folder_name, random_id(), f'{random_id()}.txt') for _ in range(4)]
+            for file_path in file_paths:
+                os.makedirs(os.path.dirname(file_path))
+                with open(file_path, 'w') as f:
+                    f.write(self.data)
+
+            result = upload_files_to_cloud_storage(self.bucket_name, file_paths, file_paths, max_processes=2,
+                                                   max_connections=2, pool_size=2)
+            self.assertTrue(result)
+            for file_path in file_paths:
+                self.assertEqual(self.data.encode(), self.server.get_object(self.bucket_name, file_path).data)
+
+            download_folder_name = random_id()
+            result = download_blobs_from_cloud_storage(self.bucket_name, upload_folder_name, download_folder_name,
+                                                       max_processes=2, max_connections=2, pool_size=2)
+            self.assertTrue(result)
+            for file_path in file_paths:
+                download_file_path = os.path.join(download_folder_name,
+                                                  file_path.replace(f'{upload_folder_name}/', ''))
+                self.assertEqual(self.expected_crc32c, crc32c_base64_hash(download_file_path))
+
+    def test_diff_transfer_manifest(self):
+        with CliRunner().isolated_filesystem():
+            for name, data in [('same.txt', b'same'), ('changed.txt', b'abcd'), ('resized.txt', b'abc'),
+                               ('new.txt', b'new')]:
+                with open(name, 'wb') as f:
+                    f.write(data)
+            for name, data in [('same.txt', b'same'), ('changed.txt', b'wxyz'), ('resized.txt', b'abcd')]:
+                self.server.put_object(self.bucket_name, f'manifest/{name}', data)
+
+            self.server.reset_stats()
+            manifest = list_blob_manifest(self.bucket_name, 'manifest/')
+            self.assertEqual(1, self.server.count_requests())
+            self.assertEqual({'manifest/same.txt', 'manifest/changed.txt', 'manifest/resized.txt'},
+                             set(manifest.keys()))
+
+            transfers = [(f'manifest/{name}', name) for name in ['same.txt', 'changed.txt', 'resized.txt', 'new.txt',
+                                                                 'missing.txt']]
+            delta = diff_transfer_manifest(manifest, transfers)
+            self.assertEqual({'changed.txt', 'resized.txt', 'new.txt', 'missing.txt'},
+                             {file_path for _, file_path in delta})
+
+    def test_upload_download_blobs_skips_unchanged(self):
+        with CliRunner().isolated_filesystem():
+            file_paths = [os.path.join('skip', f'{i}.txt') for i in range(4)]
+            os.makedirs('skip')
+            for file_path in file_paths:
+                with open(file_path, 'w') as f:
+                    f.write(self.data)
+            self.assertTrue(upload_files_to_cloud_storage(self.bucket_name, file_paths, file_paths, max_processes=2,
+                                                          max_connections=2))
+
+            # Only the changed file is uploaded again, with no per blob metadata requests
+            with open(file_paths[0], 'w') as f:
+                f.write('hello there')
+            self.server.reset_stats()
+            self.assertTrue(upload_files_to_cloud_storage(self.bucket_name, file_paths, file_paths, max_processes=2,
+                                                          max_connections=2))
+            self.assertEqual(1, self.server.count_requests('GET'))
+            self.assertEqual(1, self.server.count_requests('POST'))
+            self.assertEqual(b'hello there', self.server.get_object(self.bucket_name, file_paths[0]).data)
+
+            # Downloading into a folder that is already up to date only lists the prefix
+            self.assertTrue(download_blobs_from_cloud_storage(self.bucket_name, 'skip', 'download', max_processes=2,
+                                                              max_connections=2))
+            self.server.reset_stats()
+            self.assertTrue(download_blobs_from_cloud_storage(self.bucket_name, 'skip', 'download', max_processes=2,
+                                                              max_connections=2))
+            self.assertEqual(1, self.server.count_requests())
+
+    def test_upload_files_lists_blob_directories(self):
+        with CliRunner().isolated_filesystem():
+            # Blobs of another release that share a prefix with the blob names, and a blob at the top of the bucket
+            self.server.put_object(self.bucket_name, 'unpaywall/unpaywall_2021/data.txt', b'other')
+            self.server.put_object(self.bucket_name, 'top.txt', self.data.encode())
+
+            file_paths = ['data.txt', 'top.txt']
+            for file_path in file_paths:
+                with open(file_path, 'w') as f:
+                    f.write(self.data)
+            blob_names = ['unpaywall/unpaywall_2020/data.txt', 'top.txt']
+
+            # Only the directory of the blob names is listed and the blob at the top of the bucket is checked on its
+            # own, so it is not uploaded again
+            self.assertTrue(upload_files_to_cloud_storage(self.bucket_name, blob_names, file_paths, max_processes=1))
+            list_requests = [path for method, path in self.server.requests
+                             if method == 'GET' and '/o?' in path and 'prefix=' in path]
+            self.assertEqual(1, len(list_requests))
+            self.assertIn('prefix=unpaywall/unpaywall_2020/&', list_requests[0])
+            self.assertEqual(1, self.server.count_requests('POST'))
+            self.assertEqual(self.data.encode(),
+                             self.server.get_object(self.bucket_name, 'unpaywall/unpaywall_2020/data.txt').data)
+
+    def test_upload_file_to_cloud_storage_checksum_mismatch(self):
+        with CliRunner().isolated_filesystem():
+            with open('test.txt', 'w') as f:
+                f.write(self.data)
+
+            # A blob that doesn't match the file is deleted and uploaded again
+            hashes = ['corrupt', self.expected_crc32c]
+            self.server.reset_stats()
+            with patch('observatory.platform.utils.gc_utils.crc32c_to_base64_str', lambda crc: hashes.pop(0)):
+                self.assertTrue(upload_file_to_cloud_storage(self.bucket_name, 'test.txt', 'test.txt',
+                                                             check_existing=False))
+            self.assertEqual(2, self.server.count_requests('POST'))
+            self.assertEqual(1, self.server.count_requests('DELETE'))
+            self.assertEqual(self.data.encode(), self.server.get_object(self.bucket_name, 'test.txt').data)
+
+            # When every try fails the upload fails and no blob is left behind
+            self.server.reset_stats()
+            with patch('observatory.platform.utils.gc_utils.crc32c_to_base64_str', return_value='corrupt'):
+                self.assertFalse(upload_file_to_cloud_storage(self.bucket_name, 'corrupt.txt', 'test.txt', retries=3,
+                                                              check_existing=False))
+            self.assertEqual(3, self.server.count_requests('POST'))
+            self.assertIsNone(self.server.get_object(self.bucket_name, 'corrupt.txt'))
+
+    def test_upload_file_to_cloud_storage_sliced(self):
+        with CliRunner().isolated_filesystem():
+            data = os.urandom(3 * 1024 * 1024 + 7)
+            with open('test.bin', 'wb') as f:
+                f.write(data)
+
+            self.assertTrue(upload_file_to_cloud_storage_sliced(self.bucket_name, 'sliced/test.bin', 'test.bin',
+                                                                slices=4))
+            self.assertEqual(data, self.server.get_object(self.bucket_name, 'sliced/test.bin').data)
+
+            # The component blobs are deleted once they have been composed
+            self.assertEqual(['sliced/test.bin'], list(self.server.buckets[self.bucket_name].keys()))
+
+    def test_download_blob_from_cloud_storage_sliced(self):
+        with CliRunner().isolated_filesystem():
+            data = os.urandom(3 * 1024 * 1024 + 7)
+            self.server.put_object(self.bucket_name, 'sliced/test.bin', data)
+
+            # A larger stale file is truncated to the size of the blob
+            with open('test.bin', 'wb') as f:
+                f.write(os.urandom(len(data) + 100))
+
+            self.server.reset_stats()
+            self.assertTrue(download_blob_from_cloud_storage_sliced(self.bucket_name, 'sliced/test.bin', 'test.bin',
+                                                                    slices=4))
+            with open('test.bin', 'rb') as f:
+                self.assertEqual(data, f.read())
+            self.assertEqual(1 + 4, self.server.count_requests('GET'))
+
+            # Data that does not match the blob's metadata fails the combined checksum
+            blob = storage_client().bucket(self.bucket_name).get_blob('sliced/test.bin')
+            self.server.put_object(self.bucket_name, 'sliced/test.bin', os.urandom(len(data)))
+            self.assertFalse(download_blob_from_cloud_storage_sliced(self.bucket_name, 'sliced/test.bin', 'test.bin',
+                                                                     slices=4, blob=blob))
+
+    def test_upload_files_to_cloud_storage_parallel_threshold(self):
+        with CliRunner().isolated_filesystem():
+            small, large = os.urandom(1024), os.urandom(64 * 1024)
+            for name, data in [('small.bin', small), ('large.bin', large)]:
+                with open(name, 'wb') as f:
+                    f.write(data)
+
+            self.server.reset_stats()
+            result = upload_files_to_cloud_storage(self.bucket_name, ['small.bin', 'large.bin'],
+                                                   ['small.bin', 'large.bin'], max_processes=1, max_connections=1,
+                                                   parallel_upload_threshold=32 * 1024, parallel_upload_slices=3)
+            self.assertTrue(result)
+            self.assertEqual(small, self.server.get_object(self.bucket_name, 'small.bin').data)
+            self.assertEqual(large, self.server.get_object(self.bucket_name, 'large.bin').data)
+
+            # Only the large file was composed
+            compose_requests = [path for method, path in self.server.requests if '/compose' in path]
+            self.assertEqual(1, len(compose_requests))
+
+    def test_cloud_storage_sink(self):
+        chunk_size = 256 * 1024
+        data = os.urandom(chunk_size * 2 + 100)
+
+        # Data is uploaded in chunks as it is written, with a retried chunk resuming from the committed offset
+        self.server.reset_stats()
+        self.server.fail_next = [None, None, 503]
+        with CloudStorageSink(self.bucket_name, 'data.bin', chunk_size=chunk_size) as sink:
+            for i in range(0, len(data), 1000):
+                sink.write(data[i:i + 1000])
+        self.assertEqual(data, self.server.get_object(self.bucket_name, 'data.bin').data)
+        self.assertEqual(5, self.server.count_requests('PUT'))
+        self.assertEqual(crc32c_to_base64_str(int.from_bytes(Crc32cChecksum(data).digest(), 'big')), sink.crc32c)
+
+        # Data can be gzip compressed on the fly
+        lines = b''.join([f'{{"id": {i}}}\n'.encode() for i in range(100000)])
+        with CloudStorageSink(self.bucket_name, 'data.jsonl.gz', compress=True, chunk_size=chunk_size) as sink:
+            sink.write(lines)
+        blob = self.server.get_object(self.bucket_name, 'data.jsonl.gz')
+        self.assertEqual(lines, gzip.decompress(blob.data))
+        self.assertEqual(len(blob.data), sink.size)
+
+        # The blob is not created when an error is raised while writing
+        with self.assertRaises(RuntimeError):
+            with CloudStorageSink(self.bucket_name, 'error.bin', chunk_size=chunk_size) as sink:
+                sink.write(data)
+                raise RuntimeError('transform failed')
+        self.assertIsNone(self.server.get_object(self.bucket_name, 'error.bin'))
+
+        # The blob is not created when a sink is garbage collected without being closed
+        sink = CloudStorageSink(self.bucket_name, 'dropped.bin', chunk_size=chunk_size)
+        sink.write(data)
+        del sink
+        gc.collect()
+        self.assertIsNone(self.server.get_object(self.bucket_name, 'dropped.bin'))
+
+        # A committed range outside of the buffered data is rejected
+        with self.assertRaises(TransferError):
+            with CloudStorageSink(self.bucket_name, 'range.bin', chunk_size=chunk_size) as sink:
+                sink.write(data[:100])
+                sink._commit(MagicMock(headers={'Range': f'bytes=0-{chunk_size}'}))
+        self.assertIsNone(self.server.get_object(self.bucket_name, 'range.bin'))
+
 
 class TestGoogleCloudUtils(unittest.TestCase):
 